@@ -0,0 +1,160 @@
+import os
+from datetime import date, datetime
+import db
+
+# Usage and feedback rollups. Every saved message and every feedback change
+# adjusts one row of message_stats per (center, day, role), in the same
+# transaction as the write itself, so the rollups never drift from the
+# messages they count and /stats reads a few small rows instead of scanning
+# conversations. Rows are never decremented by retention.py: they describe
+# traffic, not what is still stored.
+#
+# Tokens are the tokenizer count of each message (context.count_tokens) and,
+# for answers, of the prompt that produced them; latency is from request
+# arrival to the saved answer. Feedback is counted on the day of the message
+# it rates, so like and dislike rates are per day of answers.
+STATS_MAX_DAYS = int(os.getenv("STATS_MAX_DAYS", 366))
+FEEDBACK_BATCH_MAX = int(os.getenv("FEEDBACK_BATCH_MAX", 100))
+
+COUNTERS = ["messages", "tokens", "prompt_tokens", "latency_ms", "latency_count", "likes", "dislikes"]
+
+UPSERT_SQL = {
+    "sqlite": f'''
+        INSERT INTO message_stats (center_id, day, role, {", ".join(COUNTERS)}, max_latency_ms)
+        VALUES (?, ?, ?, {", ".join("?" * len(COUNTERS))}, ?)
+        ON CONFLICT (center_id, day, role) DO UPDATE SET
+            {", ".join(f"{c} = {c} + excluded.{c}" for c in COUNTERS)},
+            max_latency_ms = MAX(max_latency_ms, excluded.max_latency_ms)
+    ''',
+    # HOLDLOCK: concurrent first writes of the day must not both insert the row
+    "mssql": f'''
+        MERGE message_stats WITH (HOLDLOCK) AS t
+        USING (SELECT ? AS center_id, ? AS day, ? AS role,
+                      {", ".join(f"? AS {c}" for c in COUNTERS)}, ? AS max_latency_ms) AS s
+        ON t.center_id = s.center_id AND t.day = s.day AND t.role = s.role
+        WHEN MATCHED THEN UPDATE SET
+            {", ".join(f"t.{c} = t.{c} + s.{c}" for c in COUNTERS)},
+            t.max_latency_ms = CASE WHEN s.max_latency_ms > t.max_latency_ms
+                                    THEN s.max_latency_ms ELSE t.max_latency_ms END
+        WHEN NOT MATCHED THEN
+            INSERT (center_id, day, role, {", ".join(COUNTERS)}, max_latency_ms)
+            VALUES (s.center_id, s.day, s.role, {", ".join(f"s.{c}" for c in COUNTERS)}, s.max_latency_ms);
+    ''',
+}
+
+
+def day_of(timestamp):
+    if isinstance(timestamp, (datetime, date)):
+        return timestamp.strftime("%Y-%m-%d")
+    return str(timestamp)[:10]
+
+
+def _apply(cursor, deltas):
+    # deltas: (center_id, day, role) -> {counter: amount, "max_latency_ms": ms}
+    sql = UPSERT_SQL["sqlite" if db.DB_BACKEND == "sqlite" else "mssql"]
+    rows = [
+        (*key, *(delta.get(c, 0) for c in COUNTERS), delta.get("max_latency_ms", 0))
+        for key, delta in sorted(deltas.items())  # a fixed order, so concurrent batches cannot deadlock
+    ]
+    db.executemany(cursor, sql, rows)
+
+
+def record_messages(cursor, records):
+    """Adds saved messages to the rollups; records as built by app.save_message."""
+    deltas = {}
+    for r in records:
+        delta = deltas.setdefault((r["center_id"], day_of(r["timestamp"]), r["role"]), {})
+        delta["messages"] = delta.get("messages", 0) + 1
+        delta["tokens"] = delta.get("tokens", 0) + (r.get("tokens") or 0)
+        delta["prompt_tokens"] = delta.get("prompt_tokens", 0) + (r.get("prompt_tokens") or 0)
+        if r.get("latency_ms") is not None:
+            delta["latency_ms"] = delta.get("latency_ms", 0) + r["latency_ms"]
+            delta["latency_count"] = delta.get("latency_count", 0) + 1
+            delta["max_latency_ms"] = max(delta.get("max_latency_ms", 0), r["latency_ms"])
+    if deltas:
+        _apply(cursor, deltas)
+
+
+def apply_votes(cursor, votes):
+    """Sets feedback on messages and moves the rollup counts; returns
+    {message_id: user_id} of the messages found.
+
+    Each update only applies if the stored value is still the one read, so two
+    concurrent votes on one message cannot both count against the old value.
+    """
+    found, deltas = {}, {}
+    pending = dict(votes)  # message_id -> feedback, the last vote per message wins
+    while pending:
+        ids = list(pending)
+        cursor.execute(
+            f"""SELECT message_id, COALESCE(feedback, 0), center_id, role, timestamp, user_id
+               FROM conversations WHERE message_id IN ({", ".join("?" * len(ids))})""",
+            ids
+        )
+        current = {str(row[0]).lower(): row[1:] for row in cursor.fetchall()}
+        retry = {}
+        for message_id, value in pending.items():
+            if message_id.lower() not in current:
+                continue
+            old, center, role, timestamp, user_id = current[message_id.lower()]
+            found[message_id] = user_id
+            if old == value:
+                continue
+            cursor.execute(
+                "UPDATE conversations SET feedback = ? WHERE message_id = ? AND COALESCE(feedback, 0) = ?",
+                (value, message_id, old)
+            )
+            if cursor.rowcount == 0:
+                retry[message_id] = value  # changed since it was read
+                continue
+            delta = deltas.setdefault((center, day_of(timestamp), role), {})
+            delta["likes"] = delta.get("likes", 0) + (value == 1) - (old == 1)
+            delta["dislikes"] = delta.get("dislikes", 0) + (value == -1) - (old == -1)
+        pending = retry
+    if deltas:
+        _apply(cursor, deltas)
+    return found
+
+
+def _rates(entry, counts):
+    answers = counts["messages"] or 0
+    entry["like_rate"] = counts["likes"] / answers if answers else None
+    entry["dislike_rate"] = counts["dislikes"] / answers if answers else None
+    entry["mean_latency_ms"] = counts["latency_ms"] / counts["latency_count"] if counts["latency_count"] else None
+
+
+def daily_stats(cursor, center_id, start, end):
+    """Rollup rows for a center between two days (inclusive), with derived rates."""
+    cursor.execute(
+        f"""SELECT day, role, {", ".join(COUNTERS)}, max_latency_ms
+           FROM message_stats
+           WHERE center_id = ? AND day >= ? AND day <= ?
+           ORDER BY day, role""",
+        (center_id, start.isoformat(), end.isoformat())
+    )
+    days = {}
+    for row in cursor.fetchall():
+        day, role = day_of(row[0]), row[1]
+        counts = dict(zip(COUNTERS, row[2:2 + len(COUNTERS)]))
+        counts["max_latency_ms"] = row[-1]
+        entry = days.setdefault(day, {"day": day})
+        entry[role] = counts
+        if role == "assistant":
+            _rates(entry, counts)
+    return list(days.values())
+
+
+def totals(days):
+    """Sums daily_stats() rows per role over the whole range."""
+    result = {}
+    for entry in days:
+        for role, counts in entry.items():
+            if not isinstance(counts, dict):
+                continue
+            total = result.setdefault(role, dict.fromkeys(COUNTERS + ["max_latency_ms"], 0))
+            for counter in COUNTERS:
+                total[counter] += counts[counter]
+            total["max_latency_ms"] = max(total["max_latency_ms"], counts["max_latency_ms"])
+    if "assistant" in result:
+        _rates(result, result["assistant"])
+    return result
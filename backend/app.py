@@ -1,17 +1,36 @@
-from flask import Flask, request, jsonify, render_template, session
-import markdown2
+from flask import (Flask, request, jsonify, render_template, session, Response, stream_with_context, g,
+                   send_file, url_for)
 import os
 from dotenv import load_dotenv
 import logging
-from openai import AzureOpenAI
 import json
+import hmac
+import math
+import time
 import uuid
-from datetime import datetime
-import re
-import markdown
-import pyodbc
-from flask_sqlalchemy import SQLAlchemy
+from datetime import date, datetime, timedelta
+from urllib.parse import quote
 from flask_cors import CORS
+import db
+import llm
+import cache
+import context
+import writer
+import embeddings
+import streaming
+import metrics
+import coalesce
+import dispatch
+import users
+import render
+import retention
+import analytics
+import export
+import tenants
+import assets
+import compression
+import speech
+import sharedcache
 
 
 
@@ -22,23 +41,10 @@ logging.basicConfig(level=logging.INFO)
 load_dotenv()
 
 # Load configuration
-endpoint = os.getenv("ENDPOINT_URL")
-deployment = os.getenv("DEPLOYMENT_NAME")
-search_endpoint = os.getenv("SEARCH_ENDPOINT")
-search_key = os.getenv("SEARCH_KEY")
-search_index = os.getenv("SEARCH_INDEX_NAME")
-subscription_key = os.getenv("AZURE_OPENAI_API_KEY")
-speech_api_key = os.getenv("SPEECH_API_KEY")
+# The default center; each request's own is tenants.current(), see tenants.py
 center_id = os.getenv("COMMERCIAL_CENTER_ID")
 center_name = os.getenv("COMMERCIAL_CENTER_NAME")
 
-# Initialize Azure OpenAI client
-client = AzureOpenAI(
-    azure_endpoint=endpoint,
-    api_key=subscription_key,
-    api_version="2024-05-01-preview",
-)
-
 # Initialize Flask app
 app = Flask(__name__, static_folder='../frontend/static', template_folder='../frontend/templates',static_url_path='/static')
 app.secret_key = os.getenv("FLASK_SECRET_KEY", os.urandom(24))
@@ -47,213 +53,312 @@ app.config.update(
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SAMESITE='None'  # Allows cookies in cross-site requests
 )
-CORS(app, supports_credentials=True)
-
-# Azure SQL Database configuration
-DB_CONFIG = {
-    'server': os.getenv('AZURE_SQL_SERVER'),
-    'database': os.getenv('AZURE_SQL_DATABASE'),
-    'username': os.getenv('AZURE_SQL_USERNAME'),
-    'password': os.getenv('AZURE_SQL_PASSWORD'),
-    'driver': '{ODBC Driver 18 for SQL Server}'
-}
-
-# Initialize SQLAlchemy
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    f"mssql+pyodbc://{DB_CONFIG['username']}:{DB_CONFIG['password']}@"
-    f"{DB_CONFIG['server']}/{DB_CONFIG['database']}?driver=ODBC+Driver+18+for+SQL+Server"
-)
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
-
-def get_db_connection():
-    conn_str = (
-        f"Driver={DB_CONFIG['driver']};"
-        f"Server=tcp:{DB_CONFIG['server']},1433;"
-        f"Database={DB_CONFIG['database']};"
-        f"Uid={DB_CONFIG['username']};"
-        f"Pwd={DB_CONFIG['password']};"
-        "Encrypt=yes;TrustServerCertificate=no;"
-        "Connection Timeout=30;"
-    )
-    return pyodbc.connect(conn_str)
-
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Create commercial_centers table
-    cursor.execute('''
-    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='commercial_centers' AND xtype='U')
-    CREATE TABLE commercial_centers (
-        id NVARCHAR(50) PRIMARY KEY,
-        name NVARCHAR(100) NOT NULL,
-        location NVARCHAR(255),
-        website_url NVARCHAR(255),
-        created_at DATETIME2 DEFAULT GETDATE()
-    )
-    ''')
-
-    # Create users table with center reference
-    cursor.execute('''
-    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='users' AND xtype='U')
-    CREATE TABLE users (
-        id NVARCHAR(50) PRIMARY KEY,
-        center_id NVARCHAR(50),
-        created_at DATETIME2 DEFAULT GETDATE(),
-        FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
-    )
-    ''')
-    
-    # Modified conversations table with center reference
-    cursor.execute('''
-    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='conversations' AND xtype='U')
-    CREATE TABLE conversations (
-        id INT IDENTITY(1,1) PRIMARY KEY,
-        user_id NVARCHAR(50),
-        center_id NVARCHAR(50),
-        message NVARCHAR(MAX),
-        role NVARCHAR(50),
-        timestamp DATETIME2,
-        message_id NVARCHAR(50) UNIQUE,
-        feedback INT DEFAULT 0,
-        FOREIGN KEY (user_id) REFERENCES users(id),
-        FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
-    )
-    ''')
-
-    # Create knowledge_base table for center-specific information
-    cursor.execute('''
-    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='knowledge_base' AND xtype='U')
-    CREATE TABLE knowledge_base (
-        id INT IDENTITY(1,1) PRIMARY KEY,
-        center_id NVARCHAR(50),
-        content_type NVARCHAR(50),
-        title NVARCHAR(255),
-        content NVARCHAR(MAX),
-        last_updated DATETIME2 DEFAULT GETDATE(),
-        FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
-    )
-    ''')
-    
-    # Ensure the configured commercial center exists
-    cursor.execute('''
-    IF NOT EXISTS (SELECT 1 FROM commercial_centers WHERE id = ?)
-    INSERT INTO commercial_centers (id, name) VALUES (?, ?)
-    ''', (center_id, center_id, center_name))
-    
-    cursor.execute('''
-    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='conversation_sessions' AND xtype='U')
-    CREATE TABLE conversation_sessions (
-        id NVARCHAR(50) PRIMARY KEY,
-        user_id NVARCHAR(50),
-        center_id NVARCHAR(50),
-        title NVARCHAR(255),
-        created_at DATETIME2 DEFAULT GETDATE(),
-        last_updated DATETIME2 DEFAULT GETDATE(),
-        FOREIGN KEY (user_id) REFERENCES users(id),
-        FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
-    )
-    ''')
-    
-    # Modify conversations table to include conversation_id
-    cursor.execute('''
-    IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                  WHERE TABLE_NAME = 'conversations' 
-                  AND COLUMN_NAME = 'conversation_id')
-    ALTER TABLE conversations 
-    ADD conversation_id NVARCHAR(50),
-    CONSTRAINT FK_ConversationSession 
-    FOREIGN KEY (conversation_id) 
-    REFERENCES conversation_sessions(id)
-    ''')
-    
-    conn.commit()
-    conn.close()
+# asgi.py adds the same headers to the chat routes it answers without Flask
+cors_options = dict(supports_credentials=True)
+CORS(app, **cors_options)
 
-init_db()
+# Schema setup is a deployment step (python backend/schema.py, or on_starting
+# in gunicorn.conf.py with PREPARE_ON_START=true), so workers start without
+# touching the database. Clients and connections are created on
+# first use in each worker, which keeps gunicorn's preload_app fork-safe.
 
 # Helper functions for database operations
+known_users = users.KnownUsers()
+# Sessions, conversation lists and history pages, shared by the workers of the host
+shared_cache = sharedcache.SharedCache()
+
+@metrics.timed("db_user")
 def get_or_create_user(user_id):
-    # Validate user_id
-    try:
-        uuid.UUID(user_id)
-    except (ValueError, TypeError):
-        raise ValueError("Invalid user_id. Must be a valid UUID.")
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
-    
-    if not user:
-        cursor.execute("INSERT INTO users (id, center_id) VALUES (?, ?)", 
-                      (user_id, center_id))
-        conn.commit()
-    
-    conn.close()
-    return user_id
+    # Raises ValueError for ids that are not UUIDs; known ids cost no round trip
+    return known_users.ensure(user_id, tenants.current().id)
+
+def insert_messages(records):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        db.executemany(
+            cursor,
+            "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id, conversation_id, "
+            "message_html) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(r["user_id"], r["center_id"], r["message"], r["role"], r["timestamp"], r["message_id"],
+              r.get("conversation_id"), r.get("message_html")) for r in records]
+        )
+        analytics.record_messages(cursor, records)
+    # Only now can a read from another worker see the rows: a page it loaded and
+    # stored between the enqueue and this commit must not outlive the commit
+    for user_id in {r["user_id"] for r in records}:
+        shared_cache.invalidate(user_id)
 
-def save_message(user_id, message, role, message_id=None):
+def insert_message(record):
+    insert_messages([record])
+
+# With WRITE_BEHIND=true messages are committed in batches by a background thread
+message_writer = writer.MessageWriter(insert_messages, insert_message)
+
+@metrics.timed("db_save")
+def save_message(user_id, message, role, message_id=None, conversation_id=None, rendered=None,
+                 prompt_tokens=None, latency_ms=None):
     if not message_id:
         message_id = str(uuid.uuid4())
         
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    record = {
+        "user_id": user_id,
+        "center_id": tenants.current().id,
+        "message": message,
+        "role": role,
+        "timestamp": datetime.now().isoformat(),
+        "message_id": message_id,
+        "conversation_id": conversation_id,
+        "message_html": rendered,
+        # Only feed the message_stats rollups, see analytics.py
+        "tokens": context.count_tokens(message),
+        "prompt_tokens": prompt_tokens,
+        "latency_ms": latency_ms
+    }
     
-    timestamp = datetime.now().isoformat()
-    
-    cursor.execute(
-        "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id) VALUES (?, ?, ?, ?, ?, ?)",
-        (user_id, center_id, message, role, timestamp, message_id)
-    )
-    
-    conn.commit()
-    conn.close()
+    if writer.WRITE_BEHIND:
+        message_writer.enqueue(record)
+        # So that this worker's next read misses and flushes; the commit invalidates again
+        shared_cache.invalidate(user_id)
+    else:
+        insert_message(record)
     
     return message_id
 
+# Rendered HTML of stored markdown, by content hash; see render.py
+renders = render.RenderCache()
+
+def save_answer(user_id, text, message_id=None, conversation_id=None, prompt_tokens=None, started=None):
+    # Stores the answer as markdown and returns (message_id, html)
+    with metrics.span("render"):
+        rendered = renders.render(text)
+    latency_ms = round((time.perf_counter() - started) * 1000) if started is not None else None
+    message_id = save_message(user_id, text, "assistant", message_id, conversation_id,
+                              rendered=rendered if render.RENDER_PERSIST else None,
+                              prompt_tokens=prompt_tokens, latency_ms=latency_ms)
+    return message_id, rendered
+
+@metrics.timed("db_history")
 def get_conversation_history(user_id, limit=20):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        """SELECT message, role, timestamp, message_id, feedback 
-           FROM conversations 
-           WHERE user_id = ? AND center_id = ? 
-           ORDER BY timestamp ASC 
-           OFFSET 0 ROWS FETCH NEXT ? ROWS ONLY""",
-        (user_id, center_id, limit)
-    )
+    # Most recent `limit` messages, returned oldest first
+    center = tenants.current().id
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""SELECT message, role, timestamp, message_id, feedback 
+               FROM conversations 
+               WHERE user_id = ? AND center_id = ? AND {retention.visible_clause()}
+               ORDER BY timestamp DESC 
+               {db.limit_clause()}""",
+            (user_id, center, user_id, retention.NO_TOMBSTONE, limit)
+        )
+        rows = cursor.fetchall()
     
     history = []
-    for msg, role, timestamp, message_id, feedback in cursor.fetchall():
+    for msg, role, timestamp, message_id, feedback in reversed(rows):
         history.append({
             "role": role,
             "content": msg,
             "timestamp": timestamp,
-            "message_id": message_id,
+            # SQL Server returns UNIQUEIDENTIFIER values in upper case
+            "message_id": str(message_id).lower(),
             "feedback": feedback
         })
     
-    conn.close()
+    # Messages still waiting in the write-behind queue are part of the history too
+    if writer.WRITE_BEHIND:
+        stored = {msg["message_id"] for msg in history}
+        pending = [
+            {
+                "role": r["role"],
+                "content": r["message"],
+                "timestamp": r["timestamp"],
+                "message_id": r["message_id"],
+                "feedback": 0
+            }
+            for r in message_writer.pending_for(user_id)
+            if r["center_id"] == center and r["message_id"] not in stored
+        ]
+        if pending:
+            history = sorted(history + pending, key=lambda msg: (
+                msg["timestamp"] if isinstance(msg["timestamp"], str) else msg["timestamp"].isoformat()
+            ))[-limit:]
+    
     return history
 
-def update_feedback(message_id, feedback):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def format_cursor(timestamp, row_id):
+    # Exact to the microsecond, unlike the HTTP date Flask renders datetimes as
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.isoformat()
+    return f"{timestamp},{row_id}"
+
+def parse_cursor(value):
+    timestamp, _, row_id = value.rpartition(",")
+    if not timestamp:
+        raise ValueError(value)
+    return timestamp, int(row_id)
+
+@metrics.timed("db_history_page")
+def get_history_page(user_id, conversation_id=None, limit=50, before=None, since=None):
+    # Keyset pagination on (timestamp, id): every page is a single index range
+    # scan, however long the conversation. `before` pages back from the newest
+    # message; `since` returns what was added after a cursor, oldest first.
+    if writer.WRITE_BEHIND and message_writer.pending_for(user_id):
+        message_writer.flush()
     
-    cursor.execute(
-        "UPDATE conversations SET feedback = ? WHERE message_id = ?",
-        (feedback, message_id)
-    )
+    conditions = ["user_id = ?", "center_id = ?", retention.visible_clause()]
+    params = [user_id, tenants.current().id, user_id, retention.NO_TOMBSTONE]
+    if conversation_id:
+        conditions.append("conversation_id = ?")
+        params.append(conversation_id)
+    if since:
+        conditions.append("timestamp >= ? AND (timestamp > ? OR id > ?)")
+        params += [since[0], since[0], since[1]]
+        order = "ASC"
+    else:
+        if before:
+            # The bare range lets the index seek to the cursor instead of scanning to it
+            conditions.append("timestamp <= ? AND (timestamp < ? OR id < ?)")
+            params += [before[0], before[0], before[1]]
+        order = "DESC"
+    
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""SELECT id, message, role, timestamp, message_id, feedback, message_html
+               FROM conversations
+               WHERE {" AND ".join(conditions)}
+               ORDER BY timestamp {order}, id {order}
+               {db.limit_clause()}""",
+            params + [limit + 1]
+        )
+        rows = cursor.fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "DESC":
+        rows.reverse()
+    
+    messages = [
+        {
+            "role": role,
+            "content": msg,
+            "timestamp": timestamp,
+            "message_id": str(message_id).lower(),
+            "feedback": feedback,
+            "cursor": format_cursor(timestamp, row_id),
+            "html": message_html
+        }
+        for row_id, msg, role, timestamp, message_id, feedback, message_html in rows
+    ]
+    return messages, has_more
+
+@metrics.timed("db_message")
+def get_message(user_id, message_id):
+    if writer.WRITE_BEHIND and message_writer.is_pending(message_id):
+        message_writer.flush()
+    
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""SELECT message, role, timestamp, message_id, feedback, message_html
+               FROM conversations
+               WHERE message_id = ? AND user_id = ? AND center_id = ? AND {retention.visible_clause()}""",
+            (message_id, user_id, tenants.current().id, user_id, retention.NO_TOMBSTONE)
+        )
+        row = cursor.fetchone()
+    
+    if not row:
+        return None
+    msg, role, timestamp, message_id, feedback, message_html = row
+    return {
+        "role": role,
+        "content": msg,
+        "timestamp": timestamp,
+        "message_id": str(message_id).lower(),
+        "feedback": feedback,
+        "html": message_html
+    }
+
+def requested_format():
+    # ?format=raw|html, else the Accept header; HTML by default, which the web client renders
+    fmt = request.args.get('format')
+    if fmt is None:
+        best = request.accept_mimetypes.best_match(["text/html", "text/markdown"], default="text/html")
+        return "raw" if best == "text/markdown" else "html"
+    if fmt not in render.FORMATS:
+        raise ValueError(fmt)
+    return fmt
+
+def present_message(msg, fmt):
+    # Stored content is markdown; "html" renders it, preferring the persisted render
+    rendered = msg.pop("html", None)
+    if fmt == "html":
+        msg["content"] = renders.message(msg["role"], msg["content"], rendered)
+    return msg
+
+def resolve_conversation(user_id, conversation_id):
+    # Messages may only be filed under one of the user's own conversations
+    if not conversation_id:
+        return None
+    try:
+        uuid.UUID(conversation_id)
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("Invalid conversation_id. Must be a valid UUID.")
     
-    updated = cursor.rowcount > 0
-    conn.commit()
-    conn.close()
+    if not shared_cache.cached("session", user_id, (conversation_id,),
+                               lambda: conversation_exists(user_id, conversation_id)):
+        raise ValueError("Unknown conversation_id.")
+    
+    return conversation_id
+
+@metrics.timed("db_conversation")
+def conversation_exists(user_id, conversation_id):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT 1 FROM conversation_sessions WHERE id = ? AND user_id = ?",
+            (conversation_id, user_id)
+        )
+        return cursor.fetchone() is not None
+
+@metrics.timed("db_feedback")
+def update_feedbacks(votes):
+    # votes: [(message_id, feedback)]; returns the ids of the messages found
+    # The rows must exist before they can be updated
+    if writer.WRITE_BEHIND and any(message_writer.is_pending(message_id) for message_id, _ in votes):
+        message_writer.flush()
     
-    return updated
+    with db.connection() as conn:
+        found = analytics.apply_votes(conn.cursor(), votes)
+    # History pages carry the feedback of each message
+    for owner in set(found.values()):
+        shared_cache.invalidate(owner)
+    return found
+
+def update_feedback(message_id, feedback):
+    return message_id in update_feedbacks([(message_id, feedback)])
+
+# Fingerprinted, precompressed copies of frontend/static; see assets.py
+built_assets = assets.Assets()
+
+@app.context_processor
+def asset_helpers():
+    def asset_url(name):
+        return built_assets.url(name) or url_for('static', filename=name)
+    return {"asset_url": asset_url}
+
+@app.route('/static/dist/<path:filename>', methods=['GET'])
+def built_asset(filename):
+    found = built_assets.variant(filename, request.headers.get('Accept-Encoding'))
+    if found is None:
+        return jsonify({"error": "Not found"}), 404
+    path, encoding = found
+    response = send_file(path, mimetype=assets.content_type(filename), conditional=True)
+    response.headers["Cache-Control"] = assets.IMMUTABLE_CACHE_CONTROL
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
 
 @app.route('/')
 def index():
@@ -264,128 +369,492 @@ def index():
     else:
         get_or_create_user(session['user_id'])
         
-    return render_template('index.html')
+    return render_template('index.html', voice_streaming=speech.enabled())
+
+def summarize_turns(previous_summary, turns, user_id):
+    # Through the dispatcher like the answers: same admission, budgets and failover
+    with metrics.span("summary"):
+        completion = llm_dispatcher.complete(user_id, llm.summary_messages(previous_summary, turns),
+                                             **llm.SUMMARY_OPTIONS)
+    return completion.choices[0].message.content
+
+context_builder = context.ContextBuilder(
+    summarizer=summarize_turns if context.CONTEXT_SUMMARY else None
+)
+
+# RETRIEVAL_BACKEND=local searches knowledge_base in process instead of azure_search
+retriever = None
+if llm.RETRIEVAL_BACKEND == "local":
+    import retrieval
+    retriever = retrieval.Retriever(
+        embeddings.create_embedder(os.getenv("RETRIEVAL_EMBEDDER", "local"), llm.get_client)
+    )
+
+def build_api_messages(user_id, user_input, user_message_id):
+    # Get conversation history from database, minus the message just saved
+    history = [
+        msg for msg in get_conversation_history(user_id, limit=context.CONTEXT_MAX_MESSAGES)
+        if msg["message_id"] != user_message_id
+    ]
+    
+    # Nothing earlier to condition the answer on
+    first_turn = not any(msg["role"] in ["user", "assistant"] for msg in history)
+    
+    center = tenants.current()
+    system_prompt = center.system_prompt
+    if retriever is not None:
+        with metrics.span("retrieval"):
+            documents = retriever.search(center.id, user_input, top_k=center.retrieval_top_k)
+        system_prompt += "\n\nRetrieved documents:\n\n" + retrieval.format_documents(documents)
+    
+    # Most recent turns that fit the token budget, as plain text
+    with metrics.span("context"):
+        api_messages = context_builder.build(system_prompt, history, user_input, user_id)
+    return api_messages, first_turn
+
+@metrics.timed("db_kb_version")
+def load_kb_version(center):
+    # Any edit, insert or delete in the knowledge base changes this value
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT MAX(last_updated), COUNT(*) FROM knowledge_base WHERE center_id = ?",
+            (center,)
+        )
+        return tuple(str(value) for value in cursor.fetchone())
+
+response_embedder = embeddings.create_embedder(cache.RESPONSE_CACHE_SEMANTIC, llm.get_client)
+
+def new_response_cache(max_entries):
+    return cache.ResponseCache(max_entries=max_entries, embedder=response_embedder,
+                               version_loader=load_kb_version)
+
+# Per-center configuration and response caches, resolved for every request
+centers = tenants.Registry(new_response_cache)
+
+def get_cached_answer(user_input, first_turn):
+    # Answers depend on the conversation, so only history-free questions are cached
+    if not first_turn or not cache.RESPONSE_CACHE_ENABLED:
+        return None
+    try:
+        with metrics.span("cache_lookup"):
+            center = tenants.current()
+            return center.response_cache.get(center.id, user_input)
+    except Exception as e:
+        logging.error(f"Error reading response cache: {e}")
+        return None
+
+def store_cached_answer(user_input, first_turn, answer):
+    if not first_turn or not cache.RESPONSE_CACHE_ENABLED:
+        return
+    try:
+        center = tenants.current()
+        center.response_cache.put(center.id, user_input, answer)
+    except Exception as e:
+        logging.error(f"Error writing response cache: {e}")
+
+coalescer = coalesce.Coalescer()
+
+def coalesced(user_input, first_turn, produce):
+    # Only history-free questions get the same answer for everyone; see coalesce.py
+    if not first_turn or not coalesce.COALESCE_ENABLED:
+        return produce()
+    return coalescer.stream(tenants.current().id, user_input, produce)
+
+llm_dispatcher = dispatch.Dispatcher()
+
+def complete_text(user_id, api_messages):
+    with metrics.span("llm"):
+        completion = llm_dispatcher.complete(user_id, api_messages, grounding=tenants.current().grounding())
+    metrics.record_usage(completion.usage)
+    # Remove any [doc*] pattern
+    yield streaming.strip_doc_refs(completion.choices[0].message.content)
+
+def open_stream(user_id, api_messages):
+    with metrics.span("llm"):
+        return llm_dispatcher.complete(user_id, api_messages, stream=True,
+                                       grounding=tenants.current().grounding())
+
+def overloaded_response(error):
+    # Shed before the request ties up a worker for the whole upstream timeout
+    metrics.errors.inc(stage="overloaded")
+    response = jsonify({"error": "The assistant is busy right now. Please try again in a moment."})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(max(1, math.ceil(error.retry_after)))
+    return response
+
+def stream_text(answer, upstream, api_messages):
+    yield from answer.text_deltas(upstream)
+    record_stream_usage(answer, api_messages)
+
+def validate_input_and_user():
+    # Get user input from the request
+    user_input = request.json.get('message')
+    if not user_input or not isinstance(user_input, str) or len(user_input.strip()) == 0:
+        return None, None
+    
+    return user_input, current_user_id()
+
+def current_user_id():
+    # Get or create user_id
+    user_id = session.get('user_id', str(uuid.uuid4()))
+    if 'user_id' not in session:
+        session['user_id'] = user_id
+        get_or_create_user(user_id)
+    return user_id
+
+def prompt_tokens(api_messages):
+    return sum(context.count_tokens(m["content"]) for m in api_messages)
+
+def record_stream_usage(answer, api_messages):
+    # Streamed completions only carry usage when the deployment sends it; estimate otherwise
+    if answer.usage is not None:
+        metrics.record_usage(answer.usage)
+    else:
+        metrics.record_usage(
+            prompt_estimate=prompt_tokens(api_messages),
+            completion_estimate=context.count_tokens(answer.text)
+        )
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.begin_request()
+
+# Operational endpoints expose traffic, tenants and usage: they answer only to
+# OPS_TOKEN as a bearer token (EXPORT_TOKEN when it is unset), and are hidden
+# while neither is set. Prometheus sends it with `authorization: credentials`.
+OPS_TOKEN = os.getenv("OPS_TOKEN", "") or export.EXPORT_TOKEN
+OPS_ENDPOINTS = {
+    'prometheus_metrics', 'stats', 'db_stats', 'llm_stats', 'tenant_stats', 'cache_stats', 'user_cache_stats',
+    'render_stats', 'compression_stats', 'coalesce_stats', 'retrieval_stats', 'stream_stats', 'speech_stats',
+}
+
+def authorize(token):
+    # None if the request carries the bearer token, else the response refusing it
+    if not token:
+        return jsonify({"error": "Not found"}), 404
+    sent = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not hmac.compare_digest(sent.encode(), token.encode()):
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
+@app.before_request
+def require_ops_token():
+    # Before resolve_center, so a refused request loads no center configuration
+    if request.endpoint in OPS_ENDPOINTS:
+        return authorize(OPS_TOKEN)
+
+@app.before_request
+def resolve_center():
+    # After start_request_metrics, so a 404 here is still timed. Liveness and
+    # scrapes answer whatever the Host.
+    if request.endpoint in ('healthz', 'prometheus_metrics', 'static', 'built_asset'):
+        return None
+    try:
+        center = centers.resolve(request.host, request.headers.get(tenants.TENANT_HEADER),
+                                 request.headers.get(tenants.TENANT_SECRET_HEADER))
+    except tenants.UnknownCenter:
+        return jsonify({"error": "Unknown commercial center"}), 404
+    tenants.activate(center)
+
+@app.after_request
+def record_request_metrics(response):
+    # For streamed answers this is the time to the first byte; see chatbot_stream_seconds
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.request_seconds.observe(elapsed, endpoint=endpoint, method=request.method,
+                                    status=response.status_code)
+    if metrics.SERVER_TIMING:
+        response.headers["Server-Timing"] = metrics.server_timing(elapsed)
+    return response
+
+response_compressor = compression.ResponseCompressor()
+
+@app.after_request
+def compress_response(response):
+    # Registered after record_request_metrics, so it runs first and is timed
+    if compression.COMPRESS_ENABLED:
+        with metrics.span("compress"):
+            return response_compressor.apply(response, request.headers.get('Accept-Encoding'))
+    return response
 
 @app.route('/process-input', methods=['POST'])
 def process_input():
     try:
-        # Get user input from the request
-        user_input = request.json.get('message')
-        if not user_input or not isinstance(user_input, str) or len(user_input.strip()) == 0:
+        user_input, user_id = validate_input_and_user()
+        if user_input is None:
             return jsonify({"error": "Invalid input. Message must be a non-empty string."}), 400
         
-        # Get or create user_id
-        user_id = session.get('user_id', str(uuid.uuid4()))
-        if 'user_id' not in session:
-            session['user_id'] = user_id
-            get_or_create_user(user_id)
+        try:
+            conversation_id = resolve_conversation(user_id, request.json.get('conversation_id'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         # Save user message to database
-        user_message_id = save_message(user_id, user_input, "user")
-        
-        # Get conversation history from database
-        history = get_conversation_history(user_id)
-        
-        # Build chat messages for API
-        chat_messages = [msg for msg in history if msg["role"] in ["user", "assistant"]]
-        
-        # Prepare system message
-        system_prompt = {
-            "role": "system",
-            "content": "You are an AI assistant who helps users find information. "
-                       "You cannot include references. If the requested information "
-                       "is not available in the retrieved data, direct the user to "
-                       "the form hosted at https://www.cap3000.com/faq#contact-section "
-                       "so that someone can assist them."
-        }
+        user_message_id = save_message(user_id, user_input, "user", conversation_id=conversation_id)
         
-        # Create API message format
-        api_messages = [system_prompt] + [
-            {"role": msg["role"], "content": msg["content"]} 
-            for msg in chat_messages
-        ] + [{"role": "user", "content": user_input}]
-        
-        # Generate completion
-        completion = client.chat.completions.create(
-            model=deployment,
-            messages=api_messages,
-            max_tokens=800,
-            temperature=0.7,
-            top_p=0.95,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=None,
-            stream=False,
-            extra_body={
-                "data_sources": [{
-                    "type": "azure_search",
-                    "parameters": {
-                        "endpoint": search_endpoint,
-                        "index_name": search_index,
-                        "semantic_configuration": "default",
-                        "query_type": "vector_simple_hybrid",
-                        "fields_mapping": {},
-                        "in_scope": True,
-                        "role_information": "You are an AI assistant who helps users find information. You cannot include references. If the requested information is not available in the retrieved data, direct the user to the form hosted at https://www.cap3000.com/faq#contact-section so that someone can assist them.",
-                        "filter": None,
-                        "strictness": 3,
-                        "top_n_documents": 5,
-                        "authentication": {
-                            "type": "api_key",
-                            "key": search_key
-                        },
-                        "embedding_dependency": {
-                            "type": "deployment_name",
-                            "deployment_name": "text-embedding-3-small"
-                        }
-                    }
-                }]
-            }
-        )
-
-        # Extract the assistant's response
-        assistant_response = completion.choices[0].message.content
-
-        # Step 1: Remove any trailing [doc*] pattern
-        assistant_response = re.sub(r'\[doc\d+\]', '', assistant_response)  # Remove any [doc*] pattern
-
-        assistant_response = markdown.markdown(assistant_response)
-
+        api_messages, first_turn = build_api_messages(user_id, user_input, user_message_id)
         
+        assistant_response = get_cached_answer(user_input, first_turn)
+        prompt_cost = 0
+        if assistant_response is None:
+            # Generate completion, or share one already running for the same question
+            assistant_response = "".join(
+                coalesced(user_input, first_turn, lambda: complete_text(user_id, api_messages))
+            )
+            store_cached_answer(user_input, first_turn, assistant_response)
+            prompt_cost = prompt_tokens(api_messages)
+
         # Save assistant message to database
-        assistant_message_id = save_message(user_id, assistant_response, "assistant")
+        assistant_message_id, rendered = save_answer(user_id, assistant_response,
+                                                     conversation_id=conversation_id,
+                                                     prompt_tokens=prompt_cost, started=g.request_started)
         
         # Return the response with message IDs for feedbacK
         return jsonify({
-            "response": assistant_response,
+            "response": rendered,
             "user_message_id": user_message_id,
             "assistant_message_id": assistant_message_id
         })
 
+    except dispatch.Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logging.error(f"Error processing input: {e}")
+        metrics.errors.inc(stage="process_input")
+        return jsonify({"error": "Could not process your request."}), 500
+
+@app.route('/process-input/stream', methods=['POST'])
+def process_input_stream():
+    # Server-sent events, see streaming.AnswerStream for the event types
+    started = time.perf_counter()
+    try:
+        user_input, user_id = validate_input_and_user()
+        if user_input is None:
+            return jsonify({"error": "Invalid input. Message must be a non-empty string."}), 400
+        
+        try:
+            conversation_id = resolve_conversation(user_id, request.json.get('conversation_id'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        user_message_id = save_message(user_id, user_input, "user", conversation_id=conversation_id)
+        api_messages, first_turn = build_api_messages(user_id, user_input, user_message_id)
+        answer = streaming.AnswerStream(started, user_message_id, str(uuid.uuid4()))
+        cached_answer = get_cached_answer(user_input, first_turn)
+        if cached_answer is None:
+            # Admitted and opened before the response starts, unless another request leads
+            texts = coalesced(user_input, first_turn,
+                              lambda: stream_text(answer, open_stream(user_id, api_messages), api_messages))
+    except dispatch.Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         logging.error(f"Error processing input: {e}")
+        metrics.errors.inc(stage="process_input")
+        return jsonify({"error": "Could not process your request."}), 500
+
+    def generate():
+        yield answer.start()
+        try:
+            if cached_answer is not None:
+                yield from answer.feed_text(cached_answer)
+            else:
+                for text in texts:
+                    yield from answer.feed_text(text)
+            yield from answer.finish()
+            if cached_answer is None:
+                store_cached_answer(user_input, first_turn, answer.text)
+
+            # Persist the assembled message exactly as the non-streaming path does
+            _, rendered = save_answer(user_id, answer.text, answer.assistant_message_id, conversation_id,
+                                      0 if cached_answer is not None else prompt_tokens(api_messages),
+                                      started)
+            yield answer.done(rendered)
+        except Exception as e:
+            logging.error(f"Error streaming response: {e}")
+            metrics.errors.inc(stage="stream")
+            yield answer.error()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+VOICE_HEADERS = ["X-Transcript", "X-Conversation-Id", "X-User-Message-Id", "X-Assistant-Message-Id"]
+
+@app.route('/speech', methods=['POST'])
+def speech_turn():
+    # Audio in, audio out; see speech.py. The transcript and message ids come back
+    # as headers, the answer text through /messages/<assistant_message_id>.
+    if not speech.enabled():
+        return jsonify({"error": "Not found"}), 404
+    started = time.perf_counter()
+    pipeline = speech.get_pipeline()
+    try:
+        turn = pipeline.turn(request.args.get('language', speech.SPEECH_LANGUAGE))
+        user_id = current_user_id()
+        conversation_id = resolve_conversation(user_id, request.args.get('conversation_id'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with metrics.span("speech_recognition"):
+            transcript = turn.transcribe(request.stream.read)
+    except speech.AudioTooLong as e:
+        return jsonify({"error": f"Recording too long: {e}."}), 413
+    except speech.SpeechError as e:
+        logging.error(f"Error recognizing speech: {e}")
+        metrics.errors.inc(stage="speech_recognition")
+        return jsonify({"error": "Speech recognition is unavailable."}), 502
+    if not transcript:
+        return jsonify({"error": "No speech was recognized."}), 422
+
+    try:
+        user_message_id = save_message(user_id, transcript, "user", conversation_id=conversation_id)
+        api_messages, first_turn = build_api_messages(user_id, transcript, user_message_id)
+        answer = streaming.AnswerStream(started, user_message_id, str(uuid.uuid4()))
+        cached_answer = get_cached_answer(transcript, first_turn)
+        if cached_answer is None:
+            texts = coalesced(transcript, first_turn,
+                              lambda: stream_text(answer, open_stream(user_id, api_messages), api_messages))
+    except dispatch.Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logging.error(f"Error processing speech input: {e}")
+        metrics.errors.inc(stage="process_input")
         return jsonify({"error": "Could not process your request."}), 500
 
+    def generate():
+        sentences = speech.SentenceSplitter()
+        try:
+            for text in [cached_answer] if cached_answer is not None else texts:
+                # Fed for answer.text and the first-token metrics; its SSE frames are not sent
+                answer.feed_text(text)
+                for sentence in sentences.feed(text):
+                    yield from turn.speak(sentence)
+            answer.finish()
+            for sentence in sentences.flush():
+                yield from turn.speak(sentence)
+            if cached_answer is None:
+                store_cached_answer(transcript, first_turn, answer.text)
+            save_answer(user_id, answer.text, answer.assistant_message_id, conversation_id,
+                        0 if cached_answer is not None else prompt_tokens(api_messages), started)
+        except Exception as e:
+            logging.error(f"Error streaming spoken response: {e}")
+            metrics.errors.inc(stage="speech_synthesis")
+        finally:
+            turn.finish()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=pipeline.synthesizer.mimetype,
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            # Headers are latin-1: the transcript is percent-encoded (decodeURIComponent)
+            "X-Transcript": quote(transcript),
+            "X-Conversation-Id": str(conversation_id or ""),
+            "X-User-Message-Id": user_message_id,
+            "X-Assistant-Message-Id": answer.assistant_message_id,
+            "Access-Control-Expose-Headers": ", ".join(VOICE_HEADERS),
+        }
+    )
+
+@app.route('/speech-stats', methods=['GET'])
+def speech_stats():
+    if not speech.enabled():
+        # Not configured: no pipeline, and no engine client created for this request
+        return jsonify({"status": "success", "speech": None})
+    return jsonify({"status": "success", "speech": speech.get_pipeline().snapshot()})
+
+@app.route('/stream-stats', methods=['GET'])
+def stream_stats():
+    return jsonify({
+        "status": "success",
+        "time_to_first_token": streaming.time_to_first_token.snapshot(),
+        "stream_duration": streaming.stream_duration.snapshot()
+    })
+
+@app.route('/retrieval-stats', methods=['GET'])
+def retrieval_stats():
+    return jsonify({
+        "status": "success",
+        "backend": llm.RETRIEVAL_BACKEND,
+        "retriever": retriever.snapshot() if retriever is not None else None
+    })
+
+@app.route('/coalesce-stats', methods=['GET'])
+def coalesce_stats():
+    # Counts for the worker that served this request; /metrics has every worker's
+    return jsonify({"status": "success", "coalesce": coalescer.snapshot()})
+
+@app.route('/llm-stats', methods=['GET'])
+def llm_stats():
+    # Admission queue and per-deployment state for the worker that served this request
+    return jsonify({"status": "success", "dispatch": llm_dispatcher.snapshot()})
+
+@app.route('/render-stats', methods=['GET'])
+def render_stats():
+    return jsonify({"status": "success", "render_cache": renders.snapshot()})
+
+@app.route('/user-cache-stats', methods=['GET'])
+def user_cache_stats():
+    return jsonify({"status": "success", "known_users": known_users.snapshot()})
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify({"status": "success", "response_cache": tenants.current().response_cache.snapshot(),
+                    "shared_cache": shared_cache.snapshot()})
+
+@app.route('/compression-stats', methods=['GET'])
+def compression_stats():
+    return jsonify({"status": "success", "responses": response_compressor.snapshot(),
+                    "assets": built_assets.snapshot()})
+
+@app.route('/tenant-stats', methods=['GET'])
+def tenant_stats():
+    # Every center this worker has loaded, with its cache and pool usage
+    return jsonify({"status": "success", "tenants": centers.snapshot()})
+
 @app.route('/feedback', methods=['POST'])
 def feedback():
+    # One vote as {message_id, feedback}, or several as {"votes": [{message_id, feedback}, ...]}
     try:
         data = request.json
-        message_id = data.get('message_id')
-        feedback_value = data.get('feedback')  # 1 for like, -1 for dislike, 0 for neutral
-        
-        # Validate message_id
-        try:
-            uuid.UUID(message_id)
-        except (ValueError, TypeError):
-            return jsonify({"error": "Invalid message_id. Must be a valid UUID."}), 400
+        batch = isinstance(data.get('votes'), list)
+        items = data['votes'] if batch else [data]
+        if not items or len(items) > analytics.FEEDBACK_BATCH_MAX:
+            return jsonify({"error": f"Send between 1 and {analytics.FEEDBACK_BATCH_MAX} votes."}), 400
         
-        # Validate feedback_value
-        if feedback_value not in [1, -1, 0]:
-            return jsonify({"error": "Invalid feedback value. Must be 1, -1, or 0."}), 400
+        votes = []
+        for item in items:
+            if not isinstance(item, dict):
+                return jsonify({"error": "Each vote must be an object."}), 400
+            message_id = item.get('message_id')
+            feedback_value = item.get('feedback')  # 1 for like, -1 for dislike, 0 for neutral
             
-        updated = update_feedback(message_id, feedback_value)
+            # Validate message_id
+            try:
+                uuid.UUID(message_id)
+            except (ValueError, TypeError, AttributeError):
+                return jsonify({"error": "Invalid message_id. Must be a valid UUID."}), 400
+            
+            # Validate feedback_value
+            if feedback_value not in [1, -1, 0]:
+                return jsonify({"error": "Invalid feedback value. Must be 1, -1, or 0."}), 400
+            votes.append((message_id, feedback_value))
+        
+        found = update_feedbacks(votes)
         
-        if updated:
+        if batch:
+            return jsonify({
+                "status": "success",
+                "updated": [message_id for message_id, _ in votes if message_id in found],
+                "not_found": [message_id for message_id, _ in votes if message_id not in found]
+            })
+        if found:
             return jsonify({"status": "success", "message": "Feedback recorded"})
         else:
             return jsonify({"error": "Message not found"}), 404
@@ -394,6 +863,79 @@ def feedback():
         logging.error(f"Error processing feedback: {e}")
         return jsonify({"error": "Could not process feedback"}), 500
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    # Daily usage and feedback of this center, read from the message_stats rollups
+    try:
+        try:
+            end = date.fromisoformat(request.args['to']) if request.args.get('to') else date.today()
+            start = (date.fromisoformat(request.args['from']) if request.args.get('from')
+                     else end - timedelta(days=29))
+        except ValueError:
+            return jsonify({"error": "Invalid date. Use YYYY-MM-DD."}), 400
+        if start > end or (end - start).days >= analytics.STATS_MAX_DAYS:
+            return jsonify({"error": f"from must be before to, at most {analytics.STATS_MAX_DAYS} days apart."}), 400
+        
+        with db.connection() as conn:
+            days = analytics.daily_stats(conn.cursor(), tenants.current().id, start, end)
+        
+        return jsonify({
+            "status": "success",
+            "center_id": tenants.current().id,
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "days": days,
+            "totals": analytics.totals(days)
+        })
+        
+    except Exception as e:
+        logging.error(f"Error getting stats: {e}")
+        return jsonify({"error": "Could not retrieve stats"}), 500
+
+@app.route('/export', methods=['GET'])
+def export_conversations():
+    # Streams this center's conversations as NDJSON or CSV; see export.py. Disabled unless EXPORT_TOKEN is set.
+    refused = authorize(export.EXPORT_TOKEN)
+    if refused is not None:
+        return refused
+
+    try:
+        start = export.parse_day(request.args.get('from'))
+        end = export.parse_day(request.args.get('to'))
+    except ValueError:
+        return jsonify({"error": "Invalid date. Use YYYY-MM-DD."}), 400
+    conversation_id = request.args.get('conversation_id')
+    if conversation_id:
+        try:
+            uuid.UUID(conversation_id)
+        except ValueError:
+            return jsonify({"error": "Invalid conversation_id. Must be a valid UUID."}), 400
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        return jsonify({"error": f"Invalid format. Use one of: {', '.join(export.FORMATS)}."}), 400
+    # Only the center this request resolved to: the token does not reach other centers' data
+    center = tenants.current().id
+
+    exporter = export.Exporter(fmt, request.args.get('gzip') == 'true')
+
+    def generate():
+        try:
+            yield from exporter.stream(export.rows(center, start, end, conversation_id))
+        except Exception as e:
+            # Headers are already sent; the client sees a truncated body
+            logging.error(f"Export of {center} failed after {exporter.rows} rows: {e}")
+            raise
+        logging.info(f"Exported {exporter.rows} rows of {center} ({exporter.bytes} bytes)")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=exporter.mimetype,
+        headers={
+            "Content-Disposition": f'attachment; filename="{exporter.filename(center)}"',
+            "Cache-Control": "no-store",
+        }
+    )
+
 @app.route('/clear-session', methods=['POST'])
 def clear_session():
     try:
@@ -401,12 +943,15 @@ def clear_session():
         if not user_id:
             return jsonify({"error": "No active session"}), 400
             
-        # Delete all messages for this user
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
-        conn.commit()
-        conn.close()
+        # Queued messages are served from the queue, which the tombstone does not cover
+        if writer.WRITE_BEHIND:
+            message_writer.flush()
+        
+        # Hide all messages for this user; retention.py deletes them in the background
+        with db.connection() as conn:
+            retention.clear_user(conn.cursor(), user_id)
+        context_builder.forget(user_id)
+        shared_cache.invalidate(user_id)
         
         return jsonify({"status": "success", "message": "Conversation history cleared"})
         
@@ -436,17 +981,92 @@ def get_history():
         except ValueError:
             return jsonify({"error": "Invalid limit. Must be an integer between 1 and 100."}), 400
         
-        history = get_conversation_history(user_id, limit=limit)
+        # Validate conversation_id and cursors
+        conversation_id = request.args.get('conversation_id') or None
+        if conversation_id:
+            try:
+                uuid.UUID(conversation_id)
+            except ValueError:
+                return jsonify({"error": "Invalid conversation_id. Must be a valid UUID."}), 400
+        try:
+            before = parse_cursor(request.args['before']) if request.args.get('before') else None
+            since = parse_cursor(request.args['since']) if request.args.get('since') else None
+        except ValueError:
+            return jsonify({"error": "Invalid cursor. Must be <timestamp>,<id>."}), 400
+        if before and since:
+            return jsonify({"error": "Use either before or since, not both."}), 400
+        try:
+            fmt = requested_format()
+        except ValueError:
+            return jsonify({"error": "Invalid format. Must be html or raw."}), 400
+        
+        history, has_more = shared_cache.cached(
+            "history", user_id, (tenants.current().id, conversation_id, limit, before, since),
+            lambda: get_history_page(user_id, conversation_id, limit, before, since)
+        )
+        with metrics.span("render"):
+            history = [present_message(msg, fmt) for msg in history]
         
-        return jsonify({
-            "status": "success", 
-            "history": history
+        response = jsonify({
+            "status": "success",
+            "history": history,
+            "has_more": has_more,
+            # Pass back as before= for older messages, or as since= to poll for new ones
+            "before": history[0]["cursor"] if history and has_more and not since else None,
+            "latest": history[-1]["cursor"] if history else request.args.get('since')
         })
+        # Revalidated on every use; unchanged pages cost a 304 and no body
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.vary.add("Accept")
+        response.add_etag()
+        return response.make_conditional(request)
         
     except Exception as e:
         logging.error(f"Error getting history: {e}")
         return jsonify({"error": "Could not retrieve history"}), 500
 
+@app.route('/messages/<message_id>', methods=['GET'])
+def get_single_message(message_id):
+    # One message as text/markdown, text/html or JSON, chosen by the Accept header;
+    # JSON carries the content in the format requested with ?format=
+    try:
+        user_id = session.get('user_id')
+        if not user_id:
+            return jsonify({"error": "No active session"}), 400
+        
+        try:
+            uuid.UUID(message_id)
+        except ValueError:
+            return jsonify({"error": "Invalid message_id. Must be a valid UUID."}), 400
+        try:
+            fmt = requested_format()
+        except ValueError:
+            return jsonify({"error": "Invalid format. Must be html or raw."}), 400
+        
+        msg = get_message(user_id, message_id)
+        if msg is None:
+            return jsonify({"error": "Message not found"}), 404
+        
+        mimetype = request.accept_mimetypes.best_match(
+            ["application/json", "text/html", "text/markdown"], default="application/json"
+        )
+        if mimetype == "text/markdown":
+            msg = present_message(msg, "raw")
+            response = Response(msg["content"], mimetype="text/markdown")
+        elif mimetype == "text/html":
+            msg = present_message(msg, "html")
+            response = Response(msg["content"], mimetype="text/html")
+        else:
+            response = jsonify({"status": "success", "message": present_message(msg, fmt)})
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.vary.add("Accept")
+        response.add_etag()
+        return response.make_conditional(request)
+        
+    except Exception as e:
+        logging.error(f"Error getting message: {e}")
+        return jsonify({"error": "Could not retrieve message"}), 500
+
 # Add these new routes in app.py
 @app.route('/conversations', methods=['GET'])
 def get_conversations():
@@ -455,7 +1075,17 @@ def get_conversations():
         if not user_id:
             return jsonify({"error": "No active session"}), 400
             
-        conn = get_db_connection()
+        conversations = shared_cache.cached("conversations", user_id, (),
+                                            lambda: load_conversations(user_id))
+        return jsonify({"status": "success", "conversations": conversations})
+        
+    except Exception as e:
+        logging.error(f"Error getting conversations: {e}")
+        return jsonify({"error": "Could not retrieve conversations"}), 500
+
+@metrics.timed("db_conversations")
+def load_conversations(user_id):
+    with db.connection() as conn:
         cursor = conn.cursor()
         cursor.execute("""
             SELECT id, title, created_at, last_updated 
@@ -463,22 +1093,17 @@ def get_conversations():
             WHERE user_id = ? 
             ORDER BY last_updated DESC
         """, (user_id,))
-        
-        conversations = []
-        for conv_id, title, created_at, last_updated in cursor.fetchall():
-            conversations.append({
-                "id": conv_id,
-                "title": title,
-                "created_at": created_at,
-                "last_updated": last_updated
-            })
-            
-        conn.close()
-        return jsonify({"status": "success", "conversations": conversations})
-        
-    except Exception as e:
-        logging.error(f"Error getting conversations: {e}")
-        return jsonify({"error": "Could not retrieve conversations"}), 500
+        rows = cursor.fetchall()
+    
+    conversations = []
+    for conv_id, title, created_at, last_updated in rows:
+        conversations.append({
+            "id": conv_id,
+            "title": title,
+            "created_at": created_at,
+            "last_updated": last_updated
+        })
+    return conversations
 
 @app.route('/conversations', methods=['POST'])
 def create_conversation():
@@ -490,14 +1115,13 @@ def create_conversation():
         conversation_id = str(uuid.uuid4())
         title = "New Conversation"  # You can allow users to set this
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO conversation_sessions (id, user_id, center_id, title) 
-            VALUES (?, ?, ?, ?)
-        """, (conversation_id, user_id, center_id, title))
-        conn.commit()
-        conn.close()
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO conversation_sessions (id, user_id, center_id, title) 
+                VALUES (?, ?, ?, ?)
+            """, (conversation_id, user_id, tenants.current().id, title))
+        shared_cache.invalidate(user_id)
         
         return jsonify({
             "status": "success",
@@ -512,7 +1136,115 @@ def create_conversation():
         logging.error(f"Error creating conversation: {e}")
         return jsonify({"error": "Could not create conversation"}), 500
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # Liveness only: answers without touching the database or Azure OpenAI
+    return jsonify({"status": "ok"})
+
+def collect_runtime_metrics():
+    for name, pool in db.all_pool_stats().items():
+        for state in ("in_use", "idle"):
+            yield ("chatbot_db_pool_connections", "gauge", "Open pooled connections by state.",
+                   {"pool": name, "state": state}, pool[state])
+        for key in ("connects", "waits", "timeouts"):
+            yield (f"chatbot_db_pool_{key}_total", "counter", f"Pool {key} since the worker started.",
+                   {"pool": name}, pool[key])
+        yield ("chatbot_db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection.",
+               {"pool": name}, pool["wait_seconds"])
+    if writer.WRITE_BEHIND:
+        stats = message_writer.snapshot()
+        yield ("chatbot_writer_queue_depth", "gauge", "Messages waiting for the write-behind writer.",
+               {}, stats["queue_depth"])
+        yield ("chatbot_writer_written_total", "counter", "Messages written by the write-behind writer.",
+               {}, stats["written"])
+    for center, data in centers.snapshot()["centers"].items():
+        stats = data["response_cache"]
+        if stats is None:
+            continue
+        yield ("chatbot_response_cache_entries", "gauge", "Answers held in the response cache.",
+               {"center": center}, stats["entries"])
+        for kind in ("exact_hits", "semantic_hits", "misses"):
+            yield ("chatbot_response_cache_lookups_total", "counter", "Response cache lookups by outcome.",
+                   {"center": center, "outcome": kind}, stats[kind])
+    stats = response_compressor.snapshot()
+    yield ("chatbot_compressed_responses_total", "counter", "Responses compressed on the fly.",
+           {}, stats["compressed"])
+    for direction, key in (("in", "bytes_in"), ("out", "bytes_out")):
+        yield ("chatbot_compression_bytes_total", "counter", "Bytes before (in) and after (out) compression.",
+               {"direction": direction}, stats[key])
+    if speech.enabled():
+        stats = speech.get_pipeline().snapshot()
+        for outcome in ("turns", "no_speech", "too_long", "errors"):
+            yield ("chatbot_speech_turns_total", "counter", "Voice turns by outcome.",
+                   {"outcome": outcome}, stats[outcome])
+        for direction, key in (("in", "audio_bytes_in"), ("out", "audio_bytes_out")):
+            yield ("chatbot_speech_audio_bytes_total", "counter", "Audio received (in) and synthesized (out).",
+                   {"direction": direction}, stats[key])
+    stats = renders.snapshot()
+    yield ("chatbot_render_cache_entries", "gauge", "Rendered messages held in the render cache.",
+           {}, stats["entries"])
+    for outcome in ("hits", "misses"):
+        yield ("chatbot_render_cache_lookups_total", "counter", "Render cache lookups by outcome.",
+               {"outcome": outcome}, stats[outcome])
+    yield ("chatbot_render_seconds_total", "counter", "Time spent rendering markdown to HTML.",
+           {}, stats["render_seconds"])
+    stats = known_users.snapshot()
+    yield ("chatbot_known_users_entries", "gauge", "User ids held in the known-user cache.",
+           {}, stats["entries"])
+    for outcome in ("hits", "shared_hits", "misses"):
+        yield ("chatbot_known_users_lookups_total", "counter", "Known-user cache lookups by outcome.",
+               {"outcome": outcome}, stats[outcome])
+    if shared_cache.enabled:
+        stats = shared_cache.snapshot()
+        for outcome in ("hits", "shared_hits", "misses"):
+            yield ("chatbot_shared_cache_lookups_total", "counter",
+                   "Shared cache lookups by outcome; shared_hits were stored by another worker.",
+                   {"outcome": outcome}, stats[outcome])
+        for key in ("evictions", "invalidations"):
+            yield (f"chatbot_shared_cache_{key}_total", "counter", f"Shared cache {key} by this worker.",
+                   {}, stats[key])
+    stats = coalescer.snapshot()
+    for role in ("leaders", "local_followers", "shared_followers", "fallbacks"):
+        yield ("chatbot_llm_coalesce_total", "counter",
+               "First-turn requests by coalescing role; followers cost no upstream call.",
+               {"role": role}, stats[role])
+    stats = llm_dispatcher.snapshot()
+    yield ("chatbot_llm_in_flight", "gauge", "Admitted LLM calls in progress.", {}, stats["in_flight"])
+    yield ("chatbot_llm_waiting", "gauge", "Requests queued for an LLM slot.", {}, stats["waiting"])
+    for outcome in ("admitted", "queued", "shed", "retries", "failovers", "exhausted"):
+        yield ("chatbot_llm_dispatch_total", "counter", "LLM dispatch decisions by outcome.",
+               {"outcome": outcome}, stats[outcome])
+    for deployment in stats["deployments"]:
+        labels = {"deployment": deployment["name"]}
+        yield ("chatbot_llm_deployment_circuit_open", "gauge", "1 while the deployment's circuit is open.",
+               labels, int(deployment["state"] != "closed"))
+        if deployment["latency_ms"] is not None:
+            yield ("chatbot_llm_deployment_latency_seconds", "gauge",
+                   "Moving average of time to response headers.", labels, deployment["latency_ms"] / 1000)
+        for key in ("calls", "errors", "rate_limited"):
+            yield (f"chatbot_llm_deployment_{key}_total", "counter", f"Deployment {key} since the worker started.",
+                   labels, deployment[key])
+
+metrics.register_collector(collect_runtime_metrics)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/db-stats', methods=['GET'])
+def db_stats():
+    # Pool statistics for the worker that served this request
+    return jsonify({
+        "status": "success",
+        "pool": db.pool_stats(),
+        "pools": db.all_pool_stats(),
+        "writer": message_writer.snapshot() if writer.WRITE_BEHIND else None
+    })
+
 # Run the Flask app
 if __name__ == '__main__':
+    import schema
+    schema.migrate()
+    schema.ensure_center(center_id, center_name)
     app.run(host='0.0.0.0', port=5000, debug=True)
     
\ No newline at end of file
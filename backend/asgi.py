@@ -0,0 +1,362 @@
+import os
+import json
+import math
+import time
+import uuid
+import asyncio
+import contextvars
+import logging
+from http.cookies import SimpleCookie
+from concurrent.futures import ThreadPoolExecutor
+from a2wsgi import WSGIMiddleware
+from flask_cors.core import get_cors_headers, get_cors_options
+from werkzeug.datastructures import Headers
+import app as flask_module
+import assets
+import coalesce
+import db
+import dispatch
+import metrics
+import streaming
+import tenants
+
+# Async serving mode. The chat endpoints run natively on the event loop with the
+# async OpenAI client, so a slow completion costs a coroutine instead of a worker;
+# DB calls are offloaded to a thread pool. Every other route is the unchanged
+# Flask app, bridged through a WSGI thread pool.
+#
+#   gunicorn -k uvicorn_worker.UvicornWorker asgi:application
+
+ASGI_DB_THREADS = int(os.getenv("ASGI_DB_THREADS", 32))
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", 16))
+
+flask_app = flask_module.app
+wsgi = WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)
+
+
+# Flask-CORS only sees what goes through Flask: the async routes add its headers
+# themselves, computed from the same options. Preflights (OPTIONS) are not
+# routed here and still get their answer from Flask.
+cors_options = get_cors_options(flask_app, flask_module.cors_options)
+
+
+def with_cors(scope, send):
+    request_headers = Headers([(name.decode("latin-1"), value.decode("latin-1"))
+                               for name, value in scope.get("headers") or []])
+    cors = [(name.lower().encode("latin-1"), str(value).encode("latin-1"))
+            for name, value in get_cors_headers(cors_options, request_headers, scope["method"]).items(multi=True)]
+
+    async def send_cors(message):
+        if message["type"] == "http.response.start" and cors:
+            message = dict(message, headers=list(message["headers"]) + cors)
+        await send(message)
+
+    return send_cors
+
+
+def session_user_id(scope):
+    # Reads the user id from Flask's signed session cookie
+    headers = dict(scope.get("headers") or [])
+    raw = headers.get(b"cookie")
+    if not raw:
+        return None
+    cookie = SimpleCookie()
+    cookie.load(raw.decode("latin-1"))
+    morsel = cookie.get(flask_app.config["SESSION_COOKIE_NAME"])
+    if morsel is None:
+        return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        data = serializer.loads(
+            morsel.value,
+            max_age=int(flask_app.permanent_session_lifetime.total_seconds())
+        )
+    except Exception:
+        return None
+    return data.get("user_id")
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_json(send, status, data, headers=()):
+    body = json.dumps(data).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ] + list(headers),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def run_db(func, *args):
+    # Carries the request's context over, so spans timed in the thread reach Server-Timing
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(None, context.run, func, *args)
+
+
+async def parse_input(receive, send, user_id):
+    # Returns (message, conversation_id), or None once a 400 has been sent
+    try:
+        data = json.loads(await read_body(receive) or b"{}")
+        user_input = data.get("message")
+    except (ValueError, AttributeError):
+        data, user_input = {}, None
+    if not user_input or not isinstance(user_input, str) or len(user_input.strip()) == 0:
+        await send_json(send, 400, {"error": "Invalid input. Message must be a non-empty string."})
+        return None
+    try:
+        conversation_id = await run_db(flask_module.resolve_conversation, user_id, data.get("conversation_id"))
+    except ValueError as e:
+        await send_json(send, 400, {"error": str(e)})
+        return None
+    return user_input, conversation_id
+
+
+async def coalesced(user_input, first_turn, produce):
+    if not first_turn or not coalesce.COALESCE_ENABLED:
+        return await coalesce.aproduce(produce)
+    # Same flights as the Flask routes of this worker, see app.coalesced
+    return await flask_module.coalescer.astream(tenants.current().id, user_input, produce)
+
+
+async def send_overloaded(send, error):
+    metrics.errors.inc(stage="overloaded")
+    retry_after = str(max(1, math.ceil(error.retry_after))).encode()
+    await send_json(send, 503, {"error": "The assistant is busy right now. Please try again in a moment."},
+                    [(b"retry-after", retry_after)])
+
+
+async def complete_text(user_id, api_messages):
+    with metrics.span("llm"):
+        completion = await flask_module.llm_dispatcher.acomplete(user_id, api_messages,
+                                                                 grounding=tenants.current().grounding())
+    metrics.record_usage(completion.usage)
+    yield streaming.strip_doc_refs(completion.choices[0].message.content)
+
+
+async def open_stream(user_id, api_messages):
+    with metrics.span("llm"):
+        return await flask_module.llm_dispatcher.acomplete(user_id, api_messages, stream=True,
+                                                           grounding=tenants.current().grounding())
+
+
+async def stream_text(answer, upstream, api_messages):
+    try:
+        async for text in answer.atext_deltas(upstream):
+            yield text
+    finally:
+        # Also when the client went away mid-answer: the upstream response goes with it
+        await upstream.aclose()
+    flask_module.record_stream_usage(answer, api_messages)
+
+
+async def process_input(scope, receive, send, user_id):
+    started = time.perf_counter()
+    parsed = await parse_input(receive, send, user_id)
+    if parsed is None:
+        return
+    user_input, conversation_id = parsed
+    try:
+        user_message_id = await run_db(flask_module.save_message, user_id, user_input, "user", None,
+                                       conversation_id)
+        api_messages, first_turn = await run_db(flask_module.build_api_messages, user_id, user_input,
+                                                 user_message_id)
+
+        assistant_response = await run_db(flask_module.get_cached_answer, user_input, first_turn)
+        prompt_cost = 0
+        if assistant_response is None:
+            texts = await coalesced(user_input, first_turn, lambda: complete_text(user_id, api_messages))
+            assistant_response = "".join([text async for text in texts])
+            await run_db(flask_module.store_cached_answer, user_input, first_turn, assistant_response)
+            prompt_cost = flask_module.prompt_tokens(api_messages)
+        assistant_message_id, rendered = await run_db(flask_module.save_answer, user_id, assistant_response,
+                                                      None, conversation_id, prompt_cost, started)
+    except dispatch.Overloaded as e:
+        await send_overloaded(send, e)
+        return
+    except Exception as e:
+        logging.error(f"Error processing input: {e}")
+        metrics.errors.inc(stage="process_input")
+        await send_json(send, 500, {"error": "Could not process your request."})
+        return
+
+    await send_json(send, 200, {
+        "response": rendered,
+        "user_message_id": user_message_id,
+        "assistant_message_id": assistant_message_id
+    })
+
+
+async def process_input_stream(scope, receive, send, user_id):
+    started = time.perf_counter()
+    parsed = await parse_input(receive, send, user_id)
+    if parsed is None:
+        return
+    user_input, conversation_id = parsed
+    try:
+        user_message_id = await run_db(flask_module.save_message, user_id, user_input, "user", None,
+                                       conversation_id)
+        api_messages, first_turn = await run_db(flask_module.build_api_messages, user_id, user_input,
+                                                 user_message_id)
+        answer = streaming.AnswerStream(started, user_message_id, str(uuid.uuid4()))
+        cached_answer = await run_db(flask_module.get_cached_answer, user_input, first_turn)
+        texts = upstream = None
+
+        async def open_text():
+            # Kept to be closed below even if texts never starts reading it
+            nonlocal upstream
+            upstream = await open_stream(user_id, api_messages)
+            return stream_text(answer, upstream, api_messages)
+
+        if cached_answer is None:
+            # Admitted and opened before the response starts, unless another request leads
+            texts = await coalesced(user_input, first_turn, open_text)
+    except dispatch.Overloaded as e:
+        await send_overloaded(send, e)
+        return
+    except Exception as e:
+        logging.error(f"Error processing input: {e}")
+        metrics.errors.inc(stage="process_input")
+        await send_json(send, 500, {"error": "Could not process your request."})
+        return
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+
+    async def emit(frames):
+        for frame in frames:
+            await send({"type": "http.response.body", "body": frame.encode(), "more_body": True})
+
+    await emit([answer.start()])
+    try:
+        if cached_answer is not None:
+            await emit(answer.feed_text(cached_answer))
+        else:
+            async for text in texts:
+                await emit(answer.feed_text(text))
+        await emit(answer.finish())
+        if cached_answer is None:
+            await run_db(flask_module.store_cached_answer, user_input, first_turn, answer.text)
+
+        prompt_cost = 0 if cached_answer is not None else flask_module.prompt_tokens(api_messages)
+        _, rendered = await run_db(flask_module.save_answer, user_id, answer.text,
+                                   answer.assistant_message_id, conversation_id, prompt_cost, started)
+        await emit([answer.done(rendered)])
+    except Exception as e:
+        logging.error(f"Error streaming response: {e}")
+        metrics.errors.inc(stage="stream")
+        await emit([answer.error()])
+    finally:
+        # Not left to the garbage collector: that would hold the upstream connection and slot
+        if texts is not None:
+            await texts.aclose()
+        if upstream is not None:
+            await upstream.aclose()
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def observed(handler, scope, receive, send, user_id):
+    # Same request histogram and Server-Timing header as the Flask hooks
+    started = time.perf_counter()
+    metrics.begin_request()
+
+    async def send_observed(message):
+        if message["type"] == "http.response.start":
+            elapsed = time.perf_counter() - started
+            metrics.request_seconds.observe(elapsed, endpoint=scope["path"], method=scope["method"],
+                                            status=message["status"])
+            if metrics.SERVER_TIMING:
+                headers = list(message["headers"])
+                headers.append((b"server-timing", metrics.server_timing(elapsed).encode()))
+                message = dict(message, headers=headers)
+        await send(message)
+
+    await handler(scope, receive, send_observed, user_id)
+
+
+async def send_asset(scope, send):
+    # Built assets are answered on the loop from memory, without a WSGI thread
+    headers = dict(scope.get("headers") or [])
+    name = scope["path"][len("/static/dist/"):]
+    found = flask_module.built_assets.read(name, headers.get(b"accept-encoding", b"").decode("latin-1"))
+    if found is None:
+        return await send_json(send, 404, {"error": "Not found"})
+    body, encoding, content_type = found
+    response_headers = [
+        (b"content-type", content_type.encode()),
+        (b"content-length", str(len(body)).encode()),
+        (b"cache-control", assets.IMMUTABLE_CACHE_CONTROL.encode()),
+        (b"vary", b"Accept-Encoding"),
+    ]
+    if encoding:
+        response_headers.append((b"content-encoding", encoding.encode()))
+    await send({"type": "http.response.start", "status": 200, "headers": response_headers})
+    await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else body})
+
+
+ASYNC_ROUTES = {
+    "/process-input": process_input,
+    "/process-input/stream": process_input_stream,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            loop = asyncio.get_running_loop()
+            loop.set_default_executor(ThreadPoolExecutor(ASGI_DB_THREADS, thread_name_prefix="db"))
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            db.close_pools()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    if (scope["type"] == "http" and scope["method"] in ("GET", "HEAD")
+            and scope["path"].startswith("/static/dist/")):
+        return await send_asset(scope, send)
+
+    handler = ASYNC_ROUTES.get(scope["path"])
+    if scope["type"] == "http" and scope["method"] == "POST" and handler:
+        # Visitors without a session yet go through Flask, which creates it
+        user_id = session_user_id(scope)
+        if user_id:
+            send = with_cors(scope, send)
+            # Resolved like app.resolve_center, off the loop as it may reload the
+            # configuration; activated here, so that every run_db call inherits it
+            headers = dict(scope.get("headers") or [])
+            try:
+                center = await run_db(
+                    flask_module.centers.resolve,
+                    headers.get(b"host", b"").decode("latin-1"),
+                    headers.get(tenants.TENANT_HEADER.lower().encode(), b"").decode("latin-1") or None,
+                    headers.get(tenants.TENANT_SECRET_HEADER.lower().encode(), b"").decode("latin-1") or None
+                )
+            except tenants.UnknownCenter:
+                return await send_json(send, 404, {"error": "Unknown commercial center"})
+            tenants.activate(center)
+            return await observed(handler, scope, receive, send, user_id)
+
+    return await wsgi(scope, receive, send)
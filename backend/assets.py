@@ -0,0 +1,259 @@
+import os
+import re
+import sys
+import json
+import hashlib
+import logging
+import argparse
+import mimetypes
+import compression
+
+try:
+    import rjsmin
+    import rcssmin
+except ImportError:  # optional: the conservative minifiers below are used instead
+    rjsmin = rcssmin = None
+
+# Build step for frontend/static. Every file is minified (CSS, JS), renamed
+# with a hash of its content, and precompressed with gzip and, if the brotli
+# package is installed, brotli at their highest levels, into ASSETS_BUILD_DIR
+# with a manifest.json mapping source names to built ones. References to
+# other assets (/static/<name>) are rewritten first, so a changed image also
+# changes the hash of the stylesheet or script that points at it.
+#
+# A built name never changes content, so it is served with an immutable
+# one-year Cache-Control: browsers fetch each version once and never
+# revalidate, and repeat visits cost no worker at all. Templates link through
+# asset_url(), which falls back to the plain /static/ file when no build has
+# been run, as in development. Earlier builds are kept unless --prune is
+# given, so pages rendered before a deploy still find their assets.
+#
+#   python backend/assets.py            build into frontend/static/dist
+#   python backend/assets.py --prune    also delete files of earlier builds
+#
+# ASSETS_URL may point at a CDN or storage origin holding the build directory;
+# then the app serves no static traffic at all.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS_SOURCE_DIR = os.getenv("ASSETS_SOURCE_DIR", os.path.join(ROOT, "frontend", "static"))
+ASSETS_BUILD_DIR = os.getenv("ASSETS_BUILD_DIR", os.path.join(ASSETS_SOURCE_DIR, "dist"))
+ASSETS_URL = os.getenv("ASSETS_URL", "/static/dist/")
+ASSETS_MAX_AGE = 365 * 86400
+
+IMMUTABLE_CACHE_CONTROL = f"public, max-age={ASSETS_MAX_AGE}, immutable"
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".html", ".txt", ".map", ".ico"}
+SUFFIXES = {"br": "br", "gzip": "gz"}
+HASH_LENGTH = 12
+
+
+def minify_css(text):
+    if rcssmin is not None:
+        return rcssmin.cssmin(text)
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    text = re.sub(r"\s+", " ", text)
+    # Spaces before a colon are kept: ".a :hover" is not ".a:hover"
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    text = re.sub(r":\s+", ":", text)
+    return text.replace(";}", "}").strip()
+
+
+def minify_js(text):
+    """Drops comments, indentation and blank lines; strings and templates are kept as is.
+
+    Line breaks stay, so automatic semicolon insertion sees the same code.
+    Returns the text unchanged if its quotes do not balance, e.g. because a
+    regex literal holds one.
+    """
+    if rjsmin is not None:
+        return rjsmin.jsmin(text)
+    out, line = [], []
+    state, i, n = "code", 0, len(text)
+    while i < n:
+        c = text[i]
+        pair = text[i:i + 2]
+        if state == "code":
+            if pair == "//":
+                end = text.find("\n", i)
+                i = n if end < 0 else end
+                continue
+            if pair == "/*":
+                end = text.find("*/", i + 2)
+                if end < 0:
+                    return text
+                i = end + 2
+                continue
+            if c == "\\":
+                line.append(text[i:i + 2])  # inside a regex literal
+                i += 2
+                continue
+            if c in "'\"`":
+                state = c
+            if c == "\n":
+                stripped = "".join(line).strip()
+                if stripped:
+                    out.append(stripped)
+                line = []
+            else:
+                line.append(c)
+            i += 1
+            continue
+        # Inside a string or template literal: copied verbatim, newlines included
+        if c == "\\":
+            line.append(text[i:i + 2])
+            i += 2
+            continue
+        if c == state:
+            state = "code"
+        elif c == "\n" and state != "`":
+            return text  # an unterminated quote: not something we parsed right
+        line.append(c)
+        i += 1
+    if state != "code":
+        return text
+    stripped = "".join(line).strip()
+    if stripped:
+        out.append(stripped)
+    # Lines inside template literals were joined into one "line" above and kept whole
+    return "\n".join(out) + "\n"
+
+
+MINIFIERS = {".css": minify_css, ".js": minify_js}
+
+
+def _order(names):
+    # Files that reference others (CSS, JS) come after everything they can reference
+    return sorted(names, key=lambda name: (os.path.splitext(name)[1] in MINIFIERS, name))
+
+
+def hashed_name(name, data):
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    base, ext = os.path.splitext(name)
+    return f"{base}.{digest}{ext}"
+
+
+def build(source_dir=ASSETS_SOURCE_DIR, build_dir=ASSETS_BUILD_DIR, url=ASSETS_URL, prune=False):
+    """Builds every file of source_dir; returns the manifest."""
+    os.makedirs(build_dir, exist_ok=True)
+    names = [
+        name for name in os.listdir(source_dir)
+        if os.path.isfile(os.path.join(source_dir, name)) and not name.startswith(".")
+    ]
+    manifest = {}
+    for name in _order(names):
+        with open(os.path.join(source_dir, name), "rb") as f:
+            data = f.read()
+        ext = os.path.splitext(name)[1].lower()
+        size = len(data)
+        if ext in MINIFIERS:
+            text = data.decode("utf-8")
+            for other, entry in manifest.items():
+                text = text.replace(f"/static/{other}", url + entry["file"])
+            data = MINIFIERS[ext](text).encode("utf-8")
+        built = hashed_name(name, data)
+        entry = {"file": built, "bytes": size, "minified": len(data), "encodings": {}}
+        _write(os.path.join(build_dir, built), data)
+        if ext in COMPRESSIBLE:
+            for encoding in compression.available():
+                compressed = compression.compress(data, encoding, level=11 if encoding == "br" else 9)
+                if len(compressed) < len(data):
+                    _write(os.path.join(build_dir, f"{built}.{SUFFIXES[encoding]}"), compressed)
+                    entry["encodings"][encoding] = len(compressed)
+        manifest[name] = entry
+        sizes = [f"{size} B", f"minified {len(data)} B"] + [f"{e} {b} B" for e, b in entry["encodings"].items()]
+        logging.info(f"{name} -> {built}: {', '.join(sizes)}")
+
+    # Replaced in one step, so a worker never reads half a manifest
+    path = os.path.join(build_dir, "manifest.json")
+    _write(path + ".tmp", json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+    os.replace(path + ".tmp", path)
+
+    if prune:
+        keep = {"manifest.json"}
+        for entry in manifest.values():
+            keep.add(entry["file"])
+            keep.update(f"{entry['file']}.{SUFFIXES[e]}" for e in entry["encodings"])
+        for name in os.listdir(build_dir):
+            if name not in keep:
+                os.remove(os.path.join(build_dir, name))
+                logging.info(f"pruned {name}")
+    return manifest
+
+
+def _write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+class Assets:
+    """The built assets of this deployment, read once from manifest.json."""
+
+    def __init__(self, build_dir=ASSETS_BUILD_DIR, url=ASSETS_URL):
+        self.build_dir = build_dir
+        self.url_prefix = url
+        self._manifest = None
+        self._files = {}  # built name -> (source name, encodings)
+        self._cache = {}  # (built name, encoding) -> bytes, for the ASGI server
+
+    def manifest(self):
+        if self._manifest is None:
+            try:
+                with open(os.path.join(self.build_dir, "manifest.json"), encoding="utf-8") as f:
+                    self._manifest = json.load(f)
+            except FileNotFoundError:
+                self._manifest = {}
+            self._files = {entry["file"]: (name, list(entry["encodings"])) for name, entry in self._manifest.items()}
+        return self._manifest
+
+    def url(self, name):
+        """URL of the built file for a source name, or None without a build."""
+        entry = self.manifest().get(name)
+        return self.url_prefix + entry["file"] if entry else None
+
+    def variant(self, built, accept_encoding):
+        """(path, encoding) of the best variant of a built file for a client, or None."""
+        self.manifest()
+        known = self._files.get(built)
+        if known is None:
+            return None
+        encoding = compression.negotiate(accept_encoding, known[1])
+        suffix = f".{SUFFIXES[encoding]}" if encoding else ""
+        return os.path.join(self.build_dir, built + suffix), encoding
+
+    def read(self, built, accept_encoding):
+        """(bytes, encoding, content type), held in memory after the first read; or None."""
+        found = self.variant(built, accept_encoding)
+        if found is None:
+            return None
+        path, encoding = found
+        key = (built, encoding)
+        if key not in self._cache:
+            with open(path, "rb") as f:
+                self._cache[key] = f.read()
+        return self._cache[key], encoding, content_type(built)
+
+    def snapshot(self):
+        manifest = self.manifest()
+        return {
+            "built": bool(manifest),
+            "url": self.url_prefix,
+            "files": {name: entry["file"] for name, entry in manifest.items()},
+        }
+
+
+def content_type(name):
+    mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if mimetype.startswith("text/") or mimetype == "application/javascript":
+        mimetype += "; charset=utf-8"
+    return mimetype
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(description="Minify, fingerprint and precompress frontend/static.")
+    parser.add_argument("--source", default=ASSETS_SOURCE_DIR)
+    parser.add_argument("--output", default=ASSETS_BUILD_DIR)
+    parser.add_argument("--url", default=ASSETS_URL, help="URL prefix the build is served from")
+    parser.add_argument("--prune", action="store_true", help="delete files of earlier builds")
+    args = parser.parse_args()
+    manifest = build(args.source, args.output, args.url, args.prune)
+    if not manifest:
+        sys.exit(f"No files in {args.source}")
@@ -0,0 +1,124 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from embeddings import normalize_text, dot
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1000))
+# Semantic tier: "off", "local" (hashing embedder) or "azure" (embedding deployment)
+RESPONSE_CACHE_SEMANTIC = os.getenv("RESPONSE_CACHE_SEMANTIC", "off").lower()
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", 0.92))
+RESPONSE_CACHE_KB_CHECK_INTERVAL = float(os.getenv("RESPONSE_CACHE_KB_CHECK_INTERVAL", 60))
+
+
+class ResponseCache:
+    """LRU + TTL cache of first-turn answers, scoped per commercial center.
+
+    Entries are keyed on the normalized question and the knowledge base
+    version of their center, so a knowledge base update invalidates them.
+    With an embedder, a miss on the exact key falls back to the most similar
+    cached question above the similarity threshold.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL,
+                 embedder=None, similarity=RESPONSE_CACHE_SIMILARITY,
+                 version_loader=None, version_check_interval=RESPONSE_CACHE_KB_CHECK_INTERVAL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embedder = embedder
+        self.similarity = similarity
+        self.version_loader = version_loader
+        self.version_check_interval = version_check_interval
+        self._entries = OrderedDict()  # (scope, normalized) -> (answer, expires_at, vector)
+        self._versions = {}  # scope -> (version, checked_at)
+        self._lock = threading.Lock()
+        self.stats = {
+            "exact_hits": 0,
+            "semantic_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+
+    def _scope_version(self, center_id):
+        now = time.monotonic()
+        cached = self._versions.get(center_id)
+        if cached and now - cached[1] < self.version_check_interval:
+            return cached[0]
+        version = self.version_loader(center_id) if self.version_loader else None
+        with self._lock:
+            previous = self._versions.get(center_id)
+            self._versions[center_id] = (version, now)
+            if previous and previous[0] != version:
+                self._drop_scope(center_id)
+        return version
+
+    def _drop_scope(self, center_id):
+        stale = [key for key in self._entries if key[0][0] == center_id]
+        for key in stale:
+            del self._entries[key]
+        self.stats["invalidations"] += len(stale)
+
+    def get(self, center_id, question):
+        scope = (center_id, self._scope_version(center_id))
+        normalized = normalize_text(question)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((scope, normalized))
+            if entry:
+                if entry[1] > now:
+                    self._entries.move_to_end((scope, normalized))
+                    self.stats["exact_hits"] += 1
+                    return entry[0]
+                del self._entries[(scope, normalized)]
+                self.stats["expirations"] += 1
+
+        if self.embedder is not None:
+            vector = self.embedder.embed([normalized])[0]
+            with self._lock:
+                best_key, best_score = None, self.similarity
+                for key, (answer, expires_at, other) in self._entries.items():
+                    if key[0] != scope or other is None or expires_at <= now:
+                        continue
+                    score = dot(vector, other)
+                    if score >= best_score:
+                        best_key, best_score = key, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.stats["semantic_hits"] += 1
+                    return self._entries[best_key][0]
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, center_id, question, answer):
+        scope = (center_id, self._scope_version(center_id))
+        normalized = normalize_text(question)
+        vector = self.embedder.embed([normalized])[0] if self.embedder is not None else None
+        with self._lock:
+            self._entries[(scope, normalized)] = (answer, time.monotonic() + self.ttl, vector)
+            self._entries.move_to_end((scope, normalized))
+            self.stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+            data["entries"] = len(self._entries)
+        hits = data["exact_hits"] + data["semantic_hits"]
+        lookups = hits + data["misses"]
+        data["hit_rate"] = hits / lookups if lookups else 0.0
+        data["semantic"] = RESPONSE_CACHE_SEMANTIC if self.embedder is not None else "off"
+        return data
@@ -0,0 +1,349 @@
+import os
+import json
+import fcntl
+import asyncio
+import hashlib
+import inspect
+import threading
+import time
+from embeddings import normalize_text
+
+# Single-flight for first-turn answers: concurrent requests asking the same
+# question (same center, same normalized text, no history) share one upstream
+# completion. The first request leads and makes the call; the others follow and
+# receive the same text deltas as they arrive, streamed or not. Every request
+# still saves its own messages.
+#
+# Flights are shared between the threads or coroutines of a worker. With
+# COALESCE_DIR set (ideally on tmpfs, e.g. /dev/shm/chatbot-flights), they are
+# also shared between workers: the leader holds an flock on a file named after
+# the question and appends each delta to it; followers in other workers tail it.
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+COALESCE_DIR = os.getenv("COALESCE_DIR", "")
+COALESCE_WAIT_TIMEOUT = float(os.getenv("COALESCE_WAIT_TIMEOUT", 120))
+COALESCE_POLL_INTERVAL = float(os.getenv("COALESCE_POLL_INTERVAL", 0.01))
+
+WAIT = object()  # yielded by followers when nothing new has arrived yet
+STARTED = object()  # yielded once by a leader that has called produce()
+
+
+class CoalescedError(Exception):
+    """The leader's upstream call failed; followers fail the same way."""
+
+
+class Abandoned(Exception):
+    """The leader stopped before finishing, e.g. its client disconnected."""
+
+
+async def aproduce(produce):
+    source = produce()
+    if inspect.isawaitable(source):
+        source = await source
+    return source
+
+
+def flight_key(scope, question):
+    return hashlib.sha256(f"{scope}\0{normalize_text(question)}".encode("utf-8")).hexdigest()[:32]
+
+
+class Flight:
+    """An answer in progress in this worker: the deltas so far and how it ended."""
+
+    def __init__(self):
+        self.parts = []
+        self.state = None  # None while running, then "done", "error" or "abandoned"
+        self.message = None
+        self.error = None  # the leader's exception, re-raised in followers of this worker
+        self._cond = threading.Condition()
+
+    def publish(self, text):
+        with self._cond:
+            self.parts.append(text)
+            self._cond.notify_all()
+
+    def finish(self, state="done", message=None, error=None):
+        with self._cond:
+            self.state, self.message, self.error = state, message, error
+            self._cond.notify_all()
+
+    def read(self, position):
+        with self._cond:
+            return self.parts[position:], self.state, self.message
+
+    def wait(self, timeout):
+        with self._cond:
+            if self.state is None:
+                self._cond.wait(timeout)
+
+
+class SharedFlight:
+    """An answer in progress in some worker, as an NDJSON file guarded by flock."""
+
+    def __init__(self, path, fd, leader):
+        self.path = path
+        self.fd = fd
+        self.leader = leader
+        self._buffer = b""
+        self._offset = 0
+
+    @classmethod
+    def join(cls, directory, key):
+        path = os.path.join(directory, f"{key}.flight")
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return cls(path, fd, leader=False)
+            # The previous leader may have unlinked the file while we waited for it
+            try:
+                if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                    os.ftruncate(fd, 0)
+                    return cls(path, fd, leader=True)
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _append(self, record):
+        os.write(self.fd, (json.dumps(record) + "\n").encode("utf-8"))
+
+    def publish(self, text):
+        self._append({"t": text})
+
+    def finish(self, state="done", message=None):
+        # Followers that already opened the file read it to the end; new ones start over
+        try:
+            self._append({"state": state, "message": message})
+            os.unlink(self.path)
+        finally:
+            self.close()
+
+    def read(self, position):
+        # Position is implied by what this reader has consumed so far
+        if os.fstat(self.fd).st_size < self._offset:
+            # Truncated by a new leader: whoever wrote what we read is gone
+            return [], "abandoned", "flight restarted"
+        data = os.pread(self.fd, 65536, self._offset)
+        self._offset += len(data)
+        lines = (self._buffer + data).split(b"\n")
+        self._buffer = lines.pop()
+        parts = []
+        for line in lines:
+            record = json.loads(line)
+            if "t" in record:
+                parts.append(record["t"])
+            else:
+                return parts, record["state"], record["message"]
+        if not data and self._leader_gone():
+            # Read once more: the leader may have finished between the two checks
+            data = os.pread(self.fd, 65536, self._offset)
+            if not data:
+                return parts, "abandoned", "leader exited"
+        return parts, None, None
+
+    def _leader_gone(self):
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return True
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Coalescer:
+    """Joins identical in-flight first-turn completions and counts how often."""
+
+    def __init__(self, shared_dir=COALESCE_DIR, wait_timeout=COALESCE_WAIT_TIMEOUT,
+                 poll_interval=COALESCE_POLL_INTERVAL):
+        self.shared_dir = shared_dir
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._flights = {}  # key -> Flight led by this worker
+        self._lock = threading.Lock()
+        self.stats = {
+            "leaders": 0,
+            "local_followers": 0,
+            "shared_followers": 0,
+            "fallbacks": 0,
+            "failures": 0,
+        }
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _join(self, key):
+        # Returns (flight, leads_locally, shared flight or None)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.stats["local_followers"] += 1
+                return flight, False, None
+            flight = self._flights[key] = Flight()
+        shared = None
+        if self.shared_dir:
+            try:
+                os.makedirs(self.shared_dir, exist_ok=True)
+                shared = SharedFlight.join(self.shared_dir, key)
+            except OSError:
+                shared = None
+        if shared is None or shared.leader:
+            self._count("leaders")
+        else:
+            self._count("shared_followers")
+        return flight, True, shared
+
+    def _leave(self, key, flight, shared, state, message=None, error=None):
+        flight.finish(state, message, error)
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        if shared is not None:
+            if shared.leader:
+                shared.finish(state, message)
+            else:
+                shared.close()
+        if state != "done":
+            self._count("failures")
+
+    def _follow(self, flight):
+        # Yields deltas, or WAIT when the caller should sleep before asking again
+        position = 0
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            parts, state, message = flight.read(position)
+            if parts:
+                position += len(parts)
+                deadline = time.monotonic() + self.wait_timeout
+                yield from parts
+            if state == "done":
+                return
+            if state == "error":
+                raise getattr(flight, "error", None) or CoalescedError(message)
+            if state == "abandoned":
+                raise Abandoned(message)
+            if time.monotonic() > deadline:
+                raise Abandoned(f"no progress for {self.wait_timeout}s")
+            yield WAIT
+
+    def stream(self, scope, question, produce):
+        """Returns the answer's text deltas, from produce() or an identical call in flight.
+
+        `produce()` returns an iterator of text deltas and is only called by the
+        leader, or by a follower whose leader gave up before sending anything.
+        The leader calls it before this returns, so that admission errors
+        (dispatch.Overloaded) reach the caller before it starts a response.
+        """
+        key = flight_key(scope, question)
+        flight, leads, shared = self._join(key)
+        if not leads:
+            return self._follow_sync(flight, produce)
+        lead = self._lead(key, flight, shared, produce)
+        next(lead)
+        return lead
+
+    def _lead(self, key, flight, shared, produce):
+        try:
+            source = produce() if shared is None or shared.leader else self._follow_sync(shared, produce)
+            yield STARTED
+            for text in source:
+                if not text:
+                    continue
+                flight.publish(text)
+                if shared is not None and shared.leader:
+                    shared.publish(text)
+                yield text
+        except GeneratorExit:
+            self._leave(key, flight, shared, "abandoned", "leader stopped")
+            raise
+        except Exception as e:
+            self._leave(key, flight, shared, "error", str(e), e)
+            raise
+        self._leave(key, flight, shared, "done")
+
+    def _follow_sync(self, flight, produce):
+        received = False
+        try:
+            for text in self._follow(flight):
+                if text is WAIT:
+                    flight.wait(self.poll_interval)
+                    continue
+                received = True
+                yield text
+        except Abandoned:
+            if received:
+                raise
+            # Nothing was sent yet, so this request can still make its own call
+            self._count("fallbacks")
+            yield from produce()
+
+    async def astream(self, scope, question, produce):
+        """Async variant of stream(); `produce()` returns an async iterator, or a coroutine of one."""
+        key = flight_key(scope, question)
+        flight, leads, shared = self._join(key)
+        if not leads:
+            return self._follow_async(flight, produce)
+        lead = self._alead(key, flight, shared, produce)
+        await lead.__anext__()
+        return lead
+
+    async def _alead(self, key, flight, shared, produce):
+        source = None
+        try:
+            if shared is None or shared.leader:
+                source = await aproduce(produce)
+            else:
+                source = self._follow_async(shared, produce)
+            yield STARTED
+            async for text in source:
+                if not text:
+                    continue
+                flight.publish(text)
+                if shared is not None and shared.leader:
+                    shared.publish(text)
+                yield text
+        except (GeneratorExit, asyncio.CancelledError):
+            self._leave(key, flight, shared, "abandoned", "leader stopped")
+            # Closes the upstream stream now rather than when the generator is collected
+            if source is not None:
+                await source.aclose()
+            raise
+        except Exception as e:
+            self._leave(key, flight, shared, "error", str(e), e)
+            raise
+        self._leave(key, flight, shared, "done")
+
+    async def _follow_async(self, flight, produce):
+        received = False
+        try:
+            for text in self._follow(flight):
+                if text is WAIT:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                received = True
+                yield text
+        except Abandoned:
+            if received:
+                raise
+            self._count("fallbacks")
+            async for text in await aproduce(produce):
+                yield text
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+            data["in_flight"] = len(self._flights)
+        followers = data["local_followers"] + data["shared_followers"]
+        requests = data["leaders"] + followers
+        # Share of coalescable requests that did not cost an upstream call
+        data["coalescing_ratio"] = (followers - data["fallbacks"]) / requests if requests else 0.0
+        data["shared"] = bool(self.shared_dir)
+        return data
@@ -0,0 +1,103 @@
+import os
+import gzip
+import threading
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only without it
+    brotli = None
+
+# Content-Encoding negotiation, shared by the asset build (assets.py), which
+# compresses once at the highest levels, and by responses compressed on the
+# fly, which use cheaper levels. Only JSON, HTML and markdown bodies of at
+# least COMPRESS_MIN_BYTES are compressed on the fly: below that the headers
+# and CPU cost more than the bytes saved. Streamed bodies are left alone.
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "true").lower() == "true"
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", 6))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", 4))
+COMPRESS_MIMETYPES = {"application/json", "text/html", "text/markdown"}
+
+
+def available():
+    # Most preferred first
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def negotiate(accept_encoding, offered=None):
+    """The best of `offered` the Accept-Encoding header allows, or None for identity."""
+    offered = available() if offered is None else offered
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.lower()] = quality
+    best, best_quality = None, 0.0
+    for coding in offered:
+        quality = accepted.get(coding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress(data, encoding, level=None):
+    if encoding == "br":
+        return brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY if level is None else level)
+    # mtime=0 keeps the output identical for identical input
+    return gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL if level is None else level, mtime=0)
+
+
+class ResponseCompressor:
+    """Compresses eligible Flask responses in place, per Accept-Encoding."""
+
+    def __init__(self, min_bytes=COMPRESS_MIN_BYTES, mimetypes=COMPRESS_MIMETYPES):
+        self.min_bytes = min_bytes
+        self.mimetypes = mimetypes
+        self._lock = threading.Lock()
+        self.stats = {"compressed": 0, "skipped_small": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def apply(self, response, accept_encoding):
+        if (response.direct_passthrough or response.is_streamed
+                or response.mimetype not in self.mimetypes
+                or "Content-Encoding" in response.headers
+                or response.status_code < 200 or response.status_code in (204, 304)):
+            return response
+        response.vary.add("Accept-Encoding")
+        data = response.get_data()
+        if len(data) < self.min_bytes:
+            with self._lock:
+                self.stats["skipped_small"] += 1
+            return response
+        encoding = negotiate(accept_encoding)
+        if encoding is None:
+            return response
+        compressed = compress(data, encoding)
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            # Byte-for-byte different, semantically the same: weak, as nginx does, so
+            # If-None-Match still matches the identity tag make_conditional() compares
+            response.set_etag(etag, weak=True)
+        with self._lock:
+            self.stats["compressed"] += 1
+            self.stats["bytes_in"] += len(data)
+            self.stats["bytes_out"] += len(compressed)
+        return response
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+        data["ratio"] = data["bytes_in"] / data["bytes_out"] if data["bytes_out"] else None
+        data["encodings"] = available()
+        data["min_bytes"] = self.min_bytes
+        return data
@@ -0,0 +1,98 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", 50))
+CONTEXT_SUMMARY = os.getenv("CONTEXT_SUMMARY", "false").lower() == "true"
+CONTEXT_SUMMARY_MIN_MESSAGES = int(os.getenv("CONTEXT_SUMMARY_MIN_MESSAGES", 6))
+CONTEXT_SUMMARY_MAX_USERS = int(os.getenv("CONTEXT_SUMMARY_MAX_USERS", 5000))
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+
+# Every chat message carries a few tokens of framing on top of its content
+MESSAGE_OVERHEAD = 4
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+except Exception:
+    _encoding = None
+
+# Fallback estimate: words, numbers and single punctuation marks, long words split
+TOKEN_PATTERN = re.compile(r"\w{1,6}|[^\w\s]")
+
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(TOKEN_PATTERN.findall(text))
+
+
+class ContextBuilder:
+    """Picks the most recent turns that fit in a token budget.
+
+    With a summarizer, summarizer(previous_summary, turns, user_id), turns that
+    fall out of the window are folded into a rolling per-user summary that is
+    cached and only extended once enough new turns have dropped out.
+    """
+
+    def __init__(self, budget=CONTEXT_TOKEN_BUDGET, summarizer=None,
+                 summary_min_messages=CONTEXT_SUMMARY_MIN_MESSAGES,
+                 max_users=CONTEXT_SUMMARY_MAX_USERS):
+        self.budget = budget
+        self.summarizer = summarizer
+        self.summary_min_messages = summary_min_messages
+        self.max_users = max_users
+        self._summaries = OrderedDict()  # user_id -> (summary, last folded message_id)
+        self._lock = threading.Lock()
+
+    def build(self, system_prompt, history, user_input, user_id=None):
+        # history: earlier messages in chronological order, without the current turn
+        turns = [
+            {"role": msg["role"], "content": msg["content"],
+             "message_id": msg.get("message_id")}
+            for msg in history if msg["role"] in ["user", "assistant"]
+        ]
+
+        used = count_tokens(system_prompt) + count_tokens(user_input) + 2 * MESSAGE_OVERHEAD
+        start = len(turns)
+        while start > 0:
+            cost = count_tokens(turns[start - 1]["content"]) + MESSAGE_OVERHEAD
+            if used + cost > self.budget:
+                break
+            used += cost
+            start -= 1
+        window, dropped = turns[start:], turns[:start]
+
+        messages = [{"role": "system", "content": system_prompt}]
+        summary = self._summary(user_id, dropped) if dropped and self.summarizer else None
+        if summary:
+            messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {summary}"
+            })
+        messages += [{"role": t["role"], "content": t["content"]} for t in window]
+        messages.append({"role": "user", "content": user_input})
+        return messages
+
+    def _summary(self, user_id, dropped):
+        with self._lock:
+            summary, folded_until = self._summaries.get(user_id, (None, None))
+
+        ids = [t["message_id"] for t in dropped]
+        pending = dropped[ids.index(folded_until) + 1:] if folded_until in ids else dropped
+        if len(pending) < self.summary_min_messages:
+            return summary
+
+        summary = self.summarizer(summary, pending, user_id)
+        with self._lock:
+            self._summaries[user_id] = (summary, dropped[-1]["message_id"])
+            self._summaries.move_to_end(user_id)
+            while len(self._summaries) > self.max_users:
+                self._summaries.popitem(last=False)
+        return summary
+
+    def forget(self, user_id):
+        with self._lock:
+            self._summaries.pop(user_id, None)
@@ -0,0 +1,290 @@
+import os
+import sqlite3
+import threading
+import time
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+
+# Backend selection: "mssql" (Azure SQL through pyodbc) or "sqlite" for local runs
+DB_BACKEND = os.getenv("DB_BACKEND", "mssql").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "chatbot.db")
+
+# Azure SQL Database configuration
+DB_CONFIG = {
+    'server': os.getenv('AZURE_SQL_SERVER'),
+    'database': os.getenv('AZURE_SQL_DATABASE'),
+    'username': os.getenv('AZURE_SQL_USERNAME'),
+    'password': os.getenv('AZURE_SQL_PASSWORD'),
+    'driver': '{ODBC Driver 18 for SQL Server}'
+}
+
+# Pool configuration
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", 1800))
+POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", 30))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def connect_mssql():
+    # Imported here so the sqlite backend works on hosts without an ODBC driver
+    import pyodbc
+
+    conn_str = (
+        f"Driver={DB_CONFIG['driver']};"
+        f"Server=tcp:{DB_CONFIG['server']},1433;"
+        f"Database={DB_CONFIG['database']};"
+        f"Uid={DB_CONFIG['username']};"
+        f"Pwd={DB_CONFIG['password']};"
+        "Encrypt=yes;TrustServerCertificate=no;"
+        "Connection Timeout=30;"
+    )
+    return pyodbc.connect(conn_str)
+
+
+def connect_sqlite():
+    # Pooled connections are handed between threads, never shared concurrently
+    conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA journal_mode = WAL")
+    return conn
+
+
+class ConnectionPool:
+    """Bounded pool of DB-API connections with health checks on checkout."""
+
+    def __init__(self, connect, max_size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                 recycle=POOL_RECYCLE, ping_after=POOL_PING_AFTER):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._idle = deque()  # (conn, created_at, last_used)
+        self._size = 0
+        self._cond = threading.Condition()
+        self.pid = os.getpid()
+        self.stats = {
+            "connects": 0,
+            "checkouts": 0,
+            "reuses": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "ping_failures": 0,
+            "recycled": 0,
+            "discarded": 0,
+            "connect_seconds": 0.0,
+        }
+
+    def _open(self):
+        start = time.perf_counter()
+        conn = self._connect()
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            self.stats["connects"] += 1
+            self.stats["connect_seconds"] += elapsed
+        return conn
+
+    def _is_alive(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        wait_start = time.monotonic()
+        self._count("checkouts")
+        while True:
+            with self._cond:
+                if self._idle:
+                    conn, created_at, last_used = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                    conn = None
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection available after {self.timeout}s"
+                        )
+                    if not waited:
+                        self.stats["waits"] += 1
+                        waited = True
+                    self._cond.wait(remaining)
+                    continue
+            if waited:
+                with self._cond:
+                    self.stats["wait_seconds"] += time.monotonic() - wait_start
+
+            if conn is None:
+                try:
+                    return self._open(), time.monotonic()
+                except Exception:
+                    self._release_slot()
+                    raise
+
+            now = time.monotonic()
+            if now - created_at > self.recycle:
+                self._close_quietly(conn)
+                self._count("recycled")
+            elif now - last_used > self.ping_after and not self._is_alive(conn):
+                self._close_quietly(conn)
+                self._count("ping_failures")
+            else:
+                self._count("reuses")
+                return conn, created_at
+            # Replace the stale connection without giving up the slot
+            try:
+                return self._open(), time.monotonic()
+            except Exception:
+                self._release_slot()
+                raise
+
+    def release(self, conn, created_at, broken=False):
+        if broken:
+            self._close_quietly(conn)
+            self._count("discarded")
+            self._release_slot()
+            return
+        with self._cond:
+            self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _count(self, key):
+        with self._cond:
+            self.stats[key] += 1
+
+    def resize(self, max_size):
+        # Applies to the next checkouts; connections already open are kept
+        with self._cond:
+            self.max_size = max_size
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                conn, _, _ = self._idle.pop()
+                self._close_quietly(conn)
+                self._size -= 1
+
+    def snapshot(self):
+        with self._cond:
+            data = dict(self.stats)
+            data.update({
+                "pid": self.pid,
+                "backend": DB_BACKEND,
+                "max_size": self.max_size,
+                "open": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+            })
+        return data
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+# The pool connection() draws from: (name, max_size), or the default pool if unset
+_pool_choice = contextvars.ContextVar("db_pool", default=None)
+
+
+def get_pool(name="default", max_size=POOL_SIZE):
+    # Connections must never cross a fork, so each worker builds its own pools
+    pool = _pools.get(name)
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = _pools.get(name)
+            if pool is None or pool.pid != os.getpid():
+                connect = connect_sqlite if DB_BACKEND == "sqlite" else connect_mssql
+                pool = _pools[name] = ConnectionPool(connect, max_size=max_size)
+    if pool.max_size != max_size:
+        pool.resize(max_size)
+    return pool
+
+
+def use_pool(name, max_size):
+    """Sends this request's connection() calls to a separate, named pool."""
+    _pool_choice.set((name, max_size))
+
+
+@contextmanager
+def connection():
+    pool = get_pool(*(_pool_choice.get() or ()))
+    with metrics.span("db_acquire"):
+        conn, created_at = pool.acquire()
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
+        raise
+    finally:
+        pool.release(conn, created_at, broken=broken)
+
+
+@contextmanager
+def dedicated_connection():
+    # Outside the pool, for long reads such as exports that would otherwise hold a slot
+    conn = connect_sqlite() if DB_BACKEND == "sqlite" else connect_mssql()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def pool_stats():
+    return get_pool().snapshot()
+
+
+def all_pool_stats():
+    # name -> snapshot, for the pools this worker has opened
+    return {name: pool.snapshot() for name, pool in list(_pools.items()) if pool.pid == os.getpid()}
+
+
+def close_pools():
+    for pool in list(_pools.values()):
+        if pool.pid == os.getpid():
+            pool.close()
+
+
+def executemany(cursor, sql, rows):
+    if DB_BACKEND == "mssql":
+        # Sends all parameter rows in one round trip instead of one per row
+        cursor.fast_executemany = True
+    cursor.executemany(sql, rows)
+
+
+def limit_clause():
+    # Row limiting differs between T-SQL and SQLite; both take the limit as a parameter
+    if DB_BACKEND == "sqlite":
+        return "LIMIT ?"
+    return "OFFSET 0 ROWS FETCH NEXT ? ROWS ONLY"
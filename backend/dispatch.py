@@ -0,0 +1,526 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+import context
+import llm
+
+# Admission control and failover for chat completions. A request first needs a
+# slot: at most LLM_MAX_CONCURRENCY calls in flight per worker and
+# LLM_MAX_PER_USER per user. Requests without a slot wait in a queue of
+# LLM_QUEUE_SIZE for up to LLM_QUEUE_TIMEOUT seconds; beyond that they are shed
+# with Overloaded, which the routes turn into a 503 with Retry-After.
+#
+# An admitted request goes to one of the configured deployments (see
+# llm.deployment_configs), chosen at random weighted by inverse observed latency
+# among those whose circuit is closed, that are not cooling down after a 429, and
+# whose token bucket can cover the prompt plus max_tokens. Buckets are refilled
+# from each deployment's "tpm"/"rpm"; set LLM_BUDGET_WORKERS to the number of
+# workers sharing them, since every worker keeps its own. Throttled and failed
+# calls are retried on another deployment straight away when one is free, or
+# after a jittered backoff that is never shorter than the Retry-After received.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 32))
+LLM_MAX_PER_USER = int(os.getenv("LLM_MAX_PER_USER", 2))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", 64))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 10))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+LLM_RETRY_BASE = float(os.getenv("LLM_RETRY_BASE", 0.5))
+LLM_RETRY_MAX = float(os.getenv("LLM_RETRY_MAX", 10))
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", 5))
+LLM_CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", 30))
+LLM_BUDGET_WORKERS = int(os.getenv("LLM_BUDGET_WORKERS", 1))
+
+LATENCY_DECAY = 0.2  # weight of the newest sample in the latency average
+RETRYABLE_ERRORS = ("APITimeoutError", "APIConnectionError", "TimeoutError", "ConnectionError")
+
+
+class Overloaded(Exception):
+    """No capacity for this request now; the client should retry after `retry_after` seconds."""
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Refills `per_minute` units evenly over a minute, holding at most a minute's worth."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        # A request larger than the whole bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class Deployment:
+    """One endpoint/deployment pair: its budget, latency and circuit state."""
+
+    def __init__(self, config):
+        self.config = config
+        self.name = config["name"]
+        share = max(1, LLM_BUDGET_WORKERS)
+        self.tokens = TokenBucket(config["tpm"] / share) if config.get("tpm") else None
+        self.requests = TokenBucket(config["rpm"] / share) if config.get("rpm") else None
+        self.latency = None  # moving average of seconds to response headers
+        self.state = "closed"  # "open" after repeated failures, "half_open" while probing
+        self.failures = 0
+        self.opened_at = 0.0
+        self.cooling_until = 0.0  # set from Retry-After
+        self.in_flight = 0
+        self.stats = {"calls": 0, "errors": 0, "rate_limited": 0, "circuit_opens": 0}
+        self._clients = {}
+        self._client_lock = threading.Lock()
+
+    def client(self, kind="sync"):
+        # One client per process, so that its connection pool is reused across calls
+        key = (kind, os.getpid())
+        if key not in self._clients:
+            with self._client_lock:
+                if key not in self._clients:
+                    self._clients[key] = llm.create_deployment_client(self.config, kind)
+        return self._clients[key]
+
+    def params(self, messages, stream, grounding=None, options=None):
+        params = llm.completion_params(messages, stream=stream, grounding=grounding, **(options or {}))
+        params["model"] = self.config.get("deployment") or params["model"]
+        return params
+
+    def wait_time(self, estimate, now):
+        # Seconds until this deployment could take the request; 0 if it can now
+        if self.state == "open":
+            if now - self.opened_at < LLM_CIRCUIT_COOLDOWN:
+                return self.opened_at + LLM_CIRCUIT_COOLDOWN - now
+        elif self.state == "half_open":
+            return LLM_CIRCUIT_COOLDOWN  # one probe at a time
+        wait = max(0.0, self.cooling_until - now)
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(estimate, now))
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        return wait
+
+    def reserve(self, estimate, now):
+        if self.state == "open":
+            self.state = "half_open"
+        if self.tokens is not None:
+            self.tokens.take(estimate, now)
+        if self.requests is not None:
+            self.requests.take(1, now)
+        self.in_flight += 1
+        self.stats["calls"] += 1
+
+    def weight(self, default_latency):
+        return 1.0 / max(self.latency if self.latency is not None else default_latency, 0.01)
+
+    def succeeded(self, elapsed):
+        self.in_flight -= 1
+        self.latency = elapsed if self.latency is None else (
+            LATENCY_DECAY * elapsed + (1 - LATENCY_DECAY) * self.latency
+        )
+        self.state = "closed"
+        self.failures = 0
+
+    def failed(self, estimate, retry_after=None, now=None):
+        # Neither throttled nor failed calls are billed
+        self.in_flight -= 1
+        if self.tokens is not None:
+            self.tokens.refund(estimate)
+        if retry_after is not None:
+            # Throttling says nothing about health: cool down, keep the circuit closed
+            self.stats["rate_limited"] += 1
+            self.cooling_until = max(self.cooling_until, now + retry_after)
+            if self.state == "half_open":
+                self.state = "open"
+            return
+        self.stats["errors"] += 1
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= LLM_CIRCUIT_FAILURES:
+            if self.state != "open":
+                self.stats["circuit_opens"] += 1
+                logging.warning(f"Circuit opened for LLM deployment {self.name}")
+            self.state = "open"
+            self.opened_at = now
+
+    def rejected(self, estimate):
+        # A 400 or a content filter: the deployment answered, so a probe closes the circuit
+        self.in_flight -= 1
+        if self.tokens is not None:
+            self.tokens.refund(estimate)
+        if self.state == "half_open":
+            self.state = "closed"
+            self.failures = 0
+
+    def settle(self, estimate, used):
+        # The reservation assumed max_tokens would all be generated
+        if self.tokens is not None and used is not None:
+            self.tokens.refund(max(0, estimate - used))
+
+    def snapshot(self, now):
+        data = dict(self.stats)
+        data.update({
+            "name": self.name,
+            "state": self.state,
+            "latency_ms": self.latency * 1000 if self.latency is not None else None,
+            "in_flight": self.in_flight,
+            "cooling_s": max(0.0, self.cooling_until - now),
+            "tokens_available": self.tokens.tokens if self.tokens is not None else None,
+        })
+        return data
+
+
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value) * scale
+            except ValueError:
+                pass  # HTTP-date form; fall back to backoff
+    return None
+
+
+def classify(error):
+    # "throttled" (429), "failed" (worth another try, counts against the circuit) or "fatal"
+    status = getattr(error, "status_code", None)
+    if status == 429:
+        return "throttled"
+    if status in (408, 409) or (status is not None and status >= 500):
+        return "failed"
+    if status is None and any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__):
+        return "failed"
+    return "fatal"
+
+
+def estimate_tokens(messages, max_tokens=None):
+    return sum(context.count_tokens(m["content"]) for m in messages) + (max_tokens or llm.MAX_TOKENS)
+
+
+class Dispatcher:
+    """Admits, places and retries chat completions across deployments."""
+
+    def __init__(self, configs=None, max_concurrency=LLM_MAX_CONCURRENCY, max_per_user=LLM_MAX_PER_USER,
+                 queue_size=LLM_QUEUE_SIZE, queue_timeout=LLM_QUEUE_TIMEOUT, max_retries=LLM_MAX_RETRIES):
+        self.deployments = [Deployment(config) for config in (configs or llm.deployment_configs())]
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self._active = 0
+        self._per_user = {}
+        self._queue = deque()  # [user_id] tickets in arrival order
+        self._cond = threading.Condition()
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "shed": 0,
+            "retries": 0,
+            "failovers": 0,
+            "exhausted": 0,
+        }
+
+    # Each step below is a generator that yields how long to wait before it is
+    # resumed, so that complete() can sleep on a condition and acomplete() on the
+    # event loop.
+
+    def _next_eligible(self):
+        # First queued request whose user is under the per-user limit; FIFO otherwise
+        for ticket in self._queue:
+            if self._per_user.get(ticket[0], 0) < self.max_per_user:
+                return ticket
+        return None
+
+    def _admit(self, user_id):
+        deadline = time.monotonic() + self.queue_timeout
+        ticket = None
+        try:
+            while True:
+                with self._cond:
+                    free = self._active < self.max_concurrency and self._per_user.get(user_id, 0) < self.max_per_user
+                    # New arrivals do not overtake requests already waiting
+                    if free and (self._next_eligible() is ticket if ticket else not self._queue):
+                        if ticket:
+                            self._queue.remove(ticket)
+                            ticket = None
+                        self._active += 1
+                        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+                        self.stats["admitted"] += 1
+                        return
+                    if ticket is None:
+                        if len(self._queue) >= self.queue_size:
+                            self.stats["shed"] += 1
+                            raise Overloaded("LLM queue is full", retry_after=1.0)
+                        ticket = [user_id]
+                        self._queue.append(ticket)
+                        self.stats["queued"] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self._cond:
+                        self.stats["shed"] += 1
+                    raise Overloaded("Timed out waiting for an LLM slot", retry_after=self.queue_timeout)
+                yield remaining
+        finally:
+            if ticket is not None:
+                with self._cond:
+                    self._queue.remove(ticket)
+                    self._cond.notify_all()
+
+    def _release(self, user_id):
+        with self._cond:
+            self._active -= 1
+            remaining = self._per_user.get(user_id, 1) - 1
+            if remaining:
+                self._per_user[user_id] = remaining
+            else:
+                self._per_user.pop(user_id, None)
+            self._cond.notify_all()
+
+    def _place(self, estimate, tried):
+        # Returns a deployment with the request's budget reserved
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            now = time.monotonic()
+            with self._cond:
+                ready, soonest = [], None
+                for deployment in self.deployments:
+                    wait = deployment.wait_time(estimate, now)
+                    if wait <= 0:
+                        ready.append(deployment)
+                    elif soonest is None or wait < soonest:
+                        soonest = wait
+                # Prefer deployments this request has not failed on yet
+                fresh = [d for d in ready if d not in tried] or ready
+                if fresh:
+                    known = [d.latency for d in self.deployments if d.latency is not None]
+                    default = min(known) if known else 1.0  # unmeasured deployments get a fair try
+                    deployment = random.choices(fresh, [d.weight(default) for d in fresh])[0]
+                    deployment.reserve(estimate, now)
+                    return deployment
+            if soonest is None or now + soonest > deadline:
+                with self._cond:
+                    self.stats["shed"] += 1
+                raise Overloaded("No LLM deployment has capacity", retry_after=soonest or 1.0)
+            yield soonest
+
+    def _failed(self, deployment, estimate, error, attempt):
+        # Returns the delay before the next attempt, or raises
+        kind = classify(error)
+        retry_after = retry_after_seconds(error) if kind == "throttled" else None
+        now = time.monotonic()
+        with self._cond:
+            if kind == "throttled":
+                deployment.failed(estimate, retry_after if retry_after is not None else LLM_RETRY_BASE, now)
+            elif kind == "failed":
+                deployment.failed(estimate, now=now)
+            else:
+                deployment.rejected(estimate)
+            if kind == "fatal":
+                raise error
+            if attempt >= self.max_retries:
+                self.stats["exhausted"] += 1
+                if kind == "throttled":
+                    raise Overloaded("LLM deployments are throttling", retry_after=retry_after or 1.0) from error
+                raise error
+            self.stats["retries"] += 1
+            if any(d.wait_time(estimate, now) <= 0 for d in self.deployments if d is not deployment):
+                self.stats["failovers"] += 1
+                return 0.0
+        # Full jitter, but never earlier than the deployment asked for
+        backoff = random.uniform(0, min(LLM_RETRY_MAX, LLM_RETRY_BASE * 2 ** attempt))
+        if retry_after is not None:
+            if retry_after > LLM_RETRY_MAX:
+                raise Overloaded("LLM deployments are throttling", retry_after=retry_after) from error
+            backoff = max(backoff, retry_after * random.uniform(1.0, 1.2))
+        return backoff
+
+    def _succeeded(self, deployment, started):
+        with self._cond:
+            deployment.succeeded(time.monotonic() - started)
+
+    def _settle(self, deployment, estimate, used, user_id):
+        with self._cond:
+            deployment.settle(estimate, used)
+        self._release(user_id)
+
+    def _wait(self, steps):
+        try:
+            while True:
+                delay = next(steps)
+                with self._cond:
+                    self._cond.wait(delay)
+        except StopIteration as stop:
+            return stop.value
+
+    async def _await(self, steps):
+        try:
+            while True:
+                await asyncio.sleep(min(next(steps), 0.05))
+        except StopIteration as stop:
+            return stop.value
+
+    def complete(self, user_id, messages, stream=False, grounding=None, **options):
+        """Like client.chat.completions.create(), through admission, placement and retries.
+
+        `options` go to llm.completion_params, e.g. llm.SUMMARY_OPTIONS.
+        """
+        estimate = estimate_tokens(messages, options.get("max_tokens"))
+        self._wait(self._admit(user_id))
+        try:
+            tried = set()
+            for attempt in range(self.max_retries + 1):
+                deployment = self._wait(self._place(estimate, tried))
+                started = time.monotonic()
+                try:
+                    response = deployment.client().chat.completions.create(**deployment.params(messages, stream, grounding, options))
+                except Exception as e:
+                    tried.add(deployment)
+                    delay = self._failed(deployment, estimate, e, attempt)
+                    if delay:
+                        time.sleep(delay)
+                    continue
+                self._succeeded(deployment, started)
+                break
+        except BaseException:
+            self._release(user_id)
+            raise
+        if stream:
+            return Stream(self, deployment, estimate, user_id, response)
+        self._settle(deployment, estimate, getattr(response.usage, "total_tokens", None), user_id)
+        return response
+
+    async def acomplete(self, user_id, messages, stream=False, grounding=None, **options):
+        estimate = estimate_tokens(messages, options.get("max_tokens"))
+        await self._await(self._admit(user_id))
+        try:
+            tried = set()
+            for attempt in range(self.max_retries + 1):
+                deployment = await self._await(self._place(estimate, tried))
+                started = time.monotonic()
+                try:
+                    response = await deployment.client("async").chat.completions.create(
+                        **deployment.params(messages, stream, grounding, options)
+                    )
+                except Exception as e:
+                    tried.add(deployment)
+                    delay = self._failed(deployment, estimate, e, attempt)
+                    if delay:
+                        await asyncio.sleep(delay)
+                    continue
+                self._succeeded(deployment, started)
+                break
+        except BaseException:
+            self._release(user_id)
+            raise
+        if stream:
+            return AsyncStream(self, deployment, estimate, user_id, response)
+        self._settle(deployment, estimate, getattr(response.usage, "total_tokens", None), user_id)
+        return response
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._cond:
+            data = dict(self.stats)
+            data.update({
+                "in_flight": self._active,
+                "waiting": len(self._queue),
+                "users": len(self._per_user),
+                "deployments": [d.snapshot(now) for d in self.deployments],
+            })
+        return data
+
+
+class Stream:
+    """A streamed completion that gives its slot back once read to the end or closed."""
+
+    def __init__(self, dispatcher, deployment, estimate, user_id, upstream):
+        self._dispatcher = dispatcher
+        self._deployment = deployment
+        self._estimate = estimate
+        self._user_id = user_id
+        self._upstream = iter(upstream)
+        self._prompt = estimate - llm.MAX_TOKENS
+        self._completion = 0
+        self._usage = None
+        self._open = True
+
+    def __iter__(self):
+        return self
+
+    def _observe(self, chunk):
+        if getattr(chunk, "usage", None) is not None:
+            self._usage = chunk.usage.total_tokens
+        if chunk.choices and chunk.choices[0].delta.content:
+            self._completion += context.count_tokens(chunk.choices[0].delta.content)
+        return chunk
+
+    def __next__(self):
+        try:
+            return self._observe(next(self._upstream))
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if not getattr(self, "_open", False):
+            return
+        self._open = False
+        close = getattr(self._upstream, "close", None)
+        if close is not None:
+            close()
+        used = self._usage if self._usage is not None else self._prompt + self._completion
+        self._dispatcher._settle(self._deployment, self._estimate, used, self._user_id)
+
+    def __del__(self):
+        self.close()
+
+
+class AsyncStream(Stream):
+    def __init__(self, dispatcher, deployment, estimate, user_id, upstream):
+        super().__init__(dispatcher, deployment, estimate, user_id, [])
+        self._response = upstream
+        self._aupstream = upstream.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return self._observe(await self._aupstream.__anext__())
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        # Releases the upstream response and its pooled connection, then the slot.
+        # close() alone, as from __del__, can only give the slot back.
+        if not self._open:
+            return
+        try:
+            # The SDK's stream has an async close(), an async generator aclose()
+            close = getattr(self._response, "aclose", None) or getattr(self._response, "close", None)
+            if close is not None:
+                await close()
+        finally:
+            self.close()
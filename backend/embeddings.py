@@ -0,0 +1,73 @@
+import os
+import re
+import math
+import hashlib
+import unicodedata
+
+EMBEDDING_DEPLOYMENT = os.getenv("EMBEDDING_DEPLOYMENT_NAME", "text-embedding-3-small")
+
+WORD = re.compile(r"\w+")
+
+
+def normalize_text(text):
+    # Lowercase, drop accents and punctuation, collapse whitespace
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(WORD.findall(text))
+
+
+def unit(vector):
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector] if norm else vector
+
+
+def dot(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+class HashingEmbedder:
+    """Deterministic local embedder: hashed word and character trigram features.
+
+    Needs no model or network, so it serves offline runs and tests.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def _bucket(self, feature):
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        return value % self.dim, 1.0 if (value >> 63) & 1 else -1.0
+
+    def embed_one(self, text):
+        vector = [0.0] * self.dim
+        words = normalize_text(text).split()
+        for word in words:
+            index, sign = self._bucket("w:" + word)
+            vector[index] += 2.0 * sign
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                index, sign = self._bucket("c:" + padded[i:i + 3])
+                vector[index] += sign
+        return unit(vector)
+
+    def embed(self, texts):
+        return [self.embed_one(text) for text in texts]
+
+
+class AzureEmbedder:
+    def __init__(self, get_client, deployment=EMBEDDING_DEPLOYMENT):
+        self.get_client = get_client
+        self.deployment = deployment
+
+    def embed(self, texts):
+        response = self.get_client().embeddings.create(model=self.deployment, input=texts)
+        return [unit(item.embedding) for item in response.data]
+
+
+def create_embedder(kind, get_client=None):
+    if kind == "local":
+        return HashingEmbedder()
+    if kind == "azure":
+        return AzureEmbedder(get_client)
+    return None
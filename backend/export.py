@@ -0,0 +1,183 @@
+import os
+import io
+import sys
+import csv
+import json
+import time
+import zlib
+import logging
+import argparse
+import resource
+from datetime import date, datetime
+import db
+import retention
+
+# Streams a center's conversations, joined with their session titles, as NDJSON
+# or CSV. Rows are read with fetchmany() from a forward-only cursor on a
+# connection outside the pool and encoded batch by batch, optionally through a
+# streaming gzip compressor, so memory stays flat however many rows match.
+# Messages hidden by a cleared session are left out.
+#
+#   python export.py --center my-center --from 2025-01-01 --to 2025-02-01 --gzip -o jan.ndjson.gz
+#   curl -H "Authorization: Bearer $EXPORT_TOKEN" "https://.../export?format=csv&gzip=true" -o all.csv.gz
+#
+# The HTTP endpoint is disabled unless EXPORT_TOKEN is set, and only exports the
+# center the request resolves to (by Host, with TENANCY=multi).
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", 1000))
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN", "")
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+COLUMNS = ["id", "message_id", "conversation_id", "conversation_title", "user_id", "center_id", "role",
+           "timestamp", "feedback", "message"]
+
+
+def _query(center_id, start=None, end=None, conversation_id=None):
+    conditions = ["c.center_id = ?",
+                  "c.timestamp > COALESCE((SELECT cleared_at FROM session_tombstones t "
+                  "WHERE t.user_id = c.user_id), ?)"]
+    params = [center_id, retention.NO_TOMBSTONE]
+    if start:
+        conditions.append("c.timestamp >= ?")
+        params.append(start.isoformat())
+    if end:
+        # Exclusive, so consecutive ranges never export a row twice
+        conditions.append("c.timestamp < ?")
+        params.append(end.isoformat())
+    if conversation_id:
+        conditions.append("c.conversation_id = ?")
+        params.append(conversation_id)
+    sql = f"""
+        SELECT c.id, c.message_id, c.conversation_id, s.title, c.user_id, c.center_id, c.role,
+               c.timestamp, c.feedback, c.message
+        FROM conversations c
+        LEFT JOIN conversation_sessions s ON s.id = c.conversation_id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY c.timestamp, c.id
+    """
+    return sql, params
+
+
+def _value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return str(value).lower()  # UNIQUEIDENTIFIER
+
+
+def rows(center_id, start=None, end=None, conversation_id=None, fetch_size=EXPORT_FETCH_SIZE):
+    """Yields batches of matching rows as dicts, oldest first."""
+    sql, params = _query(center_id, start, end, conversation_id)
+    with db.dedicated_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        while True:
+            batch = cursor.fetchmany(fetch_size)
+            if not batch:
+                return
+            yield [dict(zip(COLUMNS, (_value(v) for v in row))) for row in batch]
+
+
+def _ndjson(batch):
+    return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in batch).encode("utf-8")
+
+
+def _csv(batch, header=False):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(COLUMNS)
+    writer.writerows([row[c] for c in COLUMNS] for row in batch)
+    return buffer.getvalue().encode("utf-8")
+
+
+class Exporter:
+    """Encodes row batches as NDJSON or CSV bytes, gzipped on the fly if asked."""
+
+    def __init__(self, fmt="ndjson", compress=False):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown export format: {fmt}")
+        self.fmt = fmt
+        self.compress = compress
+        self.rows = 0
+        self.raw_bytes = 0
+        self.bytes = 0
+
+    @property
+    def mimetype(self):
+        return "application/gzip" if self.compress else FORMATS[self.fmt]
+
+    def filename(self, center_id):
+        return f"conversations-{center_id}.{self.fmt}" + (".gz" if self.compress else "")
+
+    def stream(self, batches):
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if self.compress else None
+        first = True
+        for batch in batches:
+            if self.fmt == "ndjson":
+                data = _ndjson(batch)
+            else:
+                data = _csv(batch, header=first)
+            first = False
+            self.rows += len(batch)
+            self.raw_bytes += len(data)
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                self.bytes += len(data)
+                yield data
+        if self.fmt == "csv" and first:
+            data = _csv([], header=True)
+            self.raw_bytes += len(data)
+            if compressor is not None:
+                data = compressor.compress(data)
+            self.bytes += len(data)
+            yield data
+        if compressor is not None:
+            data = compressor.flush()
+            self.bytes += len(data)
+            yield data
+
+
+def parse_day(value):
+    return date.fromisoformat(value) if value else None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(description="Export a center's conversations as NDJSON or CSV.")
+    parser.add_argument("--center", default=os.getenv("COMMERCIAL_CENTER_ID"))
+    parser.add_argument("--from", dest="start", type=parse_day, help="first day, YYYY-MM-DD")
+    parser.add_argument("--to", dest="end", type=parse_day, help="day after the last one, YYYY-MM-DD")
+    parser.add_argument("--conversation", help="only this conversation_id")
+    parser.add_argument("--format", default="ndjson", choices=list(FORMATS))
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--fetch-size", type=int, default=EXPORT_FETCH_SIZE)
+    parser.add_argument("-o", "--output", help="file to write (default: stdout)")
+    parser.add_argument("--stats", action="store_true", help="report throughput as JSON on stderr")
+    args = parser.parse_args()
+    if not args.center:
+        parser.error("--center or COMMERCIAL_CENTER_ID is required")
+
+    exporter = Exporter(args.format, args.gzip)
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    started = time.perf_counter()
+    try:
+        for chunk in exporter.stream(rows(args.center, args.start, args.end, args.conversation, args.fetch_size)):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+    elapsed = time.perf_counter() - started
+    # ru_maxrss is in kilobytes on Linux
+    result = {"rows": exporter.rows, "raw_bytes": exporter.raw_bytes, "bytes": exporter.bytes,
+              "seconds": elapsed, "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if args.stats:
+        print(json.dumps(result), file=sys.stderr)
+    else:
+        logging.info(
+            f"{result['rows']} rows, {result['raw_bytes'] / 1e6:.1f} MB ({result['bytes'] / 1e6:.1f} MB written) "
+            f"in {elapsed:.1f}s: {result['rows'] / elapsed:,.0f} rows/s, "
+            f"{result['raw_bytes'] / 1e6 / elapsed:.1f} MB/s, peak RSS {result['peak_rss_mb']:.0f} MB"
+        )
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import asyncio
+import random
+from types import SimpleNamespace
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Load configuration
+endpoint = os.getenv("ENDPOINT_URL")
+deployment = os.getenv("DEPLOYMENT_NAME")
+search_endpoint = os.getenv("SEARCH_ENDPOINT")
+search_key = os.getenv("SEARCH_KEY")
+search_index = os.getenv("SEARCH_INDEX_NAME")
+subscription_key = os.getenv("AZURE_OPENAI_API_KEY")
+API_VERSION = "2024-05-01-preview"
+MAX_TOKENS = 800
+# Per attempt; retries and failover across deployments are handled in dispatch.py
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 60))
+
+# "azure" talks to Azure OpenAI; "fake" uses the offline stand-in below
+LLM_BACKEND = os.getenv("LLM_BACKEND", "azure").lower()
+# "azure_search" grounds answers through the data_sources extension; "local"
+# means the caller has already put retrieved documents in the prompt (retrieval.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "azure_search").lower()
+
+CONTACT_URL = os.getenv("CONTACT_URL", "https://www.cap3000.com/faq#contact-section")
+SYSTEM_PROMPT_TEMPLATE = (
+    "You are an AI assistant who helps users find information. "
+    "You cannot include references. If the requested information "
+    "is not available in the retrieved data, direct the user to "
+    "the form hosted at {contact_url} "
+    "so that someone can assist them."
+)
+SYSTEM_PROMPT = SYSTEM_PROMPT_TEMPLATE.format(contact_url=CONTACT_URL)
+
+
+def create_client():
+    if LLM_BACKEND == "fake":
+        return FakeClient()
+    # The SDK is slow to import; only pay for it when a client is first needed
+    from openai import AzureOpenAI
+    return AzureOpenAI(
+        azure_endpoint=endpoint,
+        api_key=subscription_key,
+        api_version=API_VERSION,
+    )
+
+
+def create_async_client():
+    if LLM_BACKEND == "fake":
+        return AsyncFakeClient()
+    from openai import AsyncAzureOpenAI
+    return AsyncAzureOpenAI(
+        azure_endpoint=endpoint,
+        api_key=subscription_key,
+        api_version=API_VERSION,
+    )
+
+
+def deployment_configs():
+    # LLM_DEPLOYMENTS is a JSON list of {"name", "endpoint", "deployment", "api_key",
+    # "tpm", "rpm"}; without it, the single ENDPOINT_URL/DEPLOYMENT_NAME pair
+    raw = os.getenv("LLM_DEPLOYMENTS")
+    if not raw:
+        return [{"name": "default", "endpoint": endpoint, "deployment": deployment,
+                 "api_key": subscription_key}]
+    configs = json.loads(raw)
+    for i, config in enumerate(configs):
+        config.setdefault("name", config.get("deployment") or f"deployment-{i}")
+        config.setdefault("api_key", subscription_key)
+    return configs
+
+
+def create_deployment_client(config, kind="sync"):
+    if LLM_BACKEND == "fake":
+        return AsyncFakeClient() if kind == "async" else FakeClient()
+    from openai import AzureOpenAI, AsyncAzureOpenAI
+    cls = AsyncAzureOpenAI if kind == "async" else AzureOpenAI
+    # The SDK's own retries would sleep through 429s that another deployment could serve
+    return cls(
+        azure_endpoint=config["endpoint"],
+        api_key=config["api_key"],
+        api_version=API_VERSION,
+        max_retries=0,
+        timeout=LLM_TIMEOUT,
+    )
+
+
+_clients = {}
+
+
+def get_client(kind="sync"):
+    # Created on first use, once per process: HTTP connection pools must not cross a fork
+    key = (kind, os.getpid())
+    if key not in _clients:
+        _clients[key] = create_async_client() if kind == "async" else create_client()
+    return _clients[key]
+
+
+def get_async_client():
+    return get_client("async")
+
+
+def completion_params(messages, stream=False, grounding=None, retrieval=True, **overrides):
+    # grounding overrides the azure_search parameters, e.g. a center's own
+    # index_name, role_information and top_n_documents (see tenants.py);
+    # retrieval=False leaves the search out, overrides replace sampling options
+    params = dict(
+        model=deployment,
+        messages=messages,
+        max_tokens=MAX_TOKENS,
+        temperature=0.7,
+        top_p=0.95,
+        frequency_penalty=0,
+        presence_penalty=0,
+        stop=None,
+        stream=stream,
+    )
+    params.update(overrides)
+    if RETRIEVAL_BACKEND != "azure_search" or not retrieval:
+        return params
+    params["extra_body"] = {
+        "data_sources": [{
+            "type": "azure_search",
+            "parameters": {
+                "endpoint": search_endpoint,
+                "index_name": search_index,
+                "semantic_configuration": "default",
+                "query_type": "vector_simple_hybrid",
+                "fields_mapping": {},
+                "in_scope": True,
+                "role_information": SYSTEM_PROMPT,
+                "filter": None,
+                "strictness": 3,
+                "top_n_documents": 5,
+                "authentication": {
+                    "type": "api_key",
+                    "key": search_key
+                },
+                "embedding_dependency": {
+                    "type": "deployment_name",
+                    "deployment_name": "text-embedding-3-small"
+                }
+            }
+        }]
+    }
+    if grounding:
+        params["extra_body"]["data_sources"][0]["parameters"].update(grounding)
+    return params
+
+
+# Rolling summaries are short, deterministic and not grounded on the search index
+SUMMARY_OPTIONS = dict(max_tokens=200, temperature=0, retrieval=False)
+
+
+def summary_messages(previous_summary, turns):
+    # Folds turns that left the context window into a short running summary;
+    # sent with SUMMARY_OPTIONS
+    transcript = "\n".join(f"{t['role']}: {t['content']}" for t in turns)
+    if previous_summary:
+        transcript = f"Earlier summary: {previous_summary}\n\n{transcript}"
+    return [
+        {"role": "system", "content": "Summarize this conversation between a visitor and "
+                                      "a shopping center assistant in at most five sentences. "
+                                      "Keep names, stores, dates and open questions."},
+        {"role": "user", "content": transcript},
+    ]
+
+
+# Offline stand-in for the Azure OpenAI client, shaped like the SDK objects we read
+FAKE_LLM_FIRST_TOKEN_DELAY = float(os.getenv("FAKE_LLM_FIRST_TOKEN_DELAY", 0.2))
+FAKE_LLM_TOKEN_DELAY = float(os.getenv("FAKE_LLM_TOKEN_DELAY", 0.02))
+
+
+def fake_answer(messages):
+    question = next(
+        (m["content"] for m in reversed(messages) if m["role"] == "user"), ""
+    )
+    return (
+        f"You asked: *{question.strip()}*[doc1]\n\n"
+        "The center is open **every day from 10:00 to 20:00**.[doc2]\n\n"
+        "- Parking is free for the first hour\n"
+        "- Shops are listed on the website map[doc3]"
+    )
+
+
+def split_tokens(text):
+    # Roughly word-sized pieces; markers are deliberately split across chunks
+    pieces = []
+    i = 0
+    rng = random.Random(len(text))
+    while i < len(text):
+        step = rng.randint(1, 6)
+        pieces.append(text[i:i + step])
+        i += step
+    return pieces
+
+
+def fake_completion(messages, answer):
+    usage = SimpleNamespace(
+        prompt_tokens=sum(len(m["content"].split()) for m in messages),
+        completion_tokens=len(answer.split()),
+        total_tokens=0,
+    )
+    usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+    message = SimpleNamespace(role="assistant", content=answer)
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=message, finish_reason="stop")],
+        usage=usage,
+    )
+
+
+def fake_chunk(content, finish_reason=None):
+    delta = SimpleNamespace(role="assistant" if content else None, content=content)
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=delta, finish_reason=finish_reason)],
+        usage=None,
+    )
+
+
+class FakeCompletions:
+    def __init__(self, first_token_delay, token_delay):
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+
+    def create(self, messages, stream=False, **kwargs):
+        answer = fake_answer(messages)
+        if not stream:
+            time.sleep(self.first_token_delay + self.token_delay * len(split_tokens(answer)))
+            return fake_completion(messages, answer)
+        return self._stream(answer)
+
+    def _stream(self, answer):
+        time.sleep(self.first_token_delay)
+        for piece in split_tokens(answer):
+            yield fake_chunk(piece)
+            time.sleep(self.token_delay)
+        yield fake_chunk(None, finish_reason="stop")
+
+
+class AsyncFakeCompletions(FakeCompletions):
+    async def create(self, messages, stream=False, **kwargs):
+        answer = fake_answer(messages)
+        if not stream:
+            await asyncio.sleep(self.first_token_delay + self.token_delay * len(split_tokens(answer)))
+            return fake_completion(messages, answer)
+        return self._stream(answer)
+
+    async def _stream(self, answer):
+        await asyncio.sleep(self.first_token_delay)
+        for piece in split_tokens(answer):
+            yield fake_chunk(piece)
+            await asyncio.sleep(self.token_delay)
+        yield fake_chunk(None, finish_reason="stop")
+
+
+class FakeClient:
+    def __init__(self, first_token_delay=FAKE_LLM_FIRST_TOKEN_DELAY,
+                 token_delay=FAKE_LLM_TOKEN_DELAY):
+        self.chat = SimpleNamespace(
+            completions=FakeCompletions(first_token_delay, token_delay)
+        )
+
+
+class AsyncFakeClient:
+    def __init__(self, first_token_delay=FAKE_LLM_FIRST_TOKEN_DELAY,
+                 token_delay=FAKE_LLM_TOKEN_DELAY):
+        self.chat = SimpleNamespace(
+            completions=AsyncFakeCompletions(first_token_delay, token_delay)
+        )
@@ -0,0 +1,283 @@
+import os
+import json
+import bisect
+import glob
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+from writer import pid_alive
+
+# Prometheus text-format metrics without a client library. Each worker keeps its
+# own counters and histograms; with METRICS_DIR set, workers also dump them to
+# that directory every METRICS_FLUSH_INTERVAL seconds and /metrics merges every
+# worker's file, so a scrape through the load balancer sees the whole server.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() == "true"
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+_collectors = []
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def state(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def state(self):
+        with self._lock:
+            return [[list(key), list(counts)] for key, counts in self._values.items()]
+
+
+def register_collector(collect):
+    # `collect()` returns (name, kind, help, {label: value}, value) tuples read at scrape time
+    _collectors.append(collect)
+
+
+# Pipeline instruments
+
+request_seconds = Histogram(
+    "chatbot_request_seconds", "Time to produce the response headers, by route.",
+    ("endpoint", "method", "status")
+)
+stage_seconds = Histogram(
+    "chatbot_stage_seconds", "Time spent in each stage of request handling.", ("stage",)
+)
+first_token_seconds = Histogram(
+    "chatbot_llm_first_token_seconds",
+    "Request start to first streamed token; includes Azure Search retrieval."
+)
+stream_seconds = Histogram("chatbot_stream_seconds", "Duration of streamed answers.")
+llm_tokens = Counter(
+    "chatbot_llm_tokens_total", "Tokens billed by Azure OpenAI, or estimated when usage is absent.",
+    ("kind", "source")
+)
+speech_seconds = Histogram(
+    "chatbot_speech_seconds",
+    "Voice turns: end of the user's speech to the transcript (transcript) and to the first "
+    "audio byte (first_audio); synthesis time to first byte of each sentence (sentence).",
+    ("stage",)
+)
+errors = Counter("chatbot_errors_total", "Errors by stage.", ("stage",))
+
+
+# Per-request spans, for the Server-Timing header
+
+_spans = contextvars.ContextVar("metrics_spans", default=None)
+
+
+def begin_request():
+    ensure_flusher()
+    _spans.set([])
+
+
+def record(stage, elapsed):
+    stage_seconds.observe(elapsed, stage=stage)
+    spans = _spans.get()
+    if spans is not None:
+        spans.append((stage, elapsed))
+
+
+@contextmanager
+def span(stage):
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def server_timing(total=None):
+    # Repeated stages (e.g. two saves) are summed and carry a count, so that
+    # db_acquire;count=3 reads as three pool checkouts; nested stages overlap their parent
+    durations, counts = {}, {}
+    for stage, elapsed in _spans.get() or []:
+        durations[stage] = durations.get(stage, 0.0) + elapsed
+        counts[stage] = counts.get(stage, 0) + 1
+    if total is not None:
+        durations["total"] = total
+    return ", ".join(
+        f"{stage};dur={elapsed * 1000:.1f}" + (f";count={counts[stage]}" if counts.get(stage, 1) > 1 else "")
+        for stage, elapsed in durations.items()
+    )
+
+
+def record_usage(usage=None, prompt_estimate=0, completion_estimate=0):
+    if not METRICS_ENABLED:
+        return
+    if usage is not None:
+        llm_tokens.inc(usage.prompt_tokens or 0, kind="prompt", source="usage")
+        llm_tokens.inc(usage.completion_tokens or 0, kind="completion", source="usage")
+    else:
+        llm_tokens.inc(prompt_estimate, kind="prompt", source="estimate")
+        llm_tokens.inc(completion_estimate, kind="completion", source="estimate")
+
+
+# Cross-worker aggregation
+
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _state():
+    data = {}
+    for metric in _registry:
+        entry = {"kind": metric.kind, "help": metric.help, "labels": list(metric.labels),
+                 "series": metric.state()}
+        if metric.kind == "histogram":
+            entry["buckets"] = list(metric.buckets)
+        data[metric.name] = entry
+    for collect in _collectors:
+        for name, kind, help, labels, value in collect():
+            entry = data.setdefault(name, {"kind": kind, "help": help, "labels": list(labels),
+                                           "series": [], "live": True})
+            entry["series"].append([[str(v) for v in labels.values()], value])
+    return data
+
+
+def _dump():
+    path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(_state(), f)
+    os.replace(tmp, path)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            _dump()
+        except OSError:
+            pass
+
+
+def ensure_flusher():
+    global _flusher_pid
+    if not METRICS_DIR or _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            _flusher_pid = os.getpid()
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+
+def _merge(total, state):
+    for name, entry in state.items():
+        target = total.setdefault(name, dict(entry, series={}))
+        for labels, value in entry["series"]:
+            key = tuple(labels)
+            if isinstance(value, list):
+                current = target["series"].get(key)
+                target["series"][key] = value if current is None else [a + b for a, b in zip(current, value)]
+            else:
+                target["series"][key] = target["series"].get(key, 0) + value
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render():
+    total = {}
+    _merge(total, _state())
+    if METRICS_DIR:
+        for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+            try:
+                pid = int(os.path.basename(path)[len("metrics-"):-len(".json")])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            try:
+                with open(path, encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not pid_alive(pid):
+                # Counts of exited workers still add up; their gauges no longer hold
+                state = {name: entry for name, entry in state.items() if not entry.get("live")}
+            _merge(total, state)
+
+    lines = []
+    for name, entry in total.items():
+        lines.append(f"# HELP {name} {entry['help']}")
+        lines.append(f"# TYPE {name} {entry['kind']}")
+        names = entry["labels"]
+        for key, value in entry["series"].items():
+            if entry["kind"] != "histogram":
+                lines.append(f"{name}{_labels(names, key)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(entry["buckets"] + ["+Inf"], value[:-1]):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{name}_bucket{_labels(names, key, le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(names, key)} {value[-1]}")
+            lines.append(f"{name}_count{_labels(names, key)} {cumulative}")
+    return "\n".join(lines) + "\n"
@@ -1,91 +1,218 @@
-import sqlite3
-import pyodbc
 import os
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
-
-# Azure SQL Database configuration
-DB_CONFIG = {
-    'server': os.getenv('AZURE_SQL_SERVER'),
-    'database': os.getenv('AZURE_SQL_DATABASE'),
-    'username': os.getenv('AZURE_SQL_USERNAME'),
-    'password': os.getenv('AZURE_SQL_PASSWORD'),
-    'driver': '{ODBC Driver 18 for SQL Server}'
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import db
+import schema
+
+# Copies a legacy SQLite archive (users and conversations, no centers) into the
+# database configured for the app: Azure SQL, or SQLite when DB_BACKEND=sqlite.
+#
+#   python migrate.py --source ../conversations.db --center my-center
+#
+# Rows are read in chunks by primary key and each chunk is loaded in a single
+# transaction: staged into a temp table with fast_executemany and MERGEd on
+# Azure SQL, INSERT OR IGNORE on SQLite. After each chunk the last copied key
+# is written to the checkpoint file, so an interrupted run resumes where it
+# stopped. Loads are idempotent, so replaying the chunk in flight is harmless.
+
+MIGRATE_CHUNK_SIZE = int(os.getenv("MIGRATE_CHUNK_SIZE", 5000))
+
+SOURCE_QUERIES = {
+    "users": '''
+        SELECT rowid, id, created_at
+        FROM users
+        WHERE rowid > ?
+        ORDER BY rowid
+        LIMIT ?
+    ''',
+    # Each message carries its user's creation time, so that the conversations
+    # copy can create missing users itself and run alongside the users copy
+    "conversations": '''
+        SELECT c.id, c.user_id, u.created_at, c.message, c.role, c.timestamp,
+               c.message_id, COALESCE(c.feedback, 0)
+        FROM conversations c
+        LEFT JOIN users u ON u.id = c.user_id
+        WHERE c.id > ?
+        ORDER BY c.id
+        LIMIT ?
+    ''',
 }
 
-def get_azure_sql_connection():
-    conn_str = (
-        f"Driver={DB_CONFIG['driver']};"
-        f"Server=tcp:{DB_CONFIG['server']},1433;"
-        f"Database={DB_CONFIG['database']};"
-        f"Uid={DB_CONFIG['username']};"
-        f"Pwd={DB_CONFIG['password']};"
-        "Encrypt=yes;TrustServerCertificate=no;"
-        "Connection Timeout=30;"
+
+def _load_users_sqlite(cursor, rows, center_id):
+    db.executemany(
+        cursor,
+        "INSERT OR IGNORE INTO users (id, center_id, created_at) "
+        "VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))",
+        [(user_id, center_id, created_at) for user_id, created_at in rows]
     )
-    return pyodbc.connect(conn_str)
-
-def migrate_data():
-    # Connect to SQLite database
-    sqlite_conn = sqlite3.connect('conversations.db')
-    sqlite_cursor = sqlite_conn.cursor()
-
-    # Connect to Azure SQL Database
-    azure_conn = get_azure_sql_connection()
-    azure_cursor = azure_conn.cursor()
-
-    # Ensure Azure SQL tables exist
-    azure_cursor.execute('''
-    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='users' AND xtype='U')
-    CREATE TABLE users (
-        id NVARCHAR(50) PRIMARY KEY,
-        created_at DATETIME2 DEFAULT GETDATE()
+
+
+def _load_conversations_sqlite(cursor, rows, center_id):
+    _load_users_sqlite(cursor, list({row[0]: row[1] for row in rows}.items()), center_id)
+    db.executemany(
+        cursor,
+        "INSERT OR IGNORE INTO conversations "
+        "(user_id, center_id, message, role, timestamp, message_id, feedback) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(user_id, center_id, message, role, timestamp, message_id, feedback)
+         for user_id, _, message, role, timestamp, message_id, feedback in rows]
     )
-    ''')
-    azure_cursor.execute('''
-    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='conversations' AND xtype='U')
-    CREATE TABLE conversations (
-        id INT IDENTITY(1,1) PRIMARY KEY,
-        user_id NVARCHAR(50),
-        message NVARCHAR(MAX),
-        role NVARCHAR(50),
-        timestamp DATETIME2,
-        message_id NVARCHAR(50) UNIQUE,
-        feedback INT DEFAULT 0,
-        FOREIGN KEY (user_id) REFERENCES users(id)
+
+
+def _stage(cursor, table, columns, rows):
+    # Temp tables live as long as the pooled connection; reuse and empty them
+    cursor.execute(f"IF OBJECT_ID('tempdb..{table}') IS NULL CREATE TABLE {table} ({columns})")
+    cursor.execute(f"TRUNCATE TABLE {table}")
+    placeholders = ", ".join("?" * len(rows[0]))
+    db.executemany(cursor, f"INSERT INTO {table} VALUES ({placeholders})", rows)
+
+
+def _load_users_mssql(cursor, rows, center_id):
+    _stage(cursor, "#stage_users", "id NVARCHAR(50), created_at DATETIME2", rows)
+    # HOLDLOCK keeps the concurrent conversations copy from inserting the same user
+    cursor.execute('''
+        MERGE users WITH (HOLDLOCK) AS t
+        USING #stage_users AS s ON t.id = s.id
+        WHEN NOT MATCHED THEN
+            INSERT (id, center_id, created_at)
+            VALUES (s.id, ?, COALESCE(s.created_at, GETDATE()));
+    ''', (center_id,))
+
+
+def _load_conversations_mssql(cursor, rows, center_id):
+    _stage(
+        cursor, "#stage_conversations",
+        "user_id NVARCHAR(50), user_created_at DATETIME2, message NVARCHAR(MAX), "
+        "role NVARCHAR(50), timestamp DATETIME2, message_id UNIQUEIDENTIFIER, feedback INT",
+        rows
     )
-    ''')
-    azure_conn.commit()
-
-    # Migrate users table
-    sqlite_cursor.execute("SELECT id, created_at FROM users")
-    users = sqlite_cursor.fetchall()
-    for user in users:
-        azure_cursor.execute(
-            "IF NOT EXISTS (SELECT 1 FROM users WHERE id = ?) "
-            "INSERT INTO users (id, created_at) VALUES (?, ?)",
-            (user[0], user[0], user[1])
-        )
-    azure_conn.commit()
-
-    # Migrate conversations table
-    sqlite_cursor.execute("SELECT user_id, message, role, timestamp, message_id, feedback FROM conversations")
-    conversations = sqlite_cursor.fetchall()
-    for conversation in conversations:
-        azure_cursor.execute(
-            "IF NOT EXISTS (SELECT 1 FROM conversations WHERE message_id = ?) "
-            "INSERT INTO conversations (user_id, message, role, timestamp, message_id, feedback) "
-            "VALUES (?, ?, ?, ?, ?, ?)",
-            (conversation[4], conversation[0], conversation[1], conversation[2], conversation[3], conversation[4], conversation[5])
-        )
-    azure_conn.commit()
-
-    # Close connections
-    sqlite_conn.close()
-    azure_conn.close()
-    print("Data migration completed successfully.")
+    cursor.execute('''
+        MERGE users WITH (HOLDLOCK) AS t
+        USING (SELECT user_id, MIN(user_created_at) AS created_at
+               FROM #stage_conversations GROUP BY user_id) AS s
+        ON t.id = s.user_id
+        WHEN NOT MATCHED THEN
+            INSERT (id, center_id, created_at)
+            VALUES (s.user_id, ?, COALESCE(s.created_at, GETDATE()));
+    ''', (center_id,))
+    cursor.execute('''
+        MERGE conversations WITH (HOLDLOCK) AS t
+        USING #stage_conversations AS s ON t.message_id = s.message_id
+        WHEN NOT MATCHED THEN
+            INSERT (user_id, center_id, message, role, timestamp, message_id, feedback)
+            VALUES (s.user_id, ?, s.message, s.role, s.timestamp, s.message_id, s.feedback);
+    ''', (center_id,))
+
+
+LOADERS = {
+    "sqlite": {"users": _load_users_sqlite, "conversations": _load_conversations_sqlite},
+    "mssql": {"users": _load_users_mssql, "conversations": _load_conversations_mssql},
+}
+
+
+class Checkpoint:
+    """Last copied source key and row count per table, kept in a JSON file."""
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+        self._lock = threading.Lock()
+        self.tables = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("source") != self.source:
+                raise ValueError(f"Checkpoint {path} belongs to {data.get('source')}, not {self.source}")
+            self.tables = data["tables"]
+
+    def position(self, table):
+        state = self.tables.get(table, {})
+        return state.get("last_id", 0), state.get("rows", 0)
+
+    def advance(self, table, last_id, rows):
+        with self._lock:
+            state = self.tables.setdefault(table, {"last_id": 0, "rows": 0})
+            state["last_id"] = last_id
+            state["rows"] += rows
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"source": self.source, "tables": self.tables}, f)
+            os.replace(tmp, self.path)
+
+
+def copy_table(table, source, checkpoint, center_id, chunk_size=MIGRATE_CHUNK_SIZE):
+    # Each thread reads through its own read-only connection to the archive
+    src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    load = LOADERS[db.DB_BACKEND][table]
+    last_id, previous = checkpoint.position(table)
+    if last_id:
+        logging.info(f"{table}: resuming after id {last_id} ({previous} rows already copied)")
+    copied = 0
+    started = time.perf_counter()
+    try:
+        while True:
+            rows = src.execute(SOURCE_QUERIES[table], (last_id, chunk_size)).fetchall()
+            if not rows:
+                break
+            with db.connection() as conn:
+                load(conn.cursor(), [row[1:] for row in rows], center_id)
+            last_id = rows[-1][0]
+            copied += len(rows)
+            checkpoint.advance(table, last_id, len(rows))
+            elapsed = time.perf_counter() - started
+            logging.info(f"{table}: {previous + copied} rows copied, {copied / elapsed:.0f} rows/s")
+    finally:
+        src.close()
+    return {"rows": copied, "seconds": time.perf_counter() - started}
+
+
+def migrate_data(source, center_id, center_name=None, checkpoint_path=None,
+                 chunk_size=MIGRATE_CHUNK_SIZE, restart=False):
+    checkpoint_path = checkpoint_path or f"{source}.checkpoint.json"
+    if restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = Checkpoint(checkpoint_path, source)
+
+    schema.migrate()
+    schema.ensure_center(center_id, center_name)
+
+    started = time.perf_counter()
+    tables = list(SOURCE_QUERIES)
+    with ThreadPoolExecutor(len(tables)) as pool:
+        futures = {
+            table: pool.submit(copy_table, table, source, checkpoint, center_id, chunk_size)
+            for table in tables
+        }
+        results = {table: future.result() for table, future in futures.items()}
+    elapsed = time.perf_counter() - started
+    results["total"] = {"rows": sum(r["rows"] for r in results.values()), "seconds": elapsed}
+    return results
+
 
 if __name__ == "__main__":
-    migrate_data()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(description="Copy a legacy SQLite archive into the app database.")
+    parser.add_argument("--source", default="conversations.db", help="SQLite archive to copy from")
+    parser.add_argument("--center", default=os.getenv("COMMERCIAL_CENTER_ID"),
+                        help="center the archived users and messages belong to")
+    parser.add_argument("--center-name", default=os.getenv("COMMERCIAL_CENTER_NAME"))
+    parser.add_argument("--chunk-size", type=int, default=MIGRATE_CHUNK_SIZE)
+    parser.add_argument("--checkpoint", help="defaults to <source>.checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start over")
+    args = parser.parse_args()
+    if not args.center:
+        parser.error("--center or COMMERCIAL_CENTER_ID is required")
+    if not os.path.exists(args.source):
+        parser.error(f"{args.source} does not exist")
+
+    results = migrate_data(args.source, args.center, args.center_name, args.checkpoint,
+                           args.chunk_size, args.restart)
+    for table, result in results.items():
+        rate = result["rows"] / result["seconds"] if result["seconds"] else 0
+        print(f"{table:>13}: {result['rows']:>9} rows in {result['seconds']:7.2f}s ({rate:,.0f} rows/s)")
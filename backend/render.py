@@ -0,0 +1,155 @@
+import os
+import re
+import html
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+import markdown
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+
+# Messages are stored as the raw markdown the model wrote (minus [docN] markers):
+# that is what goes back to the model as history, and it is smaller than HTML.
+# HTML is produced here, by one Markdown pipeline per thread that is built once
+# and reset between documents. The pipeline drops raw HTML from its input (it
+# comes out escaped) and removes link and image URLs whose scheme is not
+# allowed, so model output cannot inject markup into the page.
+#
+# Renders are kept in an LRU keyed by a hash of the text, so loading the same
+# history twice, or the same cached answer for many users, renders it once per
+# worker. With RENDER_PERSIST=true the HTML of each assistant message is also
+# stored next to it in conversations.message_html and history loads use it as is.
+RENDER_CACHE_MAX_ENTRIES = int(os.getenv("RENDER_CACHE_MAX_ENTRIES", 5000))
+RENDER_PERSIST = os.getenv("RENDER_PERSIST", "false").lower() == "true"
+
+FORMATS = ("html", "raw")
+SAFE_SCHEMES = {"http", "https", "mailto", "tel"}
+URL_SCHEME = re.compile(r"^([a-z][a-z0-9+.\-]*):")
+# Browsers ignore these inside a scheme, e.g. "java\tscript:"
+URL_IGNORED = re.compile(r"[\x00-\x20\x7f]+")
+
+
+def safe_url(url):
+    match = URL_SCHEME.match(URL_IGNORED.sub("", html.unescape(url)).lower())
+    return match is None or match.group(1) in SAFE_SCHEMES
+
+
+class _SafeUrls(Treeprocessor):
+    def run(self, root):
+        for element in root.iter():
+            for attribute in ("href", "src"):
+                value = element.get(attribute)
+                if value is not None and not safe_url(value):
+                    del element.attrib[attribute]
+
+
+class SanitizeExtension(Extension):
+    def extendMarkdown(self, md):
+        # Without these, "<script>" in the text is escaped instead of passed through
+        md.preprocessors.deregister("html_block")
+        md.inlinePatterns.deregister("html")
+        # After "unescape", which would otherwise rebuild a URL from backslash escapes
+        md.treeprocessors.register(_SafeUrls(md), "safe_urls", -10)
+
+
+_local = threading.local()
+
+
+def to_html(text):
+    """Renders markdown to sanitized HTML, without caching."""
+    md = getattr(_local, "md", None)
+    if md is None:
+        md = _local.md = markdown.Markdown(extensions=[SanitizeExtension()])
+    try:
+        return md.convert(text)
+    finally:
+        md.reset()
+
+
+class _TextExtractor(HTMLParser):
+    BLOCKS = {"p", "div", "li", "br", "h1", "h2", "h3", "h4", "h5", "h6", "pre", "tr"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "li":
+            self.parts.append("\n- ")
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.BLOCKS and tag != "li":
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+
+def html_to_text(html):
+    # Assistant messages used to be stored as rendered HTML; see schema migration 6
+    if "<" not in html:
+        return html
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    text = "".join(extractor.parts)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+class RenderCache:
+    """LRU of rendered HTML keyed by a hash of the markdown it was rendered from."""
+
+    def __init__(self, max_entries=RENDER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # digest -> html
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "render_seconds": 0.0,
+        }
+
+    def render(self, text):
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            rendered = self._entries.get(key)
+            if rendered is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return rendered
+        started = time.perf_counter()
+        rendered = to_html(text)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.stats["misses"] += 1
+            self.stats["render_seconds"] += elapsed
+            self._entries[key] = rendered
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return rendered
+
+    def message(self, role, text, rendered=None):
+        # HTML for a stored message: assistant markdown rendered, user text escaped
+        if role != "assistant":
+            return html.escape(text, quote=False)
+        return rendered if rendered is not None else self.render(text)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+            data["entries"] = len(self._entries)
+        lookups = data["hits"] + data["misses"]
+        data["hit_rate"] = data["hits"] / lookups if lookups else 0.0
+        data["persist"] = RENDER_PERSIST
+        return data
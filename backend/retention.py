@@ -0,0 +1,283 @@
+import os
+import io
+import json
+import gzip
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta
+import db
+import schema
+import sharedcache
+
+# Retention job: keeps the conversations table from growing forever.
+#
+# Clearing a session only writes a tombstone (session_tombstones), which hides
+# the user's earlier messages at once; this job deletes them later. Messages
+# older than their center's commercial_centers.retention_days (or
+# RETENTION_DEFAULT_DAYS when unset; 0 keeps them) are appended to compressed,
+# date-partitioned archive files and then deleted.
+#
+#   python retention.py                 one pass
+#   python retention.py --interval 300  a pass every 5 minutes
+#
+# Deletes run in batches of RETENTION_BATCH_SIZE rows, each in its own short
+# transaction, so SQL Server never escalates to a table lock (it does so at
+# 5000 row locks) and the app's writes interleave with the job. A batch is
+# archived and synced to disk before its delete commits; if the job dies in
+# between, the next run archives those rows again rather than losing them.
+#
+#   <RETENTION_ARCHIVE_DIR>/center=<id>/date=<YYYY-MM-DD>/messages.ndjson.gz
+#   <RETENTION_ARCHIVE_DIR>/center=<id>/date=<YYYY-MM-DD>/part-<run>-<n>.parquet
+#
+# NDJSON batches are appended as gzip members, which gzip readers concatenate.
+# Parquet (RETENTION_ARCHIVE_FORMAT=parquet) needs pyarrow. Cleared sessions are
+# deleted without being archived: the user asked for them to be gone.
+#
+# Run on the app's host with the same SHARED_CACHE_PATH, the job bumps the
+# shared-cache version of every user whose messages a batch deleted, once the
+# batch has committed, so workers stop serving pages that still list them.
+RETENTION_DEFAULT_DAYS = int(os.getenv("RETENTION_DEFAULT_DAYS", 0))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", 1000))
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", 0.05))
+RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "archive")
+RETENTION_ARCHIVE_FORMAT = os.getenv("RETENTION_ARCHIVE_FORMAT", "ndjson").lower()
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+ARCHIVE_COLUMNS = ["id", "user_id", "center_id", "conversation_id", "role", "timestamp", "message_id",
+                   "feedback", "message", "message_html"]
+
+# Sorts before any stored timestamp, for users without a tombstone
+NO_TOMBSTONE = "0001-01-01T00:00:00"
+
+TOMBSTONE_SQL = {
+    "sqlite": "INSERT OR REPLACE INTO session_tombstones (user_id, cleared_at) VALUES (?, ?)",
+    "mssql": '''
+        MERGE session_tombstones WITH (HOLDLOCK) AS t
+        USING (SELECT ? AS user_id, ? AS cleared_at) AS s ON t.user_id = s.user_id
+        WHEN MATCHED THEN UPDATE SET cleared_at = s.cleared_at
+        WHEN NOT MATCHED THEN INSERT (user_id, cleared_at) VALUES (s.user_id, s.cleared_at);
+    ''',
+}
+
+
+def visible_clause():
+    # Messages at or before the user's tombstone are hidden until the job deletes them.
+    # The bound is a constant for the query, so the timestamp index still seeks on it.
+    # Takes (user_id, NO_TOMBSTONE) as parameters.
+    return "timestamp > COALESCE((SELECT cleared_at FROM session_tombstones WHERE user_id = ?), ?)"
+
+
+def clear_user(cursor, user_id, cleared_at=None):
+    """Hides every message the user has so far; one row written, whatever the history size."""
+    cleared_at = cleared_at or datetime.now().isoformat()
+    cursor.execute(TOMBSTONE_SQL["sqlite" if db.DB_BACKEND == "sqlite" else "mssql"], (user_id, cleared_at))
+    return cleared_at
+
+
+def _day(timestamp):
+    if isinstance(timestamp, datetime):
+        return timestamp.date().isoformat()
+    return str(timestamp)[:10]
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return str(value).lower()  # UNIQUEIDENTIFIER
+
+
+class Archive:
+    """Date-partitioned files that expired messages are appended to before deletion."""
+
+    def __init__(self, directory=RETENTION_ARCHIVE_DIR, fmt=RETENTION_ARCHIVE_FORMAT):
+        if fmt not in ("ndjson", "parquet"):
+            raise ValueError(f"Unknown archive format: {fmt}")
+        if fmt == "parquet" and pyarrow is None:
+            raise RuntimeError("RETENTION_ARCHIVE_FORMAT=parquet requires pyarrow")
+        self.directory = directory
+        self.fmt = fmt
+        self.run = datetime.now().strftime("%Y%m%dT%H%M%S")
+        self.parts = 0
+        self.files = set()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def write(self, center_id, rows):
+        by_day = {}
+        for row in rows:
+            record = {column: _json_value(value) for column, value in zip(ARCHIVE_COLUMNS, row)}
+            by_day.setdefault(_day(row[ARCHIVE_COLUMNS.index("timestamp")]), []).append(record)
+        for day, records in by_day.items():
+            partition = os.path.join(self.directory, f"center={center_id}", f"date={day}")
+            os.makedirs(partition, exist_ok=True)
+            if self.fmt == "ndjson":
+                self._append_ndjson(os.path.join(partition, "messages.ndjson.gz"), records)
+            else:
+                self.parts += 1
+                self._write_parquet(os.path.join(partition, f"part-{self.run}-{self.parts:05d}.parquet"), records)
+
+    def _append_ndjson(self, path, records):
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+        compressed = gzip.compress(data)
+        with open(path, "ab") as f:
+            f.write(compressed)
+            f.flush()
+            os.fsync(f.fileno())
+        self._count(path, len(data), len(compressed))
+
+    def _write_parquet(self, path, records):
+        table = pyarrow.Table.from_pylist(records)
+        buffer = io.BytesIO()
+        pyarrow.parquet.write_table(table, buffer, compression="zstd")
+        with open(path, "wb") as f:
+            f.write(buffer.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        self._count(path, sum(len(json.dumps(r)) for r in records), buffer.tell())
+
+    def _count(self, path, raw, written):
+        self.files.add(path)
+        self.bytes_in += raw
+        self.bytes_out += written
+
+
+class RetentionJob:
+    """One pass deletes tombstoned sessions, then archives and deletes expired messages."""
+
+    def __init__(self, archive=None, batch_size=RETENTION_BATCH_SIZE, pause=RETENTION_BATCH_PAUSE,
+                 default_days=RETENTION_DEFAULT_DAYS, cache=None):
+        self.archive = archive
+        self.cache = cache
+        self.batch_size = batch_size
+        self.pause = pause
+        self.default_days = default_days
+        self.stats = {
+            "tombstones": 0,
+            "reaped": 0,
+            "expired": 0,
+            "batches": 0,
+            "invalidations": 0,
+            "max_batch_seconds": 0.0,
+        }
+
+    def _invalidate(self, user_ids):
+        # After the delete committed, like the app's own writes
+        if self.cache is None:
+            return
+        for user_id in user_ids:
+            self.cache.invalidate(user_id)
+            self.stats["invalidations"] += 1
+
+    def _batch_done(self, started):
+        self.stats["batches"] += 1
+        self.stats["max_batch_seconds"] = max(self.stats["max_batch_seconds"], time.perf_counter() - started)
+        time.sleep(self.pause)
+
+    def _delete_batch_sql(self):
+        if db.DB_BACKEND == "sqlite":
+            return ("DELETE FROM conversations WHERE id IN (SELECT id FROM conversations "
+                    "WHERE user_id = ? AND timestamp <= ? LIMIT ?)")
+        return "DELETE TOP (?) FROM conversations WHERE user_id = ? AND timestamp <= ?"
+
+    def reap_tombstones(self):
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id, cleared_at FROM session_tombstones")
+            tombstones = cursor.fetchall()
+        sql = self._delete_batch_sql()
+        for user_id, cleared_at in tombstones:
+            while True:
+                started = time.perf_counter()
+                with db.connection() as conn:
+                    cursor = conn.cursor()
+                    if db.DB_BACKEND == "sqlite":
+                        cursor.execute(sql, (user_id, cleared_at, self.batch_size))
+                    else:
+                        cursor.execute(sql, (self.batch_size, user_id, cleared_at))
+                    deleted = cursor.rowcount
+                    if deleted < self.batch_size:
+                        # Kept if the user cleared again meanwhile; the next pass handles that one
+                        cursor.execute(
+                            "DELETE FROM session_tombstones WHERE user_id = ? AND cleared_at = ?",
+                            (user_id, cleared_at)
+                        )
+                self.stats["reaped"] += deleted
+                if deleted:
+                    self._invalidate([user_id])
+                self._batch_done(started)
+                if deleted < self.batch_size:
+                    break
+            self.stats["tombstones"] += 1
+
+    def policies(self):
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, retention_days FROM commercial_centers")
+            rows = cursor.fetchall()
+        return {center: days if days is not None else self.default_days for center, days in rows}
+
+    def expire_center(self, center_id, days, now=None):
+        if not days or days <= 0:
+            return
+        cutoff = ((now or datetime.now()) - timedelta(days=days)).isoformat()
+        while True:
+            started = time.perf_counter()
+            with db.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    f"""SELECT {", ".join(ARCHIVE_COLUMNS)} FROM conversations
+                       WHERE center_id = ? AND timestamp < ?
+                       ORDER BY timestamp, id {db.limit_clause()}""",
+                    (center_id, cutoff, self.batch_size)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                if self.archive is not None:
+                    self.archive.write(center_id, rows)
+                db.executemany(cursor, "DELETE FROM conversations WHERE id = ?", [(row[0],) for row in rows])
+            self.stats["expired"] += len(rows)
+            self._invalidate({row[1] for row in rows})
+            self._batch_done(started)
+            if len(rows) < self.batch_size:
+                break
+
+    def run_once(self, now=None):
+        started = time.perf_counter()
+        self.reap_tombstones()
+        for center_id, days in self.policies().items():
+            self.expire_center(center_id, days, now)
+        return dict(self.stats, seconds=time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    parser = argparse.ArgumentParser(description="Delete cleared sessions and archive expired messages.")
+    parser.add_argument("--interval", type=float, default=0, help="seconds between passes (0: one pass)")
+    parser.add_argument("--archive-dir", default=RETENTION_ARCHIVE_DIR)
+    parser.add_argument("--format", default=RETENTION_ARCHIVE_FORMAT, choices=["ndjson", "parquet"])
+    parser.add_argument("--no-archive", action="store_true", help="delete expired messages without archiving")
+    parser.add_argument("--batch-size", type=int, default=RETENTION_BATCH_SIZE)
+    args = parser.parse_args()
+
+    schema.migrate()
+    cache = sharedcache.SharedCache() if sharedcache.SHARED_CACHE_PATH else None
+    while True:
+        archive = None if args.no_archive else Archive(args.archive_dir, args.format)
+        result = RetentionJob(archive, args.batch_size, cache=cache).run_once()
+        logging.info(
+            f"{result['tombstones']} cleared sessions ({result['reaped']} messages), "
+            f"{result['expired']} expired messages in {result['batches']} batches, "
+            f"{result['seconds']:.1f}s, longest batch {result['max_batch_seconds'] * 1000:.0f} ms"
+        )
+        if not args.interval:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,474 @@
+import os
+import json
+import math
+import mmap
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+import numpy as np
+import db
+from embeddings import normalize_text
+
+# Local hybrid retrieval over the knowledge_base table, used instead of the
+# azure_search data source when RETRIEVAL_BACKEND=local.
+#
+# Each center gets an index directory holding passage embeddings (brute-force
+# matrix product) and a BM25 inverted index with precomputed term weights.
+# Everything a search reads is memory-mapped read-only, so every worker on the
+# host shares one copy through the page cache: the arrays are .npy files
+# opened with mmap_mode="r", and the passages, the sorted vocabulary and the
+# rows' timestamps are string tables, one blob plus an offset table, decoded
+# only for the entries a search touches; query terms are found through a
+# sorted array of term hashes. The two rankings are merged by
+# reciprocal rank fusion.
+#
+# Indexes are built ahead of time with the command below (or by the gunicorn
+# master with PREPARE_ON_START=true); a worker that finds none builds it in
+# the background and answers without retrieval meanwhile. When
+# the knowledge base changes, a background thread of one worker rebuilds the
+# index under a file lock while searches keep using the current version.
+# Passages of unchanged rows keep their stored embeddings, so only the new and
+# edited rows are embedded again. The new files are then published through
+# manifest.json, and the other workers pick them up on their next check.
+#
+#   python retrieval.py --center <id>     build or refresh one center's index
+#   python retrieval.py --all             every center in commercial_centers
+
+RETRIEVAL_INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", "kb_index")
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 5))
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", 50))
+RETRIEVAL_REFRESH_INTERVAL = float(os.getenv("RETRIEVAL_REFRESH_INTERVAL", 60))
+RETRIEVAL_PASSAGE_WORDS = int(os.getenv("RETRIEVAL_PASSAGE_WORDS", 120))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+EMBED_BATCH = 64
+# Bumped when the files change; a version written in another format is rebuilt in full
+INDEX_FORMAT = 2
+
+
+def split_passages(title, content, max_words=RETRIEVAL_PASSAGE_WORDS):
+    # Paragraphs are packed into passages of up to max_words, each led by the title
+    passages, current = [], []
+    for paragraph in (content or "").split("\n"):
+        words = paragraph.split()
+        while words:
+            room = max_words - len(current)
+            current += words[:room]
+            words = words[room:]
+            if len(current) >= max_words:
+                passages.append(current)
+                current = []
+    if current or not passages:
+        passages.append(current)
+    prefix = f"{title}\n" if title else ""
+    return [prefix + " ".join(words) for words in passages]
+
+
+def kb_fingerprint(state):
+    # Changes with any insert, edit or delete: latest update, row count, and the ids
+    ids = ",".join(sorted(state, key=int)).encode("utf-8")
+    return [max(state.values(), default=""), len(state), hashlib.blake2b(ids, digest_size=8).hexdigest()]
+
+
+def bm25_arrays(texts):
+    # Inverted index as CSR arrays: term i's (passage, weight) postings are the
+    # slice spans[i]:spans[i + 1], terms in sorted order
+    tokenized = [normalize_text(text).split() for text in texts]
+    lengths = np.array([len(tokens) for tokens in tokenized], dtype=np.float32)
+    avg_length = float(lengths.mean()) if len(lengths) else 0.0
+    postings = {}
+    for passage, tokens in enumerate(tokenized):
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            postings.setdefault(token, []).append((passage, tf))
+
+    n = len(texts)
+    terms = sorted(postings)
+    spans = [0]
+    doc_ids, weights = [], []
+    for term in terms:
+        entries = postings[term]
+        idf = np.log(1 + (n - len(entries) + 0.5) / (len(entries) + 0.5))
+        for passage, tf in entries:
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[passage] / avg_length) if avg_length else BM25_K1
+            doc_ids.append(passage)
+            weights.append(idf * tf * (BM25_K1 + 1) / (tf + norm))
+        spans.append(len(doc_ids))
+    return (terms, np.array(spans, dtype=np.int64), np.array(doc_ids, dtype=np.int32),
+            np.array(weights, dtype=np.float32))
+
+
+def write_strings(prefix, strings):
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.array([len(data) for data in encoded], dtype=np.int64), out=offsets[1:])
+    with open(f"{prefix}.blob", "wb") as f:
+        f.write(b"".join(encoded))
+    np.save(f"{prefix}.offsets.npy", offsets)
+
+
+class StringTable:
+    """Strings written by write_strings, memory-mapped: entry i is the UTF-8
+    slice offsets[i]:offsets[i + 1] of the blob."""
+
+    def __init__(self, prefix):
+        self.offsets = np.load(f"{prefix}.offsets.npy", mmap_mode="r")
+        with open(f"{prefix}.blob", "rb") as f:
+            # mmap refuses empty files; an empty table has nothing to map
+            size = os.fstat(f.fileno()).st_size
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def __getitem__(self, i):
+        return self.raw(i).decode("utf-8")
+
+
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def term_lookup(terms):
+    # Sorted term hashes and the term each belongs to, searched with np.searchsorted
+    hashes = np.array([term_hash(term) for term in terms], dtype=np.uint64)
+    order = np.argsort(hashes, kind="stable")
+    return hashes[order], order.astype(np.int64)
+
+
+def rrf(rankings, limit):
+    scores = {}
+    for ranking in rankings:
+        for rank, passage in enumerate(ranking):
+            scores[passage] = scores.get(passage, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+
+def top_indices(scores, limit):
+    if len(scores) <= limit:
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, limit)[:limit]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class CenterIndex:
+    """One published version of a center's index, memory-mapped read-only."""
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        with open(os.path.join(path, f"{version}.meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format") != INDEX_FORMAT:
+            raise ValueError(f"index version {version} in {path} has format {meta.get('format')}, "
+                             f"not {INDEX_FORMAT}")
+        self.kb_version = meta["kb_version"]
+        self.embedder = meta["embedder"]
+        self.count = meta["passages"]
+
+        def load(name):
+            return np.load(os.path.join(path, f"{version}.{name}.npy"), mmap_mode="r")
+
+        self.vectors = load("vectors")
+        self.doc_ids = load("postings")
+        self.weights = load("weights")
+        self.spans = load("spans")
+        self.term_hashes = load("term_hashes")
+        self.term_order = load("term_order")
+        self.row_spans = load("rows")  # kb id, first passage, passage count; by kb id
+        self.terms = StringTable(os.path.join(path, f"{version}.terms"))
+        self.passages = StringTable(os.path.join(path, f"{version}.passages"))  # JSON [kb id, title, type, text]
+        self.updated = StringTable(os.path.join(path, f"{version}.updated"))  # last_updated per row
+
+    def passage(self, i):
+        return json.loads(self.passages[i])
+
+    def term(self, term):
+        # Index of the term in the vocabulary, or None
+        key = np.uint64(term_hash(term))
+        at = int(np.searchsorted(self.term_hashes, key))
+        while at < len(self.term_hashes) and self.term_hashes[at] == key:
+            i = int(self.term_order[at])
+            if self.terms[i] == term:
+                return i
+            at += 1
+        return None
+
+    def rows(self):
+        # kb id -> (last_updated, first passage, passage count), read when rebuilding
+        return {str(kb_id): (self.updated[i], int(first), int(count))
+                for i, (kb_id, first, count) in enumerate(self.row_spans)}
+
+    def bm25(self, query, limit):
+        scores = np.zeros(self.count, dtype=np.float32)
+        for term in set(normalize_text(query).split()):
+            i = self.term(term)
+            if i is not None:
+                start, end = int(self.spans[i]), int(self.spans[i + 1])
+                np.add.at(scores, self.doc_ids[start:end], self.weights[start:end])
+        ranked = top_indices(scores, limit)
+        return [int(i) for i in ranked if scores[i] > 0]
+
+    def dense(self, query_vector, limit):
+        if not self.count:
+            return []
+        scores = self.vectors @ query_vector
+        return [int(i) for i in top_indices(scores, limit)]
+
+
+class Retriever:
+    """Hybrid BM25 + vector search over each center's knowledge base."""
+
+    def __init__(self, embedder, index_dir=RETRIEVAL_INDEX_DIR, top_k=RETRIEVAL_TOP_K,
+                 candidates=RETRIEVAL_CANDIDATES, refresh_interval=RETRIEVAL_REFRESH_INTERVAL):
+        self.embedder = embedder
+        self.embedder_name = f"{type(embedder).__name__}:{getattr(embedder, 'dim', '')}"
+        self.index_dir = index_dir
+        self.top_k = top_k
+        self.candidates = candidates
+        self.refresh_interval = refresh_interval
+        self._indexes = {}  # center -> CenterIndex
+        self._checked = {}  # center -> monotonic time of the last freshness check
+        self._refreshing = set()  # centers with a refresh thread running
+        self._lock = threading.Lock()
+        self.stats = {"searches": 0, "unindexed_searches": 0, "builds": 0, "reloads": 0, "refresh_errors": 0,
+                      "embedded_passages": 0}
+
+    def _center_dir(self, center):
+        return os.path.join(self.index_dir, center)
+
+    def _published_version(self, center):
+        try:
+            with open(os.path.join(self._center_dir(center), "manifest.json"), encoding="utf-8") as f:
+                return json.load(f)["version"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _load(self, center, version):
+        # None for a version written in another format, which the next build replaces
+        try:
+            return CenterIndex(self._center_dir(center), version)
+        except ValueError as e:
+            logging.info(f"Not using the retrieval index of center {center}: {e}")
+            return None
+
+    # Database
+
+    def _kb_state(self, center):
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, last_updated FROM knowledge_base WHERE center_id = ?", (center,))
+            return {str(kb_id): str(last_updated) for kb_id, last_updated in cursor.fetchall()}
+
+    def _kb_rows(self, ids):
+        rows = {}
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                cursor.execute(
+                    f"SELECT id, title, content_type, content FROM knowledge_base "
+                    f"WHERE id IN ({', '.join('?' * len(chunk))})",
+                    [int(kb_id) for kb_id in chunk]
+                )
+                for kb_id, title, content_type, content in cursor.fetchall():
+                    rows[str(kb_id)] = (title, content_type, content)
+        return rows
+
+    # Building
+
+    def _embed(self, texts):
+        vectors = []
+        for start in range(0, len(texts), EMBED_BATCH):
+            vectors += self.embedder.embed(texts[start:start + EMBED_BATCH])
+        self.stats["embedded_passages"] += len(texts)
+        return np.array(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+    def build(self, center):
+        """Brings the center's index up to date with knowledge_base; returns its version."""
+        path = self._center_dir(center)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._kb_state(center)
+            kb_version = kb_fingerprint(state)
+            version = self._published_version(center)
+            previous = self._load(center, version) if version else None
+            if previous is not None and previous.embedder != self.embedder_name:
+                previous = None
+            if previous is not None and previous.kb_version == kb_version:
+                return version
+
+            previous_rows = previous.rows() if previous is not None else {}
+            unchanged = {
+                kb_id for kb_id, last_updated in state.items()
+                if previous_rows.get(kb_id, [None])[0] == last_updated
+            }
+            fresh = self._kb_rows(sorted(state.keys() - unchanged, key=int))
+
+            passages, rows, reused, new_texts = [], {}, [], []
+            for kb_id in sorted(state, key=int):
+                start = len(passages)
+                if kb_id in unchanged:
+                    _, first, count = previous_rows[kb_id]
+                    passages += [previous.passage(i) for i in range(first, first + count)]
+                    reused.append((start, first, count))
+                elif kb_id in fresh:
+                    title, content_type, content = fresh[kb_id]
+                    texts = split_passages(title, content)
+                    passages += [[kb_id, title, content_type, text] for text in texts]
+                    new_texts.append((start, texts))
+                else:
+                    continue  # deleted between the two queries
+                rows[kb_id] = [state[kb_id], start, len(passages) - start]
+
+            dim = previous.vectors.shape[1] if previous is not None else None
+            embedded = self._embed([t for _, texts in new_texts for t in texts]) if new_texts else None
+            if dim is None:
+                dim = embedded.shape[1] if embedded is not None else getattr(self.embedder, "dim", 1)
+            vectors = np.zeros((len(passages), dim), dtype=np.float32)
+            for start, first, count in reused:
+                vectors[start:start + count] = previous.vectors[first:first + count]
+            offset = 0
+            for start, texts in new_texts:
+                vectors[start:start + len(texts)] = embedded[offset:offset + len(texts)]
+                offset += len(texts)
+
+            terms, spans, doc_ids, weights = bm25_arrays([p[3] for p in passages])
+            new_version = (version or 0) + 1
+            prefix = os.path.join(path, str(new_version))
+            np.save(f"{prefix}.vectors.npy", vectors)
+            np.save(f"{prefix}.postings.npy", doc_ids)
+            np.save(f"{prefix}.weights.npy", weights)
+            np.save(f"{prefix}.spans.npy", spans)
+            term_hashes, term_order = term_lookup(terms)
+            np.save(f"{prefix}.term_hashes.npy", term_hashes)
+            np.save(f"{prefix}.term_order.npy", term_order)
+            row_ids = sorted(rows, key=int)
+            np.save(f"{prefix}.rows.npy", np.array([[int(kb_id)] + rows[kb_id][1:] for kb_id in row_ids],
+                                                   dtype=np.int64).reshape(len(row_ids), 3))
+            write_strings(f"{prefix}.terms", terms)
+            write_strings(f"{prefix}.passages", [json.dumps(p, ensure_ascii=False) for p in passages])
+            write_strings(f"{prefix}.updated", [rows[kb_id][0] for kb_id in row_ids])
+            # Written last: a version is complete once its meta.json exists
+            with open(f"{prefix}.meta.json", "w", encoding="utf-8") as f:
+                json.dump({"format": INDEX_FORMAT, "kb_version": kb_version, "embedder": self.embedder_name,
+                           "passages": len(passages)}, f)
+            tmp = os.path.join(path, "manifest.json.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"version": new_version}, f)
+            os.replace(tmp, os.path.join(path, "manifest.json"))
+
+            # Mapped files stay readable after unlink; keep the previous version for
+            # workers that read the old manifest a moment ago
+            for name in os.listdir(path):
+                head = name.split(".", 1)[0]
+                if head.isdigit() and int(head) < new_version - 1:
+                    os.remove(os.path.join(path, name))
+            self.stats["builds"] += 1
+            logging.info(f"Indexed {len(passages)} passages for center {center} "
+                         f"({len(new_texts)} rows embedded, {len(reused)} reused)")
+            return new_version
+
+    # Searching
+
+    def _refresh(self, center):
+        # Off the request path: searches keep the current index until the new one is published
+        try:
+            index = self._indexes.get(center)
+            state = self._kb_state(center)
+            if index is None or index.kb_version != kb_fingerprint(state) or index.embedder != self.embedder_name:
+                # Returns at once when another worker has already published this state
+                version = self.build(center)
+                if index is None or version != index.version:
+                    self._indexes[center] = CenterIndex(self._center_dir(center), version)
+                    self.stats["reloads"] += 1
+        except Exception as e:
+            logging.error(f"Could not refresh the retrieval index of center {center}: {e}")
+            self.stats["refresh_errors"] += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(center)
+
+    def _index(self, center):
+        now = time.monotonic()
+        if now - self._checked.get(center, -math.inf) >= self.refresh_interval:
+            with self._lock:
+                if now - self._checked.get(center, -math.inf) >= self.refresh_interval \
+                        and center not in self._refreshing:
+                    self._checked[center] = now
+                    self._refreshing.add(center)
+                    threading.Thread(target=self._refresh, args=(center,), name=f"retrieval-{center}",
+                                     daemon=True).start()
+        index = self._indexes.get(center)
+        if index is None:
+            # Mapping a published version reads nothing yet, so it is done inline
+            version = self._published_version(center)
+            index = self._load(center, version) if version else None
+            if index is not None:
+                with self._lock:
+                    index = self._indexes.setdefault(center, index)
+        return index
+
+    def search(self, center, query, top_k=None, mode="hybrid"):
+        index = self._index(center)
+        self.stats["searches"] += 1
+        if index is None:
+            # Not built yet: the refresh thread builds it, answers go ungrounded meanwhile
+            self.stats["unindexed_searches"] += 1
+            return []
+        limit = top_k or self.top_k
+        rankings = []
+        if mode in ("hybrid", "bm25"):
+            rankings.append(index.bm25(query, self.candidates))
+        if mode in ("hybrid", "vector"):
+            query_vector = np.asarray(self.embedder.embed([query])[0], dtype=np.float32)
+            rankings.append(index.dense(query_vector, self.candidates))
+        results = []
+        for passage in rrf(rankings, limit):
+            kb_id, title, content_type, text = index.passage(passage)
+            results.append({"kb_id": kb_id, "title": title, "content_type": content_type, "text": text})
+        return results
+
+    def snapshot(self):
+        data = dict(self.stats)
+        data["centers"] = {center: {"version": index.version, "passages": index.count}
+                           for center, index in self._indexes.items()}
+        return data
+
+
+def format_documents(documents):
+    # Numbered like the azure_search citations, which the answer path already strips
+    return "\n\n".join(
+        f"[doc{i}] {doc['title'] or ''}\n{doc['text']}" for i, doc in enumerate(documents, 1)
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    import embeddings
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build or refresh a center's local retrieval index.")
+    parser.add_argument("--center", default=os.getenv("COMMERCIAL_CENTER_ID"))
+    parser.add_argument("--all", action="store_true", help="every center in commercial_centers")
+    parser.add_argument("--embedder", default=os.getenv("RETRIEVAL_EMBEDDER", "local"))
+    args = parser.parse_args()
+    if not args.center and not args.all:
+        parser.error("--center, --all or COMMERCIAL_CENTER_ID is required")
+    import llm
+    import tenants
+    retriever = Retriever(embeddings.create_embedder(args.embedder, llm.get_client))
+    for center in [c.id for c in tenants.load_centers()] if args.all else [args.center]:
+        started = time.perf_counter()
+        version = retriever.build(center)
+        print(f"Center {center} index at version {version} in {time.perf_counter() - started:.2f}s")
@@ -0,0 +1,469 @@
+import os
+import sys
+import logging
+from datetime import datetime
+import db
+import render
+
+# Versioned schema migrations. Each entry lists the statements per backend;
+# a statement may also be a function of the cursor. Applied versions are
+# recorded in schema_version, so every migration runs exactly once per
+# database. Append new migrations, never edit applied ones.
+#
+#   python schema.py            apply pending migrations and register the
+#                               center from COMMERCIAL_CENTER_ID
+#   python schema.py --status   show applied and pending versions
+
+
+def _mssql_add_column(table, column, definition):
+    return f'''
+    IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS
+                  WHERE TABLE_NAME = '{table}' AND COLUMN_NAME = '{column}')
+    ALTER TABLE {table} ADD {column} {definition}
+    '''
+
+
+MIGRATIONS = [
+    (1, "baseline tables", {
+        # Guarded so that databases created by the old init_db adopt this version
+        "mssql": [
+            '''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='commercial_centers' AND xtype='U')
+            CREATE TABLE commercial_centers (
+                id NVARCHAR(50) PRIMARY KEY,
+                name NVARCHAR(100) NOT NULL,
+                location NVARCHAR(255),
+                website_url NVARCHAR(255),
+                created_at DATETIME2 DEFAULT GETDATE()
+            )
+            ''',
+            '''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='users' AND xtype='U')
+            CREATE TABLE users (
+                id NVARCHAR(50) PRIMARY KEY,
+                center_id NVARCHAR(50),
+                created_at DATETIME2 DEFAULT GETDATE(),
+                FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
+            )
+            ''',
+            '''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='conversations' AND xtype='U')
+            CREATE TABLE conversations (
+                id INT IDENTITY(1,1) PRIMARY KEY,
+                user_id NVARCHAR(50),
+                center_id NVARCHAR(50),
+                message NVARCHAR(MAX),
+                role NVARCHAR(50),
+                timestamp DATETIME2,
+                message_id NVARCHAR(50) UNIQUE,
+                feedback INT DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
+            )
+            ''',
+            '''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='knowledge_base' AND xtype='U')
+            CREATE TABLE knowledge_base (
+                id INT IDENTITY(1,1) PRIMARY KEY,
+                center_id NVARCHAR(50),
+                content_type NVARCHAR(50),
+                title NVARCHAR(255),
+                content NVARCHAR(MAX),
+                last_updated DATETIME2 DEFAULT GETDATE(),
+                FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
+            )
+            ''',
+            '''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='conversation_sessions' AND xtype='U')
+            CREATE TABLE conversation_sessions (
+                id NVARCHAR(50) PRIMARY KEY,
+                user_id NVARCHAR(50),
+                center_id NVARCHAR(50),
+                title NVARCHAR(255),
+                created_at DATETIME2 DEFAULT GETDATE(),
+                last_updated DATETIME2 DEFAULT GETDATE(),
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
+            )
+            ''',
+        ],
+        "sqlite": [
+            '''
+            CREATE TABLE IF NOT EXISTS commercial_centers (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                location TEXT,
+                website_url TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS users (
+                id TEXT PRIMARY KEY,
+                center_id TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                center_id TEXT,
+                message TEXT,
+                role TEXT,
+                timestamp TIMESTAMP,
+                message_id TEXT UNIQUE,
+                feedback INTEGER DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS knowledge_base (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                center_id TEXT,
+                content_type TEXT,
+                title TEXT,
+                content TEXT,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS conversation_sessions (
+                id TEXT PRIMARY KEY,
+                user_id TEXT,
+                center_id TEXT,
+                title TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (center_id) REFERENCES commercial_centers(id)
+            )
+            ''',
+        ],
+    }),
+    (2, "conversation_id on conversations", {
+        "mssql": [
+            '''
+            IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS
+                          WHERE TABLE_NAME = 'conversations'
+                          AND COLUMN_NAME = 'conversation_id')
+            ALTER TABLE conversations
+            ADD conversation_id NVARCHAR(50),
+            CONSTRAINT FK_ConversationSession
+            FOREIGN KEY (conversation_id)
+            REFERENCES conversation_sessions(id)
+            ''',
+        ],
+        "sqlite": [
+            lambda cursor: _sqlite_add_column(
+                cursor, "conversations", "conversation_id",
+                "TEXT REFERENCES conversation_sessions(id)"
+            ),
+        ],
+    }),
+    (3, "message_id as UNIQUEIDENTIFIER", {
+        # 16 bytes instead of up to 100; the unnamed UNIQUE constraint is replaced
+        "mssql": [
+            '''
+            DECLARE @name sysname;
+            SELECT @name = kc.name
+            FROM sys.key_constraints kc
+            JOIN sys.index_columns ic
+              ON ic.object_id = kc.parent_object_id AND ic.index_id = kc.unique_index_id
+            JOIN sys.columns c
+              ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+            WHERE kc.parent_object_id = OBJECT_ID('conversations')
+              AND kc.type = 'UQ' AND c.name = 'message_id';
+            IF @name IS NOT NULL
+                EXEC('ALTER TABLE conversations DROP CONSTRAINT ' + QUOTENAME(@name));
+            ''',
+            "ALTER TABLE conversations ALTER COLUMN message_id UNIQUEIDENTIFIER NOT NULL",
+            "ALTER TABLE conversations ADD CONSTRAINT UQ_conversations_message_id UNIQUE (message_id)",
+        ],
+        # SQLite has no UUID type; TEXT UNIQUE stays
+        "sqlite": [],
+    }),
+    (4, "indexes for history, clear-session and conversation list queries", {
+        # Leading user_id also serves DELETE ... WHERE user_id = ?. The message
+        # body stays out of the index; only the page of rows returned is looked up.
+        "mssql": [
+            '''
+            CREATE INDEX IX_conversations_user_center_time
+            ON conversations (user_id, center_id, timestamp)
+            INCLUDE (role, message_id, feedback, conversation_id)
+            ''',
+            '''
+            CREATE INDEX IX_conversation_sessions_user_updated
+            ON conversation_sessions (user_id, last_updated DESC)
+            INCLUDE (title, created_at)
+            ''',
+        ],
+        "sqlite": [
+            "CREATE INDEX IX_conversations_user_center_time ON conversations (user_id, center_id, timestamp)",
+            "CREATE INDEX IX_conversation_sessions_user_updated ON conversation_sessions (user_id, last_updated DESC)",
+        ],
+    }),
+    (5, "index for conversation-scoped history pages", {
+        # Keyset pages on (timestamp, id); id rides along as the clustered key / rowid
+        "mssql": [
+            '''
+            CREATE INDEX IX_conversations_conversation_time
+            ON conversations (conversation_id, timestamp)
+            INCLUDE (user_id, center_id, role, message_id, feedback)
+            ''',
+        ],
+        "sqlite": [
+            "CREATE INDEX IX_conversations_conversation_time ON conversations (conversation_id, timestamp)",
+        ],
+    }),
+    (6, "raw markdown messages with an optional persisted render", {
+        # Assistant rows used to hold rendered HTML: it moves to message_html and
+        # message keeps its text, which is what the model is sent as history
+        "mssql": [
+            '''
+            IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS
+                          WHERE TABLE_NAME = 'conversations'
+                          AND COLUMN_NAME = 'message_html')
+            ALTER TABLE conversations ADD message_html NVARCHAR(MAX)
+            ''',
+            lambda cursor: _move_rendered_messages(cursor),
+        ],
+        "sqlite": [
+            lambda cursor: _sqlite_add_column(cursor, "conversations", "message_html", "TEXT"),
+            lambda cursor: _move_rendered_messages(cursor),
+        ],
+    }),
+    (7, "retention: per-center TTL, clear-session tombstones", {
+        # Tombstoned and expired messages are deleted in batches by retention.py
+        "mssql": [
+            '''
+            IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS
+                          WHERE TABLE_NAME = 'commercial_centers'
+                          AND COLUMN_NAME = 'retention_days')
+            ALTER TABLE commercial_centers ADD retention_days INT
+            ''',
+            '''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='session_tombstones' AND xtype='U')
+            CREATE TABLE session_tombstones (
+                user_id NVARCHAR(50) PRIMARY KEY,
+                cleared_at DATETIME2 NOT NULL
+            )
+            ''',
+            "CREATE INDEX IX_conversations_center_time ON conversations (center_id, timestamp)",
+        ],
+        "sqlite": [
+            lambda cursor: _sqlite_add_column(cursor, "commercial_centers", "retention_days", "INTEGER"),
+            '''
+            CREATE TABLE IF NOT EXISTS session_tombstones (
+                user_id TEXT PRIMARY KEY,
+                cleared_at TIMESTAMP NOT NULL
+            )
+            ''',
+            "CREATE INDEX IX_conversations_center_time ON conversations (center_id, timestamp)",
+        ],
+    }),
+    (8, "message_stats rollups by center, day and role", {
+        # Maintained by analytics.py; existing messages and votes are counted once here
+        "mssql": [
+            '''
+            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='message_stats' AND xtype='U')
+            CREATE TABLE message_stats (
+                center_id NVARCHAR(50) NOT NULL,
+                day DATE NOT NULL,
+                role NVARCHAR(50) NOT NULL,
+                messages INT NOT NULL DEFAULT 0,
+                tokens BIGINT NOT NULL DEFAULT 0,
+                prompt_tokens BIGINT NOT NULL DEFAULT 0,
+                latency_ms BIGINT NOT NULL DEFAULT 0,
+                latency_count INT NOT NULL DEFAULT 0,
+                max_latency_ms INT NOT NULL DEFAULT 0,
+                likes INT NOT NULL DEFAULT 0,
+                dislikes INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (center_id, day, role)
+            )
+            ''',
+            '''
+            INSERT INTO message_stats (center_id, day, role, messages, likes, dislikes)
+            SELECT center_id, CAST(timestamp AS DATE), role, COUNT(*),
+                   SUM(CASE WHEN feedback = 1 THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN feedback = -1 THEN 1 ELSE 0 END)
+            FROM conversations
+            WHERE center_id IS NOT NULL AND role IS NOT NULL AND timestamp IS NOT NULL
+            GROUP BY center_id, CAST(timestamp AS DATE), role
+            ''',
+        ],
+        "sqlite": [
+            '''
+            CREATE TABLE IF NOT EXISTS message_stats (
+                center_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                role TEXT NOT NULL,
+                messages INTEGER NOT NULL DEFAULT 0,
+                tokens INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                latency_ms INTEGER NOT NULL DEFAULT 0,
+                latency_count INTEGER NOT NULL DEFAULT 0,
+                max_latency_ms INTEGER NOT NULL DEFAULT 0,
+                likes INTEGER NOT NULL DEFAULT 0,
+                dislikes INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (center_id, day, role)
+            )
+            ''',
+            '''
+            INSERT INTO message_stats (center_id, day, role, messages, likes, dislikes)
+            SELECT center_id, substr(timestamp, 1, 10), role, COUNT(*),
+                   SUM(CASE WHEN feedback = 1 THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN feedback = -1 THEN 1 ELSE 0 END)
+            FROM conversations
+            WHERE center_id IS NOT NULL AND role IS NOT NULL AND timestamp IS NOT NULL
+            GROUP BY center_id, substr(timestamp, 1, 10), role
+            ''',
+        ],
+    }),
+    (9, "per-center serving configuration", {
+        # Read by tenants.py; NULL keeps the environment defaults. hostnames is a
+        # comma-separated list of the Host names the center is served on.
+        "mssql": [
+            _mssql_add_column("commercial_centers", "hostnames", "NVARCHAR(500)"),
+            _mssql_add_column("commercial_centers", "system_prompt", "NVARCHAR(MAX)"),
+            _mssql_add_column("commercial_centers", "contact_url", "NVARCHAR(255)"),
+            _mssql_add_column("commercial_centers", "search_index", "NVARCHAR(255)"),
+            _mssql_add_column("commercial_centers", "retrieval_top_k", "INT"),
+            _mssql_add_column("commercial_centers", "db_pool_size", "INT"),
+            _mssql_add_column("commercial_centers", "cache_max_entries", "INT"),
+        ],
+        "sqlite": [
+            lambda cursor: _sqlite_add_column(cursor, "commercial_centers", "hostnames", "TEXT"),
+            lambda cursor: _sqlite_add_column(cursor, "commercial_centers", "system_prompt", "TEXT"),
+            lambda cursor: _sqlite_add_column(cursor, "commercial_centers", "contact_url", "TEXT"),
+            lambda cursor: _sqlite_add_column(cursor, "commercial_centers", "search_index", "TEXT"),
+            lambda cursor: _sqlite_add_column(cursor, "commercial_centers", "retrieval_top_k", "INTEGER"),
+            lambda cursor: _sqlite_add_column(cursor, "commercial_centers", "db_pool_size", "INTEGER"),
+            lambda cursor: _sqlite_add_column(cursor, "commercial_centers", "cache_max_entries", "INTEGER"),
+        ],
+    }),
+]
+
+
+def _sqlite_add_column(cursor, table, column, definition):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _move_rendered_messages(cursor, chunk_size=1000):
+    last_id = 0
+    while True:
+        cursor.execute(
+            f"""SELECT id, message FROM conversations
+               WHERE id > ? AND role = 'assistant' AND message_html IS NULL AND message LIKE '<%'
+               ORDER BY id {db.limit_clause()}""",
+            (last_id, chunk_size)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        db.executemany(
+            cursor,
+            "UPDATE conversations SET message = ?, message_html = ? WHERE id = ?",
+            [(render.html_to_text(message), message, row_id) for row_id, message in rows]
+        )
+        last_id = rows[-1][0]
+
+
+def _ensure_version_table(cursor):
+    if db.DB_BACKEND == "sqlite":
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP
+        )
+        ''')
+    else:
+        cursor.execute('''
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='schema_version' AND xtype='U')
+        CREATE TABLE schema_version (
+            version INT PRIMARY KEY,
+            description NVARCHAR(255),
+            applied_at DATETIME2
+        )
+        ''')
+
+
+def applied_versions():
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        _ensure_version_table(cursor)
+        cursor.execute("SELECT version FROM schema_version")
+        return {row[0] for row in cursor.fetchall()}
+
+
+def _lock(cursor):
+    # Several workers or deploy slots may start at once; only one migrates
+    if db.DB_BACKEND == "sqlite":
+        cursor.execute("BEGIN IMMEDIATE")
+    else:
+        cursor.execute(
+            "EXEC sp_getapplock @Resource = 'schema_migrations', @LockMode = 'Exclusive', "
+            "@LockOwner = 'Transaction', @LockTimeout = 120000"
+        )
+
+
+def migrate(target=None):
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            _ensure_version_table(cursor)
+            conn.commit()
+            _lock(cursor)
+            cursor.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,))
+            if cursor.fetchone():
+                continue
+            for statement in statements[db.DB_BACKEND]:
+                if callable(statement):
+                    statement(cursor)
+                else:
+                    cursor.execute(statement)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, datetime.now().isoformat())
+            )
+        logging.info(f"Applied schema migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+def ensure_center(center_id, center_name):
+    # Ensure the configured commercial center exists
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM commercial_centers WHERE id = ?", (center_id,))
+        if not cursor.fetchone():
+            cursor.execute(
+                "INSERT INTO commercial_centers (id, name) VALUES (?, ?)",
+                (center_id, center_name or center_id)
+            )
+
+
+def status():
+    applied = applied_versions()
+    return [(version, description, version in applied) for version, description, _ in MIGRATIONS]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if "--status" in sys.argv:
+        for version, description, done in status():
+            print(f"{version:>3}  {'applied' if done else 'pending':<8} {description}")
+    else:
+        applied = migrate()
+        if os.getenv("COMMERCIAL_CENTER_ID"):
+            ensure_center(os.getenv("COMMERCIAL_CENTER_ID"), os.getenv("COMMERCIAL_CENTER_NAME"))
+        print(f"Applied {len(applied)} migration(s); schema is at version {MIGRATIONS[-1][0]}.")
@@ -0,0 +1,301 @@
+import os
+import time
+import fcntl
+import mmap
+import pickle
+import struct
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+# Per-user read results shared by every worker on the host: conversation
+# ownership checks ("session"), conversation lists and history pages. Without
+# it each gunicorn worker would keep its own copy, cold in the other three.
+#
+# Everything lives in one memory-mapped file, SHARED_CACHE_PATH (ideally on
+# tmpfs, e.g. /dev/shm/chatbot-cache); unset, reads go to the database as
+# before. The file holds
+#   - a version counter per user (hashed into SHARED_CACHE_VERSION_SLOTS),
+#     part of every key of that user: a write that changes what the user sees
+#     bumps it, and every older entry of the user stops matching at once.
+#     Readers take the version before loading, so a value read while a write
+#     lands is stored under the old version and never served. This needs the
+#     bump to follow the commit: with WRITE_BEHIND, insert_messages bumps again
+#     once the batch is committed, retiring pages read from the database
+#     before then.
+#   - a set-associative index of SHARED_CACHE_ENTRIES keys; a full set drops
+#     its least recently used entry.
+#   - a ring of SHARED_CACHE_BYTES holding the pickled values, overwritten
+#     oldest first; an entry whose bytes were overwritten is a miss.
+# Writers hold an flock on the file; readers take no lock and check what they
+# read against the write head and a checksum instead, so a torn or
+# overwritten entry is a miss, never a wrong value. Entries also expire after
+# SHARED_CACHE_TTL, which bounds how long changes made outside the app stay
+# invisible (the retention job bumps versions itself when it shares the file).
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", "")
+SHARED_CACHE_BYTES = int(os.getenv("SHARED_CACHE_BYTES", 64 * 1024 * 1024))
+SHARED_CACHE_ENTRIES = int(os.getenv("SHARED_CACHE_ENTRIES", 65536))
+SHARED_CACHE_WAYS = int(os.getenv("SHARED_CACHE_WAYS", 8))
+SHARED_CACHE_VERSION_SLOTS = int(os.getenv("SHARED_CACHE_VERSION_SLOTS", 65536))
+SHARED_CACHE_TTL = int(os.getenv("SHARED_CACHE_TTL", 300))
+SHARED_CACHE_MAX_VALUE_BYTES = int(os.getenv("SHARED_CACHE_MAX_VALUE_BYTES", 1024 * 1024))
+
+MAGIC = b"CBSCACHE"
+# magic, buckets, ways, version slots, ring bytes, write head (absolute, never wraps)
+HEADER = struct.Struct("<8sQQQQQ")
+HEADER_SIZE = 64
+HEAD_OFFSET = 40
+HEAD = struct.Struct("<Q")
+VERSION = struct.Struct("<Q")
+# key, ring position, checksum, last used (ms), length, expires (s), writer pid
+ENTRY = struct.Struct("<16sQQQIII4x")
+USED_OFFSET = 32
+KEY_SIZE = 16
+EMPTY_KEY = bytes(KEY_SIZE)
+
+
+def digest(data, size=KEY_SIZE):
+    return hashlib.blake2b(data, digest_size=size).digest()
+
+
+def checksum(data):
+    return int.from_bytes(digest(data, 8), "little")
+
+
+class SharedStore:
+    """Versions, index and value ring in one memory-mapped file."""
+
+    def __init__(self, path, ring_bytes=SHARED_CACHE_BYTES, entries=SHARED_CACHE_ENTRIES,
+                 ways=SHARED_CACHE_WAYS, version_slots=SHARED_CACHE_VERSION_SLOTS):
+        self.ways = ways
+        self.buckets = max(1, entries // ways)
+        self.version_slots = version_slots
+        self.ring_bytes = ring_bytes
+        self.versions_at = HEADER_SIZE
+        self.index_at = self.versions_at + version_slots * VERSION.size
+        self.ring_at = self.index_at + self.buckets * ways * ENTRY.size
+        size = self.ring_at + ring_bytes
+        header = HEADER.pack(MAGIC, self.buckets, ways, version_slots, ring_bytes, 0)[:HEAD_OFFSET]
+
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            with self._locked():
+                existing = os.fstat(self._fd).st_size
+                if existing == 0:
+                    os.ftruncate(self._fd, size)
+                    os.pwrite(self._fd, header, 0)
+                elif existing != size or os.pread(self._fd, HEAD_OFFSET, 0) != header:
+                    # Shrinking a file another process has mapped would crash it on access
+                    raise ValueError(f"{path} was created with another layout; remove it or use another path")
+                self._map = mmap.mmap(self._fd, size)
+        except Exception:
+            os.close(self._fd)
+            raise
+        self.pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        # flock excludes other processes, the thread lock the other threads of this one
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _head(self):
+        return HEAD.unpack_from(self._map, HEAD_OFFSET)[0]
+
+    def _version_at(self, user):
+        return self.versions_at + int.from_bytes(user[:8], "little") % self.version_slots * VERSION.size
+
+    def version(self, user):
+        return VERSION.unpack_from(self._map, self._version_at(user))[0]
+
+    def bump(self, user):
+        at = self._version_at(user)
+        with self._locked():
+            VERSION.pack_into(self._map, at, VERSION.unpack_from(self._map, at)[0] + 1)
+
+    def _bucket(self, key):
+        index = int.from_bytes(key[8:], "little") % self.buckets
+        return self.index_at + index * self.ways * ENTRY.size
+
+    def _live(self, position, length, head):
+        return head - self.ring_bytes <= position and position + length <= head
+
+    def get(self, key, now):
+        """(value bytes, writer pid), or (None, reason) on a miss."""
+        start = self._bucket(key)
+        for at in range(start, start + self.ways * ENTRY.size, ENTRY.size):
+            if self._map[at:at + KEY_SIZE] != key:
+                continue
+            found, position, value_sum, _, length, expires, pid = ENTRY.unpack_from(self._map, at)
+            if found != key:
+                return None, "misses"  # replaced since the key was compared
+            if expires <= now:
+                return None, "expired"
+            if not self._live(position, length, self._head()):
+                return None, "overwritten"
+            offset = self.ring_at + position % self.ring_bytes
+            data = self._map[offset:offset + length]
+            # The head moves before a writer overwrites, so this catches a copy it raced
+            if not self._live(position, length, self._head()) or checksum(data) != value_sum:
+                return None, "overwritten"
+            struct.pack_into("<Q", self._map, at + USED_OFFSET, int(now * 1000))
+            return data, pid
+        return None, "misses"
+
+    def put(self, key, data, expires, now):
+        """Stores data under key; returns True if a live entry was evicted for it."""
+        with self._locked():
+            head = self._head()
+            if head % self.ring_bytes + len(data) > self.ring_bytes:
+                head += self.ring_bytes - head % self.ring_bytes  # the end of the lap stays unused
+            new_head = head + len(data)
+            HEAD.pack_into(self._map, HEAD_OFFSET, new_head)
+            offset = self.ring_at + head % self.ring_bytes
+            self._map[offset:offset + len(data)] = data
+
+            # The same key (two workers missed together), else a free or dead slot, else the LRU one
+            start = self._bucket(key)
+            same, free, victim, victim_used = None, None, None, None
+            for at in range(start, start + self.ways * ENTRY.size, ENTRY.size):
+                found, position, _, used, length, entry_expires, _ = ENTRY.unpack_from(self._map, at)
+                if found == key:
+                    same = at
+                    break
+                if found == EMPTY_KEY or entry_expires <= now or not self._live(position, length, new_head):
+                    free = at if free is None else free
+                elif victim_used is None or used < victim_used:
+                    victim, victim_used = at, used
+            slot = same or free or victim
+            ENTRY.pack_into(self._map, slot, key, head, checksum(data), int(now * 1000), len(data), expires,
+                            os.getpid())
+            return slot == victim
+
+    def usage(self):
+        head = self._head()
+        return {"ring_bytes": self.ring_bytes, "ring_used": min(head, self.ring_bytes), "written": head,
+                "capacity": self.buckets * self.ways, "version_slots": self.version_slots}
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+class SharedCache:
+    """Per-user values shared by the workers of a host, under versioned keys.
+
+    cached(namespace, user_id, params, load) returns the stored value or stores
+    what load() returns; invalidate(user_id) retires every value of the user.
+    Values are pickled: the file is private to the app's user, like its memory.
+    """
+
+    def __init__(self, path=SHARED_CACHE_PATH, ttl=SHARED_CACHE_TTL,
+                 max_value_bytes=SHARED_CACHE_MAX_VALUE_BYTES, store_factory=SharedStore):
+        self.path = path
+        self.ttl = ttl
+        self.max_value_bytes = max_value_bytes
+        self.store_factory = store_factory
+        self._store = None
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "overwritten": 0,
+            "stores": 0,
+            "evictions": 0,
+            "too_large": 0,
+            "invalidations": 0,
+            "errors": 0,
+        }
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _shared_store(self):
+        # The mapping is opened once per worker, after the fork
+        if not self.path:
+            return None
+        if self._store is None or self._store.pid != os.getpid():
+            with self._lock:
+                if self._store is None or self._store.pid != os.getpid():
+                    try:
+                        self._store = self.store_factory(self.path)
+                    except (OSError, ValueError) as e:
+                        logging.error(f"Shared cache disabled: {e}")
+                        self.path = ""
+                        return None
+        return self._store
+
+    def cached(self, namespace, user_id, params, load):
+        store = self._shared_store()
+        if store is None:
+            return load()
+        user_id = str(user_id).lower()  # SQL Server returns UNIQUEIDENTIFIER values in upper case
+        try:
+            user = digest(user_id.encode("utf-8"))
+            # Read before loading: a write landing meanwhile bumps past this version
+            version = store.version(user)
+            key = digest(repr((namespace, user_id, version, params)).encode("utf-8"))
+            now = time.time()
+            data, found = store.get(key, now)
+        except Exception as e:
+            logging.error(f"Error reading shared cache: {e}")
+            self._count("errors")
+            return load()
+        if data is not None:
+            self._count("hits" if found == os.getpid() else "shared_hits")
+            return pickle.loads(data)
+
+        self._count("misses")
+        if found != "misses":
+            self._count(found)
+        value = load()
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_value_bytes or len(data) > store.ring_bytes:
+            self._count("too_large")
+            return value
+        try:
+            evicted = store.put(key, data, int(now + self.ttl), now)
+        except Exception as e:
+            logging.error(f"Error writing shared cache: {e}")
+            self._count("errors")
+            return value
+        self._count("stores")
+        if evicted:
+            self._count("evictions")
+        return value
+
+    def invalidate(self, user_id):
+        store = self._shared_store()
+        if store is None:
+            return
+        try:
+            store.bump(digest(str(user_id).lower().encode("utf-8")))
+        except Exception as e:
+            # Entries of this user may now be stale until they expire
+            logging.error(f"Error invalidating shared cache: {e}")
+            self._count("errors")
+            return
+        self._count("invalidations")
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+        lookups = data["hits"] + data["shared_hits"] + data["misses"]
+        data["hit_rate"] = (data["hits"] + data["shared_hits"]) / lookups if lookups else 0.0
+        data["enabled"] = self.enabled
+        store = self._shared_store()
+        data["shared"] = dict(store.usage(), path=self.path, ttl=self.ttl) if store is not None else None
+        return data
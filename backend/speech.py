@@ -0,0 +1,351 @@
+import os
+import re
+import json
+import time
+import threading
+from abc import ABC, abstractmethod
+from xml.sax.saxutils import escape, quoteattr
+import metrics
+from streaming import LatencyStats
+
+# Voice turns (POST /speech). The browser streams microphone audio as 16 kHz,
+# 16-bit mono PCM in a WAV container with a chunked request body, and each
+# chunk is forwarded to the recognizer as it arrives: recognition runs while
+# the user is still speaking, so the transcript is ready shortly after the last
+# chunk. The transcript then goes through the same chat flow as typed input.
+# The answer comes back as audio: its text is cut into sentences as it streams
+# from the model, and each sentence is synthesized as soon as it is complete,
+# so the first one plays while the rest of the answer is still being written.
+#
+# Latency is measured from the end of the user's speech, i.e. the last chunk
+# of the upload, to the transcript and to the first audio byte sent back.
+#
+# Off unless SPEECH_BACKEND is set: "azure" uses the Azure Speech REST
+# endpoints with SPEECH_API_KEY and SPEECH_REGION, "fake" is the offline
+# stand-in below. Without it the browser keeps its own speech recognition.
+# Recognition through REST is limited to SPEECH_MAX_SECONDS of audio a turn.
+SPEECH_BACKEND = os.getenv("SPEECH_BACKEND", "").lower()
+SPEECH_API_KEY = os.getenv("SPEECH_API_KEY")
+SPEECH_REGION = os.getenv("SPEECH_REGION", "westeurope")
+SPEECH_LANGUAGE = os.getenv("SPEECH_LANGUAGE", "fr-FR")
+SPEECH_OUTPUT_FORMAT = os.getenv("SPEECH_OUTPUT_FORMAT", "audio-24khz-48kbitrate-mono-mp3")
+SPEECH_TIMEOUT = float(os.getenv("SPEECH_TIMEOUT", 30))
+SPEECH_MAX_SECONDS = int(os.getenv("SPEECH_MAX_SECONDS", 60))
+SPEECH_CHUNK_BYTES = int(os.getenv("SPEECH_CHUNK_BYTES", 8000))  # 250 ms of audio
+SPEECH_MIN_SENTENCE_CHARS = int(os.getenv("SPEECH_MIN_SENTENCE_CHARS", 24))
+
+SAMPLE_RATE = 16000
+SAMPLE_BYTES = 2
+WAV_HEADER_BYTES = 44
+INPUT_CONTENT_TYPE = f"audio/wav; codecs=audio/pcm; samplerate={SAMPLE_RATE}"
+MAX_AUDIO_BYTES = WAV_HEADER_BYTES + SPEECH_MAX_SECONDS * SAMPLE_RATE * SAMPLE_BYTES
+
+# Neural voice per recognition language; SPEECH_VOICES (JSON) overrides or adds
+VOICES = {
+    "en-US": "en-US-JennyNeural",
+    "en-GB": "en-GB-SoniaNeural",
+    "fr-FR": "fr-FR-DeniseNeural",
+    "es-ES": "es-ES-ElviraNeural",
+    "de-DE": "de-DE-KatjaNeural",
+    "it-IT": "it-IT-ElsaNeural",
+    "pt-BR": "pt-BR-FranciscaNeural",
+    "ru-RU": "ru-RU-SvetlanaNeural",
+    "zh-CN": "zh-CN-XiaoxiaoNeural",
+    "ja-JP": "ja-JP-NanamiNeural",
+    "ar-SA": "ar-SA-ZariyahNeural",
+    "hi-IN": "hi-IN-SwaraNeural",
+}
+VOICES.update(json.loads(os.getenv("SPEECH_VOICES", "{}")))
+
+
+class SpeechError(Exception):
+    pass
+
+
+class AudioTooLong(Exception):
+    pass
+
+
+def enabled():
+    return SPEECH_BACKEND == "fake" or (SPEECH_BACKEND == "azure" and bool(SPEECH_API_KEY))
+
+
+# Answer text to sentences
+
+# Latin sentence ends need the space after them ("10.30" is not one); CJK ones do not
+SENTENCE_END = re.compile(r'[.!?…]+["»”)\]]*\s+|[。！？]+|\n+')
+MARKDOWN_LINK = re.compile(r'\[([^\]]*)\]\([^)]*\)')
+URL = re.compile(r'https?://\S+')
+LIST_MARKER = re.compile(r'^\s*(?:[-+*]|\d+[.)])\s+')
+MARKDOWN_MARKS = re.compile(r'[*_`#>|~]+')
+
+
+def speakable(text):
+    """Markdown answer text as it should be read aloud."""
+    text = MARKDOWN_LINK.sub(r'\1', text)
+    text = URL.sub('', text)
+    text = LIST_MARKER.sub('', text)
+    text = MARKDOWN_MARKS.sub('', text)
+    return ' '.join(text.split())
+
+
+class SentenceSplitter:
+    """Cuts streamed answer text into sentences, each read aloud on its own.
+
+    Sentences shorter than min_chars are held and joined with the next, so a
+    "Bonjour !" does not cost a synthesis call of its own.
+    """
+
+    def __init__(self, min_chars=SPEECH_MIN_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self._buffer = ''
+        self._pending = ''
+
+    def feed(self, text):
+        self._buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self._buffer):
+            piece = speakable(self._buffer[start:match.end()])
+            start = match.end()
+            if not piece:
+                continue
+            self._pending = f"{self._pending} {piece}" if self._pending else piece
+            if len(self._pending) >= self.min_chars:
+                sentences.append(self._pending)
+                self._pending = ''
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self):
+        text = f"{self._pending} {speakable(self._buffer)}".strip()
+        self._pending = self._buffer = ''
+        return [text] if text else []
+
+
+# Engines
+
+class Recognizer(ABC):
+    @abstractmethod
+    def transcribe(self, chunks, language):
+        """The transcript of the audio in `chunks`, an iterable of bytes consumed
+        as the client sends them; '' when no speech was recognized."""
+
+
+class Synthesizer(ABC):
+    mimetype = "audio/mpeg"
+
+    @abstractmethod
+    def synthesize(self, text, language, voice):
+        """Yields the audio of `text` in chunks, as soon as each is available.
+
+        Consecutive outputs must concatenate into one playable stream.
+        """
+
+
+class AzureSpeech(Recognizer, Synthesizer):
+    """Azure Speech over REST: chunked uploads for recognition, streamed synthesis."""
+
+    def __init__(self, api_key=SPEECH_API_KEY, region=SPEECH_REGION, timeout=SPEECH_TIMEOUT):
+        # Comes with the openai SDK; imported here so the fake backend does not need it
+        import httpx
+        self._httpx = httpx
+        self.api_key = api_key
+        self.stt_url = (f"https://{region}.stt.speech.microsoft.com"
+                        "/speech/recognition/conversation/cognitiveservices/v1")
+        self.tts_url = f"https://{region}.tts.speech.microsoft.com/cognitiveservices/v1"
+        self.client = httpx.Client(timeout=timeout)
+
+    def transcribe(self, chunks, language):
+        try:
+            # An iterable body goes out with Transfer-Encoding: chunked, one chunk at a time
+            response = self.client.post(
+                self.stt_url,
+                params={"language": language, "format": "simple"},
+                headers={"Ocp-Apim-Subscription-Key": self.api_key, "Content-Type": INPUT_CONTENT_TYPE,
+                         "Accept": "application/json"},
+                content=chunks,
+            )
+        except self._httpx.HTTPError as e:
+            raise SpeechError(f"recognition request failed: {e}") from e
+        if response.status_code != 200:
+            raise SpeechError(f"recognition failed with HTTP {response.status_code}")
+        result = response.json()
+        # NoMatch, InitialSilenceTimeout and BabbleTimeout all mean nothing to answer
+        if result.get("RecognitionStatus") != "Success":
+            return ''
+        return result.get("DisplayText", '')
+
+    def synthesize(self, text, language, voice):
+        ssml = (f"<speak version='1.0' xml:lang={quoteattr(language)}>"
+                f"<voice name={quoteattr(voice)}>{escape(text)}</voice></speak>")
+        headers = {"Ocp-Apim-Subscription-Key": self.api_key, "Content-Type": "application/ssml+xml",
+                   "X-Microsoft-OutputFormat": SPEECH_OUTPUT_FORMAT, "User-Agent": "iachatbot"}
+        try:
+            with self.client.stream("POST", self.tts_url, headers=headers,
+                                    content=ssml.encode("utf-8")) as response:
+                if response.status_code != 200:
+                    raise SpeechError(f"synthesis failed with HTTP {response.status_code}")
+                yield from response.iter_bytes()
+        except self._httpx.HTTPError as e:
+            raise SpeechError(f"synthesis request failed: {e}") from e
+
+
+# Offline stand-in for Azure Speech
+FAKE_SPEECH_RECOGNITION_DELAY = float(os.getenv("FAKE_SPEECH_RECOGNITION_DELAY", 0.15))
+FAKE_SPEECH_SYNTHESIS_DELAY = float(os.getenv("FAKE_SPEECH_SYNTHESIS_DELAY", 0.1))
+FAKE_SPEECH_TRANSCRIPT = os.getenv("FAKE_SPEECH_TRANSCRIPT", "Quels sont les horaires d'ouverture ?")
+
+# One MPEG-1 Layer III frame of silence: 128 kbit/s, 44.1 kHz, mono, 26 ms
+SILENT_MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0xC0]) + bytes(413)
+FAKE_FRAMES_PER_WORD = 12
+
+
+class FakeSpeech(Recognizer, Synthesizer):
+    """Hears the UTF-8 text sent in place of samples, so tests pick the
+    transcript (real microphone audio is heard as FAKE_SPEECH_TRANSCRIPT), and
+    speaks silent MP3 whose length follows the number of words."""
+
+    def __init__(self, recognition_delay=FAKE_SPEECH_RECOGNITION_DELAY,
+                 synthesis_delay=FAKE_SPEECH_SYNTHESIS_DELAY):
+        self.recognition_delay = recognition_delay
+        self.synthesis_delay = synthesis_delay
+
+    def transcribe(self, chunks, language):
+        audio = b''.join(chunks)
+        time.sleep(self.recognition_delay)
+        samples = audio[WAV_HEADER_BYTES:] if audio.startswith(b"RIFF") else audio
+        if not samples.strip(b"\0"):
+            return ''
+        try:
+            text = samples.decode("utf-8").strip()
+        except UnicodeDecodeError:
+            return FAKE_SPEECH_TRANSCRIPT
+        return text if text.isprintable() else FAKE_SPEECH_TRANSCRIPT
+
+    def synthesize(self, text, language, voice):
+        time.sleep(self.synthesis_delay)
+        frames = FAKE_FRAMES_PER_WORD * max(1, len(text.split()))
+        for start in range(0, frames, FAKE_FRAMES_PER_WORD):
+            yield SILENT_MP3_FRAME * min(FAKE_FRAMES_PER_WORD, frames - start)
+
+
+def create_engine():
+    if SPEECH_BACKEND == "fake":
+        return FakeSpeech()
+    return AzureSpeech()
+
+
+# Latency from the end of the user's speech, and synthesis time per sentence
+transcript_latency = LatencyStats()
+first_audio_latency = LatencyStats()
+sentence_latency = LatencyStats()
+
+
+class VoiceTurn:
+    """One voice turn: reads the upload into the recognizer, then speaks the answer."""
+
+    def __init__(self, pipeline, language, voice):
+        self.pipeline = pipeline
+        self.language = language
+        self.voice = voice
+        self.speech_ended = None
+        self.first_audio_at = None
+        self.audio_in = 0
+        self.audio_out = 0
+
+    def upload(self, read, chunk_bytes=SPEECH_CHUNK_BYTES, max_bytes=MAX_AUDIO_BYTES):
+        # The request body, chunk by chunk as it arrives; its end is the end of speech
+        while True:
+            chunk = read(chunk_bytes)
+            if not chunk:
+                break
+            self.audio_in += len(chunk)
+            if self.audio_in > max_bytes:
+                raise AudioTooLong(f"more than {SPEECH_MAX_SECONDS} s of audio")
+            yield chunk
+        self.speech_ended = time.perf_counter()
+
+    def transcribe(self, read):
+        try:
+            transcript = self.pipeline.recognizer.transcribe(self.upload(read), self.language).strip()
+        except AudioTooLong:
+            self.pipeline.count("too_long")
+            raise
+        except SpeechError:
+            self.pipeline.count("errors")
+            raise
+        finally:
+            self.pipeline.count("audio_bytes_in", self.audio_in)
+        if self.speech_ended is None:
+            # The recognizer stopped reading early, e.g. at a long silence
+            self.speech_ended = time.perf_counter()
+        elapsed = time.perf_counter() - self.speech_ended
+        transcript_latency.observe(elapsed)
+        metrics.speech_seconds.observe(elapsed, stage="transcript")
+        self.pipeline.count("turns" if transcript else "no_speech")
+        return transcript
+
+    def speak(self, sentence):
+        started = time.perf_counter()
+        for chunk in self.pipeline.synthesizer.synthesize(sentence, self.language, self.voice):
+            if not chunk:
+                continue
+            now = time.perf_counter()
+            if started is not None:
+                sentence_latency.observe(now - started)
+                metrics.speech_seconds.observe(now - started, stage="sentence")
+                started = None
+            if self.first_audio_at is None:
+                self.first_audio_at = now
+                first_audio_latency.observe(now - self.speech_ended)
+                metrics.speech_seconds.observe(now - self.speech_ended, stage="first_audio")
+            self.audio_out += len(chunk)
+            yield chunk
+        self.pipeline.count("sentences")
+
+    def finish(self):
+        self.pipeline.count("audio_bytes_out", self.audio_out)
+
+
+class Pipeline:
+    """The recognizer and synthesizer of this worker, and counters of the turns they served."""
+
+    def __init__(self, recognizer, synthesizer):
+        self.recognizer = recognizer
+        self.synthesizer = synthesizer
+        self._lock = threading.Lock()
+        self.stats = {"turns": 0, "no_speech": 0, "too_long": 0, "errors": 0, "sentences": 0,
+                      "audio_bytes_in": 0, "audio_bytes_out": 0}
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def turn(self, language):
+        """A VoiceTurn in `language`; raises ValueError for one without a voice."""
+        voice = VOICES.get(language)
+        if voice is None:
+            raise ValueError(f"Unsupported language: {language}")
+        return VoiceTurn(self, language, voice)
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+        data["backend"] = SPEECH_BACKEND
+        data["transcript"] = transcript_latency.snapshot()
+        data["first_audio"] = first_audio_latency.snapshot()
+        data["sentence"] = sentence_latency.snapshot()
+        return data
+
+
+_pipelines = {}
+
+
+def get_pipeline():
+    # Created on first use, once per process: HTTP connection pools must not cross a fork
+    pid = os.getpid()
+    if pid not in _pipelines:
+        engine = create_engine()
+        _pipelines[pid] = Pipeline(engine, engine)
+    return _pipelines[pid]
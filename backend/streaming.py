@@ -0,0 +1,203 @@
+import json
+import re
+import threading
+import time
+from collections import deque
+import metrics
+import render
+
+DOC_REF = re.compile(r'\[doc\d+\]')
+# A suffix that could still grow into a [docN] marker
+PARTIAL_DOC_REF = re.compile(r'\[(d(o(c\d*)?)?)?$')
+
+
+def strip_doc_refs(text):
+    return DOC_REF.sub('', text)
+
+
+class DocRefStripper:
+    """Removes [docN] markers from a stream, even when split across chunks."""
+
+    def __init__(self):
+        self._pending = ''
+
+    def feed(self, chunk):
+        text = strip_doc_refs(self._pending + chunk)
+        match = PARTIAL_DOC_REF.search(text)
+        if match:
+            self._pending = text[match.start():]
+            return text[:match.start()]
+        self._pending = ''
+        return text
+
+    def flush(self):
+        text, self._pending = self._pending, ''
+        return text
+
+
+class MarkdownBlockRenderer:
+    """Renders markdown one finished block at a time as text streams in.
+
+    A block is complete once a blank line follows it outside a code fence, so
+    earlier blocks are rendered once and never re-rendered. Each rendered block
+    is returned with the offset of the raw text it covers up to.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self._done = 0  # offset of the first unrendered character
+
+    def feed(self, chunk):
+        self.text += chunk
+        blocks = []
+        while True:
+            cut = self._next_boundary()
+            if cut is None:
+                return blocks
+            block = self.text[self._done:cut]
+            self._done = cut
+            if block.strip():
+                blocks.append((render.to_html(block), cut))
+
+    def _next_boundary(self):
+        start = self._done
+        while True:
+            idx = self.text.find('\n\n', start)
+            if idx == -1:
+                return None
+            # Blank lines inside an open ``` fence do not end a block
+            if self.text.count('```', self._done, idx) % 2 == 0:
+                return idx + 2
+            start = idx + 2
+
+    @property
+    def tail(self):
+        return self.text[self._done:]
+
+    def finish(self):
+        tail = self.tail
+        self._done = len(self.text)
+        return render.to_html(tail) if tail.strip() else ''
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class AnswerStream:
+    """Turns upstream completion chunks into SSE frames for one answer.
+
+    "delta" carries raw text as it arrives, "block" carries each finished
+    markdown block rendered to HTML, "done" closes the stream.
+    """
+
+    def __init__(self, started, user_message_id, assistant_message_id):
+        self.started = started
+        self.user_message_id = user_message_id
+        self.assistant_message_id = assistant_message_id
+        self.first_token_at = None
+        self.usage = None
+        self._stripper = DocRefStripper()
+        self._renderer = MarkdownBlockRenderer()
+
+    @property
+    def text(self):
+        return self._renderer.text
+
+    def start(self):
+        return sse("start", {
+            "user_message_id": self.user_message_id,
+            "assistant_message_id": self.assistant_message_id
+        })
+
+    def feed(self, chunk):
+        return self.feed_text(self._chunk_text(chunk))
+
+    def _chunk_text(self, chunk):
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+        # Azure sends citation/context chunks with no choices or no content
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            return ''
+        return self._stripper.feed(chunk.choices[0].delta.content)
+
+    def text_deltas(self, chunks):
+        # Upstream chunks as marker-free text, for answers shared between requests (coalesce.py)
+        for chunk in chunks:
+            yield self._chunk_text(chunk)
+        yield self._stripper.flush()
+
+    async def atext_deltas(self, chunks):
+        async for chunk in chunks:
+            yield self._chunk_text(chunk)
+        yield self._stripper.flush()
+
+    def feed_text(self, text):
+        # Text that is already free of [docN] markers, e.g. a cached answer
+        if not text:
+            return []
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            time_to_first_token.observe(self.first_token_at - self.started)
+            metrics.first_token_seconds.observe(self.first_token_at - self.started)
+        frames = [sse("delta", {"text": text})]
+        for html, end in self._renderer.feed(text):
+            frames.append(sse("block", {"html": html, "end": end}))
+        return frames
+
+    def finish(self):
+        frames = self.feed_text(self._stripper.flush())
+        last_block = self._renderer.finish()
+        if last_block:
+            frames.append(sse("block", {"html": last_block, "end": len(self.text)}))
+        return frames
+
+    def done(self, response):
+        elapsed = time.perf_counter() - self.started
+        stream_duration.observe(elapsed)
+        metrics.stream_seconds.observe(elapsed)
+        ttft = self.first_token_at - self.started if self.first_token_at else None
+        return sse("done", {
+            "response": response,
+            "user_message_id": self.user_message_id,
+            "assistant_message_id": self.assistant_message_id,
+            "ttft_ms": ttft * 1000 if ttft is not None else None,
+            "total_ms": elapsed * 1000
+        })
+
+    def error(self):
+        return sse("error", {"error": "Could not process your request."})
+
+
+class LatencyStats:
+    """Keeps a window of recent samples (seconds) and reports percentiles."""
+
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._samples.append(value)
+            self.count += 1
+            self.total += value
+
+    def snapshot(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count, total = self.count, self.total
+        data = {"count": count, "mean_ms": (total / count * 1000) if count else None}
+        for p in (50, 95, 99):
+            if samples:
+                idx = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+                data[f"p{p}_ms"] = samples[idx] * 1000
+            else:
+                data[f"p{p}_ms"] = None
+        return data
+
+
+# Time from request arrival to the first forwarded token, and total stream duration
+time_to_first_token = LatencyStats()
+stream_duration = LatencyStats()
@@ -0,0 +1,219 @@
+import os
+import hmac
+import time
+import logging
+import threading
+import contextvars
+import db
+import llm
+import cache
+
+# Which commercial center a request is for, and everything that differs per
+# center: name, system prompt and contact URL, search index and retrieval
+# parameters, and the budgets of its DB pool and response cache.
+#
+# With TENANCY=single (the default) every request is for COMMERCIAL_CENTER_ID,
+# as before. With TENANCY=multi one fleet serves every center: a request is
+# resolved by its Host against commercial_centers.hostnames, then falls back
+# to COMMERCIAL_CENTER_ID if set. A front door that routes by something else
+# can name the center in the TENANT_HEADER header instead; the header is only
+# honoured alongside TENANT_SECRET_HEADER carrying TENANT_HEADER_SECRET, since
+# a client can send any header it likes. Without a secret it is ignored. Each center then draws its connections from
+# its own pool, so one busy center cannot take every connection of a worker.
+#
+# Configurations are read from commercial_centers in one query and reloaded
+# every TENANT_CONFIG_TTL seconds. A reload keeps each center's response cache,
+# which stays warm across config changes; a changed budget is applied in place.
+# Unset columns fall back to the single-center environment variables.
+TENANCY = os.getenv("TENANCY", "single").lower()
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Commercial-Center")
+TENANT_SECRET_HEADER = os.getenv("TENANT_SECRET_HEADER", "X-Tenant-Secret")
+TENANT_HEADER_SECRET = os.getenv("TENANT_HEADER_SECRET", "")
+TENANT_CONFIG_TTL = float(os.getenv("TENANT_CONFIG_TTL", 60))
+TENANT_DB_POOL_SIZE = int(os.getenv("TENANT_DB_POOL_SIZE", 4))
+TENANT_CACHE_MAX_ENTRIES = int(os.getenv("TENANT_CACHE_MAX_ENTRIES", cache.RESPONSE_CACHE_MAX_ENTRIES))
+
+DEFAULT_CENTER_ID = os.getenv("COMMERCIAL_CENTER_ID")
+DEFAULT_CENTER_NAME = os.getenv("COMMERCIAL_CENTER_NAME")
+
+COLUMNS = ["id", "name", "hostnames", "system_prompt", "contact_url", "search_index",
+           "retrieval_top_k", "db_pool_size", "cache_max_entries"]
+
+_current = contextvars.ContextVar("tenant", default=None)
+
+
+class UnknownCenter(Exception):
+    pass
+
+
+class Center:
+    """Serving configuration of one commercial center."""
+
+    def __init__(self, id, name=None, hostnames=None, system_prompt=None, contact_url=None,
+                 search_index=None, retrieval_top_k=None, db_pool_size=None, cache_max_entries=None):
+        self.id = id
+        self.name = name or id
+        self.hostnames = [h.strip().lower() for h in (hostnames or "").split(",") if h.strip()]
+        self.contact_url = contact_url or llm.CONTACT_URL
+        self.system_prompt = system_prompt or llm.SYSTEM_PROMPT_TEMPLATE.format(contact_url=self.contact_url)
+        self.search_index = search_index or llm.search_index
+        self.retrieval_top_k = retrieval_top_k or None
+        self.db_pool_size = db_pool_size or TENANT_DB_POOL_SIZE
+        self.cache_max_entries = cache_max_entries or TENANT_CACHE_MAX_ENTRIES
+        self.response_cache = None  # set by the registry
+
+    def grounding(self):
+        # azure_search data source parameters that differ from the defaults
+        params = {"index_name": self.search_index, "role_information": self.system_prompt}
+        if self.retrieval_top_k:
+            params["top_n_documents"] = self.retrieval_top_k
+        return params
+
+    def snapshot(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "hostnames": self.hostnames,
+            "contact_url": self.contact_url,
+            "search_index": self.search_index,
+            "retrieval_top_k": self.retrieval_top_k,
+            "db_pool_size": self.db_pool_size,
+            "cache_max_entries": self.cache_max_entries,
+        }
+
+
+def load_centers():
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(COLUMNS)} FROM commercial_centers")
+        return [Center(**dict(zip(COLUMNS, row))) for row in cursor.fetchall()]
+
+
+class Registry:
+    """Centers by id and hostname, reloaded from the database after a TTL.
+
+    cache_factory(max_entries) builds a center's response cache the first time
+    the center is seen.
+    """
+
+    def __init__(self, cache_factory, loader=load_centers, ttl=TENANT_CONFIG_TTL,
+                 default_center_id=DEFAULT_CENTER_ID):
+        self.cache_factory = cache_factory
+        self.loader = loader
+        self.ttl = ttl
+        self.default_center_id = default_center_id
+        self._centers = {}  # id -> Center
+        self._hosts = {}  # hostname -> Center
+        self._caches = {}  # id -> ResponseCache, kept across reloads
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self.stats = {"resolved": 0, "by_header": 0, "by_host": 0, "by_default": 0, "unknown": 0,
+                      "untrusted_headers": 0, "reloads": 0, "reload_errors": 0}
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < self.ttl:
+            return
+        with self._lock:
+            if self._loaded_at is not None and now - self._loaded_at < self.ttl:
+                return
+            try:
+                centers = self.loader()
+            except Exception as e:
+                # Keep serving the last configuration (or the env one); retry after the TTL
+                logging.error(f"Error loading center configuration: {e}")
+                self.stats["reload_errors"] += 1
+                self._loaded_at = now
+                return
+            hosts = {}
+            for center in centers:
+                cache = self._caches.get(center.id)
+                if cache is None:
+                    cache = self._caches[center.id] = self.cache_factory(center.cache_max_entries)
+                cache.max_entries = center.cache_max_entries
+                center.response_cache = cache
+                for hostname in center.hostnames:
+                    hosts[hostname] = center
+            self._centers = {center.id: center for center in centers}
+            self._hosts = hosts
+            self._loaded_at = now
+            self.stats["reloads"] += 1
+
+    def _fallback(self, center_id):
+        # A center missing from the table, e.g. before schema.py has run: env config only
+        with self._lock:
+            center = self._centers.get(center_id)
+            if center is None:
+                center = self._centers[center_id] = Center(center_id, DEFAULT_CENTER_NAME)
+                if center_id not in self._caches:
+                    self._caches[center_id] = self.cache_factory(center.cache_max_entries)
+                center.response_cache = self._caches[center_id]
+        return center
+
+    def resolve(self, host=None, header=None, secret=None):
+        """The center for a request's Host and tenant header; raises UnknownCenter."""
+        self._refresh()
+        if TENANCY == "multi":
+            if header and not trusted(secret):
+                self.stats["untrusted_headers"] += 1
+                header = None
+            if header:
+                center = self._centers.get(header)
+                if center is None:
+                    self.stats["unknown"] += 1
+                    raise UnknownCenter(header)
+                self.stats["by_header"] += 1
+                self.stats["resolved"] += 1
+                return center
+            hostname = (host or "").rsplit(":", 1)[0].lower()
+            center = self._hosts.get(hostname)
+            if center is not None:
+                self.stats["by_host"] += 1
+                self.stats["resolved"] += 1
+                return center
+        if not self.default_center_id:
+            self.stats["unknown"] += 1
+            raise UnknownCenter(host)
+        self.stats["by_default"] += 1
+        self.stats["resolved"] += 1
+        return self._centers.get(self.default_center_id) or self._fallback(self.default_center_id)
+
+    def centers(self):
+        self._refresh()
+        return list(self._centers.values())
+
+    def snapshot(self):
+        centers = {}
+        pools = db.all_pool_stats()
+        for center in list(self._centers.values()):
+            data = center.snapshot()
+            data["response_cache"] = center.response_cache.snapshot() if center.response_cache else None
+            pool = pools.get(pool_name(center)) if TENANCY == "multi" else None
+            data["pool"] = {key: pool[key] for key in ("max_size", "open", "in_use", "waits", "timeouts")} \
+                if pool else None
+            centers[center.id] = data
+        return {"mode": TENANCY, "header": TENANT_HEADER, "header_trusted": bool(TENANT_HEADER_SECRET),
+                "stats": dict(self.stats), "centers": centers}
+
+
+def trusted(secret):
+    # Whether a request's tenant header was set by the front door
+    return bool(TENANT_HEADER_SECRET) and hmac.compare_digest((secret or "").encode(), TENANT_HEADER_SECRET.encode())
+
+
+def pool_name(center):
+    return f"center:{center.id}"
+
+
+def activate(center):
+    """Makes center the current one for this request, and its pool the one used."""
+    _current.set(center)
+    if TENANCY == "multi":
+        db.use_pool(pool_name(center), center.db_pool_size)
+
+
+def current():
+    center = _current.get()
+    if center is None:
+        raise UnknownCenter("no center resolved for this request")
+    return center
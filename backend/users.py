@@ -0,0 +1,190 @@
+import os
+import mmap
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+import db
+
+# Users are never deleted, so once a user row is known to exist it stays known.
+# KnownUsers remembers the ids this worker has seen in a bounded LRU; a repeat
+# visit costs no database round trip and a first visit costs one idempotent
+# upsert (MERGE on Azure SQL, INSERT OR IGNORE on SQLite) instead of a SELECT
+# followed by an INSERT.
+#
+# With KNOWN_USERS_SHARED_PATH set (ideally on tmpfs, e.g. /dev/shm/chatbot-users),
+# workers also share a fixed-size table of known ids in a memory-mapped file, so
+# a user first seen by one worker is a hit in the others. The table is
+# set-associative: an id hashes to a bucket of KNOWN_USERS_SHARED_WAYS slots and
+# a full bucket drops its oldest id. Slots are read and written without locks: a
+# torn slot only ever fails to match, and a miss costs one idempotent upsert.
+KNOWN_USERS_ENABLED = os.getenv("KNOWN_USERS_ENABLED", "true").lower() == "true"
+KNOWN_USERS_MAX_ENTRIES = int(os.getenv("KNOWN_USERS_MAX_ENTRIES", 100000))
+KNOWN_USERS_SHARED_PATH = os.getenv("KNOWN_USERS_SHARED_PATH", "")
+KNOWN_USERS_SHARED_SLOTS = int(os.getenv("KNOWN_USERS_SHARED_SLOTS", 262144))  # 16 bytes each
+KNOWN_USERS_SHARED_WAYS = int(os.getenv("KNOWN_USERS_SHARED_WAYS", 8))
+
+SLOT_SIZE = 16  # a 128-bit digest of the id
+EMPTY_SLOT = bytes(SLOT_SIZE)
+
+UPSERT_SQL = {
+    "sqlite": "INSERT OR IGNORE INTO users (id, center_id) VALUES (?, ?)",
+    # HOLDLOCK makes the existence check and the insert atomic under concurrent first visits
+    "mssql": '''
+        MERGE users WITH (HOLDLOCK) AS t
+        USING (SELECT ? AS id, ? AS center_id) AS s ON t.id = s.id
+        WHEN NOT MATCHED THEN
+            INSERT (id, center_id) VALUES (s.id, s.center_id);
+    ''',
+}
+
+
+def parse_user_id(user_id):
+    try:
+        return uuid.UUID(user_id)
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("Invalid user_id. Must be a valid UUID.")
+
+
+def user_key(user_id):
+    # Digest of the id as stored, so differently spelled forms of a UUID stay distinct rows
+    parse_user_id(user_id)
+    return hashlib.blake2b(user_id.encode("utf-8"), digest_size=SLOT_SIZE).digest()
+
+
+def upsert_user(user_id, center_id):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(UPSERT_SQL["sqlite" if db.DB_BACKEND == "sqlite" else "mssql"], (user_id, center_id))
+
+
+class SharedTable:
+    """Fixed-size set of 16-byte ids in a memory-mapped file shared by workers."""
+
+    def __init__(self, path, slots=KNOWN_USERS_SHARED_SLOTS, ways=KNOWN_USERS_SHARED_WAYS):
+        self.ways = ways
+        self.buckets = max(1, slots // ways)
+        size = self.buckets * ways * SLOT_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Every worker sizes the file the same way; growing it zero-fills the new slots
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.pid = os.getpid()
+
+    def _bucket(self, key):
+        index = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") % self.buckets
+        start = index * self.ways * SLOT_SIZE
+        return start, start + self.ways * SLOT_SIZE
+
+    def __contains__(self, key):
+        start, end = self._bucket(key)
+        bucket = self._map[start:end]
+        return any(bucket[i:i + SLOT_SIZE] == key for i in range(0, len(bucket), SLOT_SIZE))
+
+    def add(self, key):
+        # Newest id first; the oldest falls off the end of a full bucket
+        start, end = self._bucket(key)
+        bucket = self._map[start:end]
+        kept = [bucket[i:i + SLOT_SIZE] for i in range(0, len(bucket), SLOT_SIZE)]
+        kept = [slot for slot in kept if slot != key and slot != EMPTY_SLOT]
+        slots = [key] + kept[:self.ways - 1]
+        self._map[start:end] = b"".join(slots).ljust(end - start, b"\0")
+
+    @property
+    def capacity(self):
+        return self.buckets * self.ways
+
+    def close(self):
+        self._map.close()
+
+
+class KnownUsers:
+    """LRU of user ids known to have a row, backed by an optional cross-worker table."""
+
+    def __init__(self, max_entries=KNOWN_USERS_MAX_ENTRIES, shared_path=KNOWN_USERS_SHARED_PATH,
+                 enabled=KNOWN_USERS_ENABLED):
+        self.max_entries = max_entries
+        self.shared_path = shared_path
+        self.enabled = enabled
+        self._entries = OrderedDict()  # user_key(id) -> None
+        self._shared = None
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+            "upserts": 0,
+            "evictions": 0,
+        }
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _shared_table(self):
+        # The mapping is opened once per worker, after the fork
+        if not self.shared_path:
+            return None
+        if self._shared is None or self._shared.pid != os.getpid():
+            with self._lock:
+                if self._shared is None or self._shared.pid != os.getpid():
+                    try:
+                        self._shared = SharedTable(self.shared_path)
+                    except OSError:
+                        self.shared_path = ""
+                        return None
+        return self._shared
+
+    def _remember(self, key):
+        with self._lock:
+            self._entries[key] = None
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def ensure(self, user_id, center_id):
+        """Makes sure the user row exists, touching the database only for unknown ids."""
+        key = user_key(user_id)
+        if not self.enabled:
+            upsert_user(user_id, center_id)
+            self._count("upserts")
+            return user_id
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return user_id
+        shared = self._shared_table()
+        if shared is not None and key in shared:
+            self._count("shared_hits")
+            self._remember(key)
+            return user_id
+
+        self._count("misses")
+        upsert_user(user_id, center_id)
+        self._count("upserts")
+        self._remember(key)
+        if shared is not None:
+            shared.add(key)
+        return user_id
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+            data["entries"] = len(self._entries)
+        lookups = data["hits"] + data["shared_hits"] + data["misses"]
+        data["hit_rate"] = (data["hits"] + data["shared_hits"]) / lookups if lookups else 0.0
+        data["enabled"] = self.enabled
+        shared = self._shared_table() if self.enabled else None
+        data["shared"] = {"path": self.shared_path, "capacity": shared.capacity} if shared is not None else None
+        return data
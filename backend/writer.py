@@ -0,0 +1,405 @@
+import os
+import json
+import glob
+import queue
+import atexit
+import logging
+import threading
+import time
+
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() == "true"
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 200))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 0.05))
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", 5000))
+WRITE_BEHIND_PUT_TIMEOUT = float(os.getenv("WRITE_BEHIND_PUT_TIMEOUT", 0.5))
+WRITE_BEHIND_SPOOL_DIR = os.getenv("WRITE_BEHIND_SPOOL_DIR", "spool")
+WRITE_BEHIND_SPOOL_MAX_BYTES = int(os.getenv("WRITE_BEHIND_SPOOL_MAX_BYTES", 8 * 1024 * 1024))
+# false skips the fsync per message: the spool then survives a crash of the
+# process but not of the host (power loss, kernel panic, VM restart)
+WRITE_BEHIND_FSYNC = os.getenv("WRITE_BEHIND_FSYNC", "true").lower() == "true"
+WRITE_BEHIND_RETRY_MAX = float(os.getenv("WRITE_BEHIND_RETRY_MAX", 30))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", 10))
+
+# DB-API errors about the row itself (duplicate message_id, value too long):
+# retrying cannot help. Anything else is assumed to be about the database.
+INVALID_ROW_ERRORS = ("IntegrityError", "DataError")
+
+_STOP = object()
+
+
+def invalid_row(error):
+    return any(cls.__name__ in INVALID_ROW_ERRORS for cls in type(error).__mro__)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MessageWriter:
+    """Write-behind persistence for chat messages.
+
+    Messages are appended to a local spool file, fsynced (see
+    WRITE_BEHIND_FSYNC), queued, and inserted in batches by a background
+    thread. The spool is replayed by the writer thread of the next start if the
+    process or host dies before a batch commits. When the queue is full, callers
+    wait up to `put_timeout` and then write synchronously, so memory stays
+    bounded and nothing is dropped; if that insert fails, the caller gets the
+    error.
+
+    A batch that fails is kept and retried whole, backing off up to
+    `retry_max` seconds. Only when the database rejects rows as invalid
+    (INVALID_ROW_ERRORS) are they written one by one to find and drop them; a
+    row that keeps failing while others go through is dropped after
+    `max_attempts`. Both are logged.
+
+    Until its batch commits, a message is only visible to the worker that
+    queued it (pending_for, is_pending): other workers read the database.
+    """
+
+    def __init__(self, insert_batch, insert_one, batch_size=WRITE_BEHIND_BATCH_SIZE,
+                 flush_interval=WRITE_BEHIND_FLUSH_INTERVAL, queue_size=WRITE_BEHIND_QUEUE_SIZE,
+                 put_timeout=WRITE_BEHIND_PUT_TIMEOUT, spool_dir=WRITE_BEHIND_SPOOL_DIR,
+                 spool_max_bytes=WRITE_BEHIND_SPOOL_MAX_BYTES, fsync=WRITE_BEHIND_FSYNC,
+                 retry_max=WRITE_BEHIND_RETRY_MAX, max_attempts=WRITE_BEHIND_MAX_ATTEMPTS):
+        self.insert_batch = insert_batch
+        self.insert_one = insert_one
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.put_timeout = put_timeout
+        self.spool_dir = spool_dir
+        self.spool_max_bytes = spool_max_bytes
+        self.fsync = fsync
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+        self.pid = None
+        self.stats = {
+            "enqueued": 0,
+            "written": 0,
+            "batches": 0,
+            "sync_fallbacks": 0,
+            "failed": 0,
+            "retries": 0,
+            "replayed": 0,
+            "max_batch": 0,
+        }
+
+    def _start(self):
+        # Threads and file handles do not survive a fork; each worker starts its own
+        self.pid = os.getpid()
+        self._queue = queue.Queue(self.queue_size)
+        self._lock = threading.Lock()
+        self._unflushed = {}  # user_id -> {message_id: record}
+        self._owners = {}  # message_id -> user_id for unflushed messages
+        self._segments = {}  # segment number -> messages not yet committed
+        self._segment = 0
+        self._spool = None
+        self._closed = False
+        self._attempts = {}  # message_id -> failed writes so far
+        self._replaying = set()  # message_ids taken over from a dead process's spool
+        self._orphans = []
+        if self.spool_dir:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._orphans = self._claim_orphans()
+            self._open_segment()
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        if self.pid != os.getpid():
+            with _start_lock:
+                if self.pid != os.getpid():
+                    self._start()
+
+    # Spool files
+
+    def _segment_path(self, segment):
+        return os.path.join(self.spool_dir, f"messages-{self.pid}-{segment}.ndjson")
+
+    def _open_segment(self):
+        self._segment += 1
+        self._segments[self._segment] = 0
+        self._spool = open(self._segment_path(self._segment), "a", encoding="utf-8")
+        if self.fsync:
+            # The new file's directory entry must be durable too
+            fd = os.open(self.spool_dir, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _spool_append(self, record):
+        if self._spool is None:
+            return None
+        self._spool.write(json.dumps(record) + "\n")
+        self._spool.flush()
+        if self.fsync:
+            os.fsync(self._spool.fileno())
+        self._segments[self._segment] += 1
+        segment = self._segment
+        if self._spool.tell() >= self.spool_max_bytes:
+            self._spool.close()
+            self._open_segment()
+        return segment
+
+    def _segment_done(self, segment):
+        if segment is None:
+            return
+        self._segments[segment] -= 1
+        if self._segments[segment] > 0:
+            return
+        if segment != self._segment:
+            del self._segments[segment]
+            os.remove(self._segment_path(segment))
+        else:
+            self._spool.truncate(0)
+            self._spool.seek(0)
+
+    def _claim_orphans(self):
+        # Renames the spool files of dead processes, so that no other worker
+        # replays them too; the writer thread reads and writes them
+        claimed = []
+        for path in glob.glob(os.path.join(self.spool_dir, "messages-*.ndjson*")):
+            name = os.path.basename(path)
+            try:
+                # messages-<pid>-<n>.ndjson, or .ndjson.replay-<pid> if its replayer died too
+                owner = int(name.rpartition("-")[2] if ".replay-" in name else name.split("-")[1])
+            except (IndexError, ValueError):
+                continue
+            if owner != self.pid and pid_alive(owner):
+                continue
+            target = f"{path.partition('.replay-')[0]}.replay-{self.pid}"
+            try:
+                os.rename(path, target)
+            except OSError:
+                continue
+            claimed.append(target)
+        return claimed
+
+    def _replay_orphans(self):
+        # The claimed messages move to this process's spool and are written like any other batch
+        items = []
+        for path in self._orphans:
+            records = []
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # The line being written when the process died
+                        if line.strip():
+                            logging.error(f"Skipping a truncated line of {path}")
+            with self._lock:
+                for record in records:
+                    items.append((record, self._spool_append(record)))
+                    self._replaying.add(record["message_id"])
+            os.remove(path)
+        self._orphans = []
+        return items
+
+    # Producer side
+
+    def enqueue(self, record):
+        self._ensure_started()
+        with self._lock:
+            segment = self._spool_append(record)
+            self._unflushed.setdefault(record["user_id"], {})[record["message_id"]] = record
+            self._owners[record["message_id"]] = record["user_id"]
+            self.stats["enqueued"] += 1
+        try:
+            self._queue.put((record, segment), timeout=self.put_timeout)
+        except queue.Full:
+            # Backpressure: the writer is behind, so this caller pays for its own insert
+            try:
+                self.insert_one(record)
+            except Exception:
+                # The caller sees the failure; the message must not linger as pending
+                with self._lock:
+                    self.stats["failed"] += 1
+                    self._forget([(record, segment)])
+                raise
+            with self._lock:
+                self.stats["sync_fallbacks"] += 1
+                self._forget([(record, segment)])
+
+    def pending_for(self, user_id):
+        if self.pid != os.getpid():
+            return []
+        with self._lock:
+            return [dict(r) for r in self._unflushed.get(user_id, {}).values()]
+
+    def is_pending(self, message_id):
+        if self.pid != os.getpid():
+            return False
+        with self._lock:
+            return message_id in self._owners
+
+    def flush(self, timeout=30):
+        # Blocks until everything queued so far has been written
+        if self.pid != os.getpid():
+            return
+        done = threading.Event()
+        self._queue.put((done, None))
+        done.wait(timeout)
+
+    def close(self):
+        # Also registered with atexit, so a second call does nothing
+        if self.pid != os.getpid() or self._closed:
+            return
+        self._closed = True
+        self._queue.put((_STOP, None))
+        self._thread.join(timeout=30)
+        if self._spool is not None:
+            self._spool.close()
+            if not self._segments.get(self._segment):
+                os.remove(self._segment_path(self._segment))
+
+    # Writer thread
+
+    def _forget(self, items):
+        for record, segment in items:
+            self._attempts.pop(record["message_id"], None)
+            self._replaying.discard(record["message_id"])
+            self._owners.pop(record["message_id"], None)
+            records = self._unflushed.get(record["user_id"])
+            if records is not None:
+                records.pop(record["message_id"], None)
+                if not records:
+                    del self._unflushed[record["user_id"]]
+            self._segment_done(segment)
+
+    def _run(self):
+        stopping = False
+        carry = self._write_batches(self._replay_orphans())
+        failures = 0
+        while not stopping:
+            batch, waiters = carry, []
+            if carry:
+                # The database was unreachable; back off before trying again
+                failures += 1
+                time.sleep(min(self.retry_max, self.flush_interval * 20 * 2 ** (failures - 1)))
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = (None, None)
+            else:
+                failures = 0
+                item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                record, segment = item
+                if record is None:
+                    break
+                if record is _STOP:
+                    stopping = True
+                elif isinstance(record, threading.Event):
+                    waiters.append(record)
+                else:
+                    batch.append(item)
+                if stopping or waiters or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if stopping or waiters:
+                # Drain whatever is already queued before acknowledging
+                while True:
+                    try:
+                        record, segment = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if isinstance(record, threading.Event):
+                        waiters.append(record)
+                    elif record is not _STOP:
+                        batch.append((record, segment))
+            carry = self._write_batches(batch)
+            for waiter in waiters:
+                waiter.set()
+        if carry:
+            logging.error(f"{len(carry)} messages left unwritten in the spool for replay")
+
+    def _write_batches(self, items):
+        carry = []
+        for start in range(0, len(items), self.batch_size):
+            carry += self._write(items[start:start + self.batch_size])
+        return carry
+
+    def _write(self, items):
+        # Returns the items to retry later
+        if not items:
+            return []
+        records = [record for record, _ in items]
+        try:
+            self.insert_batch(records)
+            return self._written(items, items, [])
+        except Exception as e:
+            if not invalid_row(e) and not self._exhausted(items):
+                logging.error(f"Batch insert of {len(records)} messages failed, will retry: {e}")
+                return self._retry(items)
+            logging.error(f"Batch insert of {len(records)} messages failed, retrying one by one: {e}")
+
+        written, dropped, carry = [], [], []
+        for i, item in enumerate(items):
+            record = item[0]
+            try:
+                self.insert_one(record)
+                written.append(item)
+            except Exception as e:
+                if invalid_row(e):
+                    logging.error(f"Dropping message {record['message_id']}, rejected by the database: {e}")
+                    dropped.append(item)
+                elif not written and not dropped:
+                    # Nothing gets through: an outage, not this row. Keep the rest
+                    # instead of waiting out a timeout for each of them
+                    logging.error(f"Could not write message {record['message_id']}, will retry: {e}")
+                    carry = items[i:]
+                    break
+                else:
+                    carry.append(item)
+        if carry:
+            self._retry(carry)
+        if not written and not dropped:
+            return carry
+        # The database answers, yet these rows keep failing: give up on them
+        for item in [item for item in carry if self._exhausted([item])]:
+            logging.error(f"Dropping message {item[0]['message_id']} after {self.max_attempts} attempts")
+            dropped.append(item)
+            carry.remove(item)
+        return self._written(items, written, dropped) + carry
+
+    def _exhausted(self, items):
+        return any(self._attempts.get(record["message_id"], 0) >= self.max_attempts for record, _ in items)
+
+    def _retry(self, items):
+        with self._lock:
+            for record, _ in items:
+                self._attempts[record["message_id"]] = self._attempts.get(record["message_id"], 0) + 1
+            self.stats["retries"] += 1
+        return items
+
+    def _written(self, items, written, dropped):
+        with self._lock:
+            self.stats["replayed"] += sum(1 for record, _ in written if record["message_id"] in self._replaying)
+            self._forget(written + dropped)
+            self.stats["written"] += len(written)
+            self.stats["failed"] += len(dropped)
+            self.stats["batches"] += 1
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(items))
+        return []
+
+    def snapshot(self):
+        data = dict(self.stats)
+        data["pid"] = self.pid
+        data["queue_depth"] = self._queue.qsize() if self.pid == os.getpid() else 0
+        return data
+
+
+_start_lock = threading.Lock()
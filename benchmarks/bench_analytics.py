@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import tempfile
+from datetime import date, datetime, timedelta
+
+# Checks the message_stats rollups (backend/analytics.py) on a generated SQLite
+# history: messages are written in write-behind sized batches through the same
+# path as the app, votes are cast and changed in batches, then the rollups are
+# compared with a full GROUP BY scan of conversations and both queries are
+# timed. Exits non-zero if any count differs.
+#
+#   python benchmarks/bench_analytics.py --messages 1000000 --days 90 --centers 3
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+SCAN_SQL = '''
+    SELECT substr(timestamp, 1, 10) AS day, role, COUNT(*),
+           SUM(CASE WHEN feedback = 1 THEN 1 ELSE 0 END),
+           SUM(CASE WHEN feedback = -1 THEN 1 ELSE 0 END)
+    FROM conversations
+    WHERE center_id = ? AND timestamp >= ? AND timestamp < ?
+    GROUP BY substr(timestamp, 1, 10), role
+'''
+
+
+def timed(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--centers", type=int, default=3)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=100, help="messages per write, like WRITE_BEHIND_BATCH")
+    parser.add_argument("--vote-rate", type=float, default=0.2, help="share of answers voted on")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix="bench-analytics-"), "chatbot.db")
+    os.environ.update(DB_BACKEND="sqlite", SQLITE_PATH=path, LLM_BACKEND="fake")
+    import db
+    import schema
+    import analytics
+
+    schema.migrate()
+    rng = random.Random(args.seed)
+    centers = [f"center-{i}" for i in range(args.centers)]
+    for center in centers:
+        schema.ensure_center(center, center)
+    users = [(str(uuid.uuid4()), rng.choice(centers)) for _ in range(args.users)]
+    with db.connection() as conn:
+        conn.cursor().executemany("INSERT INTO users (id, center_id) VALUES (?, ?)", users)
+
+    start = datetime.combine(date.today() - timedelta(days=args.days - 1), datetime.min.time())
+    span = args.days * 86400
+    answers = []
+    started = time.perf_counter()
+    records = []
+
+    def write(records):
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(r["user_id"], r["center_id"], r["message"], r["role"], r["timestamp"], r["message_id"])
+                 for r in records]
+            )
+            analytics.record_messages(cursor, records)
+
+    for i in range(0, args.messages, 2):
+        user_id, center = rng.choice(users)
+        at = start + timedelta(seconds=span * i / args.messages)
+        for offset, role in enumerate(("user", "assistant")):
+            message_id = str(uuid.uuid4())
+            latency = rng.lognormvariate(7, 0.5) if role == "assistant" else None
+            records.append({
+                "user_id": user_id, "center_id": center, "role": role, "message_id": message_id,
+                "message": "Le parking est-il ouvert ce soir ?", "timestamp": (at + timedelta(seconds=offset)).isoformat(),
+                "tokens": rng.randint(5, 300), "prompt_tokens": rng.randint(200, 2000) if latency else None,
+                "latency_ms": round(latency) if latency else None,
+            })
+            if role == "assistant":
+                answers.append(message_id)
+        if len(records) >= args.batch:
+            write(records)
+            records = []
+    if records:
+        write(records)
+    insert_seconds = time.perf_counter() - started
+    print(f"wrote {args.messages} messages in {insert_seconds:.1f}s ({args.messages / insert_seconds:,.0f}/s)")
+
+    # Votes, including changed minds and votes cleared back to 0
+    started = time.perf_counter()
+    voted = rng.sample(answers, int(len(answers) * args.vote_rate))
+    votes = [(message_id, rng.choice((1, 1, -1))) for message_id in voted]
+    votes += [(message_id, rng.choice((0, 1, -1))) for message_id in rng.sample(voted, len(voted) // 5)]
+    for i in range(0, len(votes), analytics.FEEDBACK_BATCH_MAX):
+        with db.connection() as conn:
+            analytics.apply_votes(conn.cursor(), votes[i:i + analytics.FEEDBACK_BATCH_MAX])
+    vote_seconds = time.perf_counter() - started
+    print(f"applied {len(votes)} votes in {vote_seconds:.1f}s ({len(votes) / vote_seconds:,.0f}/s)")
+
+    first, last = start.date(), date.today()
+    mismatches = 0
+    rollup_times, scan_times = [], []
+    for center in centers:
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            days, rollup_seconds = timed(lambda: analytics.daily_stats(cursor, center, first, last))
+            rows, scan_seconds = timed(lambda: cursor.execute(
+                SCAN_SQL, (center, first.isoformat(), (last + timedelta(days=1)).isoformat())).fetchall(), 1)
+        rollup_times.append(rollup_seconds)
+        scan_times.append(scan_seconds)
+        rolled = {(d["day"], role): (c["messages"], c["likes"], c["dislikes"])
+                  for d in days for role, c in d.items() if isinstance(c, dict)}
+        scanned = {(day, role): (count, likes, dislikes) for day, role, count, likes, dislikes in rows}
+        mismatches += sum(1 for key in scanned.keys() | rolled.keys() if scanned.get(key) != rolled.get(key))
+
+    with db.connection() as conn:
+        totals = analytics.totals(analytics.daily_stats(conn.cursor(), centers[0], first, last))
+    results = {
+        "messages": args.messages,
+        "insert_per_s": args.messages / insert_seconds,
+        "votes": len(votes),
+        "votes_per_s": len(votes) / vote_seconds,
+        "stats_ms": max(rollup_times) * 1000,
+        "scan_ms": max(scan_times) * 1000,
+        "mismatches": mismatches,
+        "dislike_rate": totals.get("dislike_rate"),
+    }
+    print(f"/stats over {args.days} days: {results['stats_ms']:.2f} ms from rollups, "
+          f"{results['scan_ms']:.0f} ms scanning conversations")
+    print("rollups match the scan" if not mismatches else f"{mismatches} (day, role) counts differ")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import os
+import sys
+import json
+import time
+import gzip
+import tempfile
+import argparse
+
+# Bytes on the wire for a first page view and for /get-history. Builds the
+# static assets (backend/assets.py) into a temporary directory and compares
+# each file as served before (raw) with its minified and precompressed
+# variants, then fills a conversation with answers from the fake LLM and
+# measures a 100-message history page uncompressed and compressed on the fly,
+# with the time the compression adds.
+#
+#   python benchmarks/bench_assets.py --messages 100
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100, help="history page size")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-assets-")
+    os.environ.update(DB_BACKEND="sqlite", SQLITE_PATH=os.path.join(workdir, "chatbot.db"),
+                      COMMERCIAL_CENTER_ID="bench", LLM_BACKEND="fake", FAKE_LLM_FIRST_TOKEN_DELAY="0",
+                      FAKE_LLM_TOKEN_DELAY="0", RESPONSE_CACHE_ENABLED="false",
+                      ASSETS_BUILD_DIR=os.path.join(workdir, "dist"))
+    import schema
+    import assets
+    import compression
+
+    manifest = assets.build()
+    results = {"assets": {}}
+    totals = {"raw": 0, "minified": 0, "best": 0}
+    for name, entry in sorted(manifest.items()):
+        best = min([entry["minified"], *entry["encodings"].values()])
+        results["assets"][name] = dict(entry, best=best)
+        totals["raw"] += entry["bytes"]
+        totals["minified"] += entry["minified"]
+        totals["best"] += best
+        encoded = ", ".join(f"{e} {b:>6} B" for e, b in entry["encodings"].items())
+        print(f"{name:>22}: {entry['bytes']:>6} B raw, {entry['minified']:>6} B minified{', ' if encoded else ''}{encoded}")
+    results["assets_total"] = totals
+    print(f"{'static total':>22}: {totals['raw']:>6} B -> {totals['best']} B "
+          f"({totals['raw'] / totals['best']:.1f}x), then cached for a year")
+
+    schema.migrate()
+    schema.ensure_center("bench", "bench")
+    import app
+    client = app.app.test_client()
+    for i in range(args.messages // 2):
+        client.post("/process-input", json={"message": f"Le parking est-il ouvert le dimanche {i} ?"})
+    url = f"/get-history?limit={args.messages}"
+    raw = client.get(url).get_data()
+    results["history"] = {"messages": args.messages, "raw": len(raw)}
+    print(f"{'history page':>22}: {len(raw):>6} B raw", end="")
+    for encoding in compression.available():
+        encoded = client.get(url, headers={"Accept-Encoding": encoding}).get_data()
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            compression.compress(raw, encoding)
+        elapsed = (time.perf_counter() - started) / args.repeat
+        results["history"][encoding] = {"bytes": len(encoded), "compress_ms": elapsed * 1000}
+        print(f", {encoding} {len(encoded)} B ({len(raw) / len(encoded):.1f}x, {elapsed * 1000:.2f} ms)", end="")
+    print()
+    assert gzip.decompress(client.get(url, headers={"Accept-Encoding": "gzip"}).get_data()) == raw
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
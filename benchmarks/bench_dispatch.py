@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from stub_openai import StubOpenAI
+
+# Drives backend/dispatch.py against local stub deployments: a fast one, a slow
+# one, one that answers a share of requests with 429 + Retry-After, and one that
+# fails outright. Reports how calls spread over the deployments, how many were
+# shed with 503, retries and failovers, and end-to-end latency.
+#
+#   python benchmarks/bench_dispatch.py --calls 400 --concurrency 64
+#   python benchmarks/bench_dispatch.py --calls 400 --concurrency 64 --tpm 60000 --queue-timeout 2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+MESSAGES = [
+    {"role": "system", "content": "You are an AI assistant who helps users find information."},
+    {"role": "user", "content": "Le parking est-il ouvert ce soir ?"},
+]
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--users", type=int, default=200, help="distinct users the calls are spread over")
+    parser.add_argument("--tpm", type=int, default=0, help="token budget per deployment (0: unlimited)")
+    parser.add_argument("--max-concurrency", type=int, default=32)
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--queue-timeout", type=float, default=10)
+    parser.add_argument("--throttle-rate", type=float, default=0.5)
+    parser.add_argument("--retry-after", type=float, default=2.0)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    stubs = {
+        "fast": StubOpenAI(first_token=0.2, token_delay=0.005).start(),
+        "slow": StubOpenAI(first_token=0.8, token_delay=0.005).start(),
+        "throttled": StubOpenAI(first_token=0.3, token_delay=0.005, throttle_rate=args.throttle_rate,
+                                retry_after=args.retry_after).start(),
+        "broken": StubOpenAI(first_token=0.1, error_rate=1.0).start(),
+    }
+    configs = [{"name": name, "endpoint": stub.url, "deployment": name, "api_key": "stub",
+                "tpm": args.tpm or None} for name, stub in stubs.items()]
+    os.environ.update(LLM_BACKEND="azure", LLM_DEPLOYMENTS=json.dumps(configs), LLM_RETRY_BASE="0.2")
+    import dispatch
+
+    dispatcher = dispatch.Dispatcher(max_concurrency=args.max_concurrency, queue_size=args.queue_size,
+                                     queue_timeout=args.queue_timeout)
+    latencies, outcomes, lock = [], {"ok": 0, "shed": 0, "error": 0}, threading.Lock()
+
+    def call(i):
+        started = time.perf_counter()
+        try:
+            response = dispatcher.complete(f"user-{i % args.users}", MESSAGES, stream=args.stream)
+            if args.stream:
+                for _ in response:
+                    pass
+            outcome = "ok"
+        except dispatch.Overloaded:
+            outcome = "shed"
+        except Exception:
+            outcome = "error"
+        with lock:
+            outcomes[outcome] += 1
+            if outcome == "ok":
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(call, range(args.calls)))
+    wall = time.perf_counter() - started
+
+    stats = dispatcher.snapshot()
+    results = {
+        "calls": args.calls,
+        "wall_s": wall,
+        "outcomes": outcomes,
+        "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+        "p95_ms": percentile(latencies, 95) * 1000 if latencies else None,
+        "dispatch": {key: stats[key] for key in ("admitted", "queued", "shed", "retries", "failovers",
+                                                  "exhausted")},
+        "deployments": {d["name"]: {"calls": d["calls"], "rate_limited": d["rate_limited"],
+                                    "errors": d["errors"], "state": d["state"],
+                                    "latency_ms": d["latency_ms"]} for d in stats["deployments"]},
+        "upstream_requests": {name: stub.requests for name, stub in stubs.items()},
+    }
+    for stub in stubs.values():
+        stub.stop()
+
+    print(f"{args.calls} calls in {wall:.1f}s: {outcomes}")
+    if latencies:
+        print(f"latency p50 {results['p50_ms']:.0f} ms, p95 {results['p95_ms']:.0f} ms")
+    print("dispatch:", results["dispatch"])
+    for name, row in results["deployments"].items():
+        latency = f"{row['latency_ms']:.0f} ms" if row["latency_ms"] is not None else "-"
+        print(f"{name:>10}: {row['calls']:>4} calls, {row['rate_limited']:>3} throttled, "
+              f"{row['errors']:>3} errors, circuit {row['state']}, latency {latency}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+# Throughput and memory of backend/export.py on a generated SQLite history.
+# Each run is a separate `python export.py --stats` process, so peak RSS is the
+# export's own: it should stay flat from a one-week slice to the whole table,
+# whatever the format. A fetchall() of the same rows, as migrate.py does, is
+# measured the same way for comparison.
+#
+#   python benchmarks/bench_export.py --messages 1000000 --days 180
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+CENTER = "bench"
+
+FETCHALL = '''
+import sys, resource, json
+import db, export
+sql, params = export._query(sys.argv[1])
+with db.dedicated_connection() as conn:
+    rows = conn.cursor().execute(sql, params).fetchall()
+print(json.dumps({"rows": len(rows), "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}),
+      file=sys.stderr)
+'''
+
+
+def generate(db, messages, days, users, conversations, rng):
+    now = datetime.now()
+    user_ids = [str(uuid.uuid4()) for _ in range(users)]
+    sessions = [(str(uuid.uuid4()), rng.choice(user_ids)) for _ in range(conversations)]
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("INSERT INTO users (id, center_id) VALUES (?, ?)", [(u, CENTER) for u in user_ids])
+        cursor.executemany(
+            "INSERT INTO conversation_sessions (id, user_id, center_id, title, created_at, last_updated) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(s, u, CENTER, f"Horaires et parking #{i}", now.isoformat(), now.isoformat())
+             for i, (s, u) in enumerate(sessions)]
+        )
+        batch = []
+        for i in range(messages):
+            # Answers follow their question in the same conversation
+            conversation_id, user_id = rng.choice(sessions) if i % 2 == 0 else (batch[-1][6], batch[-1][0])
+            timestamp = now - timedelta(seconds=(messages - i) * days * 86400 / messages)
+            role = "user" if i % 2 == 0 else "assistant"
+            text = "Bonjour, le parking est-il ouvert ce soir ? Il y a \"deux\" entrées, nord et sud.\n" * rng.randint(1, 6)
+            batch.append((user_id, CENTER, text, role, timestamp.isoformat(), str(uuid.uuid4()), conversation_id))
+            if len(batch) >= 10000:
+                cursor.executemany(
+                    "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id, "
+                    "conversation_id) VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+                batch = batch[-1:] if i % 2 == 0 else []
+        if batch:
+            cursor.executemany(
+                "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id, "
+                "conversation_id) VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+    return sessions
+
+
+def run(env, args):
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, *args], env=env, cwd=os.path.join(ROOT, "backend"),
+                             capture_output=True, text=True, check=True)
+    elapsed = time.perf_counter() - started
+    result = json.loads(process.stderr.strip().splitlines()[-1])
+    result.setdefault("seconds", elapsed)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--days", type=int, default=180)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--conversations", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-export-")
+    path = os.path.join(workdir, "chatbot.db")
+    os.environ.update(DB_BACKEND="sqlite", SQLITE_PATH=path, COMMERCIAL_CENTER_ID=CENTER, LLM_BACKEND="fake")
+    import db
+    import schema
+
+    schema.migrate()
+    schema.ensure_center(CENTER, CENTER)
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    sessions = generate(db, args.messages, args.days, args.users, args.conversations, rng)
+    print(f"generated {args.messages} messages in {time.perf_counter() - started:.0f}s "
+          f"({os.path.getsize(path) / 1e6:.0f} MB)")
+
+    env = dict(os.environ)
+    today = datetime.now().date()
+    week = ["--from", (today - timedelta(days=7)).isoformat()]
+    conversation = ["--conversation", sessions[0][0]]
+    cases = [
+        ("conversation", "ndjson", False, conversation),
+        ("last week", "ndjson", False, week),
+        ("all", "ndjson", False, []),
+        ("all", "ndjson", True, []),
+        ("all", "csv", False, []),
+        ("all", "csv", True, []),
+    ]
+    results = []
+    for name, fmt, compress, filters in cases:
+        output = os.path.join(workdir, f"export.{fmt}" + (".gz" if compress else ""))
+        result = run(env, ["export.py", "--center", CENTER, "--format", fmt, "--stats", "-o", output,
+                           *(["--gzip"] if compress else []), *filters])
+        result.update(case=name, format=fmt, gzip=compress)
+        results.append(result)
+        print(f"{name:>12} {fmt:>6}{' gz' if compress else '   '}: {result['rows']:>9} rows "
+              f"{result['rows'] / result['seconds']:>10,.0f} rows/s "
+              f"{result['raw_bytes'] / 1e6 / result['seconds']:>6.1f} MB/s "
+              f"({result['bytes'] / 1e6:.0f} MB written) peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    baseline = run(env, ["-c", FETCHALL, CENTER])
+    print(f"{'fetchall()':>23}: {baseline['rows']:>9} rows peak RSS {baseline['peak_rss_mb']:.0f} MB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"messages": args.messages, "exports": results, "fetchall": baseline}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
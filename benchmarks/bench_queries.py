@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+import uuid
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+# Before/after query plans and timings for the hot conversation queries on a
+# generated dataset, with SQLite standing in for Azure SQL.
+#
+#   python benchmarks/bench_queries.py --rows 2000000
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+QUERIES = {
+    "history": (
+        """SELECT message, role, timestamp, message_id, feedback
+           FROM conversations
+           WHERE user_id = ? AND center_id = ?
+           ORDER BY timestamp DESC
+           LIMIT 20""",
+        lambda user: (user, "bench"),
+    ),
+    "clear_session": (
+        "DELETE FROM conversations WHERE user_id = ?",
+        lambda user: (user,),
+    ),
+    "conversation_list": (
+        """SELECT id, title, created_at, last_updated
+           FROM conversation_sessions
+           WHERE user_id = ?
+           ORDER BY last_updated DESC""",
+        lambda user: (user,),
+    ),
+}
+
+
+def generate(conn, rows, users, seed=1):
+    rng = random.Random(seed)
+    user_ids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(users)]
+    start = datetime(2025, 1, 1)
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.executemany("INSERT INTO users (id, center_id) VALUES (?, 'bench')", [(u,) for u in user_ids])
+
+    sessions = []
+    for user in user_ids:
+        for _ in range(rng.randint(1, 4)):
+            sessions.append((str(uuid.UUID(int=rng.getrandbits(128))), user,
+                             (start + timedelta(minutes=rng.randint(0, 500000))).isoformat()))
+    conn.executemany(
+        "INSERT INTO conversation_sessions (id, user_id, center_id, title, last_updated) "
+        "VALUES (?, ?, 'bench', 'New Conversation', ?)",
+        sessions
+    )
+
+    batch = []
+    for i in range(rows):
+        user = user_ids[rng.randrange(users)]
+        batch.append((
+            user,
+            "Where can I find the nearest parking entrance?" if i % 2 == 0
+            else "<p>The parking entrance is on level -1, next to the north gate.</p>",
+            "user" if i % 2 == 0 else "assistant",
+            (start + timedelta(seconds=i * 7)).isoformat(),
+            str(uuid.UUID(int=rng.getrandbits(128))),
+        ))
+        if len(batch) == 50000:
+            conn.executemany(
+                "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id) "
+                "VALUES (?, 'bench', ?, ?, ?, ?)", batch
+            )
+            batch = []
+    if batch:
+        conn.executemany(
+            "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id) "
+            "VALUES (?, 'bench', ?, ?, ?, ?)", batch
+        )
+    conn.commit()
+    return user_ids
+
+
+def measure(conn, user_ids, samples, seed=2):
+    rng = random.Random(seed)
+    picks = [rng.choice(user_ids) for _ in range(samples)]
+    results = {}
+    for name, (sql, params) in QUERIES.items():
+        plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params(picks[0])).fetchall()
+        start = time.perf_counter()
+        for user in picks:
+            conn.execute(sql, params(user)).fetchall()
+            if sql.startswith("DELETE"):
+                conn.rollback()
+        elapsed = (time.perf_counter() - start) / samples
+        results[name] = (elapsed, " | ".join(row[-1] for row in plan))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--db", help="reuse this SQLite file instead of a temporary one")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["DB_BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = path
+    import schema
+    import db
+
+    schema.migrate(target=3)
+    with db.connection() as conn:
+        schema.ensure_center("bench", "Bench")
+        started = time.perf_counter()
+        user_ids = generate(conn, args.rows, args.users)
+        print(f"Generated {args.rows} messages for {args.users} users "
+              f"in {time.perf_counter() - started:.1f}s at {path}")
+
+        before = measure(conn, user_ids, args.samples)
+    started = time.perf_counter()
+    schema.migrate()
+    print(f"Applied index migration in {time.perf_counter() - started:.1f}s")
+    with db.connection() as conn:
+        conn.execute("ANALYZE")
+        after = measure(conn, user_ids, args.samples)
+
+    for name in QUERIES:
+        (t0, plan0), (t1, plan1) = before[name], after[name]
+        print(f"\n{name}: {t0 * 1000:.2f} ms -> {t1 * 1000:.3f} ms ({t0 / t1:.0f}x)")
+        print(f"  before: {plan0}")
+        print(f"  after:  {plan1}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+# Markdown rendering throughput: a fresh markdown.markdown() per message (the
+# old code path), the reused sanitizing pipeline in backend/render.py, and
+# render-cache hits, which is what history reloads of already rendered messages
+# cost. Also compares stored size and prompt tokens of the raw markdown with the
+# HTML that used to be stored.
+#
+#   python benchmarks/bench_render.py --messages 2000 --unique 200
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+WORDS = ("parking opening hours shops restaurant cinema floor level entrance gift card loyalty "
+         "discount sale refund exchange delivery pickup toilets baby changing elevator wifi "
+         "pharmacy bakery cafe terrace kids corner event weekend evening holiday").split()
+
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 16))]
+    if rng.random() < 0.4:
+        i = rng.randrange(len(words))
+        words[i] = f"**{words[i]}**"
+    if rng.random() < 0.2:
+        i = rng.randrange(len(words))
+        words[i] = f"[{words[i]}](https://example.com/{words[i]})"
+    return " ".join(words).capitalize() + "."
+
+
+def make_answer(rng):
+    # Shaped like the model's answers: short paragraphs, sometimes a list or a heading
+    blocks = []
+    if rng.random() < 0.2:
+        blocks.append(f"### {sentence(rng)[:-1]}")
+    for _ in range(rng.randint(1, 3)):
+        blocks.append(" ".join(sentence(rng) for _ in range(rng.randint(1, 3))))
+    if rng.random() < 0.5:
+        blocks.append("\n".join(f"- {sentence(rng)}" for _ in range(rng.randint(2, 5))))
+    return "\n\n".join(blocks)
+
+
+def timed(fn, texts):
+    started = time.perf_counter()
+    for text in texts:
+        fn(text)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000, help="messages rendered per run")
+    parser.add_argument("--unique", type=int, default=200, help="distinct answers among them")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    import markdown
+    import render
+    import context
+
+    rng = random.Random(args.seed)
+    answers = [make_answer(rng) for _ in range(args.unique)]
+    texts = [rng.choice(answers) for _ in range(args.messages)]
+    total_bytes = sum(len(text.encode("utf-8")) for text in texts)
+
+    cache = render.RenderCache(max_entries=args.unique)
+    cache_cold = timed(cache.render, texts)  # first sight of each answer renders, repeats hit
+    cache_warm = timed(cache.render, texts)
+    runs = {
+        "markdown_per_call": timed(markdown.markdown, texts),
+        "pipeline": timed(render.to_html, texts),
+        "cache_cold": cache_cold,
+        "cache_warm": cache_warm,
+    }
+
+    html = [markdown.markdown(text) for text in answers]
+    results = {
+        "messages": args.messages,
+        "unique": args.unique,
+        "runs": {
+            name: {
+                "seconds": seconds,
+                "messages_per_s": args.messages / seconds,
+                "mb_per_s": total_bytes / seconds / 1e6,
+            }
+            for name, seconds in runs.items()
+        },
+        "stored_bytes": {
+            "html": sum(len(h.encode("utf-8")) for h in html),
+            "markdown": sum(len(a.encode("utf-8")) for a in answers),
+        },
+        "prompt_tokens": {
+            "html": sum(context.count_tokens(h) for h in html),
+            "markdown": sum(context.count_tokens(a) for a in answers),
+        },
+        "cache": cache.snapshot(),
+    }
+
+    for name, row in results["runs"].items():
+        print(f"{name:>18}: {row['messages_per_s']:>10.0f} msg/s  {row['mb_per_s']:>7.2f} MB/s")
+    stored, tokens = results["stored_bytes"], results["prompt_tokens"]
+    print(f"stored bytes: html {stored['html']}, markdown {stored['markdown']} "
+          f"({1 - stored['markdown'] / stored['html']:.0%} smaller)")
+    print(f"prompt tokens: html {tokens['html']}, markdown {tokens['markdown']} "
+          f"({1 - tokens['markdown'] / tokens['html']:.0%} fewer)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
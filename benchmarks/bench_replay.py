@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from stub_openai import StubOpenAI
+
+# Replays the sessions recorded in conversations.db against a local gunicorn,
+# with SQLite and the stub OpenAI server in place of Azure. Each virtual user
+# opens a conversation, sends one recorded session's messages turn by turn,
+# sometimes leaves feedback, and reloads the history, so the request mix
+# follows real traffic. Reports rps and p50/p95/p99 per endpoint, pool
+# checkouts per request (from Server-Timing) and how busy the workers were.
+#
+#   python benchmarks/bench_replay.py --users 200 --concurrency 32 --output replay.json
+#   python benchmarks/bench_replay.py --users 200 --concurrency 32 --compare replay.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, "backend")
+
+WORKER_CLASSES = {"sync": "sync", "async": "uvicorn_worker.UvicornWorker"}
+APPS = {"sync": "app:app", "async": "asgi:application"}
+SESSION_GAP = 30 * 60  # seconds of silence that end a recorded session
+
+
+def load_sessions(path, gap=SESSION_GAP):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    rows = conn.execute(
+        "SELECT user_id, role, message, timestamp, COALESCE(feedback, 0) "
+        "FROM conversations ORDER BY user_id, timestamp, id"
+    ).fetchall()
+    conn.close()
+
+    sessions, current, last_user, last_time = [], None, None, None
+    answers = rated = 0
+    for user_id, role, message, timestamp, feedback in rows:
+        moment = datetime.fromisoformat(str(timestamp))
+        if user_id != last_user or (moment - last_time).total_seconds() > gap:
+            current = {"turns": [], "think": []}
+            sessions.append(current)
+        if role == "user":
+            if current["turns"]:
+                current["think"].append((moment - last_time).total_seconds())
+            current["turns"].append(message)
+        else:
+            answers += 1
+            rated += feedback != 0
+        last_user, last_time = user_id, moment
+    sessions = [s for s in sessions if s["turns"]]
+    return sessions, (rated / answers if answers else 0.0)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def start_server(args, port, db_path, stub_url, log_path):
+    env = dict(
+        os.environ,
+        DB_BACKEND="sqlite",
+        SQLITE_PATH=db_path,
+        LLM_BACKEND="azure",
+        ENDPOINT_URL=stub_url,
+        AZURE_OPENAI_API_KEY="stub",
+        DEPLOYMENT_NAME="stub",
+        COMMERCIAL_CENTER_ID="bench",
+        COMMERCIAL_CENTER_NAME="Bench",
+        FLASK_SECRET_KEY="bench",
+        SERVER_TIMING="true",
+        RESPONSE_CACHE_ENABLED=str(not args.no_cache).lower(),
+    )
+    subprocess.run([sys.executable, os.path.join(BACKEND, "schema.py")], env=env, check=True)
+    cmd = [sys.executable, "-m", "gunicorn", "--chdir", BACKEND, "-b", f"127.0.0.1:{port}",
+           "--timeout", "120", "--log-level", "warning", "-k", WORKER_CLASSES[args.mode],
+           "-w", str(args.workers), APPS[args.mode]]
+    # The app logs every Azure OpenAI call at INFO; keep that out of the report
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wait_for(port)
+    return proc
+
+
+def parse_server_timing(header):
+    stages = {}
+    for entry in (header or "").split(","):
+        name, *params = entry.strip().split(";")
+        if not name:
+            continue
+        values = dict(p.split("=", 1) for p in params if "=" in p)
+        stages[name] = (float(values.get("dur", 0)) / 1000, int(values.get("count", 1)))
+    return stages
+
+
+class Client:
+    """One virtual user: a cookie jar and a record of every request it made."""
+
+    def __init__(self, port, results, lock):
+        self.port = port
+        self.cookie = None
+        self.results = results
+        self.lock = lock
+
+    def request(self, method, path, body=None, endpoint=None, stream=False):
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=300)
+        started = time.perf_counter()
+        try:
+            conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = conn.getresponse()
+            first_byte = time.perf_counter() - started
+            payload = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            payload, status, first_byte, response = b"", 0, None, None
+        finally:
+            conn.close()
+        elapsed = time.perf_counter() - started
+        timing = parse_server_timing(response.getheader("Server-Timing")) if response else {}
+        if response and response.getheader("Set-Cookie"):
+            self.cookie = response.getheader("Set-Cookie").split(";", 1)[0]
+        server_total = timing.get("total", (None, 0))[0]
+        with self.lock:
+            self.results.append({
+                "endpoint": endpoint or f"{method} {path.split('?', 1)[0]}",
+                "status": status,
+                "latency": elapsed,
+                "first_byte": first_byte,
+                "server": server_total,
+                # A sync worker stays busy until the last streamed byte is sent
+                "busy": (server_total + elapsed - first_byte) if stream and server_total is not None
+                else server_total,
+                "db_checkouts": timing.get("db_acquire", (0, 0))[1],
+            })
+        return status, payload
+
+
+def decode(payload):
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return {}
+
+
+def stream_message_id(payload):
+    for line in payload.decode("utf-8", "replace").splitlines():
+        if line.startswith("data:"):
+            event = decode(line[5:].strip().encode())
+            if isinstance(event, dict) and event.get("assistant_message_id"):
+                return event["assistant_message_id"]
+    return None
+
+
+def run_user(port, session, args, feedback_rate, results, lock, seed):
+    rng = random.Random(seed)
+    client = Client(port, results, lock)
+    client.request("GET", "/", endpoint="GET /")
+    status, payload = client.request("POST", "/conversations", body={})
+    conversation_id = decode(payload).get("conversation", {}).get("id")
+    if rng.random() < 0.5:
+        client.request("GET", "/conversations")
+
+    for i, message in enumerate(session["turns"]):
+        if i and args.think_scale:
+            time.sleep(min(session["think"][i - 1] * args.think_scale, args.max_think))
+        body = {"message": message, "conversation_id": conversation_id}
+        if args.stream:
+            status, payload = client.request("POST", "/process-input/stream", body=body, stream=True)
+            answer_id = stream_message_id(payload) if status == 200 else None
+        else:
+            status, payload = client.request("POST", "/process-input", body=body)
+            answer_id = decode(payload).get("assistant_message_id") if status == 200 else None
+        if answer_id and rng.random() < feedback_rate:
+            client.request("POST", "/feedback", body={"message_id": answer_id,
+                                                      "feedback": rng.choice([1, -1])})
+    query = f"?conversation_id={conversation_id}" if conversation_id else ""
+    client.request("GET", f"/get-history{query}", endpoint="GET /get-history")
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+
+def summarize(results, wall, workers):
+    endpoints = {}
+    for row in results:
+        endpoints.setdefault(row["endpoint"], []).append(row)
+    summary = {}
+    for endpoint, rows in sorted(endpoints.items()):
+        latencies = [r["latency"] for r in rows]
+        served = [r for r in rows if r["server"] is not None]
+        summary[endpoint] = {
+            "requests": len(rows),
+            "errors": sum(1 for r in rows if r["status"] == 0 or r["status"] >= 500),
+            "rps": len(rows) / wall,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "db_checkouts_per_request": sum(r["db_checkouts"] for r in rows) / len(rows),
+            # Time between the client sending and the app starting: listen backlog, busy workers
+            "queue_p95_ms": percentile([r["first_byte"] - r["server"] for r in served], 95) * 1000
+            if served else None,
+        }
+    busy = sum(r["busy"] for r in results if r["busy"] is not None)
+    return {
+        "wall_s": wall,
+        "requests": len(results),
+        "rps": len(results) / wall,
+        "worker_utilization": busy / (workers * wall),
+        "endpoints": summary,
+    }
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    old = (baseline or {}).get("results", {}).get("endpoints", {})
+    print(f"{'endpoint':<30} {'reqs':>6} {'err':>4} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'db/req':>7}")
+    for endpoint, row in report["endpoints"].items():
+        line = (f"{endpoint:<30} {row['requests']:>6} {row['errors']:>4} {row['rps']:>8.1f} "
+                f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f} "
+                f"{row['db_checkouts_per_request']:>7.2f}")
+        if endpoint in old:
+            change = (row["p95_ms"] - old[endpoint]["p95_ms"]) / old[endpoint]["p95_ms"] * 100
+            line += f"  p95 {change:+.0f}%"
+        print(line)
+    print(f"total {report['requests']} requests in {report['wall_s']:.1f}s, {report['rps']:.1f} rps, "
+          f"worker utilization {report['worker_utilization']:.0%}")
+    if baseline:
+        old_rps = baseline["results"]["rps"]
+        print(f"vs {baseline.get('commit')}: rps {(report['rps'] - old_rps) / old_rps * 100:+.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default=os.path.join(ROOT, "conversations.db"))
+    parser.add_argument("--users", type=int, default=100, help="virtual users; recorded sessions are reused")
+    parser.add_argument("--concurrency", type=int, default=16, help="virtual users active at once")
+    parser.add_argument("--mode", choices=list(APPS), default="sync")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--stream", action="store_true", help="use /process-input/stream")
+    parser.add_argument("--no-cache", action="store_true", help="disable the response cache")
+    parser.add_argument("--max-turns", type=int, default=8, help="cap on turns per replayed session")
+    parser.add_argument("--think-scale", type=float, default=0.0,
+                        help="fraction of the recorded pause between turns to wait (0: closed loop)")
+    parser.add_argument("--max-think", type=float, default=5.0)
+    parser.add_argument("--feedback-rate", type=float,
+                        help="chance of feedback per answer; defaults to the rate in the source")
+    parser.add_argument("--first-token", type=float, default=0.4, help="stub LLM first token delay")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="stub LLM delay per token")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    sessions, recorded_rate = load_sessions(args.source)
+    feedback_rate = recorded_rate if args.feedback_rate is None else args.feedback_rate
+    rng = random.Random(args.seed)
+    plan = []
+    for i in range(args.users):
+        session = rng.choice(sessions)
+        plan.append({"turns": session["turns"][:args.max_turns], "think": session["think"]})
+    print(f"{len(sessions)} recorded sessions, {sum(len(s['turns']) for s in plan)} turns planned "
+          f"for {args.users} users, feedback rate {feedback_rate:.1%}")
+
+    stub = StubOpenAI(first_token=args.first_token, token_delay=args.token_delay).start()
+    port = free_port()
+    results, lock = [], threading.Lock()
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = os.path.join(tmp, "server.log")
+        proc = start_server(args, port, os.path.join(tmp, "bench.db"), stub.url, log_path)
+        try:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                futures = [pool.submit(run_user, port, session, args, feedback_rate, results, lock,
+                                       args.seed + i) for i, session in enumerate(plan)]
+                for future in futures:
+                    future.result()
+            wall = time.perf_counter() - started
+        except BaseException:
+            with open(log_path) as log:
+                sys.stderr.write(log.read()[-4000:])
+            raise
+        finally:
+            proc.terminate()
+            proc.wait()
+            stub.stop()
+
+    report = summarize(results, wall, args.workers)
+    report["llm_calls"] = stub.requests
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output:
+        config = {k: v for k, v in vars(args).items() if k not in ("output", "compare")}
+        with open(args.output, "w") as f:
+            json.dump({"commit": git_revision(), "config": config, "results": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+# Clear-session latency and table growth on a generated SQLite history.
+# Compares the old clear (DELETE of every message of the user, on the request
+# path) with the tombstone write that replaced it, then runs backend/retention.py
+# with a TTL and reports delete throughput, the longest batch (how long the job
+# holds the write lock at once), archive size, and history page latency and
+# table size before and after.
+#
+#   python benchmarks/bench_retention.py --messages 500000 --users 5000 --days 365 --ttl 90
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+CENTER = "bench"
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+
+def latency_ms(samples):
+    return {"p50": percentile(samples, 50) * 1000, "p95": percentile(samples, 95) * 1000}
+
+
+def generate(db, users, messages, days, rng):
+    # Messages spread evenly over `days`, users of very different activity
+    now = datetime.now()
+    weights = [rng.paretovariate(1.2) for _ in users]
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("INSERT INTO users (id, center_id) VALUES (?, ?)", [(u, CENTER) for u in users])
+        batch = []
+        for i in range(messages):
+            user = rng.choices(users, weights)[0] if i % 2 == 0 else batch[-1][0]
+            timestamp = now - timedelta(seconds=(messages - i) * days * 86400 / messages)
+            role = "user" if i % 2 == 0 else "assistant"
+            text = "Bonjour, le parking est-il ouvert ce soir ? " * rng.randint(1, 6)
+            batch.append((user, CENTER, text, role, timestamp.isoformat(), str(uuid.uuid4())))
+            if len(batch) >= 10000:
+                cursor.executemany(
+                    "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", batch)
+                batch = batch[-1:] if i % 2 == 0 else []
+        if batch:
+            cursor.executemany(
+                "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id) "
+                "VALUES (?, ?, ?, ?, ?, ?)", batch)
+
+
+def table_size(db, path):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM conversations")
+        rows = cursor.fetchone()[0]
+        cursor.execute("PRAGMA page_count")
+        pages = cursor.fetchone()[0]
+        cursor.execute("PRAGMA freelist_count")
+        free = cursor.fetchone()[0]
+        cursor.execute("PRAGMA page_size")
+        page_size = cursor.fetchone()[0]
+    return {"rows": rows, "file_mb": os.path.getsize(path) / 1e6, "used_mb": (pages - free) * page_size / 1e6}
+
+
+def history_latency(app, users, rng, samples=300):
+    latencies = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        app.get_history_page(rng.choice(users), limit=50)
+        latencies.append(time.perf_counter() - started)
+    return latency_ms(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--days", type=int, default=365, help="span of the generated history")
+    parser.add_argument("--ttl", type=int, default=90, help="retention_days for the center")
+    parser.add_argument("--clears", type=int, default=200, help="users cleared with each method")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-retention-")
+    path = os.path.join(workdir, "chatbot.db")
+    os.environ.update(DB_BACKEND="sqlite", SQLITE_PATH=path, COMMERCIAL_CENTER_ID=CENTER, LLM_BACKEND="fake",
+                      WRITE_BEHIND="false")
+    import db
+    import schema
+    import retention
+    import app
+
+    schema.migrate()
+    schema.ensure_center(CENTER, CENTER)
+    # History pages are read outside a request, as the default center
+    app.tenants.activate(app.centers.resolve())
+    rng = random.Random(args.seed)
+    users = [str(uuid.uuid4()) for _ in range(args.users)]
+    started = time.perf_counter()
+    generate(db, users, args.messages, args.days, rng)
+    print(f"generated {args.messages} messages for {args.users} users in {time.perf_counter() - started:.1f}s")
+
+    results = {"config": vars(args), "before": table_size(db, path)}
+    results["history_before"] = history_latency(app, users, rng)
+
+    # Most active users first: those are the slow deletes
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id FROM conversations GROUP BY user_id ORDER BY COUNT(*) DESC")
+        ranked = [row[0] for row in cursor.fetchall()]
+    old_way, tombstoned = ranked[0:2 * args.clears:2], ranked[1:2 * args.clears:2]
+    delete_latencies, tombstone_latencies = [], []
+    for user_id in old_way:
+        started = time.perf_counter()
+        with db.connection() as conn:
+            conn.cursor().execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+        delete_latencies.append(time.perf_counter() - started)
+    for user_id in tombstoned:
+        started = time.perf_counter()
+        with db.connection() as conn:
+            retention.clear_user(conn.cursor(), user_id)
+        tombstone_latencies.append(time.perf_counter() - started)
+    results["clear_ms"] = {"delete": latency_ms(delete_latencies), "tombstone": latency_ms(tombstone_latencies)}
+
+    with db.connection() as conn:
+        conn.cursor().execute("UPDATE commercial_centers SET retention_days = ?", (args.ttl,))
+    archive = retention.Archive(os.path.join(workdir, "archive"), "ndjson")
+    job = retention.RetentionJob(archive, batch_size=args.batch_size, pause=0)
+    run = job.run_once()
+    deleted = run["reaped"] + run["expired"]
+    results["retention"] = dict(
+        run,
+        rows_per_s=deleted / run["seconds"] if run["seconds"] else None,
+        archive_files=len(archive.files),
+        archive_mb=archive.bytes_out / 1e6,
+        compression_ratio=archive.bytes_in / archive.bytes_out if archive.bytes_out else None,
+    )
+    results["after"] = table_size(db, path)
+    results["history_after"] = history_latency(app, users, rng)
+    # With the TTL applied every day, the table holds about `ttl` days of traffic
+    results["steady_state_rows"] = int(args.messages * min(args.ttl, args.days) / args.days)
+
+    clear = results["clear_ms"]
+    print(f"clear-session p50/p95: DELETE {clear['delete']['p50']:.2f}/{clear['delete']['p95']:.2f} ms, "
+          f"tombstone {clear['tombstone']['p50']:.2f}/{clear['tombstone']['p95']:.2f} ms")
+    r = results["retention"]
+    print(f"retention: {r['reaped']} reaped + {r['expired']} expired in {r['seconds']:.1f}s "
+          f"({r['rows_per_s']:,.0f} rows/s), {r['batches']} batches, longest {r['max_batch_seconds'] * 1000:.0f} ms")
+    print(f"archive: {r['archive_files']} files, {r['archive_mb']:.1f} MB, {r['compression_ratio']:.1f}x compression")
+    for phase in ("before", "after"):
+        size, history = results[phase], results[f"history_{phase}"]
+        print(f"{phase:>6}: {size['rows']:>9} rows, {size['used_mb']:7.1f} MB used, "
+              f"history page p50/p95 {history['p50']:.2f}/{history['p95']:.2f} ms")
+    print(f"steady state with a {args.ttl}-day TTL: ~{results['steady_state_rows']} rows")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
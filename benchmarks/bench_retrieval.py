@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+# Recall@k and latency of the local retrieval modes (BM25, vector, hybrid) on a
+# generated knowledge base, plus full and incremental index build times.
+# Queries are built from a target document's words with typos and filler words,
+# so exact-term and fuzzy matching both matter.
+#
+#   python benchmarks/bench_retrieval.py --docs 5000 --queries 500
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+CATEGORIES = ["fashion", "shoes", "electronics", "restaurant", "cafe", "beauty", "sports", "toys",
+              "jewelry", "books", "furniture", "pharmacy", "optician", "bakery", "cinema"]
+WORDS = ("collection seasonal discount loyalty card opening terrace gift wrapping repair service "
+         "vegan menu brunch kids corner delivery click collect fitting room appointment tasting "
+         "premium outlet sale refund exchange warranty organic local artisan espresso pastry "
+         "sneakers running yoga headphones laptop smartphone perfume skincare makeup glasses "
+         "lenses watch ring bracelet novel comics sofa lamp mattress vitamins prescription").split()
+SYLLABLES = ["ka", "lo", "mi", "tra", "ven", "so", "ri", "pel", "du", "nor", "ex", "qua", "bi", "fen", "gor"]
+FILLER = ["where", "is", "the", "can", "i", "find", "do", "you", "have", "please", "what", "about"]
+
+
+def make_vocabulary(size, rng):
+    # Brand and product names, so that documents are told apart by rarer terms
+    vocabulary = set()
+    while len(vocabulary) < size:
+        vocabulary.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return WORDS + sorted(vocabulary)
+
+
+def make_documents(count, rng):
+    vocabulary = make_vocabulary(3000, rng)
+    documents = []
+    for i in range(count):
+        category = rng.choice(CATEGORIES)
+        name = f"{rng.choice(['Maison', 'Studio', 'Atelier', 'Corner', 'House'])} {i}"
+        words = rng.sample(vocabulary, 12)
+        content = (f"{name} is a {category} store on level {rng.randint(0, 3)}, unit {rng.randint(1, 400)}. "
+                   + " ".join(words) + ".")
+        documents.append((category, name, content))
+    return documents
+
+
+def typo(word, rng):
+    if len(word) < 5:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def make_queries(documents, count, rng):
+    queries = []
+    for _ in range(count):
+        target = rng.randrange(len(documents))
+        _, name, content = documents[target]
+        words = content.split(".")[-2].split()
+        picked = rng.sample(words, 3)
+        picked = [typo(w, rng) if rng.random() < 0.4 else w for w in picked]
+        query = rng.sample(FILLER, 2) + [name.split()[0]] + picked
+        rng.shuffle(query)
+        queries.append((target + 1, " ".join(query)))
+    return queries
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--edit-fraction", type=float, default=0.01)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    os.environ["DB_BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = os.path.join(tmp, "bench.db")
+    import db
+    import schema
+    import retrieval
+    import embeddings
+
+    rng = random.Random(7)
+    schema.migrate()
+    schema.ensure_center("bench", "Bench")
+    documents = make_documents(args.docs, rng)
+    with db.connection() as conn:
+        conn.executemany(
+            "INSERT INTO knowledge_base (center_id, content_type, title, content, last_updated) "
+            "VALUES ('bench', ?, ?, ?, '2025-01-01 00:00:00')",
+            documents
+        )
+
+    retriever = retrieval.Retriever(embeddings.HashingEmbedder(), index_dir=os.path.join(tmp, "index"),
+                                    top_k=args.k, refresh_interval=3600)
+    started = time.perf_counter()
+    retriever.build("bench")
+    results = {"docs": args.docs, "full_build_s": time.perf_counter() - started}
+
+    edited = rng.sample(range(1, args.docs + 1), max(1, int(args.docs * args.edit_fraction)))
+    with db.connection() as conn:
+        conn.executemany(
+            "UPDATE knowledge_base SET content = content || ' Updated.', "
+            "last_updated = '2025-02-01 00:00:00' WHERE id = ?",
+            [(kb_id,) for kb_id in edited]
+        )
+    started = time.perf_counter()
+    retriever.build("bench")
+    results["incremental_build_s"] = time.perf_counter() - started
+    results["edited_rows"] = len(edited)
+    print(f"Full build of {args.docs} docs: {results['full_build_s']:.2f}s; "
+          f"refresh after editing {len(edited)}: {results['incremental_build_s']:.2f}s")
+
+    queries = make_queries(documents, args.queries, rng)
+    retriever.search("bench", "warm up")
+    for mode in ("bm25", "vector", "hybrid"):
+        hits, latencies = 0, []
+        for target, query in queries:
+            started = time.perf_counter()
+            found = retriever.search("bench", query, mode=mode)
+            latencies.append(time.perf_counter() - started)
+            hits += str(target) in [doc["kb_id"] for doc in found]
+        results[mode] = {
+            f"recall_at_{args.k}": hits / len(queries),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+        }
+        print(f"{mode:>7}: recall@{args.k} {hits / len(queries):.3f}  "
+              f"p50 {results[mode]['p50_ms']:.2f} ms  p95 {results[mode]['p95_ms']:.2f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+# Concurrency vs. latency for the sync and async serving modes, against the
+# offline stub LLM and a SQLite database.
+#
+#   python benchmarks/bench_serving.py --concurrency 4 16 64 256
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, "backend")
+
+MODES = {
+    "sync": ["-k", "sync", "-w", "4", "app:app"],
+    "async": ["-k", "uvicorn_worker.UvicornWorker", "-w", "1", "asgi:application"],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def start_server(mode, port, db_path, llm_delay):
+    env = dict(
+        os.environ,
+        DB_BACKEND="sqlite",
+        SQLITE_PATH=db_path,
+        LLM_BACKEND="fake",
+        FAKE_LLM_FIRST_TOKEN_DELAY=str(llm_delay),
+        FAKE_LLM_TOKEN_DELAY="0",
+        COMMERCIAL_CENTER_ID="bench",
+        COMMERCIAL_CENTER_NAME="Bench",
+        FLASK_SECRET_KEY="bench",
+    )
+    subprocess.run([sys.executable, os.path.join(BACKEND, "schema.py")], env=env, check=True)
+    cmd = [sys.executable, "-m", "gunicorn", "--chdir", BACKEND, "-b", f"127.0.0.1:{port}",
+           "--timeout", "120", "--log-level", "warning"] + MODES[mode]
+    proc = subprocess.Popen(cmd, env=env)
+    wait_for(port)
+    return proc
+
+
+def session_cookie(port):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    conn.request("GET", "/")
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.getheader("Set-Cookie").split(";", 1)[0]
+
+
+def chat(port, cookie, message):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    start = time.perf_counter()
+    conn.request("POST", "/process-input", body=json.dumps({"message": message}),
+                 headers={"Content-Type": "application/json", "Cookie": cookie})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return time.perf_counter() - start, response.status
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+
+def run_level(port, concurrency, requests_per_client):
+    cookies = [session_cookie(port) for _ in range(concurrency)]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def client(cookie):
+        nonlocal errors
+        for i in range(requests_per_client):
+            elapsed, status = chat(port, cookie, f"What are the opening hours? #{i}")
+            with lock:
+                latencies.append(elapsed)
+                errors += status != 200
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(client, cookies))
+    wall = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / wall,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", default=list(MODES))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[4, 16, 64, 256])
+    parser.add_argument("--requests", type=int, default=3, help="requests per client")
+    parser.add_argument("--llm-delay", type=float, default=1.0, help="stub LLM latency in seconds")
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    for mode in args.modes:
+        port = free_port()
+        with tempfile.TemporaryDirectory() as tmp:
+            proc = start_server(mode, port, os.path.join(tmp, "bench.db"), args.llm_delay)
+            try:
+                results[mode] = []
+                for concurrency in args.concurrency:
+                    row = run_level(port, concurrency, args.requests)
+                    results[mode].append(row)
+                    print(f"{mode:>5} c={concurrency:<4} rps={row['rps']:8.1f} "
+                          f"p50={row['p50_ms']:8.0f}ms p99={row['p99_ms']:8.0f}ms "
+                          f"errors={row['errors']}")
+            finally:
+                proc.terminate()
+                proc.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
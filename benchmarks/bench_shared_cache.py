@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+# Shared cache tier (backend/sharedcache.py) against a DB round trip. Fills a
+# SQLite database with users, conversations and messages, then runs --workers
+# processes that each serve a random mix of sidebar refreshes (conversation
+# lists) and history page loads for --users users, with --write-ratio of the
+# requests saving a message (which invalidates that user). Three setups:
+#
+#   db       no cache, every read is a query
+#   private  one cache file per worker: what a per-process cache gets
+#   shared   one cache file for every worker
+#
+# and reports the hit rate, the share of hits on entries another worker
+# stored, and the latency of hits, misses and uncached reads.
+#
+#   python benchmarks/bench_shared_cache.py --workers 4 --users 500 --requests 5000
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+MODES = ("db", "private", "shared")
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] * 1000
+
+
+def populate(app, users, conversations, messages):
+    ids = []
+    for u in range(users):
+        user_id = f"00000000-0000-4000-8000-{u:012d}"
+        app.get_or_create_user(user_id)
+        for c in range(conversations):
+            conversation_id = f"{u:08d}-{c:04d}-4000-8000-000000000000"
+            with app.db.connection() as conn:
+                conn.cursor().execute(
+                    "INSERT INTO conversation_sessions (id, user_id, center_id, title) VALUES (?, ?, ?, ?)",
+                    (conversation_id, user_id, app.tenants.current().id, f"Conversation {c}")
+                )
+            for m in range(messages):
+                app.save_message(user_id, f"Message {m} du visiteur {u}", "user" if m % 2 == 0 else "assistant",
+                                 conversation_id=conversation_id)
+        ids.append(user_id)
+    return ids
+
+
+def worker(mode, index, cache_path, user_ids, args, seed, results):
+    import app
+    app.tenants.activate(app.centers.resolve())
+    app.shared_cache.path = {"db": "", "private": f"{cache_path}.{index}", "shared": cache_path}[mode]
+    rng = random.Random(seed)
+    timings = {"hit": [], "miss": [], "db": []}
+    hot = user_ids[:max(1, int(len(user_ids) * args.hot_fraction))]
+    for _ in range(args.requests):
+        # Most traffic comes from a hot set of active users
+        user_id = rng.choice(hot if rng.random() < 0.8 else user_ids)
+        if rng.random() < args.write_ratio:
+            app.save_message(user_id, "Nouveau message", "user")
+            continue
+        if rng.random() < 0.5:
+            namespace, params, load = "conversations", (), lambda: app.load_conversations(user_id)
+        else:
+            params = (app.tenants.current().id, None, args.page, None, None)
+            namespace, load = "history", lambda: app.get_history_page(user_id, None, args.page)
+        before = app.shared_cache.stats["misses"]
+        started = time.perf_counter()
+        if mode == "db":
+            load()
+            timings["db"].append(time.perf_counter() - started)
+            continue
+        app.shared_cache.cached(namespace, user_id, params, load)
+        elapsed = time.perf_counter() - started
+        timings["miss" if app.shared_cache.stats["misses"] > before else "hit"].append(elapsed)
+    stats = app.shared_cache.snapshot()
+    results.put({"timings": timings, "stats": {k: stats[k] for k in ("hits", "shared_hits", "misses",
+                                                                      "evictions", "invalidations")}})
+
+
+def run(mode, cache_path, user_ids, args):
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    procs = [context.Process(target=worker, args=(mode, i, cache_path, user_ids, args, i, results))
+             for i in range(args.workers)]
+    started = time.perf_counter()
+    for proc in procs:
+        proc.start()
+    collected = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    elapsed = time.perf_counter() - started
+
+    timings = {"hit": [], "miss": [], "db": []}
+    totals = {"hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+    for result in collected:
+        for key, values in result["timings"].items():
+            timings[key] += values
+        for key in totals:
+            totals[key] += result["stats"][key]
+    lookups = totals["hits"] + totals["shared_hits"] + totals["misses"]
+    summary = dict(totals, elapsed_s=elapsed)
+    summary["hit_rate"] = (totals["hits"] + totals["shared_hits"]) / lookups if lookups else None
+    summary["cross_worker_share"] = totals["shared_hits"] / (totals["hits"] + totals["shared_hits"]) \
+        if totals["hits"] + totals["shared_hits"] else None
+    for key, values in timings.items():
+        if values:
+            summary[f"{key}_p50_ms"] = percentile(values, 50)
+            summary[f"{key}_p95_ms"] = percentile(values, 95)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--conversations", type=int, default=3, help="per user")
+    parser.add_argument("--messages", type=int, default=20, help="per conversation")
+    parser.add_argument("--requests", type=int, default=5000, help="per worker")
+    parser.add_argument("--page", type=int, default=30, help="history page size")
+    parser.add_argument("--hot-fraction", type=float, default=0.2)
+    parser.add_argument("--write-ratio", type=float, default=0.05)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-shared-cache-")
+    shm = "/dev/shm" if os.path.isdir("/dev/shm") else workdir
+    cache_path = os.path.join(shm, f"bench-shared-cache-{os.getpid()}")
+    os.environ.update(DB_BACKEND="sqlite", SQLITE_PATH=os.path.join(workdir, "chatbot.db"),
+                      COMMERCIAL_CENTER_ID="bench", LLM_BACKEND="fake", SHARED_CACHE_PATH="")
+    import schema
+    schema.migrate()
+    schema.ensure_center("bench", "bench")
+    import app
+    app.tenants.activate(app.centers.resolve())
+    user_ids = populate(app, args.users, args.conversations, args.messages)
+    app.db.close_pools()  # workers open their own connections after the fork
+
+    results = {}
+    try:
+        for mode in MODES:
+            summary = results[mode] = run(mode, cache_path, user_ids, args)
+            if mode == "db":
+                print(f"{mode:>8}: read p50 {summary['db_p50_ms']:.3f} ms, p95 {summary['db_p95_ms']:.3f} ms, "
+                      f"{summary['elapsed_s']:.1f} s")
+                continue
+            print(f"{mode:>8}: hit rate {summary['hit_rate']:.1%} ({summary['cross_worker_share'] or 0:.0%} "
+                  f"stored by another worker), hit p50 {summary['hit_p50_ms']:.3f} ms, "
+                  f"miss p50 {summary['miss_p50_ms']:.3f} ms, {summary['elapsed_s']:.1f} s")
+    finally:
+        for name in os.listdir(shm):
+            if name.startswith(os.path.basename(cache_path)):
+                os.remove(os.path.join(shm, name))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
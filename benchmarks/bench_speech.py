@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import http.client
+
+from bench_serving import free_port, wait_for
+
+# Voice turn latency (POST /speech) against the fake speech engine and the fake
+# LLM, through gunicorn. Each turn uploads --seconds of "audio" in 250 ms
+# chunks paced in real time, as a microphone would, and the client measures
+# from its last chunk (end of speech) to the response headers (transcript
+# ready), the first audio byte and the last one. The spread between the first
+# and last audio byte is what sentence-by-sentence synthesis saves over
+# synthesizing the whole answer once it is complete.
+#
+#   python benchmarks/bench_speech.py --turns 10 --seconds 3
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, "backend")
+sys.path.insert(0, BACKEND)
+
+CHUNK_BYTES = 8000  # 250 ms of 16 kHz 16-bit mono
+
+
+def utterance(text, seconds):
+    # The fake recognizer hears the text sent in place of samples; spaces pad it to length
+    import speech
+    samples = text.encode("utf-8").ljust(seconds * speech.SAMPLE_RATE * speech.SAMPLE_BYTES, b" ")
+    return b"RIFF" + bytes(speech.WAV_HEADER_BYTES - 4) + samples
+
+
+def voice_turn(port, audio, pace):
+    timings = {}
+
+    def body():
+        for start in range(0, len(audio), CHUNK_BYTES):
+            yield audio[start:start + CHUNK_BYTES]
+            time.sleep(pace)
+        timings["speech_end"] = time.perf_counter()
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    conn.request("POST", "/speech?language=fr-FR", body=body(), encode_chunked=True,
+                 headers={"Content-Type": "audio/wav; codecs=audio/pcm; samplerate=16000"})
+    response = conn.getresponse()
+    timings["headers"] = time.perf_counter()
+    if response.status != 200:
+        raise RuntimeError(f"HTTP {response.status}: {response.read()[:200]}")
+    first = response.read(1)
+    timings["first_audio"] = time.perf_counter()
+    size = len(first) + len(response.read())
+    timings["last_audio"] = time.perf_counter()
+    conn.close()
+    end = timings["speech_end"]
+    return {key: (timings[key] - end) * 1000 for key in ("headers", "first_audio", "last_audio")}, size
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--seconds", type=int, default=3, help="length of each utterance")
+    parser.add_argument("--realtime", type=float, default=1.0, help="upload pace; 0 sends as fast as possible")
+    parser.add_argument("--recognition-delay", type=float, default=0.15)
+    parser.add_argument("--synthesis-delay", type=float, default=0.1)
+    parser.add_argument("--llm-delay", type=float, default=0.3, help="fake LLM time to first token")
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-speech-")
+    port = free_port()
+    env = dict(
+        os.environ,
+        DB_BACKEND="sqlite", SQLITE_PATH=os.path.join(workdir, "chatbot.db"),
+        LLM_BACKEND="fake", FAKE_LLM_FIRST_TOKEN_DELAY=str(args.llm_delay), FAKE_LLM_TOKEN_DELAY="0.02",
+        SPEECH_BACKEND="fake", FAKE_SPEECH_RECOGNITION_DELAY=str(args.recognition_delay),
+        FAKE_SPEECH_SYNTHESIS_DELAY=str(args.synthesis_delay),
+        RESPONSE_CACHE_ENABLED="false", COALESCE_ENABLED="false",
+        COMMERCIAL_CENTER_ID="bench", FLASK_SECRET_KEY="bench",
+    )
+    subprocess.run([sys.executable, os.path.join(BACKEND, "schema.py")], env=env, check=True)
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "--chdir", BACKEND, "-b", f"127.0.0.1:{port}",
+                             "-k", "sync", "-w", "1", "--timeout", "120", "--log-level", "warning", "app:app"],
+                            env=env)
+    try:
+        wait_for(port)
+        samples = {"headers": [], "first_audio": [], "last_audio": []}
+        audio_bytes = 0
+        pace = 0.25 * args.realtime
+        for i in range(args.turns):
+            timings, size = voice_turn(port, utterance(f"Le parking est-il ouvert le dimanche {i} ?", args.seconds),
+                                       pace)
+            audio_bytes += size
+            for key, value in timings.items():
+                samples[key].append(value)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    results = {"turns": args.turns, "seconds": args.seconds, "audio_bytes": audio_bytes}
+    for key, values in samples.items():
+        results[key] = {"p50_ms": percentile(values, 50), "p95_ms": percentile(values, 95)}
+        print(f"speech end -> {key:>11}: p50 {results[key]['p50_ms']:7.1f} ms, p95 {results[key]['p95_ms']:7.1f} ms")
+    saved = results["last_audio"]["p50_ms"] - results["first_audio"]["p50_ms"]
+    print(f"first audio plays {saved:.0f} ms before the whole answer is synthesized")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+import http.client
+
+# Cold-start cost: time to import the app module, and time until every worker
+# of a fresh gunicorn answers /healthz, with and without --preload.
+#
+#   python benchmarks/bench_startup.py --workers 4
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, "backend")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def bench_env(db_path):
+    return dict(
+        os.environ,
+        DB_BACKEND="sqlite",
+        SQLITE_PATH=db_path,
+        LLM_BACKEND="fake",
+        COMMERCIAL_CENTER_ID="bench",
+        COMMERCIAL_CENTER_NAME="Bench",
+        FLASK_SECRET_KEY="bench",
+    )
+
+
+def import_time(env, runs):
+    code = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], cwd=BACKEND, env=env,
+                             capture_output=True, text=True, check=True)
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return min(samples)
+
+
+def slowest_imports(env, top):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=BACKEND,
+                         env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Only the direct imports of app, so that packages are not counted twice
+        if name.startswith("   ") and not name.startswith("    "):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def healthy(port):
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+        conn.request("GET", "/healthz")
+        status = conn.getresponse().status
+        conn.close()
+        return status == 200
+    except OSError:
+        return False
+
+
+def time_to_ready(env, workers, preload, timeout=60):
+    # Ready means a burst of health checks all succeed, so every worker has booted
+    port = free_port()
+    cmd = [sys.executable, "-m", "gunicorn", "--chdir", BACKEND, "-b", f"127.0.0.1:{port}",
+           "-k", "sync", "-w", str(workers), "--log-level", "warning"]
+    if preload:
+        cmd.append("--preload")
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd + ["app:app"], env=env)
+    try:
+        deadline = start + timeout
+        first = None
+        while time.perf_counter() < deadline:
+            if healthy(port):
+                first = first or time.perf_counter() - start
+                if all(healthy(port) for _ in range(workers * 4)):
+                    return first, time.perf_counter() - start
+            time.sleep(0.01)
+        raise RuntimeError("gunicorn did not become ready")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8, help="slowest imports to list")
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = bench_env(os.path.join(tmp, "bench.db"))
+        subprocess.run([sys.executable, os.path.join(BACKEND, "schema.py")], env=env,
+                       check=True, capture_output=True)
+
+        results = {"import_app_ms": import_time(env, args.runs) * 1000}
+        print(f"import app: {results['import_app_ms']:.0f} ms (best of {args.runs})")
+        for cumulative, name in slowest_imports(env, args.top):
+            print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+        for preload in (False, True):
+            label = "preload" if preload else "no_preload"
+            first, ready = min(time_to_ready(env, args.workers, preload) for _ in range(args.runs))
+            results[label] = {"first_response_ms": first * 1000, "all_workers_ms": ready * 1000}
+            print(f"{label:>10} w={args.workers}: first /healthz {first * 1000:6.0f} ms, "
+                  f"all workers {ready * 1000:6.0f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
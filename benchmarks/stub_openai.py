@@ -0,0 +1,171 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-in for the Azure OpenAI chat completions API, so the app can run
+# its real SDK path (LLM_BACKEND=azure) with no network. Latency is a first
+# token delay plus a per-token delay; stream=true answers as server-sent events.
+# A share of requests can be refused with 429 + Retry-After or failed with 500,
+# to exercise the retry and failover paths of backend/dispatch.py.
+#
+#   python benchmarks/stub_openai.py --port 8089 --first-token 0.4 --token-delay 0.02
+#   python benchmarks/stub_openai.py --port 8090 --throttle-rate 0.3 --retry-after 2
+#   ENDPOINT_URL=http://127.0.0.1:8089 AZURE_OPENAI_API_KEY=stub DEPLOYMENT_NAME=stub ...
+
+ANSWER = (
+    "Le centre est ouvert **tous les jours de 10h à 20h**.[doc1]\n\n"
+    "- Le parking est gratuit la première heure\n"
+    "- Les restaurants asiatiques sont au niveau 1, près de la place centrale[doc2]\n\n"
+    "N'hésitez pas à consulter le plan sur le site."
+)
+
+
+def split_tokens(text, rng):
+    pieces, i = [], 0
+    while i < len(text):
+        step = rng.randint(2, 6)
+        pieces.append(text[i:i + step])
+        i += step
+    return pieces
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under load, adding seconds of SYN retries
+    request_queue_size = 1024
+
+
+class StubOpenAI:
+    def __init__(self, port=0, first_token=0.4, token_delay=0.02, jitter=0.1, answer=ANSWER,
+                 throttle_rate=0.0, retry_after=1.0, error_rate=0.0):
+        self.first_token = first_token
+        self.token_delay = token_delay
+        self.jitter = jitter
+        self.answer = answer
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.split("?", 1)[0].endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                with stub._lock:
+                    stub.requests += 1
+                roll = random.random()
+                if roll < stub.throttle_rate:
+                    with stub._lock:
+                        stub.throttled += 1
+                    stub.refuse(self, 429, "Rate limit exceeded", {
+                        "Retry-After": str(max(1, round(stub.retry_after))),
+                        "retry-after-ms": str(int(stub.retry_after * 1000)),
+                    })
+                elif roll < stub.throttle_rate + stub.error_rate:
+                    with stub._lock:
+                        stub.failed += 1
+                    stub.refuse(self, 500, "Internal server error", {})
+                else:
+                    stub.complete(self, body)
+
+        self.server = Server(("127.0.0.1", port), Handler)
+        self.port = self.server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def _delay(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def refuse(self, handler, status, message, headers):
+        payload = json.dumps({"error": {"code": str(status), "message": message}}).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def complete(self, handler, body):
+        rng = random.Random(len(json.dumps(body.get("messages", []))))
+        tokens = split_tokens(self.answer, rng)
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens)}
+        base = {"id": "chatcmpl-stub", "created": int(time.time()), "model": body.get("model") or "stub"}
+
+        if not body.get("stream"):
+            self._delay(self.first_token + self.token_delay * len(tokens))
+            payload = json.dumps(dict(base, object="chat.completion", usage=usage, choices=[{
+                "index": 0, "finish_reason": "stop",
+                "message": {"role": "assistant", "content": self.answer},
+            }])).encode()
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Content-Length", str(len(payload)))
+            handler.end_headers()
+            handler.wfile.write(payload)
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        def event(data):
+            frame = f"data: {data}\n\n".encode()
+            handler.wfile.write(f"{len(frame):x}\r\n".encode() + frame + b"\r\n")
+            handler.wfile.flush()
+
+        self._delay(self.first_token)
+        for i, token in enumerate(tokens):
+            delta = {"content": token}
+            if i == 0:
+                delta["role"] = "assistant"
+            event(json.dumps(dict(base, object="chat.completion.chunk", choices=[
+                {"index": 0, "delta": delta, "finish_reason": None}
+            ])))
+            self._delay(self.token_delay)
+        event(json.dumps(dict(base, object="chat.completion.chunk", usage=usage, choices=[
+            {"index": 0, "delta": {}, "finish_reason": "stop"}
+        ])))
+        event("[DONE]")
+        handler.wfile.write(b"0\r\n\r\n")
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="stub-openai", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--first-token", type=float, default=0.4, help="seconds before the first token")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between tokens")
+    parser.add_argument("--jitter", type=float, default=0.1, help="relative latency jitter")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests refused with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="seconds sent in Retry-After")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failed with 500")
+    args = parser.parse_args()
+    stub = StubOpenAI(args.port, args.first_token, args.token_delay, args.jitter,
+                      throttle_rate=args.throttle_rate, retry_after=args.retry_after, error_rate=args.error_rate)
+    print(f"Stub Azure OpenAI listening on {stub.url}")
+    stub.server.serve_forever()
@@ -16,9 +16,15 @@ document.addEventListener('DOMContentLoaded', () => {
     const closeSidebarBtn = document.querySelector('.close-sidebar');
     
     let currentConversationId = null;
+    // Keyset cursors: `before` pages back to older messages, `latest` fetches newer ones
+    const HISTORY_PAGE_SIZE = 30;
+    let historyCursors = { before: null, latest: null };
+    // Rendered messages of conversations switched away from, refreshed with since=
+    const conversationViews = new Map();
 
     // App State
     let selectedLanguage = 'en-US'; // Default language
+    let voiceTurn = null; // the recording in progress, see startVoiceTurn
     const supportedLanguages = [
         { code: 'en-US', name: 'English (US)' },
         { code: 'en-GB', name: 'English (UK)' },
@@ -134,12 +140,21 @@ document.addEventListener('DOMContentLoaded', () => {
         return `${date.toLocaleDateString()} ${date.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })}`;
     }
 
-    // Send feedback to server
-    function handleFeedback(messageId, value) {
+    // Votes are queued and sent together; repeated clicks on one message keep the last value
+    const pendingFeedback = new Map();
+    let feedbackTimer = null;
+
+    function flushFeedback() {
+        clearTimeout(feedbackTimer);
+        feedbackTimer = null;
+        if (pendingFeedback.size === 0) return;
+        const votes = Array.from(pendingFeedback, ([message_id, feedback]) => ({ message_id, feedback }));
+        pendingFeedback.clear();
         fetch('/feedback', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ message_id: messageId, feedback: value }),
+            body: JSON.stringify({ votes }),
+            keepalive: true,
         })
         .then(response => response.json())
         .then(data => {
@@ -150,6 +165,16 @@ document.addEventListener('DOMContentLoaded', () => {
         .catch(console.error);
     }
 
+    // Send feedback to server
+    function handleFeedback(messageId, value) {
+        pendingFeedback.set(messageId, value);
+        if (!feedbackTimer) feedbackTimer = setTimeout(flushFeedback, 1000);
+    }
+
+    document.addEventListener('visibilitychange', () => {
+        if (document.visibilityState === 'hidden') flushFeedback();
+    });
+
     // Create language selector dropdown
     function createLanguageSelector() {
         const selector = document.createElement('select');
@@ -175,37 +200,92 @@ document.addEventListener('DOMContentLoaded', () => {
     function loadChatHistory() {
         chatWindow.innerHTML = '';
         showLoadingIndicator();
+        historyCursors = { before: null, latest: null };
         
-        fetch('/get-history')
-            .then(response => response.json())
+        fetchHistory({})
             .then(data => {
                 chatWindow.innerHTML = '';
                 
-                if (data.status === 'success') {
-                    if (data.history.length === 0) {
-                        showWelcomeMessage();
-                    } else {
-                        data.history.forEach(msg => {
-                            addMessage(
-                                msg.role, 
-                                msg.content, 
-                                msg.timestamp,
-                                false,
-                                msg.message_id,
-                                msg.feedback
-                            );
-                        });
-                    }
-                    scrollToBottom();
+                if (data.history.length === 0) {
+                    showWelcomeMessage();
                 } else {
-                    showErrorMessage('Failed to load history:', data.error);
+                    renderHistory(data, 'replace');
                 }
+                scrollToBottom();
             })
             .catch(error => {
                 showErrorMessage('Error loading history:', error);
             });
     }
 
+    // One page of the current conversation's history
+    function fetchHistory(params) {
+        const query = new URLSearchParams({ limit: HISTORY_PAGE_SIZE, ...params });
+        if (currentConversationId) query.set('conversation_id', currentConversationId);
+        
+        return fetch(`/get-history?${query}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.status !== 'success') throw new Error(data.error);
+                return data;
+            });
+    }
+
+    // Render a history page: 'replace' the first page, 'prepend' older, 'append' newer
+    function renderHistory(data, position) {
+        const messages = data.history.filter(
+            msg => !chatWindow.querySelector(`[data-message-id="${msg.message_id}"]`)
+        );
+        const elements = messages.map(msg => createMessageElement(
+            msg.role, msg.content, msg.timestamp, msg.message_id, msg.feedback
+        ));
+        
+        if (position === 'prepend') {
+            // Keep the visible messages in place while older ones are added above
+            const previousHeight = chatWindow.scrollHeight;
+            const anchor = chatWindow.querySelector('.message');
+            elements.forEach(element => chatWindow.insertBefore(element, anchor));
+            chatWindow.scrollTop += chatWindow.scrollHeight - previousHeight;
+        } else {
+            elements.forEach(element => chatWindow.appendChild(element));
+            scrollToBottom();
+        }
+        
+        if (position !== 'append') historyCursors.before = data.before;
+        if (data.latest) historyCursors.latest = data.latest;
+        updateLoadEarlierButton();
+    }
+
+    function updateLoadEarlierButton() {
+        let button = chatWindow.querySelector('.load-earlier');
+        if (!historyCursors.before) {
+            if (button) button.remove();
+            return;
+        }
+        if (!button) {
+            button = document.createElement('button');
+            button.className = 'load-earlier';
+            button.textContent = 'Load earlier messages';
+            button.addEventListener('click', loadEarlierMessages);
+        }
+        chatWindow.prepend(button);
+    }
+
+    function loadEarlierMessages() {
+        fetchHistory({ before: historyCursors.before })
+            .then(data => renderHistory(data, 'prepend'))
+            .catch(console.error);
+    }
+
+    // Only fetch what was added after the newest rendered message
+    function loadNewMessages() {
+        const params = historyCursors.latest ? { since: historyCursors.latest } : {};
+        return fetchHistory(params).then(data => {
+            renderHistory(data, 'append');
+            if (data.has_more) return loadNewMessages();
+        });
+    }
+
     // Show loading indicator
     function showLoadingIndicator() {
         const loadingMessage = document.createElement('div');
@@ -262,6 +342,13 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Add message to chat window
     function addMessage(role, text, timestamp = null, save = true, messageId = null, feedback = 0) {
+        const messageDiv = createMessageElement(role, text, timestamp, messageId, feedback);
+        chatWindow.appendChild(messageDiv);
+        scrollToBottom();
+        return messageDiv;
+    }
+
+    function createMessageElement(role, text, timestamp = null, messageId = null, feedback = 0) {
         const messageDiv = document.createElement('div');
         messageDiv.classList.add('message', role);
         
@@ -285,8 +372,7 @@ document.addEventListener('DOMContentLoaded', () => {
         
         messageDiv.appendChild(bubbleDiv);
         messageDiv.appendChild(messageInfoDiv);
-        chatWindow.appendChild(messageDiv);
-        scrollToBottom();
+        return messageDiv;
     }
 
     // Create message info div with timestamp and feedback buttons
@@ -351,7 +437,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!inputText) return;
 
         // Add user message and clear input
-        addMessage('user', inputText);
+        const userMessage = addMessage('user', inputText);
         inputField.value = '';
         inputField.focus();
 
@@ -363,8 +449,10 @@ document.addEventListener('DOMContentLoaded', () => {
         submitBtn.disabled = true;
 
         try {
-            const response = await processUserInput(inputText);
+            const response = await streamUserInput(inputText, processingId);
             removeProcessingMessage(processingId);
+            // Lets later history fetches recognise this message as already shown
+            if (response.user_message_id) userMessage.dataset.messageId = response.user_message_id;
             addMessage('assistant', response.response, new Date().toISOString(), true, response.assistant_message_id);
         } catch (error) {
             handleProcessingError(processingId, error);
@@ -397,7 +485,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const response = await fetch('/process-input', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ message: input }),
+            body: JSON.stringify({ message: input, conversation_id: currentConversationId }),
         });
 
         if (!response.ok) {
@@ -408,6 +496,74 @@ document.addEventListener('DOMContentLoaded', () => {
         return await response.json();
     }
 
+    // Stream the answer over server-sent events, falling back to a single request
+    async function streamUserInput(input, processingId) {
+        const response = await fetch('/process-input/stream', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ message: input, conversation_id: currentConversationId }),
+        });
+
+        if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(errorData.error || 'Failed to fetch response from the server');
+        }
+
+        if (!response.body || !response.body.getReader) {
+            return processUserInput(input);
+        }
+
+        const bubble = document.querySelector(`[data-message-id="${processingId}"] .message-bubble`);
+        const rendered = document.createElement('div');
+        const pending = document.createElement('div');
+        pending.classList.add('streaming-text');
+        let streamedText = '';
+        let renderedUpTo = 0;
+        let started = false;
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const frame = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                const event = (frame.match(/^event: (.*)$/m) || [])[1];
+                const data = JSON.parse((frame.match(/^data: (.*)$/m) || [])[1] || '{}');
+
+                if (event === 'delta') {
+                    if (!started && bubble) {
+                        bubble.innerHTML = '';
+                        bubble.appendChild(rendered);
+                        bubble.appendChild(pending);
+                        started = true;
+                    }
+                    streamedText += data.text;
+                    pending.textContent = streamedText.slice(renderedUpTo);
+                    scrollToBottom();
+                } else if (event === 'block') {
+                    // The finished block replaces the raw text it covers
+                    rendered.insertAdjacentHTML('beforeend', data.html);
+                    renderedUpTo = data.end;
+                    pending.textContent = streamedText.slice(renderedUpTo);
+                } else if (event === 'done') {
+                    return data;
+                } else if (event === 'error') {
+                    throw new Error(data.error);
+                }
+            }
+        }
+
+        throw new Error('The response stream ended unexpectedly');
+    }
+
     // Remove processing message
     function removeProcessingMessage(id) {
         const processingMessage = document.querySelector(`[data-message-id="${id}"]`);
@@ -443,6 +599,19 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Handle microphone button click
     async function handleMicClick() {
+        if (isVoiceStreamingSupported()) {
+            if (voiceTurn) {
+                stopVoiceTurn();
+            } else {
+                startVoiceTurn().catch(error => {
+                    console.error('Microphone error:', error);
+                    resetMicButton();
+                    showSpeechRecognitionError();
+                });
+            }
+            return;
+        }
+
         if (!isSpeechRecognitionSupported()) {
             alert('Speech recognition is not supported in this browser. Please use Chrome, Edge, or Safari.');
             return;
@@ -469,13 +638,7 @@ document.addEventListener('DOMContentLoaded', () => {
         recognition.continuous = false;
         recognition.interimResults = false;
 
-        recognition.onstart = () => {
-            micBtn.classList.add('recording');
-            micBtn.innerHTML = '<i class="fas fa-stop"></i>';
-            micBtn.title = 'Stop recording';
-            inputField.placeholder = 'Listening...';
-            inputField.classList.add('recording');
-        };
+        recognition.onstart = showRecordingState;
 
         recognition.onend = () => {
             resetMicButton();
@@ -505,6 +668,213 @@ document.addEventListener('DOMContentLoaded', () => {
         return recognition;
     }
 
+    // Voice turns through the server (/speech, when the page says it is configured):
+    // microphone audio is uploaded while the user speaks and the spoken answer
+    // plays as it arrives. Browsers without it keep the Web Speech API above.
+    function isVoiceStreamingSupported() {
+        return document.body.dataset.voice === 'stream' &&
+            !!(navigator.mediaDevices && navigator.mediaDevices.getUserMedia) &&
+            !!(window.AudioContext || window.webkitAudioContext);
+    }
+
+    // Whether fetch can send a body that is still being written (Chromium, over HTTP/2)
+    const supportsRequestStreams = (() => {
+        let duplexAccessed = false;
+        try {
+            const hasContentType = new Request('/', {
+                body: new ReadableStream(),
+                method: 'POST',
+                get duplex() {
+                    duplexAccessed = true;
+                    return 'half';
+                },
+            }).headers.has('Content-Type');
+            return duplexAccessed && !hasContentType;
+        } catch (error) {
+            return false;
+        }
+    })();
+
+    const VOICE_SAMPLE_RATE = 16000;
+
+    // WAV header for 16 kHz 16-bit mono PCM; a streamed upload does not know its length
+    function wavHeader(dataBytes = 0xFFFFFFFF - 36) {
+        const view = new DataView(new ArrayBuffer(44));
+        const writeText = (offset, text) => {
+            for (let i = 0; i < text.length; i++) view.setUint8(offset + i, text.charCodeAt(i));
+        };
+        writeText(0, 'RIFF');
+        view.setUint32(4, 36 + dataBytes, true);
+        writeText(8, 'WAVE');
+        writeText(12, 'fmt ');
+        view.setUint32(16, 16, true);
+        view.setUint16(20, 1, true); // PCM
+        view.setUint16(22, 1, true); // mono
+        view.setUint32(24, VOICE_SAMPLE_RATE, true);
+        view.setUint32(28, VOICE_SAMPLE_RATE * 2, true);
+        view.setUint16(32, 2, true);
+        view.setUint16(34, 16, true);
+        writeText(36, 'data');
+        view.setUint32(40, dataBytes, true);
+        return new Uint8Array(view.buffer);
+    }
+
+    // Float samples at the microphone's rate to 16 kHz 16-bit PCM
+    function toPcm16(samples, sampleRate) {
+        const ratio = sampleRate / VOICE_SAMPLE_RATE;
+        const pcm = new Int16Array(Math.floor(samples.length / ratio));
+        for (let i = 0; i < pcm.length; i++) {
+            // Each output sample averages the input samples it covers
+            const start = Math.floor(i * ratio);
+            const end = Math.max(start + 1, Math.floor((i + 1) * ratio));
+            let sum = 0;
+            for (let j = start; j < end; j++) sum += samples[j] || 0;
+            const value = Math.max(-1, Math.min(1, sum / (end - start)));
+            pcm[i] = value < 0 ? value * 0x8000 : value * 0x7FFF;
+        }
+        return new Uint8Array(pcm.buffer);
+    }
+
+    function sendVoiceTurn(body, options = {}) {
+        const query = new URLSearchParams({ language: selectedLanguage });
+        if (currentConversationId) query.set('conversation_id', currentConversationId);
+        return fetch(`/speech?${query}`, {
+            method: 'POST',
+            headers: { 'Content-Type': `audio/wav; codecs=audio/pcm; samplerate=${VOICE_SAMPLE_RATE}` },
+            body,
+            ...options,
+        });
+    }
+
+    async function startVoiceTurn() {
+        const media = await navigator.mediaDevices.getUserMedia({
+            audio: { channelCount: 1, echoCancellation: true, noiseSuppression: true }
+        });
+        const context = new (window.AudioContext || window.webkitAudioContext)();
+        const source = context.createMediaStreamSource(media);
+        const processor = context.createScriptProcessor(4096, 1, 1);
+        // Chunks are also kept, to send the recording whole if it cannot be streamed
+        const turn = { media, context, source, processor, chunks: [], controller: null, upload: null };
+
+        if (supportsRequestStreams) {
+            const body = new ReadableStream({
+                start(controller) {
+                    turn.controller = controller;
+                    controller.enqueue(wavHeader());
+                }
+            });
+            turn.upload = sendVoiceTurn(body, { duplex: 'half' });
+            // Refused e.g. over HTTP/1.1: stopVoiceTurn sends the recording instead
+            turn.upload.catch(() => { turn.controller = null; });
+        }
+
+        processor.onaudioprocess = (event) => {
+            const pcm = toPcm16(event.inputBuffer.getChannelData(0), context.sampleRate);
+            turn.chunks.push(pcm);
+            if (!turn.controller) return;
+            try {
+                turn.controller.enqueue(pcm);
+            } catch (error) {
+                turn.controller = null;
+            }
+        };
+        source.connect(processor);
+        processor.connect(context.destination);
+
+        voiceTurn = turn;
+        showRecordingState();
+    }
+
+    async function stopVoiceTurn() {
+        const turn = voiceTurn;
+        voiceTurn = null;
+        turn.processor.disconnect();
+        turn.source.disconnect();
+        turn.media.getTracks().forEach(track => track.stop());
+        turn.context.close();
+        resetMicButton();
+
+        const processingId = `processing-${Date.now()}`;
+        showProcessingIndicator(processingId);
+        micBtn.disabled = true;
+        submitBtn.disabled = true;
+
+        try {
+            let response = null;
+            if (turn.controller) {
+                // The end of the upload is the end of speech: the server answers from here
+                turn.controller.close();
+                response = await turn.upload.catch(() => null);
+            }
+            if (!response) {
+                const bytes = turn.chunks.reduce((total, chunk) => total + chunk.length, 0);
+                response = await sendVoiceTurn(new Blob([wavHeader(bytes), ...turn.chunks], { type: 'audio/wav' }));
+            }
+            await playVoiceAnswer(response, processingId);
+        } catch (error) {
+            handleProcessingError(processingId, error);
+        } finally {
+            micBtn.disabled = false;
+            submitBtn.disabled = false;
+        }
+    }
+
+    // Shows the transcript, plays the answer as it streams in, then shows its text
+    async function playVoiceAnswer(response, processingId) {
+        if (!response.ok) {
+            const errorData = await response.json().catch(() => ({}));
+            if (response.status === 422) {
+                removeProcessingMessage(processingId);
+                showSpeechRecognitionError();
+                return;
+            }
+            throw new Error(errorData.error || 'Failed to fetch response from the server');
+        }
+
+        const transcript = decodeURIComponent(response.headers.get('X-Transcript') || '');
+        const userMessage = createMessageElement(
+            'user', '', new Date().toISOString(), response.headers.get('X-User-Message-Id')
+        );
+        userMessage.querySelector('.message-bubble').textContent = transcript;
+        chatWindow.insertBefore(userMessage, document.querySelector(`[data-message-id="${processingId}"]`));
+        scrollToBottom();
+
+        const type = (response.headers.get('Content-Type') || 'audio/mpeg').split(';')[0];
+        const audio = new Audio();
+        audio.addEventListener('ended', () => URL.revokeObjectURL(audio.src), { once: true });
+        if (window.MediaSource && MediaSource.isTypeSupported(type) && response.body) {
+            const mediaSource = new MediaSource();
+            audio.src = URL.createObjectURL(mediaSource);
+            await new Promise(resolve => mediaSource.addEventListener('sourceopen', resolve, { once: true }));
+            const buffer = mediaSource.addSourceBuffer(type);
+            audio.play().catch(error => console.error('Playback error:', error));
+
+            const reader = response.body.getReader();
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer.appendBuffer(value);
+                await new Promise(resolve => buffer.addEventListener('updateend', resolve, { once: true }));
+            }
+            if (mediaSource.readyState === 'open') mediaSource.endOfStream();
+        } else {
+            audio.src = URL.createObjectURL(await response.blob());
+            audio.play().catch(error => console.error('Playback error:', error));
+        }
+
+        // The answer is stored once its audio has been sent
+        removeProcessingMessage(processingId);
+        await loadNewMessages();
+    }
+
+    function showRecordingState() {
+        micBtn.classList.add('recording');
+        micBtn.innerHTML = '<i class="fas fa-stop"></i>';
+        micBtn.title = 'Stop recording';
+        inputField.placeholder = 'Listening...';
+        inputField.classList.add('recording');
+    }
+
     // Reset mic button to default state
     function resetMicButton() {
         micBtn.classList.remove('recording');
@@ -572,6 +942,8 @@ document.addEventListener('DOMContentLoaded', () => {
             if (!response.ok) throw new Error('Failed to clear server session');
             
             chatWindow.innerHTML = '';
+            conversationViews.clear();
+            historyCursors = { before: null, latest: null };
             showWelcomeMessage();
             inputField.focus();
         } catch (error) {
@@ -613,7 +985,9 @@ document.addEventListener('DOMContentLoaded', () => {
             .then(response => response.json())
             .then(data => {
                 if (data.status === 'success') {
+                    stashConversationView();
                     currentConversationId = data.conversation.id;
+                    historyCursors = { before: null, latest: null };
                     loadConversations();
                     chatWindow.innerHTML = '';
                     showWelcomeMessage();
@@ -622,19 +996,39 @@ document.addEventListener('DOMContentLoaded', () => {
             .catch(console.error);
     }
 
+    // Keep the rendered messages so that switching back only fetches new ones
+    function stashConversationView() {
+        conversationViews.set(currentConversationId, {
+            nodes: Array.from(chatWindow.childNodes),
+            cursors: historyCursors
+        });
+    }
+
     // Switch conversation
     function switchConversation(conversationId) {
+        stashConversationView();
         currentConversationId = conversationId;
         loadConversations();
-        // Load conversation history
-        fetch(`/get-history?conversation_id=${conversationId}`)
-            .then(response => response.json())
+        chatWindow.innerHTML = '';
+        
+        const view = conversationViews.get(conversationId);
+        if (view) {
+            chatWindow.append(...view.nodes);
+            historyCursors = view.cursors;
+            scrollToBottom();
+            loadNewMessages().catch(console.error);
+            return;
+        }
+        
+        // Load the newest page of conversation history
+        historyCursors = { before: null, latest: null };
+        fetchHistory({})
             .then(data => {
-                if (data.status === 'success') {
-                    chatWindow.innerHTML = '';
-                    data.history.forEach(msg => {
-                        addMessage(msg.role, msg.content, msg.timestamp, false, msg.message_id, msg.feedback);
-                    });
+                if (currentConversationId !== conversationId) return;
+                if (data.history.length === 0) {
+                    showWelcomeMessage();
+                } else {
+                    renderHistory(data, 'replace');
                 }
             })
             .catch(console.error);
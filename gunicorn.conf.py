@@ -1,4 +1,66 @@
+import os
+
 bind = "0.0.0.0:8000"
 workers = 4
 worker_class = "sync"
-timeout = 120
\ No newline at end of file
+timeout = 120
+# Lets "backend.app:app" and "app:app" resolve sibling modules such as db
+pythonpath = "backend"
+# Import the app once in the master and fork ready workers from it. Nothing in the
+# import opens connections; see on_starting below for what runs before the fork.
+preload_app = True
+
+# Schema setup is a separate one-shot step ("python backend/schema.py", see the
+# deploy job of the workflow), so a database that is down or slow never keeps
+# the server from starting. Before any worker starts, the master only builds
+# the static assets if this deployment has no build yet (as
+# "python backend/assets.py" does), which needs no database.
+#
+# PREPARE_ON_START=true also has the master apply pending migrations and, with
+# RETRIEVAL_BACKEND=local, bring every center's retrieval index up to date
+# (as "python backend/retrieval.py --all" does), for single-host setups without
+# a deploy step. If the database cannot be reached, this is logged and the
+# server starts anyway.
+PREPARE_ON_START = os.getenv("PREPARE_ON_START", "false").lower() == "true"
+
+
+def on_starting(server):
+    import assets
+    if not os.path.exists(os.path.join(assets.ASSETS_BUILD_DIR, "manifest.json")):
+        manifest = assets.build()
+        server.log.info(f"Built {len(manifest)} static asset(s) into {assets.ASSETS_BUILD_DIR}")
+    if PREPARE_ON_START:
+        try:
+            prepare_database(server)
+        except Exception as e:
+            server.log.error(f"Could not prepare the database, starting anyway: {e}")
+        finally:
+            # Workers open their own connections after the fork
+            import db
+            db.close_pools()
+
+
+def prepare_database(server):
+    import schema
+    import llm
+    applied = schema.migrate()
+    if os.getenv("COMMERCIAL_CENTER_ID"):
+        schema.ensure_center(os.getenv("COMMERCIAL_CENTER_ID"), os.getenv("COMMERCIAL_CENTER_NAME"))
+    server.log.info(f"Schema is at version {schema.MIGRATIONS[-1][0]} ({len(applied)} migration(s) applied)")
+    if llm.RETRIEVAL_BACKEND == "local":
+        import tenants
+        import retrieval
+        import embeddings
+        retriever = retrieval.Retriever(
+            embeddings.create_embedder(os.getenv("RETRIEVAL_EMBEDDER", "local"), llm.get_client)
+        )
+        for center in tenants.load_centers():
+            version = retriever.build(center.id)
+            server.log.info(f"Retrieval index of center {center.id} is at version {version}")
+
+# SERVING_MODE=async runs backend/asgi.py under uvicorn workers, where one process
+# holds many in-flight chats instead of one per sync worker
+if os.getenv("SERVING_MODE") == "async":
+    worker_class = "uvicorn_worker.UvicornWorker"
+    wsgi_app = "asgi:application"
+    workers = int(os.getenv("WEB_CONCURRENCY", 2))
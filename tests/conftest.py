@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import uuid
+import tempfile
+import pytest
+
+# The backend reads its configuration at import time, so the environment is set
+# before any test module imports it: a scratch SQLite database, the fake LLM
+# without delays, and a spool directory of its own. No network is needed.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+WORKDIR = tempfile.mkdtemp(prefix="chatbot-tests-")
+CENTER_ID = "test-center"
+
+os.environ.update(
+    DB_BACKEND="sqlite",
+    SQLITE_PATH=os.path.join(WORKDIR, "chatbot.db"),
+    LLM_BACKEND="fake",
+    FAKE_LLM_FIRST_TOKEN_DELAY="0",
+    FAKE_LLM_TOKEN_DELAY="0",
+    COMMERCIAL_CENTER_ID=CENTER_ID,
+    COMMERCIAL_CENTER_NAME="Test center",
+    FLASK_SECRET_KEY="test",
+    WRITE_BEHIND="false",
+    WRITE_BEHIND_SPOOL_DIR=os.path.join(WORKDIR, "spool"),
+    SHARED_CACHE_PATH="",
+    SPEECH_BACKEND="",
+)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    import schema
+    schema.migrate()
+    schema.ensure_center(CENTER_ID, "Test center")
+    yield
+    import db
+    db.close_pools()
+
+
+@pytest.fixture
+def app_module():
+    import app
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def center(app_module):
+    # Functions called outside a request need the center a request would resolve
+    center = app_module.centers.resolve()
+    app_module.tenants.activate(center)
+    return center
+
+
+@pytest.fixture
+def user_id(app_module, center):
+    user_id = str(uuid.uuid4())
+    app_module.get_or_create_user(user_id)
+    return user_id
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+
+
+def parse_sse(body):
+    # [(event, data)] of a text/event-stream body
+    events = []
+    for frame in body.split("\n\n"):
+        if not frame.strip():
+            continue
+        fields = dict(line.split(": ", 1) for line in frame.split("\n"))
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
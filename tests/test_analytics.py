@@ -0,0 +1,111 @@
+import uuid
+from datetime import date
+import pytest
+import db
+import schema
+import analytics
+
+DAY = date(2024, 3, 1)
+
+
+@pytest.fixture
+def stats_center():
+    # Rollups of a center of their own, so other tests' messages do not count
+    center_id = f"stats-{uuid.uuid4().hex[:8]}"
+    schema.ensure_center(center_id, "Stats center")
+    return center_id
+
+
+@pytest.fixture
+def record(user_id):
+    def record(center_id, role, message, **extra):
+        return dict(user_id=user_id, center_id=center_id, message=message, role=role,
+                    timestamp=f"{DAY.isoformat()}T10:00:00", message_id=str(uuid.uuid4()), **extra)
+    return record
+
+
+def rollup(center_id):
+    with db.connection() as conn:
+        return analytics.daily_stats(conn.cursor(), center_id, DAY, DAY)
+
+
+def vote(votes):
+    with db.connection() as conn:
+        return analytics.apply_votes(conn.cursor(), votes)
+
+
+class RacingCursor:
+    """A cursor whose first UPDATE is preceded by another voter's, as under concurrency."""
+
+    def __init__(self, cursor, race):
+        self._cursor = cursor
+        self._race = race
+
+    def execute(self, sql, params=()):
+        if sql.lstrip().startswith("UPDATE") and self._race is not None:
+            race, self._race = self._race, None
+            race()
+        return self._cursor.execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def test_saved_messages_are_counted(app_module, stats_center, record):
+    app_module.insert_messages([
+        record(stats_center, "user", "Bonjour", tokens=3),
+        record(stats_center, "assistant", "Bonjour !", tokens=4, prompt_tokens=100, latency_ms=800),
+        record(stats_center, "assistant", "Au revoir", tokens=5, prompt_tokens=120, latency_ms=1200),
+    ])
+    [day] = rollup(stats_center)
+    assert day["user"]["messages"] == 1 and day["user"]["tokens"] == 3
+    assistant = day["assistant"]
+    assert (assistant["messages"], assistant["tokens"], assistant["prompt_tokens"]) == (2, 9, 220)
+    assert assistant["max_latency_ms"] == 1200
+    assert day["mean_latency_ms"] == 1000
+    assert day["like_rate"] == 0
+
+
+def test_vote_changes_move_the_counts(app_module, stats_center, record):
+    answers = [record(stats_center, "assistant", f"answer {i}") for i in range(2)]
+    app_module.insert_messages(answers)
+    first, second = (r["message_id"] for r in answers)
+
+    assert set(vote([(first, 1), (second, -1)])) == {first, second}
+    assistant = rollup(stats_center)[0]["assistant"]
+    assert (assistant["likes"], assistant["dislikes"]) == (1, 1)
+
+    vote([(second, 1)])  # a dislike turned into a like
+    vote([(first, 1)])  # unchanged, not counted twice
+    [day] = rollup(stats_center)
+    assert (day["assistant"]["likes"], day["assistant"]["dislikes"]) == (2, 0)
+    assert day["like_rate"] == 1.0
+
+    vote([(first, 0), (second, 0)])
+    assistant = rollup(stats_center)[0]["assistant"]
+    assert (assistant["likes"], assistant["dislikes"]) == (0, 0)
+    assert analytics.totals(rollup(stats_center))["assistant"]["messages"] == 2
+
+
+def test_unknown_messages_are_not_found(stats_center):
+    assert vote([(str(uuid.uuid4()), 1)]) == {}
+    assert rollup(stats_center) == []
+
+
+def test_vote_that_lost_a_race_is_retried_against_the_new_value(app_module, stats_center, record):
+    answer = record(stats_center, "assistant", "answer")
+    app_module.insert_messages([answer])
+    message_id = answer["message_id"]
+
+    # Another request dislikes the message between this vote's read and its update
+    with db.connection() as conn:
+        cursor = RacingCursor(conn.cursor(), lambda: vote([(message_id, -1)]))
+        assert analytics.apply_votes(cursor, [(message_id, 1)]) == {message_id: answer["user_id"]}
+
+    assistant = rollup(stats_center)[0]["assistant"]
+    # The like replaced the dislike: counting it against the stale 0 would leave a dislike behind
+    assert (assistant["likes"], assistant["dislikes"]) == (1, 0)
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT feedback FROM conversations WHERE message_id = ?", (message_id,))
+        assert cursor.fetchone()[0] == 1
@@ -0,0 +1,119 @@
+import json
+import uuid
+import asyncio
+import contextvars
+import asgi
+import assets
+import metrics
+from conftest import parse_sse
+
+
+def session_cookie(user_id):
+    serializer = asgi.flask_app.session_interface.get_signing_serializer(asgi.flask_app)
+    return f"{asgi.flask_app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'user_id': user_id})}"
+
+
+def call(method, path, body=b"", headers=()):
+    # Drives the ASGI application as a server would; returns (status, headers, body)
+    headers = [("host", "localhost"), ("content-length", str(len(body)))] + list(headers)
+    scope = {"type": "http", "method": method, "path": path, "raw_path": path.encode(), "query_string": b"",
+             "root_path": "", "scheme": "http", "http_version": "1.1", "server": ("localhost", 80),
+             "client": ("127.0.0.1", 1234),
+             "headers": [(name.encode(), value.encode()) for name, value in headers]}
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    # Each request in a context of its own, as under a server
+    contextvars.copy_context().run(asyncio.run, asgi.application(scope, receive, send))
+    start = sent[0]
+    response_headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    return start["status"], response_headers, b"".join(message.get("body", b"") for message in sent[1:])
+
+
+def chat(path, user_id, message, headers=()):
+    cookie = [("cookie", session_cookie(user_id))] if user_id else []
+    return call("POST", path, json.dumps({"message": message}).encode(),
+                [("content-type", "application/json")] + cookie + list(headers))
+
+
+def test_session_cookie_is_read_without_flask():
+    user_id = str(uuid.uuid4())
+    cookie = session_cookie(user_id)
+    assert asgi.session_user_id({"headers": [(b"cookie", cookie.encode())]}) == user_id
+    assert asgi.session_user_id({"headers": [(b"cookie", cookie[:-2].encode())]}) is None
+    assert asgi.session_user_id({"headers": []}) is None
+
+
+def test_answer_on_the_event_loop(user_id):
+    status, headers, body = chat("/process-input", user_id, f"Où est la sortie {uuid.uuid4()} ?",
+                                 [("origin", "https://shop.example")])
+    assert status == 200
+    data = json.loads(body)
+    assert data["response"] and data["user_message_id"] and data["assistant_message_id"]
+    # Flask-CORS headers, although Flask never saw the request
+    assert headers["access-control-allow-origin"] == "https://shop.example"
+    assert headers["access-control-allow-credentials"] == "true"
+
+
+def test_streamed_answer_on_the_event_loop(user_id, monkeypatch):
+    monkeypatch.setattr(metrics, "SERVER_TIMING", True)
+    status, headers, body = chat("/process-input/stream", user_id, f"Le parking {uuid.uuid4()} ?")
+    assert status == 200
+    assert headers["content-type"].startswith("text/event-stream")
+    assert "db_acquire" in headers["server-timing"]
+    events = parse_sse(body.decode())
+    assert events[0][0] == "start" and events[-1][0] == "done"
+    assert "".join(data["text"] for event, data in events if event == "delta")
+
+
+def test_invalid_input_is_refused(user_id):
+    for message in ("", "   ", None, 3):
+        status, _, body = chat("/process-input", user_id, message)
+        assert status == 400 and "error" in json.loads(body)
+
+
+def test_other_requests_go_through_flask():
+    status, _, body = call("GET", "/healthz")
+    assert status == 200 and json.loads(body) == {"status": "ok"}
+    # A visitor without a session is answered by Flask, which creates one
+    status, headers, _ = chat("/process-input", None, "Bonjour")
+    assert status == 200 and asgi.flask_app.config["SESSION_COOKIE_NAME"] in headers["set-cookie"]
+
+
+def test_built_assets_are_served_from_memory(tmp_path, monkeypatch):
+    source = tmp_path / "static"
+    source.mkdir()
+    (source / "app.js").write_text("console.log('ready');\n" * 100)
+    manifest = assets.build(str(source), str(tmp_path / "dist"), "/static/dist/")
+    monkeypatch.setattr(asgi.flask_module, "built_assets", assets.Assets(str(tmp_path / "dist")))
+    name = manifest["app.js"]["file"]
+
+    status, headers, body = call("GET", f"/static/dist/{name}", headers=[("accept-encoding", "gzip")])
+    assert status == 200 and headers["content-encoding"] == "gzip"
+    assert headers["cache-control"] == assets.IMMUTABLE_CACHE_CONTROL
+    assert int(headers["content-length"]) == len(body)
+    status, _, body = call("HEAD", f"/static/dist/{name}")
+    assert status == 200 and body == b""
+    assert call("GET", "/static/dist/missing.js")[0] == 404
+
+
+def test_lifespan():
+    inbox = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return inbox.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    asyncio.run(asgi.application({"type": "lifespan"}, receive, send))
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
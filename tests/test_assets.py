@@ -0,0 +1,124 @@
+import os
+import gzip
+import json
+import pytest
+import assets
+import compression
+
+
+@pytest.mark.parametrize("header, offered, expected", [
+    ("gzip, deflate, br", ["br", "gzip"], "br"),
+    ("gzip, deflate", ["br", "gzip"], "gzip"),
+    ("br;q=0.5, gzip;q=0.8", ["br", "gzip"], "gzip"),
+    ("br;q=0, *", ["br", "gzip"], "gzip"),
+    ("*;q=0", ["br", "gzip"], None),
+    ("identity", ["br", "gzip"], None),
+    ("", ["gzip"], None),
+    (None, ["gzip"], None),
+    ("GZIP;q=bad, gzip", ["gzip"], "gzip"),
+])
+def test_negotiation(header, offered, expected):
+    assert compression.negotiate(header, offered) == expected
+
+
+def test_js_minifier_keeps_strings_and_line_breaks():
+    source = 'const a = "// not a comment";  // a comment\n\n    /* block */ let b = `x\n  y`;\n'
+    assert assets.minify_js(source) == 'const a = "// not a comment";\nlet b = `x\n  y`;\n'
+    # A quote it cannot balance (here inside a regex literal) leaves the file as it was
+    assert assets.minify_js("const re = /'/;\n") == "const re = /'/;\n"
+
+
+def test_css_minifier():
+    # Spaces before a colon may be a descendant selector, so they stay
+    assert assets.minify_css("/* c */ .a :hover {\n  color: red ;\n}\n") == ".a :hover{color:red}"
+
+
+@pytest.fixture
+def source(tmp_path):
+    directory = tmp_path / "static"
+    directory.mkdir()
+    (directory / "logo.png").write_bytes(b"\x89PNG first")
+    (directory / "style.css").write_text("body {\n  background: url(/static/logo.png);\n}\n" * 40)
+    (directory / "app.js").write_text("// entry point\nconsole.log('ready');\n")
+    return directory
+
+
+def test_build_fingerprints_rewrites_and_precompresses(source, tmp_path):
+    build_dir = tmp_path / "dist"
+    manifest = assets.build(str(source), str(build_dir), "/static/dist/")
+    logo, style = manifest["logo.png"]["file"], manifest["style.css"]["file"]
+    assert logo.startswith("logo.") and logo.endswith(".png") and len(logo) == len("logo..png") + assets.HASH_LENGTH
+
+    css = (build_dir / style).read_text()
+    assert f"url(/static/dist/{logo})" in css and "/static/logo.png" not in css
+    assert (build_dir / manifest["app.js"]["file"]).read_text() == "console.log('ready');\n"
+    assert manifest["style.css"]["encodings"]["gzip"] < manifest["style.css"]["minified"]
+    assert gzip.decompress((build_dir / f"{style}.gz").read_bytes()).decode() == css
+    # Images are not compressed again, and small files only if it helps
+    assert manifest["logo.png"]["encodings"] == {}
+    assert json.loads((build_dir / "manifest.json").read_text()) == manifest
+
+    # A changed image changes the stylesheet that points at it
+    (source / "logo.png").write_bytes(b"\x89PNG second")
+    rebuilt = assets.build(str(source), str(build_dir), "/static/dist/", prune=True)
+    assert rebuilt["style.css"]["file"] != style and rebuilt["app.js"] == manifest["app.js"]
+    assert not (build_dir / style).exists() and not (build_dir / logo).exists()
+    assert (build_dir / rebuilt["style.css"]["file"]).exists()
+
+
+def test_variants_follow_accept_encoding(source, tmp_path):
+    build_dir = tmp_path / "dist"
+    manifest = assets.build(str(source), str(build_dir), "/static/dist/")
+    built = assets.Assets(str(build_dir), "/cdn/")
+    style = manifest["style.css"]["file"]
+    assert built.url("style.css") == f"/cdn/{style}"
+    assert built.url("missing.css") is None
+
+    assert built.variant(style, "gzip, br") == (os.path.join(str(build_dir), f"{style}.gz"), "gzip")
+    assert built.variant(style, None) == (os.path.join(str(build_dir), style), None)
+    assert built.variant("style.000000000000.css", "gzip") is None
+
+    data, encoding, mimetype = built.read(style, "gzip")
+    assert encoding == "gzip" and mimetype == "text/css; charset=utf-8"
+    assert gzip.decompress(data) == (build_dir / style).read_bytes()
+    assert assets.Assets(str(tmp_path / "none")).url("style.css") is None
+
+
+def test_built_asset_route(app_module, client, monkeypatch, source, tmp_path):
+    build_dir = tmp_path / "dist"
+    manifest = assets.build(str(source), str(build_dir), "/static/dist/")
+    monkeypatch.setattr(app_module, "built_assets", assets.Assets(str(build_dir)))
+    style = manifest["style.css"]["file"]
+
+    response = client.get(f"/static/dist/{style}", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Cache-Control"] == assets.IMMUTABLE_CACHE_CONTROL
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert response.mimetype == "text/css"
+    assert gzip.decompress(response.get_data()) == (build_dir / style).read_bytes()
+
+    response = client.get(f"/static/dist/{style}")
+    assert "Content-Encoding" not in response.headers
+    assert client.get("/static/dist/unknown.css").status_code == 404
+
+
+def test_json_responses_are_compressed_when_large(app_module):
+    compressor = compression.ResponseCompressor(min_bytes=100)
+    with app_module.app.test_request_context():
+        small = compressor.apply(app_module.jsonify(ok=True), "gzip")
+        assert "Content-Encoding" not in small.headers
+
+        body = {"history": ["Le parking est gratuit"] * 20}
+        response = app_module.jsonify(body)
+        response.set_etag("page-1")
+        response = compressor.apply(response, "gzip")
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert json.loads(gzip.decompress(response.get_data())) == body
+        assert response.get_etag() == ("page-1", True)
+
+        identity = compressor.apply(app_module.jsonify(body), "identity")
+        assert "Content-Encoding" not in identity.headers
+        assert "Accept-Encoding" in identity.headers["Vary"]
+    stats = compressor.snapshot()
+    assert stats["compressed"] == 1 and stats["skipped_small"] == 1 and stats["ratio"] > 1
@@ -0,0 +1,109 @@
+import os
+import sys
+import json
+import sqlite3
+import http.client
+import pytest
+import openai
+from conftest import ROOT
+
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+import bench_replay  # noqa: E402
+from stub_openai import StubOpenAI, ANSWER  # noqa: E402
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    path = str(tmp_path / "conversations.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE conversations (id INTEGER PRIMARY KEY, user_id TEXT, role TEXT, message TEXT, "
+                 "timestamp TEXT, feedback INT)")
+    conn.executemany(
+        "INSERT INTO conversations (user_id, role, message, timestamp, feedback) VALUES (?, ?, ?, ?, ?)",
+        [
+            ("a", "user", "Bonjour", "2024-01-01T10:00:00", None),
+            ("a", "assistant", "Bonjour !", "2024-01-01T10:00:02", 1),
+            ("a", "user", "Le parking ?", "2024-01-01T10:00:32", None),
+            ("a", "assistant", "Gratuit.", "2024-01-01T10:00:34", 0),
+            # An hour later: a new session of the same user
+            ("a", "user", "Les horaires ?", "2024-01-01T11:30:00", None),
+            ("a", "assistant", "10h-20h.", "2024-01-01T11:30:02", -1),
+            ("b", "assistant", "Bienvenue", "2024-01-01T09:00:00", 0),
+        ]
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_sessions_are_split_on_silence(recorded):
+    sessions, feedback_rate = bench_replay.load_sessions(recorded)
+    assert sessions == [
+        # Thinking time runs from the answer the user read
+        {"turns": ["Bonjour", "Le parking ?"], "think": [30.0]},
+        {"turns": ["Les horaires ?"], "think": []},
+    ]
+    assert feedback_rate == 0.5
+
+
+def test_server_timing_is_parsed():
+    stages = bench_replay.parse_server_timing("db_acquire;dur=1.5;count=3, llm;dur=400, total;dur=420.2")
+    assert stages == {"db_acquire": (0.0015, 3), "llm": (0.4, 1), "total": (pytest.approx(0.4202), 1)}
+    assert bench_replay.parse_server_timing(None) == {}
+
+
+def test_summary_per_endpoint():
+    rows = [{"endpoint": "POST /process-input", "status": 200, "latency": latency, "first_byte": latency,
+             "server": latency - 0.01, "busy": latency - 0.01, "db_checkouts": 2}
+            for latency in (0.1, 0.2, 0.3, 0.4)]
+    rows.append({"endpoint": "GET /", "status": 0, "latency": 1.0, "first_byte": None, "server": None,
+                 "busy": None, "db_checkouts": 0})
+    report = bench_replay.summarize(rows, wall=2.0, workers=2)
+    endpoint = report["endpoints"]["POST /process-input"]
+    assert endpoint["requests"] == 4 and endpoint["rps"] == 2.0
+    assert endpoint["p50_ms"] == pytest.approx(300) and endpoint["p99_ms"] == pytest.approx(400)
+    assert endpoint["db_checkouts_per_request"] == 2
+    assert endpoint["queue_p95_ms"] == pytest.approx(10)
+    assert report["endpoints"]["GET /"]["errors"] == 1
+    assert report["worker_utilization"] == pytest.approx(0.96 / 4)
+
+
+@pytest.fixture
+def stub():
+    stub = StubOpenAI(first_token=0, token_delay=0).start()
+    yield stub
+    stub.stop()
+
+
+def azure_client(stub):
+    return openai.AzureOpenAI(azure_endpoint=stub.url, api_key="stub", api_version="2024-05-01-preview",
+                              max_retries=0)
+
+
+def test_stub_answers_the_sdk(stub):
+    client = azure_client(stub)
+    messages = [{"role": "user", "content": "Quand ouvrez-vous ?"}]
+    response = client.chat.completions.create(model="stub", messages=messages)
+    assert response.choices[0].message.content == ANSWER
+    assert response.usage.prompt_tokens == 3
+
+    chunks = list(client.chat.completions.create(model="stub", messages=messages, stream=True))
+    assert "".join(chunk.choices[0].delta.content or "" for chunk in chunks) == ANSWER
+    assert chunks[-1].usage.total_tokens > 3
+    assert stub.requests == 2
+
+
+def test_stub_throttles_with_retry_after():
+    stub = StubOpenAI(throttle_rate=1.0, retry_after=2).start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", stub.port, timeout=5)
+        conn.request("POST", "/openai/deployments/stub/chat/completions", body=json.dumps({"messages": []}),
+                     headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        assert response.status == 429
+        assert response.getheader("Retry-After") == "2"
+        assert json.loads(response.read())["error"]["code"] == "429"
+        conn.close()
+        assert stub.throttled == 1
+    finally:
+        stub.stop()
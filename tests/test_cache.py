@@ -0,0 +1,63 @@
+import cache
+import embeddings
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_hit_after_put_ignores_case_and_punctuation():
+    responses = cache.ResponseCache()
+    responses.put("a", "Quels sont les horaires ?", "10h-20h")
+    assert responses.get("a", "quels sont les horaires") == "10h-20h"
+    assert responses.get("b", "quels sont les horaires") is None
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    responses = cache.ResponseCache(ttl=60)
+    responses.put("a", "parking", "gratuit")
+    clock.now += 59
+    assert responses.get("a", "parking") == "gratuit"
+    clock.now += 2
+    assert responses.get("a", "parking") is None
+    assert responses.stats["expirations"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    responses = cache.ResponseCache(max_entries=2)
+    responses.put("a", "one", "1")
+    responses.put("a", "two", "2")
+    assert responses.get("a", "one") == "1"  # "two" is now the oldest
+    responses.put("a", "three", "3")
+    assert responses.get("a", "two") is None
+    assert responses.get("a", "one") == "1"
+    assert responses.get("a", "three") == "3"
+    assert responses.stats["evictions"] == 1
+
+
+def test_knowledge_base_update_invalidates_the_center(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    versions = {"a": 1, "b": 1}
+    responses = cache.ResponseCache(version_loader=versions.get, version_check_interval=10)
+    responses.put("a", "parking", "gratuit")
+    responses.put("b", "parking", "payant")
+    versions["a"] = 2
+    assert responses.get("a", "parking") == "gratuit"  # not checked again yet
+    clock.now += 11
+    assert responses.get("a", "parking") is None
+    assert responses.get("b", "parking") == "payant"
+
+
+def test_semantic_tier_matches_a_close_question():
+    responses = cache.ResponseCache(embedder=embeddings.HashingEmbedder(), similarity=0.8)
+    responses.put("a", "quels sont les horaires d'ouverture du centre", "10h-20h")
+    assert responses.get("a", "quels sont les horaires d'ouverture du centre svp") == "10h-20h"
+    assert responses.stats["semantic_hits"] == 1
+    assert responses.get("a", "ou se trouve le parking") is None
@@ -0,0 +1,197 @@
+import os
+import time
+import asyncio
+import threading
+import pytest
+import coalesce
+
+
+def slow_answer(parts, release=None):
+    # produce() for a leader that sends its deltas only once released
+    def produce():
+        def deltas():
+            if release is not None:
+                release.wait(5)
+            yield from parts
+        return deltas()
+    return produce
+
+
+def follow_in_thread(coalescer, question, produce):
+    result = {}
+
+    def run():
+        try:
+            result["text"] = "".join(coalescer.stream("center", question, produce))
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, result
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_identical_question_follows_the_leader():
+    coalescer = coalesce.Coalescer(poll_interval=0.001)
+    release = threading.Event()
+    leader = coalescer.stream("center", "Quand ouvrez-vous ?", slow_answer(["Open ", "daily."], release=release))
+    follower, result = follow_in_thread(coalescer, "quand ouvrez vous", slow_answer(["never called"]))
+    wait_until(lambda: coalescer.snapshot()["local_followers"] == 1)
+    release.set()
+    assert "".join(leader) == "Open daily."
+    follower.join(5)
+    assert result == {"text": "Open daily."}
+    stats = coalescer.snapshot()
+    assert stats["leaders"] == 1 and stats["local_followers"] == 1
+    assert stats["in_flight"] == 0
+    assert stats["coalescing_ratio"] == 0.5
+
+
+def test_other_centers_do_not_share_a_flight():
+    coalescer = coalesce.Coalescer()
+    release = threading.Event()
+    first = coalescer.stream("a", "Quand ouvrez-vous ?", slow_answer(["A"], release=release))
+    second = coalescer.stream("b", "Quand ouvrez-vous ?", slow_answer(["B"]))
+    release.set()
+    assert "".join(first) == "A" and "".join(second) == "B"
+    assert coalescer.snapshot()["leaders"] == 2
+
+
+def test_follower_makes_its_own_call_when_the_leader_stops_before_sending():
+    coalescer = coalesce.Coalescer(poll_interval=0.001)
+    leader = coalescer.stream("center", "parking", slow_answer(["never sent"]))
+    follower, result = follow_in_thread(coalescer, "parking", slow_answer(["Free parking."]))
+    wait_until(lambda: coalescer.snapshot()["local_followers"] == 1)
+    leader.close()  # the leader's client went away
+    follower.join(5)
+    assert result == {"text": "Free parking."}
+    stats = coalescer.snapshot()
+    assert stats["fallbacks"] == 1 and stats["failures"] == 1
+
+
+def test_follower_that_received_text_fails_when_the_leader_stops():
+    coalescer = coalesce.Coalescer(poll_interval=0.001)
+    leader = coalescer.stream("center", "parking", slow_answer(["Free ", "parking."]))
+    assert next(leader) == "Free "
+    follower, result = follow_in_thread(coalescer, "parking", slow_answer(["own call"]))
+    wait_until(lambda: coalescer.snapshot()["local_followers"] == 1)
+    # Give the follower time to read the first delta before the leader leaves
+    follower.join(0.05)
+    leader.close()
+    follower.join(5)
+    assert isinstance(result["error"], coalesce.Abandoned)
+    assert coalescer.snapshot()["fallbacks"] == 0
+
+
+def test_leader_error_reaches_its_followers():
+    coalescer = coalesce.Coalescer(poll_interval=0.001)
+    release = threading.Event()
+
+    def failing():
+        def deltas():
+            release.wait(5)
+            raise TimeoutError("upstream timed out")
+            yield
+        return deltas()
+
+    leader = coalescer.stream("center", "parking", failing)
+    follower, result = follow_in_thread(coalescer, "parking", slow_answer(["own call"]))
+    wait_until(lambda: coalescer.snapshot()["local_followers"] == 1)
+    release.set()
+    with pytest.raises(TimeoutError):
+        "".join(leader)
+    follower.join(5)
+    assert isinstance(result["error"], TimeoutError)
+    assert coalescer.snapshot()["in_flight"] == 0
+
+
+def test_admission_error_is_raised_before_the_first_delta():
+    coalescer = coalesce.Coalescer()
+
+    def shed():
+        raise TimeoutError("no slot")
+
+    with pytest.raises(TimeoutError):
+        coalescer.stream("center", "parking", shed)
+    assert coalescer.snapshot()["in_flight"] == 0
+
+
+def test_async_follower_shares_the_answer():
+    coalescer = coalesce.Coalescer(poll_interval=0.001)
+
+    async def answer():
+        await asyncio.sleep(0.02)
+        yield "Open "
+        yield "daily."
+
+    async def main():
+        leader = await coalescer.astream("center", "Quand ouvrez-vous ?", answer)
+        follower = await coalescer.astream("center", "Quand ouvrez-vous ?", answer)
+
+        async def read(texts):
+            return "".join([text async for text in texts])
+
+        return await asyncio.gather(read(leader), read(follower))
+
+    assert asyncio.run(main()) == ["Open daily.", "Open daily."]
+    assert coalescer.snapshot()["local_followers"] == 1
+
+
+def test_shared_flight_is_read_by_another_worker(tmp_path):
+    leader = coalesce.SharedFlight.join(str(tmp_path), "key")
+    follower = coalesce.SharedFlight.join(str(tmp_path), "key")
+    assert leader.leader and not follower.leader
+
+    leader.publish("Open ")
+    assert follower.read(0) == (["Open "], None, None)
+    leader.publish("daily.")
+    leader.finish()  # unlinks the file; the open reader still reaches the end
+    assert not os.path.exists(tmp_path / "key.flight")
+    assert follower.read(0) == (["daily."], "done", None)
+    follower.close()
+
+
+def test_shared_reader_sees_a_restarted_flight_as_abandoned(tmp_path):
+    leader = coalesce.SharedFlight.join(str(tmp_path), "key")
+    follower = coalesce.SharedFlight.join(str(tmp_path), "key")
+    leader.publish("Open ")
+    assert follower.read(0)[0] == ["Open "]
+    leader.close()  # died without finishing: the lock is released, the file stays
+
+    restarted = coalesce.SharedFlight.join(str(tmp_path), "key")
+    assert restarted.leader  # and truncated the file
+    assert follower.read(0) == ([], "abandoned", "flight restarted")
+    restarted.finish()
+    follower.close()
+
+
+def test_shared_reader_notices_a_leader_that_exited(tmp_path):
+    leader = coalesce.SharedFlight.join(str(tmp_path), "key")
+    follower = coalesce.SharedFlight.join(str(tmp_path), "key")
+    assert follower.read(0) == ([], None, None)
+    leader.close()
+    assert follower.read(0) == ([], "abandoned", "leader exited")
+    follower.close()
+
+
+def test_workers_coalesce_through_the_shared_directory(tmp_path):
+    # Two coalescers stand in for two workers of the host
+    first = coalesce.Coalescer(shared_dir=str(tmp_path), poll_interval=0.001)
+    second = coalesce.Coalescer(shared_dir=str(tmp_path), poll_interval=0.001)
+    release = threading.Event()
+    leader = first.stream("center", "parking", slow_answer(["Free ", "parking."], release=release))
+    follower, result = follow_in_thread(second, "parking", slow_answer(["own call"]))
+    wait_until(lambda: second.snapshot()["shared_followers"] == 1)
+    release.set()
+    assert "".join(leader) == "Free parking."
+    follower.join(5)
+    assert result == {"text": "Free parking."}
+    assert second.snapshot()["shared_followers"] == 1
+    assert os.listdir(tmp_path) == []
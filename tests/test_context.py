@@ -0,0 +1,52 @@
+import context
+
+
+def turns(count, words=20):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} " + "mot " * words,
+         "message_id": str(i)}
+        for i in range(count)
+    ]
+
+
+def prompt_cost(messages):
+    return sum(context.count_tokens(m["content"]) + context.MESSAGE_OVERHEAD for m in messages)
+
+
+def test_most_recent_turns_that_fit_are_kept():
+    history = turns(30)
+    messages = context.ContextBuilder(budget=300).build("system", history, "question")
+    assert messages[0] == {"role": "system", "content": "system"}
+    assert messages[-1] == {"role": "user", "content": "question"}
+    kept = messages[1:-1]
+    assert 0 < len(kept) < len(history)
+    assert [m["content"] for m in kept] == [t["content"] for t in history[-len(kept):]]
+    assert prompt_cost(messages) <= 300
+
+
+def test_short_history_is_kept_whole():
+    history = turns(4, words=2)
+    messages = context.ContextBuilder(budget=3000).build("system", history, "question")
+    assert len(messages) == len(history) + 2
+
+
+def test_dropped_turns_are_summarized_once_enough_fall_out():
+    calls = []
+
+    def summarizer(previous, pending, user_id):
+        calls.append([t["message_id"] for t in pending])
+        return f"{previous or ''}+{len(pending)}"
+
+    builder = context.ContextBuilder(budget=200, summarizer=summarizer, summary_min_messages=4)
+    history = turns(12)
+    messages = builder.build("system", history, "question", user_id="u")
+    assert messages[1]["role"] == "system" and messages[1]["content"].startswith("Summary of the earlier")
+    assert len(calls) == 1
+
+    # One more turn dropping out is below summary_min_messages: the cached summary is reused
+    builder.build("system", turns(13), "question", user_id="u")
+    assert len(calls) == 1
+
+    builder.forget("u")
+    builder.build("system", history, "question", user_id="u")
+    assert len(calls) == 2
@@ -0,0 +1,141 @@
+import os
+import time
+import sqlite3
+import threading
+import pytest
+import db
+
+
+class FakeConnection:
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.closed = False
+
+    def cursor(self):
+        if not self.alive:
+            raise sqlite3.OperationalError("connection lost")
+        return self
+
+    def execute(self, sql):
+        pass
+
+    def fetchall(self):
+        return [(1,)]
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        if not self.alive:
+            raise sqlite3.OperationalError("connection lost")
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def opened():
+    return []
+
+
+@pytest.fixture
+def pool(opened):
+    def connect():
+        conn = FakeConnection()
+        opened.append(conn)
+        return conn
+
+    return db.ConnectionPool(connect, max_size=2, timeout=0.05, recycle=3600, ping_after=3600)
+
+
+def test_released_connections_are_reused(pool, opened):
+    conn, created_at = pool.acquire()
+    pool.release(conn, created_at)
+    again, _ = pool.acquire()
+    assert again is conn and len(opened) == 1
+    stats = pool.snapshot()
+    assert (stats["checkouts"], stats["reuses"], stats["connects"]) == (2, 1, 1)
+    assert (stats["open"], stats["idle"], stats["in_use"]) == (1, 0, 1)
+
+
+def test_checkout_waits_then_times_out(pool):
+    held = [pool.acquire() for _ in range(2)]
+    with pytest.raises(db.PoolTimeout):
+        pool.acquire()
+    assert pool.snapshot()["timeouts"] == 1
+
+    # A release wakes the waiting checkout
+    pool.timeout = 5
+    threading.Timer(0.05, pool.release, held[0]).start()
+    assert pool.acquire()[0] is held[0][0]
+    assert pool.snapshot()["waits"] == 2
+
+
+def test_old_and_dead_connections_are_replaced(pool, opened):
+    conn, created_at = pool.acquire()
+    pool.release(conn, created_at - 7200)
+    fresh, _ = pool.acquire()
+    assert fresh is not conn and conn.closed
+    assert pool.snapshot()["recycled"] == 1
+
+    fresh.alive = False
+    pool.ping_after = 0
+    pool.release(fresh, time.monotonic())
+    replaced, _ = pool.acquire()
+    assert replaced is opened[-1] and fresh.closed
+    stats = pool.snapshot()
+    assert stats["ping_failures"] == 1 and stats["open"] == 1
+
+
+def test_broken_connections_give_back_their_slot(pool):
+    conn, created_at = pool.acquire()
+    pool.release(conn, created_at, broken=True)
+    assert conn.closed
+    stats = pool.snapshot()
+    assert stats["discarded"] == 1 and stats["open"] == 0
+
+
+def test_failed_connect_gives_back_its_slot():
+    def refuse():
+        raise sqlite3.OperationalError("unreachable")
+
+    pool = db.ConnectionPool(refuse, max_size=1, timeout=0)
+    for _ in range(2):
+        with pytest.raises(sqlite3.OperationalError):
+            pool.acquire()
+    assert pool.snapshot()["open"] == 0
+
+
+def test_resize_applies_to_the_next_checkouts(pool):
+    held = [pool.acquire() for _ in range(2)]
+    pool.resize(3)
+    held.append(pool.acquire())
+    pool.resize(1)
+    for conn, created_at in held:
+        pool.release(conn, created_at)
+    pool.close()
+    assert pool.snapshot()["open"] == 0
+    assert all(conn.closed for conn, _ in held)
+
+
+def test_connection_commits_or_rolls_back(monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "SQLITE_PATH", str(tmp_path / "pool.db"))
+    monkeypatch.setattr(db, "_pools", {})
+    with db.connection() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.execute("INSERT INTO t VALUES (1)")
+    with pytest.raises(RuntimeError):
+        with db.connection() as conn:
+            conn.execute("INSERT INTO t VALUES (2)")
+            raise RuntimeError("fail after the insert")
+    with db.connection() as conn:
+        assert conn.execute("SELECT x FROM t").fetchall() == [(1,)]
+
+    pool = db.get_pool()
+    assert pool.snapshot()["connects"] == 1 and pool.snapshot()["idle"] == 1
+    # Named pools are separate and follow their configured size
+    assert db.get_pool("center-a", 3).max_size == 3
+    assert db.get_pool("center-a", 5).max_size == 5
+    assert set(db.all_pool_stats()) == {"default", "center-a"}
+    assert db.pool_stats()["pid"] == os.getpid()
+    db.close_pools()
@@ -0,0 +1,216 @@
+import time
+import asyncio
+from types import SimpleNamespace
+import pytest
+import dispatch
+
+MESSAGES = [{"role": "user", "content": "Quand ouvrez-vous ?"}]
+
+
+class Unavailable(Exception):
+    status_code = 503
+
+
+class BadRequest(Exception):
+    status_code = 400
+
+
+class Throttled(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__("rate limited")
+        self.response = SimpleNamespace(headers={"retry-after": str(retry_after)})
+
+
+def stub_client(calls, name, error=None):
+    def create(**params):
+        calls.append(name)
+        if error is not None:
+            raise error
+        return SimpleNamespace(deployment=name, usage=SimpleNamespace(total_tokens=10))
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+@pytest.fixture
+def first_ready(monkeypatch):
+    # Placement picks the first eligible deployment instead of a weighted random one
+    monkeypatch.setattr(dispatch.random, "choices", lambda population, weights: [population[0]])
+    monkeypatch.setattr(dispatch.random, "uniform", lambda a, b: 0.0)
+
+
+def test_circuit_opens_probes_and_closes(monkeypatch):
+    monkeypatch.setattr(dispatch, "LLM_CIRCUIT_FAILURES", 2)
+    monkeypatch.setattr(dispatch, "LLM_CIRCUIT_COOLDOWN", 30)
+    deployment = dispatch.Deployment({"name": "a"})
+
+    for now in (0, 1):
+        deployment.reserve(100, now)
+        deployment.failed(100, now=now)
+    assert deployment.state == "open"
+    assert deployment.stats["circuit_opens"] == 1
+    assert deployment.wait_time(100, 10) == 21
+
+    # After the cooldown a single probe goes through; its failure reopens the circuit
+    assert deployment.wait_time(100, 31) == 0
+    deployment.reserve(100, 31)
+    assert deployment.state == "half_open"
+    assert deployment.wait_time(100, 31) > 0
+    deployment.failed(100, now=31)
+    assert deployment.state == "open"
+    assert deployment.stats["circuit_opens"] == 2
+
+    # A successful probe closes it
+    deployment.reserve(100, 62)
+    deployment.succeeded(0.2)
+    assert deployment.state == "closed"
+    assert deployment.failures == 0
+    assert deployment.in_flight == 0
+
+
+def test_probe_rejected_as_a_bad_request_closes_the_circuit(monkeypatch, first_ready):
+    monkeypatch.setattr(dispatch, "LLM_CIRCUIT_FAILURES", 1)
+    monkeypatch.setattr(dispatch, "LLM_CIRCUIT_COOLDOWN", 0.01)
+    errors = [Unavailable("down"), BadRequest("content filtered")]
+
+    def create(**params):
+        if errors:
+            raise errors.pop(0)
+        return SimpleNamespace(usage=SimpleNamespace(total_tokens=10))
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(dispatch.Deployment, "client", lambda self, kind="sync": client)
+    dispatcher = dispatch.Dispatcher([{"name": "a"}], max_retries=0)
+    with pytest.raises(Unavailable):
+        dispatcher.complete("u", MESSAGES)
+    assert dispatcher.deployments[0].state == "open"
+
+    time.sleep(0.02)
+    with pytest.raises(BadRequest):
+        dispatcher.complete("u", MESSAGES)  # the probe
+    assert dispatcher.deployments[0].state == "closed"
+    assert dispatcher.complete("u", MESSAGES).usage.total_tokens == 10
+    assert dispatcher.snapshot()["in_flight"] == 0
+
+
+def test_throttling_cools_down_without_opening_the_circuit(monkeypatch):
+    monkeypatch.setattr(dispatch, "LLM_CIRCUIT_FAILURES", 1)
+    deployment = dispatch.Deployment({"name": "a", "tpm": 6000})
+    now = deployment.tokens.updated
+    deployment.reserve(1000, now)
+    deployment.failed(1000, retry_after=5, now=now)
+    assert deployment.state == "closed"
+    assert deployment.stats["rate_limited"] == 1
+    assert deployment.tokens.tokens == 6000  # the throttled call is refunded
+    assert deployment.wait_time(1000, now + 2) == pytest.approx(3)
+    assert deployment.wait_time(1000, now + 5) == 0
+
+
+def test_failed_call_fails_over_to_another_deployment(monkeypatch, first_ready):
+    calls = []
+    clients = {"a": stub_client(calls, "a", Unavailable("down")), "b": stub_client(calls, "b")}
+    monkeypatch.setattr(dispatch.Deployment, "client", lambda self, kind="sync": clients[self.name])
+    dispatcher = dispatch.Dispatcher([{"name": "a"}, {"name": "b"}])
+
+    response = dispatcher.complete("u", MESSAGES)
+    assert response.deployment == "b"
+    assert calls == ["a", "b"]
+    snapshot = dispatcher.snapshot()
+    assert snapshot["failovers"] == 1
+    assert snapshot["in_flight"] == 0
+    assert [d["errors"] for d in snapshot["deployments"]] == [1, 0]
+
+
+def test_errors_are_raised_once_retries_run_out(monkeypatch, first_ready):
+    calls = []
+    monkeypatch.setattr(dispatch.Deployment, "client",
+                        lambda self, kind="sync": stub_client(calls, self.name, Unavailable("down")))
+    dispatcher = dispatch.Dispatcher([{"name": "a"}], max_retries=2)
+    with pytest.raises(Unavailable):
+        dispatcher.complete("u", MESSAGES)
+    assert len(calls) == 3
+    assert dispatcher.snapshot()["exhausted"] == 1
+    assert dispatcher.snapshot()["in_flight"] == 0
+
+
+def test_long_retry_after_is_shed_as_overloaded(monkeypatch, first_ready):
+    calls = []
+    monkeypatch.setattr(dispatch.Deployment, "client",
+                        lambda self, kind="sync": stub_client(calls, self.name, Throttled(dispatch.LLM_RETRY_MAX + 1)))
+    dispatcher = dispatch.Dispatcher([{"name": "a"}])
+    with pytest.raises(dispatch.Overloaded) as raised:
+        dispatcher.complete("u", MESSAGES)
+    assert raised.value.retry_after == dispatch.LLM_RETRY_MAX + 1
+    assert dispatcher.deployments[0].state == "closed"
+    assert dispatcher.snapshot()["in_flight"] == 0
+
+
+def test_requests_beyond_the_queue_are_shed():
+    dispatcher = dispatch.Dispatcher([{"name": "a"}], max_concurrency=1, queue_size=0)
+    dispatcher._wait(dispatcher._admit("u1"))
+    with pytest.raises(dispatch.Overloaded):
+        dispatcher.complete("u2", MESSAGES)
+    assert dispatcher.snapshot()["shed"] == 1
+
+    dispatcher._release("u1")
+    assert dispatcher.complete("u2", MESSAGES).choices
+
+
+def test_queued_request_is_shed_after_the_timeout():
+    dispatcher = dispatch.Dispatcher([{"name": "a"}], max_per_user=1, queue_timeout=0.05)
+    dispatcher._wait(dispatcher._admit("u"))
+    with pytest.raises(dispatch.Overloaded):
+        dispatcher.complete("u", MESSAGES)
+    snapshot = dispatcher.snapshot()
+    assert snapshot["queued"] == 1 and snapshot["shed"] == 1
+    assert snapshot["waiting"] == 0
+
+
+def test_stream_gives_its_slot_back_when_read_or_closed():
+    dispatcher = dispatch.Dispatcher([{"name": "a"}])
+    stream = dispatcher.complete("u", MESSAGES, stream=True)
+    assert dispatcher.snapshot()["in_flight"] == 1
+    assert "".join(chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+    assert dispatcher.snapshot()["in_flight"] == 0
+
+    stream = dispatcher.complete("u", MESSAGES, stream=True)
+    next(stream)
+    stream.close()
+    assert dispatcher.snapshot()["in_flight"] == 0
+
+
+def test_async_stream_is_closed_early():
+    dispatcher = dispatch.Dispatcher([{"name": "a"}])
+
+    async def read_one():
+        stream = await dispatcher.acomplete("u", MESSAGES, stream=True)
+        await stream.__anext__()
+        await stream.aclose()
+
+    asyncio.run(read_one())
+    assert dispatcher.snapshot()["in_flight"] == 0
+    assert dispatcher.deployments[0].in_flight == 0
+
+
+def test_summaries_go_through_the_dispatcher(app_module, monkeypatch):
+    calls = []
+
+    def create(**params):
+        calls.append(params)
+        message = SimpleNamespace(content="A visitor asked about opening hours.")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=SimpleNamespace(total_tokens=10))
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(dispatch.Deployment, "client", lambda self, kind="sync": client)
+    dispatcher = dispatch.Dispatcher([{"name": "a"}])
+    monkeypatch.setattr(app_module, "llm_dispatcher", dispatcher)
+
+    turns = [{"role": "user", "content": "Quand ouvrez-vous ?"}]
+    assert app_module.summarize_turns(None, turns, "u") == "A visitor asked about opening hours."
+    assert calls[0]["max_tokens"] == 200 and calls[0]["temperature"] == 0
+    assert "extra_body" not in calls[0]
+    assert dispatcher.snapshot()["admitted"] == 1
+
+    monkeypatch.setattr(app_module, "llm_dispatcher", dispatch.Dispatcher(max_concurrency=0, queue_size=0))
+    with pytest.raises(dispatch.Overloaded):
+        app_module.summarize_turns(None, turns, "u")
@@ -0,0 +1,104 @@
+import csv
+import gzip
+import io
+import json
+import uuid
+from datetime import date
+import pytest
+import db
+import schema
+import export
+import retention
+
+
+@pytest.fixture
+def exported(user_id, center):
+    # A center of its own: three messages over two days, two in a titled conversation
+    center_id = f"export-{uuid.uuid4().hex[:8]}"
+    schema.ensure_center(center_id, "Export center")
+    conversation_id = str(uuid.uuid4())
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO conversation_sessions (id, user_id, center_id, title) VALUES (?, ?, ?, ?)",
+                       (conversation_id, user_id, center_id, "Parking"))
+        for timestamp, text, conversation in (("2024-05-01T09:00:00", "Bonjour, l'été", None),
+                                              ("2024-05-01T10:00:00", "Où se garer ?", conversation_id),
+                                              ("2024-05-02T08:00:00", 'Niveau "-1"', conversation_id)):
+            cursor.execute(
+                "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id, "
+                "conversation_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, center_id, text, "user", timestamp, str(uuid.uuid4()), conversation)
+            )
+    return center_id, conversation_id
+
+
+def messages(batches):
+    return [row["message"] for batch in batches for row in batch]
+
+
+def test_rows_come_in_batches_oldest_first(exported):
+    center_id, conversation_id = exported
+    batches = list(export.rows(center_id, fetch_size=2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    rows = [row for batch in batches for row in batch]
+    assert [row["message"] for row in rows] == ["Bonjour, l'été", "Où se garer ?", 'Niveau "-1"']
+    assert list(rows[0]) == export.COLUMNS
+    assert rows[0]["conversation_title"] is None
+    assert rows[1]["conversation_title"] == "Parking" and rows[1]["conversation_id"] == conversation_id
+
+
+def test_rows_are_filtered_by_day_and_conversation(exported):
+    center_id, conversation_id = exported
+    # The end day is exclusive
+    assert messages(export.rows(center_id, date(2024, 5, 1), date(2024, 5, 2))) == ["Bonjour, l'été", "Où se garer ?"]
+    assert messages(export.rows(center_id, start=date(2024, 5, 2))) == ['Niveau "-1"']
+    assert messages(export.rows(center_id, conversation_id=conversation_id)) == ["Où se garer ?", 'Niveau "-1"']
+
+
+def test_cleared_messages_are_left_out(exported, user_id):
+    center_id, _ = exported
+    with db.connection() as conn:
+        retention.clear_user(conn.cursor(), user_id, "2024-05-01T12:00:00")
+    assert messages(export.rows(center_id)) == ['Niveau "-1"']
+
+
+def test_ndjson_is_gzipped_as_one_stream(exported):
+    center_id, _ = exported
+    exporter = export.Exporter("ndjson", compress=True)
+    data = b"".join(exporter.stream(export.rows(center_id, fetch_size=1)))
+    lines = gzip.decompress(data).decode("utf-8").splitlines()
+    assert [json.loads(line)["message"] for line in lines] == ["Bonjour, l'été", "Où se garer ?", 'Niveau "-1"']
+    assert exporter.rows == 3 and exporter.bytes == len(data)
+    assert exporter.raw_bytes == len(gzip.decompress(data))
+    assert exporter.mimetype == "application/gzip"
+    assert exporter.filename("c") == "conversations-c.ndjson.gz"
+
+
+def test_csv_has_one_header(exported):
+    center_id, _ = exported
+    data = b"".join(export.Exporter("csv").stream(export.rows(center_id, fetch_size=1)))
+    rows = list(csv.reader(io.StringIO(data.decode("utf-8"))))
+    assert rows[0] == export.COLUMNS
+    assert [row[-1] for row in rows[1:]] == ["Bonjour, l'été", "Où se garer ?", 'Niveau "-1"']
+    # Even without rows
+    assert b"".join(export.Exporter("csv").stream([])).decode().strip() == ",".join(export.COLUMNS)
+
+
+def test_endpoint_needs_its_token(monkeypatch, client):
+    monkeypatch.setattr(export, "EXPORT_TOKEN", "")
+    assert client.get("/export").status_code == 404
+
+    monkeypatch.setattr(export, "EXPORT_TOKEN", "export-token")
+    assert client.get("/export").status_code == 401
+    assert client.get("/export", headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+    auth = {"Authorization": "Bearer export-token"}
+    assert client.get("/export?from=yesterday", headers=auth).status_code == 400
+    assert client.get("/export?conversation_id=1", headers=auth).status_code == 400
+    assert client.get("/export?format=xml", headers=auth).status_code == 400
+
+    response = client.get("/export?format=csv&gzip=true", headers=auth)
+    assert response.status_code == 200
+    assert response.headers["Content-Disposition"] == 'attachment; filename="conversations-test-center.csv.gz"'
+    assert response.headers["Cache-Control"] == "no-store"
+    assert gzip.decompress(response.get_data()).decode().startswith(",".join(export.COLUMNS))
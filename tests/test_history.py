@@ -0,0 +1,79 @@
+import pytest
+from conftest import login
+
+
+@pytest.fixture
+def conversation(app_module, user_id):
+    # Seven messages, oldest first
+    return [app_module.save_message(user_id, f"message {i}", "user" if i % 2 == 0 else "assistant")
+            for i in range(7)]
+
+
+def history(client, **params):
+    response = client.get("/get-history", query_string=dict(format="raw", **params))
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def contents(page):
+    return [msg["content"] for msg in page["history"]]
+
+
+def test_pages_walk_back_from_the_newest_message(client, user_id, conversation):
+    login(client, user_id)
+    page = history(client, limit=3)
+    assert contents(page) == ["message 4", "message 5", "message 6"]
+    assert page["has_more"]
+
+    page = history(client, limit=3, before=page["before"])
+    assert contents(page) == ["message 1", "message 2", "message 3"]
+    assert page["has_more"]
+
+    page = history(client, limit=3, before=page["before"])
+    assert contents(page) == ["message 0"]
+    assert not page["has_more"]
+    assert page["before"] is None
+
+
+def test_since_returns_only_what_was_added(app_module, client, user_id, conversation):
+    login(client, user_id)
+    latest = history(client, limit=3)["latest"]
+    page = history(client, since=latest)
+    assert page["history"] == []
+    assert page["latest"] == latest
+
+    app_module.save_message(user_id, "message 7", "user")
+    app_module.save_message(user_id, "message 8", "assistant")
+    page = history(client, since=latest)
+    assert contents(page) == ["message 7", "message 8"]
+    assert page["latest"] == page["history"][-1]["cursor"]
+
+
+def test_unchanged_page_is_revalidated_with_a_304(app_module, client, user_id, conversation):
+    login(client, user_id)
+    response = client.get("/get-history?format=raw")
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "private, no-cache"
+
+    response = client.get("/get-history?format=raw", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.get_data() == b""
+
+    app_module.save_message(user_id, "message 7", "user")
+    response = client.get("/get-history?format=raw", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.get_json()["history"][-1]["content"] == "message 7"
+
+
+@pytest.mark.parametrize("params", [
+    {"before": "not-a-cursor"},
+    {"since": "2024-01-01T00:00:00,abc"},
+    {"before": "2024-01-01T00:00:00,1", "since": "2024-01-01T00:00:00,1"},
+    {"limit": "0"},
+])
+def test_invalid_parameters_are_rejected(client, user_id, params):
+    login(client, user_id)
+    response = client.get("/get-history", query_string=params)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
@@ -0,0 +1,107 @@
+import os
+import json
+import contextvars
+import pytest
+import metrics
+from conftest import login
+
+DEAD_PID = 2 ** 31 - 2
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    # Instruments register themselves; these ones stay out of the app's scrape
+    monkeypatch.setattr(metrics, "_registry", [])
+    monkeypatch.setattr(metrics, "_collectors", [])
+
+
+def test_histogram_renders_cumulative_buckets(registry):
+    histogram = metrics.Histogram("t_seconds", "Test.", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, route='/a"b')
+    assert metrics.render().splitlines() == [
+        "# HELP t_seconds Test.",
+        "# TYPE t_seconds histogram",
+        't_seconds_bucket{route="/a\\"b",le="0.1"} 2',
+        't_seconds_bucket{route="/a\\"b",le="1.0"} 3',
+        't_seconds_bucket{route="/a\\"b",le="+Inf"} 4',
+        't_seconds_sum{route="/a\\"b"} 3.65',
+        't_seconds_count{route="/a\\"b"} 4',
+    ]
+
+
+def test_collectors_are_read_at_scrape_time(registry):
+    counter = metrics.Counter("t_total", "Test.", ("kind",))
+    counter.inc(kind="a")
+    counter.inc(2, kind="a")
+    level = [5]
+    metrics.register_collector(lambda: [("t_level", "gauge", "Level.", {}, level[0])])
+    level[0] = 7
+    lines = metrics.render().splitlines()
+    assert 't_total{kind="a"} 3' in lines
+    assert "t_level 7" in lines
+
+
+def test_repeated_stages_are_summed_and_counted():
+    def request():
+        metrics.begin_request()
+        metrics.record("db_acquire", 0.001)
+        metrics.record("db_acquire", 0.002)
+        with metrics.span("llm"):
+            pass
+        return metrics.server_timing(total=0.5)
+
+    header = contextvars.copy_context().run(request)
+    stages = header.split(", ")
+    assert stages[0] == "db_acquire;dur=3.0;count=2"
+    assert stages[1].startswith("llm;dur=") and ";count" not in stages[1]
+    assert stages[2] == "total;dur=500.0"
+    # Outside a request there are no spans to report
+    assert contextvars.Context().run(metrics.server_timing) == ""
+
+
+def test_scrape_merges_other_workers(registry, monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    metrics.Counter("t_total", "Test.").inc(1)
+    metrics.register_collector(lambda: [("t_level", "gauge", "Level.", {}, 1)])
+
+    worker = {
+        "t_total": {"kind": "counter", "help": "Test.", "labels": [], "series": [[[], 10]]},
+        "t_level": {"kind": "gauge", "help": "Level.", "labels": [], "series": [[[], 4]], "live": True},
+    }
+    for pid in (os.getppid(), DEAD_PID):
+        (tmp_path / f"metrics-{pid}.json").write_text(json.dumps(worker))
+    (tmp_path / "metrics-stale.json").write_text("{}")
+    # This worker's own dump is not counted twice
+    (tmp_path / f"metrics-{os.getpid()}.json").write_text(json.dumps(worker))
+
+    lines = metrics.render().splitlines()
+    assert "t_total 21" in lines
+    # An exited worker's counts still add up; its gauges are dropped
+    assert "t_level 5" in lines
+
+
+def test_usage_counts_billed_or_estimated_tokens(registry, monkeypatch):
+    tokens = metrics.Counter("t_tokens_total", "Test.", ("kind", "source"))
+    monkeypatch.setattr(metrics, "llm_tokens", tokens)
+    usage = type("Usage", (), {"prompt_tokens": 12, "completion_tokens": None})()
+    metrics.record_usage(usage)
+    metrics.record_usage(prompt_estimate=3, completion_estimate=4)
+    assert sorted(tokens.state()) == [[["completion", "estimate"], 4], [["completion", "usage"], 0],
+                                      [["prompt", "estimate"], 3], [["prompt", "usage"], 12]]
+
+
+def test_requests_are_timed_and_scraped(app_module, client, user_id, monkeypatch):
+    monkeypatch.setattr(metrics, "SERVER_TIMING", True)
+    monkeypatch.setattr(app_module, "OPS_TOKEN", "ops-token")
+    login(client, user_id)
+    response = client.get("/get-history")
+    assert response.status_code == 200
+    stages = [stage.split(";")[0] for stage in response.headers["Server-Timing"].split(", ")]
+    assert "db_history_page" in stages and stages[-1] == "total"
+
+    response = client.get("/metrics", headers={"Authorization": "Bearer ops-token"})
+    assert response.mimetype == "text/plain"
+    body = response.get_data(as_text=True)
+    assert 'chatbot_request_seconds_count{endpoint="/get-history",method="GET",status="200"}' in body
+    assert 'chatbot_stage_seconds_bucket{stage="db_history_page",le="+Inf"}' in body
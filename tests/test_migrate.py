@@ -0,0 +1,87 @@
+import uuid
+import sqlite3
+import pytest
+import db
+import migrate
+
+CENTER = "legacy-center"
+
+
+@pytest.fixture
+def archive(tmp_path):
+    # A legacy SQLite archive: users and conversations, no centers
+    path = str(tmp_path / "conversations.db")
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE users (id TEXT PRIMARY KEY, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, message TEXT, role TEXT,
+            timestamp TIMESTAMP, message_id TEXT UNIQUE, feedback INTEGER DEFAULT 0
+        );
+    ''')
+    users = [str(uuid.uuid4()) for _ in range(5)]
+    conn.executemany("INSERT INTO users (id, created_at) VALUES (?, '2024-01-01 00:00:00')",
+                     [(u,) for u in users])
+    conn.executemany(
+        "INSERT INTO conversations (user_id, message, role, timestamp, message_id, feedback) "
+        "VALUES (?, ?, ?, '2024-01-02 00:00:00', ?, 0)",
+        [(users[i % 5], f"message {i}", "user" if i % 2 == 0 else "assistant", str(uuid.uuid4()))
+         for i in range(23)]
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+def copied(archive):
+    src = sqlite3.connect(archive)
+    message_ids = [row[0] for row in src.execute("SELECT message_id FROM conversations")]
+    src.close()
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT COUNT(*), COUNT(DISTINCT message_id) FROM conversations "
+            f"WHERE center_id = ? AND message_id IN ({', '.join('?' * len(message_ids))})",
+            [CENTER] + message_ids
+        )
+        return cursor.fetchone()
+
+
+def test_copies_every_row_once(archive):
+    results = migrate.migrate_data(archive, CENTER, chunk_size=4)
+    assert results["users"]["rows"] == 5
+    assert results["conversations"]["rows"] == 23
+    assert copied(archive) == (23, 23)
+
+
+def test_interrupted_copy_resumes_after_the_last_chunk(archive, monkeypatch):
+    load = migrate.LOADERS["sqlite"]["conversations"]
+    chunks = []
+
+    def failing_load(cursor, rows, center_id):
+        if len(chunks) == 3:
+            raise ConnectionError("connection lost")
+        chunks.append(len(rows))
+        load(cursor, rows, center_id)
+
+    monkeypatch.setitem(migrate.LOADERS["sqlite"], "conversations", failing_load)
+    with pytest.raises(ConnectionError):
+        migrate.migrate_data(archive, CENTER, chunk_size=5)
+    checkpoint = migrate.Checkpoint(f"{archive}.checkpoint.json", archive)
+    assert checkpoint.position("conversations") == (15, 15)
+
+    monkeypatch.setitem(migrate.LOADERS["sqlite"], "conversations", load)
+    results = migrate.migrate_data(archive, CENTER, chunk_size=5)
+    assert results["conversations"]["rows"] == 8  # only what was left
+    assert copied(archive) == (23, 23)
+
+    # Replaying everything is harmless: loads are idempotent
+    results = migrate.migrate_data(archive, CENTER, chunk_size=5, restart=True)
+    assert results["conversations"]["rows"] == 23
+    assert copied(archive) == (23, 23)
+
+
+def test_checkpoint_of_another_archive_is_refused(archive, tmp_path):
+    migrate.Checkpoint(str(tmp_path / "checkpoint.json"), archive).advance("users", 3, 3)
+    with pytest.raises(ValueError):
+        migrate.Checkpoint(str(tmp_path / "checkpoint.json"), str(tmp_path / "other.db"))
@@ -0,0 +1,48 @@
+import pytest
+import export
+
+OPS_ROUTES = ["/metrics", "/stats", "/db-stats", "/llm-stats", "/tenant-stats", "/cache-stats", "/user-cache-stats",
+              "/render-stats", "/compression-stats", "/coalesce-stats", "/retrieval-stats", "/stream-stats",
+              "/speech-stats"]
+
+
+def bearer(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_every_stats_route_is_an_ops_endpoint(app_module):
+    for rule in app_module.app.url_map.iter_rules():
+        if rule.rule.endswith("stats") or rule.rule == "/metrics":
+            assert rule.endpoint in app_module.OPS_ENDPOINTS, rule.rule
+    assert app_module.OPS_ENDPOINTS <= set(app_module.app.view_functions)
+
+
+@pytest.mark.parametrize("path", OPS_ROUTES)
+def test_ops_routes_need_the_token(app_module, client, monkeypatch, path):
+    monkeypatch.setattr(app_module, "OPS_TOKEN", "ops-token")
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers=bearer("wrong")).status_code == 401
+    assert client.get(path, headers=bearer("ops-token")).status_code == 200
+
+
+def test_ops_routes_are_hidden_without_a_token(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "OPS_TOKEN", "")
+    assert client.get("/db-stats").status_code == 404
+    assert client.get("/metrics", headers=bearer("")).status_code == 404
+    # Liveness stays open
+    assert client.get("/healthz").status_code == 200
+
+
+def test_refused_request_loads_no_center(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "OPS_TOKEN", "ops-token")
+    resolved = []
+    monkeypatch.setattr(app_module.centers, "resolve", lambda *args: resolved.append(args))
+    assert client.get("/tenant-stats", base_url="http://unknown.example").status_code == 401
+    assert resolved == []
+
+
+def test_export_token_does_not_depend_on_the_ops_token(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "OPS_TOKEN", "ops-token")
+    monkeypatch.setattr(export, "EXPORT_TOKEN", "export-token")
+    assert client.get("/export", headers=bearer("ops-token")).status_code == 401
+    assert client.get("/llm-stats", headers=bearer("export-token")).status_code == 401
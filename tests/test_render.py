@@ -0,0 +1,65 @@
+import pytest
+import render
+
+
+def test_raw_html_block_is_escaped():
+    html = render.to_html("<script>alert(1)</script>\n\nBonjour")
+    assert "<script" not in html
+    assert "&lt;script&gt;" in html
+    assert "<p>Bonjour</p>" in html
+
+
+def test_inline_html_is_escaped():
+    html = render.to_html('Le <b onclick="steal()">parking</b> est gratuit')
+    assert "<b" not in html
+    assert "&lt;b onclick" in html
+
+
+@pytest.mark.parametrize("text", [
+    "[x](javascript:alert(1))",
+    "[x](JavaScript:alert(1))",
+    "[x](java&#x09;script:alert(1))",
+    "[x](&#106;avascript:alert(1))",
+    "[x](vbscript:msgbox(1))",
+    "[x][ref]\n\n[ref]: javascript:alert(1)",
+    "![x](data:image/svg+xml;base64,PHN2Zz4=)",
+    "![x](javascript:alert(1))",
+])
+def test_unsafe_urls_are_removed(text):
+    html = render.to_html(text)
+    assert "href" not in html and "src" not in html
+    assert "script:" not in html.lower() and "data:" not in html
+
+
+def test_safe_urls_are_kept():
+    html = render.to_html("[site](https://example.org) [mail](mailto:a@example.org) "
+                          "[tel](tel:+33100000000) ![plan](/static/plan.png)")
+    assert 'href="https://example.org"' in html
+    assert 'href="mailto:a@example.org"' in html
+    assert 'href="tel:+33100000000"' in html
+    assert 'src="/static/plan.png"' in html
+
+
+def test_pipeline_is_reset_between_documents():
+    render.to_html("[y][ref]\n\n[ref]: https://example.org")
+    assert "example.org" not in render.to_html("[y][ref]")
+
+
+def test_cache_renders_each_text_once():
+    cache = render.RenderCache(max_entries=1)
+    assert cache.render("**a**") == cache.render("**a**") == "<p><strong>a</strong></p>"
+    cache.render("b")
+    stats = cache.snapshot()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["entries"]) == (1, 2, 1, 1)
+
+
+def test_user_messages_are_escaped_not_rendered():
+    cache = render.RenderCache()
+    assert cache.message("user", "<i>**hi**</i>") == "&lt;i&gt;**hi**&lt;/i&gt;"
+    assert cache.message("assistant", "**hi**") == "<p><strong>hi</strong></p>"
+    assert cache.message("assistant", "**hi**", rendered="<p>stored</p>") == "<p>stored</p>"
+
+
+def test_legacy_html_is_converted_to_text():
+    assert render.html_to_text("<p>Horaires</p><ul><li>lundi</li><li>mardi</li></ul>") == "Horaires\n\n- lundi\n- mardi"
+    assert render.html_to_text("plain **markdown**") == "plain **markdown**"
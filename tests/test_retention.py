@@ -0,0 +1,129 @@
+import gzip
+import json
+import uuid
+from datetime import datetime, timedelta
+import pytest
+import db
+import schema
+import retention
+import sharedcache
+from conftest import login
+
+NOW = datetime(2024, 6, 15, 12, 0)
+
+
+class RecordingCache:
+    def __init__(self):
+        self.invalidated = []
+
+    def invalidate(self, user_id):
+        self.invalidated.append(user_id)
+
+
+def insert(user_id, center_id, timestamp, text):
+    with db.connection() as conn:
+        conn.cursor().execute(
+            "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, center_id, text, "user", timestamp.isoformat(), str(uuid.uuid4()))
+        )
+
+
+def messages(user_id):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT message FROM conversations WHERE user_id = ? ORDER BY timestamp", (user_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+
+@pytest.fixture
+def expiring_center():
+    center_id = f"retention-{uuid.uuid4().hex[:8]}"
+    schema.ensure_center(center_id, "Retention center")
+    with db.connection() as conn:
+        conn.cursor().execute("UPDATE commercial_centers SET retention_days = 3 WHERE id = ?", (center_id,))
+    return center_id
+
+
+def test_tombstone_hides_earlier_messages(app_module, client, user_id, center):
+    for hours, text in ((3, "before 1"), (2, "before 2"), (0, "after")):
+        insert(user_id, center.id, datetime.now() - timedelta(hours=hours), text)
+    with db.connection() as conn:
+        retention.clear_user(conn.cursor(), user_id, (datetime.now() - timedelta(hours=1)).isoformat())
+
+    login(client, user_id)
+    page = client.get("/get-history?format=raw").get_json()
+    assert [msg["content"] for msg in page["history"]] == ["after"]
+    assert len(messages(user_id)) == 3  # still stored until the job runs
+
+
+def test_tombstoned_messages_are_deleted_in_batches(user_id, center):
+    for i in range(5):
+        insert(user_id, center.id, NOW + timedelta(minutes=i), f"cleared {i}")
+    insert(user_id, center.id, NOW + timedelta(hours=1), "kept")
+    with db.connection() as conn:
+        retention.clear_user(conn.cursor(), user_id, (NOW + timedelta(minutes=30)).isoformat())
+
+    cache = RecordingCache()
+    job = retention.RetentionJob(batch_size=2, pause=0, cache=cache)
+    job.reap_tombstones()
+    assert messages(user_id) == ["kept"]
+    assert job.stats["reaped"] >= 5 and job.stats["batches"] >= 3
+    assert user_id in cache.invalidated
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM session_tombstones WHERE user_id = ?", (user_id,))
+        assert cursor.fetchone()[0] == 0
+
+
+def test_expired_messages_are_archived_then_deleted(tmp_path, app_module, center, expiring_center):
+    users = [str(uuid.uuid4()) for _ in range(2)]
+    for user in users:
+        app_module.get_or_create_user(user)
+    insert(users[0], expiring_center, NOW - timedelta(days=5), "old a")
+    insert(users[1], expiring_center, NOW - timedelta(days=5, hours=-1), "old b")
+    insert(users[0], expiring_center, NOW - timedelta(days=4), "old c")
+    insert(users[0], expiring_center, NOW - timedelta(days=1), "recent")
+
+    archive = retention.Archive(str(tmp_path), "ndjson")
+    cache = RecordingCache()
+    job = retention.RetentionJob(archive, batch_size=2, pause=0, cache=cache)
+    job.expire_center(expiring_center, 3, now=NOW)
+
+    assert messages(users[0]) == ["recent"] and messages(users[1]) == []
+    assert job.stats["expired"] == 3 and job.stats["batches"] == 2
+    assert sorted(set(cache.invalidated)) == sorted(users)
+
+    partition = tmp_path / f"center={expiring_center}"
+    days = sorted(p.name for p in partition.iterdir())
+    assert days == ["date=2024-06-10", "date=2024-06-11"]
+    with gzip.open(partition / "date=2024-06-10" / "messages.ndjson.gz", "rt") as f:
+        records = [json.loads(line) for line in f]
+    assert [r["message"] for r in records] == ["old a", "old b"]
+    assert records[0]["user_id"] == users[0] and records[0]["center_id"] == expiring_center
+    assert set(records[0]) == set(retention.ARCHIVE_COLUMNS)
+    assert archive.bytes_in > 0 and len(archive.files) == 2
+
+
+def test_centers_without_a_policy_use_the_default(expiring_center):
+    policies = retention.RetentionJob(default_days=30).policies()
+    assert policies[expiring_center] == 3
+    assert policies["test-center"] == 30
+
+
+def test_reaping_retires_shared_cache_pages(tmp_path, user_id, center):
+    cache = sharedcache.SharedCache(path=str(tmp_path / "cache"))
+    insert(user_id, center.id, NOW, "cleared")
+    loads = []
+
+    def page():
+        loads.append(1)
+        return messages(user_id)
+
+    assert cache.cached("history", user_id, (), page) == ["cleared"]
+    assert cache.cached("history", user_id, (), page) == ["cleared"]
+    with db.connection() as conn:
+        retention.clear_user(conn.cursor(), user_id, (NOW + timedelta(minutes=1)).isoformat())
+    retention.RetentionJob(pause=0, cache=cache).reap_tombstones()
+    assert cache.cached("history", user_id, (), page) == []
+    assert len(loads) == 2
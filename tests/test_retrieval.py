@@ -0,0 +1,120 @@
+import os
+import uuid
+import threading
+import pytest
+import db
+import schema
+import embeddings
+import retrieval
+
+DOCUMENTS = [
+    ("Parking", "parking",
+     "Le parking souterrain compte 2000 places.\nIl est gratuit les trois premières heures."),
+    ("Horaires", "hours", "Le centre est ouvert du lundi au samedi de 10h à 20h.\nLe dimanche de 11h à 19h."),
+    ("Restaurants", "shops", "Une vingtaine de restaurants au niveau 2, dont une pizzeria et un sushi bar."),
+]
+
+
+class CountingEmbedder(embeddings.HashingEmbedder):
+    def __init__(self, dim=64):
+        super().__init__(dim)
+        self.texts = []
+
+    def embed(self, texts):
+        self.texts += texts
+        return super().embed(texts)
+
+
+@pytest.fixture
+def kb_center():
+    center_id = f"kb-{uuid.uuid4().hex[:8]}"
+    schema.ensure_center(center_id, "Knowledge base center")
+    ids = [add_document(center_id, *document) for document in DOCUMENTS]
+    return center_id, ids
+
+
+def add_document(center_id, title, content_type, content):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO knowledge_base (center_id, title, content_type, content, last_updated) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (center_id, title, content_type, content, "2024-01-01 00:00:00")
+        )
+        return cursor.lastrowid
+
+
+@pytest.fixture
+def retriever(tmp_path):
+    return retrieval.Retriever(CountingEmbedder(), index_dir=str(tmp_path), top_k=2, refresh_interval=3600)
+
+
+def titles(results):
+    return [result["title"] for result in results]
+
+
+def test_passages_are_packed_and_titled():
+    assert retrieval.split_passages("T", "a b c\nd e\nf", max_words=3) == ["T\na b c", "T\nd e f"]
+    assert retrieval.split_passages(None, "") == [""]
+
+
+def test_rank_fusion_rewards_agreement():
+    assert retrieval.rrf([[1, 2, 3], [3, 1, 4]], 3) == [1, 3, 2]
+
+
+def test_hybrid_search_finds_the_passage(retriever, kb_center):
+    center_id, _ = kb_center
+    assert retriever.build(center_id) == 1
+    assert titles(retriever.search(center_id, "Où se garer ? Le PARKING est-il gratuit ?"))[0] == "Parking"
+    # Accents and case do not matter to the keyword ranking
+    assert titles(retriever.search(center_id, "premieres heures", mode="bm25")) == ["Parking"]
+    assert titles(retriever.search(center_id, "Dimanche", mode="bm25")) == ["Horaires"]
+    assert retriever.search(center_id, "inconnu", mode="bm25") == []
+    result = retriever.search(center_id, "pizzeria", top_k=1)
+    assert result == [{"kb_id": result[0]["kb_id"], "title": "Restaurants", "content_type": "shops",
+                       "text": "Restaurants\n" + DOCUMENTS[2][2]}]
+    assert retriever.snapshot()["centers"][center_id] == {"version": 1, "passages": 3}
+
+
+def test_rebuild_embeds_only_changed_rows(retriever, kb_center):
+    center_id, ids = kb_center
+    retriever.build(center_id)
+    assert len(retriever.embedder.texts) == 3
+    assert retriever.build(center_id) == 1  # nothing changed: same version, nothing embedded
+
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE knowledge_base SET content = ?, last_updated = ? WHERE id = ?",
+                       ("Le centre ferme à 21h le vendredi.", "2024-02-01 00:00:00", ids[1]))
+        cursor.execute("DELETE FROM knowledge_base WHERE id = ?", (ids[2],))
+    retriever.embedder.texts.clear()
+    assert retriever.build(center_id) == 2
+    assert retriever.embedder.texts == ["Horaires\nLe centre ferme à 21h le vendredi."]
+
+    index = retrieval.CenterIndex(os.path.join(retriever.index_dir, center_id), 2)
+    assert index.count == 2
+    assert titles(retriever.search(center_id, "vendredi", mode="bm25")) == ["Horaires"]
+    assert retriever.search(center_id, "pizzeria", mode="bm25") == []
+
+
+def test_another_embedder_rebuilds_everything(retriever, kb_center, tmp_path):
+    center_id, _ = kb_center
+    retriever.build(center_id)
+    other = retrieval.Retriever(CountingEmbedder(dim=32), index_dir=str(tmp_path))
+    assert other.build(center_id) == 2
+    assert len(other.embedder.texts) == 3
+
+
+def test_unindexed_center_is_built_in_the_background(retriever, kb_center):
+    center_id, _ = kb_center
+    assert retriever.search(center_id, "parking") == []
+    assert retriever.stats["unindexed_searches"] == 1
+    for thread in [t for t in threading.enumerate() if t.name == f"retrieval-{center_id}"]:
+        thread.join(10)
+    assert titles(retriever.search(center_id, "parking"))[0] == "Parking"
+    assert retriever.stats["builds"] == 1
+
+
+def test_documents_are_numbered_like_citations():
+    documents = [{"title": "Parking", "text": "Gratuit."}, {"title": None, "text": "Ouvert."}]
+    assert retrieval.format_documents(documents) == "[doc1] Parking\nGratuit.\n\n[doc2] \nOuvert."
@@ -0,0 +1,91 @@
+import sqlite3
+import pytest
+import db
+import schema
+
+LATEST = schema.MIGRATIONS[-1][0]
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    # A database of its own; the session one is already at the latest version
+    path = str(tmp_path / "fresh.db")
+    monkeypatch.setattr(db, "SQLITE_PATH", path)
+    monkeypatch.setattr(db, "_pools", {})
+    yield path
+    db.close_pools()
+
+
+def columns(path, table):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    finally:
+        conn.close()
+
+
+def test_every_migration_runs_once(fresh_db):
+    assert schema.migrate() == [version for version, _, _ in schema.MIGRATIONS]
+    assert schema.migrate() == []
+    assert schema.applied_versions() == {version for version, _, _ in schema.MIGRATIONS}
+    assert all(done for _, _, done in schema.status())
+
+
+def test_migrations_stop_at_the_target(fresh_db):
+    assert schema.migrate(target=3) == [1, 2, 3]
+    assert [done for _, _, done in schema.status()] == [v <= 3 for v, _, _ in schema.MIGRATIONS]
+    assert "message_html" not in columns(fresh_db, "conversations")
+    assert schema.migrate()[0] == 4
+
+
+def test_database_from_init_db_is_adopted(fresh_db):
+    # Tables the old init_db created, with rows and no schema_version
+    conn = sqlite3.connect(fresh_db)
+    conn.executescript('''
+        CREATE TABLE commercial_centers (id TEXT PRIMARY KEY, name TEXT NOT NULL, location TEXT,
+                                         website_url TEXT, created_at TIMESTAMP);
+        CREATE TABLE users (id TEXT PRIMARY KEY, center_id TEXT, created_at TIMESTAMP);
+        CREATE TABLE conversations (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, center_id TEXT,
+                                    message TEXT, role TEXT, timestamp TIMESTAMP, message_id TEXT UNIQUE,
+                                    feedback INTEGER DEFAULT 0);
+        INSERT INTO commercial_centers (id, name) VALUES ('old', 'Old center');
+        INSERT INTO users (id, center_id) VALUES ('u1', 'old');
+        INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id, feedback)
+        VALUES ('u1', 'old', 'Bonjour', 'user', '2024-01-01 10:00:00', 'm1', 0),
+               ('u1', 'old', '<p>Le parking est <strong>gratuit</strong>.</p>', 'assistant',
+                '2024-01-01 10:00:02', 'm2', 1);
+    ''')
+    conn.close()
+
+    assert len(schema.migrate()) == LATEST
+    assert {"conversation_id", "message_html"} <= set(columns(fresh_db, "conversations"))
+    conn = sqlite3.connect(fresh_db)
+    try:
+        rows = conn.execute("SELECT message, message_html FROM conversations ORDER BY id").fetchall()
+        stats = conn.execute("SELECT role, messages, likes FROM message_stats ORDER BY role").fetchall()
+    finally:
+        conn.close()
+    # Rendered answers move to message_html; message keeps their text
+    assert rows == [("Bonjour", None),
+                    ("Le parking est gratuit.", "<p>Le parking est <strong>gratuit</strong>.</p>")]
+    assert stats == [("assistant", 1, 1), ("user", 1, 0)]
+
+
+@pytest.mark.parametrize("query, index", [
+    ("SELECT role, message FROM conversations WHERE user_id = ? AND center_id = ? ORDER BY timestamp DESC",
+     "IX_conversations_user_center_time"),
+    ("DELETE FROM conversations WHERE user_id = ?", "IX_conversations_user_center_time"),
+    ("SELECT id FROM conversations WHERE conversation_id = ? AND timestamp > ? ORDER BY timestamp",
+     "IX_conversations_conversation_time"),
+    ("SELECT id, title FROM conversation_sessions WHERE user_id = ? ORDER BY last_updated DESC",
+     "IX_conversation_sessions_user_updated"),
+    ("SELECT id FROM conversations WHERE center_id = ? AND timestamp < ?", "IX_conversations_center_time"),
+])
+def test_queries_use_their_index(fresh_db, query, index):
+    schema.migrate()
+    conn = sqlite3.connect(fresh_db)
+    try:
+        plan = " ".join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", (1,) * query.count("?")))
+    finally:
+        conn.close()
+    assert index in plan
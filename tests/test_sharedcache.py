@@ -0,0 +1,97 @@
+import sharedcache
+
+
+class Loader:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return {"page": self.calls}
+
+
+def small_store(**kwargs):
+    kwargs = dict(dict(ring_bytes=4096, entries=4, ways=4, version_slots=16), **kwargs)
+    return lambda path: sharedcache.SharedStore(path, **kwargs)
+
+
+def key(bucket):
+    return bytes(8) + bucket.to_bytes(8, "little")
+
+
+def new_cache(tmp_path, **kwargs):
+    return sharedcache.SharedCache(path=str(tmp_path / "cache"), store_factory=small_store(**kwargs))
+
+
+def test_second_read_is_served_from_the_cache(tmp_path):
+    cache, load = new_cache(tmp_path), Loader()
+    assert cache.cached("history", "U1", (1,), load) == {"page": 1}
+    assert cache.cached("history", "u1", (1,), load) == {"page": 1}
+    assert load.calls == 1
+    assert cache.cached("history", "u1", (2,), load) == {"page": 2}
+    assert cache.snapshot()["hits"] == 1
+
+
+def test_invalidation_retires_only_that_user(tmp_path):
+    cache, load = new_cache(tmp_path), Loader()
+    cache.cached("history", "u1", (), load)
+    cache.cached("history", "u2", (), load)
+    cache.invalidate("u1")
+    assert cache.cached("history", "u1", (), load) == {"page": 3}
+    assert cache.cached("history", "u2", (), load) == {"page": 2}
+
+
+def test_entries_expire(tmp_path, monkeypatch):
+    now = {"value": 1000.0}
+    monkeypatch.setattr(sharedcache.time, "time", lambda: now["value"])
+    cache, load = sharedcache.SharedCache(path=str(tmp_path / "cache"), ttl=60, store_factory=small_store()), Loader()
+    cache.cached("history", "u1", (), load)
+    now["value"] += 61
+    assert cache.cached("history", "u1", (), load) == {"page": 2}
+    assert cache.snapshot()["expired"] == 1
+
+
+def test_full_set_drops_its_least_recently_used_entry(tmp_path, monkeypatch):
+    now = {"value": 1000.0}
+    monkeypatch.setattr(sharedcache.time, "time", lambda: now["value"])
+    cache, load = new_cache(tmp_path), Loader()
+    for i in range(4):
+        cache.cached("history", "u1", (i,), load)
+        now["value"] += 1
+    cache.cached("history", "u1", (0,), load)  # (1,) is now the least recently used
+    now["value"] += 1
+    cache.cached("history", "u1", (4,), load)
+    assert cache.snapshot()["evictions"] == 1
+    assert load.calls == 5
+    cache.cached("history", "u1", (0,), load)
+    assert load.calls == 5
+    cache.cached("history", "u1", (1,), load)
+    assert load.calls == 6
+
+
+def test_overwritten_value_is_a_miss(tmp_path):
+    store = small_store(ring_bytes=256, entries=16, ways=4)(str(tmp_path / "cache"))
+    store.put(key(0), b"a" * 100, 2000, 1000)
+    assert store.get(key(0), 1000) == (b"a" * 100, store.pid)
+    for bucket in (1, 2, 3):
+        store.put(key(bucket), b"b" * 100, 2000, 1000)  # in other sets, wrapping the ring
+    assert store.get(key(0), 1000) == (None, "overwritten")
+    assert store.get(key(3), 1000) == (b"b" * 100, store.pid)
+    store.close()
+
+
+def test_workers_share_one_file(tmp_path):
+    first, second, load = new_cache(tmp_path), new_cache(tmp_path), Loader()
+    first.cached("history", "u1", (), load)
+    assert second.cached("history", "u1", (), load) == {"page": 1}
+    second.invalidate("u1")
+    assert first.cached("history", "u1", (), load) == {"page": 2}
+
+
+def test_file_of_another_layout_disables_the_cache(tmp_path):
+    new_cache(tmp_path).cached("history", "u1", (), Loader())
+    cache, load = new_cache(tmp_path, ring_bytes=8192), Loader()
+    cache.cached("history", "u1", (), load)
+    cache.cached("history", "u1", (), load)
+    assert load.calls == 2
+    assert not cache.enabled
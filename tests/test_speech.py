@@ -0,0 +1,110 @@
+import io
+import os
+from urllib.parse import unquote
+import pytest
+import speech
+from conftest import login
+
+
+def wav(text):
+    # What the fake recognizer hears: a WAV header, then the transcript in place of samples
+    return b"RIFF" + bytes(speech.WAV_HEADER_BYTES - 4) + text.encode("utf-8")
+
+
+def split(parts, min_chars=0):
+    splitter = speech.SentenceSplitter(min_chars)
+    sentences = [sentence for part in parts for sentence in splitter.feed(part)]
+    return sentences, splitter.flush()
+
+
+def test_sentences_are_cut_as_the_text_streams():
+    sentences, rest = split(["Le centre ouvre à 10", ".30 le lundi. Il fer", "me à 20 h ! Bonne visite"])
+    assert sentences == ["Le centre ouvre à 10.30 le lundi.", "Il ferme à 20 h !"]
+    assert rest == ["Bonne visite"]
+
+
+def test_short_sentences_are_joined_with_the_next():
+    sentences, rest = split(["Bonjour ! Le parking est gratuit le dimanche. Merci."], min_chars=24)
+    assert sentences == ["Bonjour ! Le parking est gratuit le dimanche."]
+    assert rest == ["Merci."]
+
+
+def test_cjk_and_line_ends_close_sentences():
+    assert split(["营业时间是十点。欢迎光临！"])[0] == ["营业时间是十点。", "欢迎光临！"]
+    assert split(["- Niveau -1\n- Niveau -2\n"])[0] == ["Niveau -1", "Niveau -2"]
+
+
+def test_markdown_is_not_read_aloud():
+    assert speech.speakable("**Horaires** : voir [le site](https://example.org) ou https://example.org/h") == \
+        "Horaires : voir le site ou"
+    assert speech.speakable("1. `Entrée` nord") == "Entrée nord"
+
+
+def test_fake_recognizer_hears_the_text_sent():
+    engine = speech.FakeSpeech(0, 0)
+    assert engine.transcribe([wav("Où est ")[:30], wav("Où est la sortie ?")[30:]], "fr-FR") == "Où est la sortie ?"
+    assert engine.transcribe([wav("")[:44] + bytes(3200)], "fr-FR") == ""
+    assert engine.transcribe([bytes([0xFF, 0xFE, 0x01])], "fr-FR") == speech.FAKE_SPEECH_TRANSCRIPT
+
+
+def test_upload_stops_at_the_size_limit():
+    pipeline = speech.Pipeline(speech.FakeSpeech(0, 0), speech.FakeSpeech(0, 0))
+    turn = pipeline.turn("fr-FR")
+    with pytest.raises(speech.AudioTooLong):
+        list(turn.upload(io.BytesIO(bytes(100)).read, chunk_bytes=30, max_bytes=64))
+    assert turn.audio_in == 90
+
+    with pytest.raises(ValueError):
+        pipeline.turn("xx-XX")
+
+
+def test_turn_speaks_each_sentence_and_counts():
+    pipeline = speech.Pipeline(speech.FakeSpeech(0, 0), speech.FakeSpeech(0, 0))
+    turn = pipeline.turn("fr-FR")
+    assert turn.transcribe(io.BytesIO(wav("Bonjour")).read) == "Bonjour"
+    audio = b"".join(turn.speak("Le parking est gratuit."))
+    turn.finish()
+    assert audio == speech.SILENT_MP3_FRAME * speech.FAKE_FRAMES_PER_WORD * 4
+    assert turn.first_audio_at is not None
+    stats = pipeline.snapshot()
+    assert (stats["turns"], stats["sentences"], stats["audio_bytes_out"]) == (1, 1, len(audio))
+    assert stats["audio_bytes_in"] == len(wav("Bonjour"))
+
+
+@pytest.fixture
+def fake_speech(monkeypatch):
+    monkeypatch.setattr(speech, "SPEECH_BACKEND", "fake")
+    engine = speech.FakeSpeech(0, 0)
+    monkeypatch.setitem(speech._pipelines, os.getpid(), speech.Pipeline(engine, engine))
+
+
+def test_voice_turn_answers_with_audio(client, user_id, fake_speech):
+    login(client, user_id)
+    response = client.post("/speech?language=fr-FR", data=wav("Où sont les toilettes du niveau 2 ?"),
+                           content_type=speech.INPUT_CONTENT_TYPE)
+    assert response.status_code == 200
+    assert response.mimetype == "audio/mpeg"
+    assert unquote(response.headers["X-Transcript"]) == "Où sont les toilettes du niveau 2 ?"
+    audio = response.get_data()
+    assert audio and len(audio) % len(speech.SILENT_MP3_FRAME) == 0
+
+    # The answer's text is stored as it was streamed
+    message = client.get(f"/messages/{response.headers['X-Assistant-Message-Id']}?format=raw",
+                         headers={"Accept": "application/json"}).get_json()["message"]
+    assert message["role"] == "assistant" and message["content"]
+    assert speech.get_pipeline().snapshot()["sentences"] >= 1
+
+
+def test_voice_turn_errors(client, user_id, fake_speech, monkeypatch):
+    login(client, user_id)
+    assert client.post("/speech?language=xx-XX", data=wav("Bonjour")).status_code == 400
+    assert client.post("/speech", data=wav("")[:44] + bytes(1600)).status_code == 422
+
+    def unavailable(chunks, language):
+        raise speech.SpeechError("down")
+
+    monkeypatch.setattr(speech.get_pipeline().recognizer, "transcribe", unavailable)
+    assert client.post("/speech", data=wav("Bonjour")).status_code == 502
+
+    monkeypatch.setattr(speech, "SPEECH_BACKEND", "")
+    assert client.post("/speech", data=wav("Bonjour")).status_code == 404
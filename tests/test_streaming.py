@@ -0,0 +1,118 @@
+import json
+import asyncio
+from types import SimpleNamespace
+import pytest
+import dispatch
+import streaming
+from conftest import login, parse_sse
+
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+
+
+def test_sse_frame():
+    assert streaming.sse("delta", {"text": "a\nb"}) == 'event: delta\ndata: {"text": "a\\nb"}\n\n'
+
+
+def test_doc_refs_split_across_chunks_are_stripped():
+    stripper = streaming.DocRefStripper()
+    out = "".join(stripper.feed(piece) for piece in ["Open [d", "oc1", "] daily [doc", "2]."])
+    assert out + stripper.flush() == "Open  daily ."
+
+
+def test_unfinished_marker_is_flushed_as_text():
+    stripper = streaming.DocRefStripper()
+    assert stripper.feed("see [do") == "see "
+    assert stripper.flush() == "[do"
+
+
+def test_blocks_render_once_complete():
+    renderer = streaming.MarkdownBlockRenderer()
+    assert renderer.feed("# Title") == []
+    blocks = renderer.feed("\n\nBody")
+    assert [html for html, _ in blocks] == ["<h1>Title</h1>"]
+    assert blocks[0][1] == len("# Title\n\n")
+    assert renderer.finish() == "<p>Body</p>"
+
+
+def test_blank_lines_inside_a_code_fence_do_not_end_a_block():
+    renderer = streaming.MarkdownBlockRenderer()
+    assert renderer.feed("```\na\n\nb\n") == []
+    assert len(renderer.feed("```\n\n")) == 1
+
+
+def test_answer_stream_frames():
+    answer = streaming.AnswerStream(0.0, "user-message", "assistant-message")
+    frames = [answer.start()]
+    for text in ["Hello[doc1]", " there\n\n", "Bye"]:
+        frames += answer.feed(chunk(text))
+    frames += answer.finish()
+    frames.append(answer.done("<p>Hello there</p>\n<p>Bye</p>"))
+    events = parse_sse("".join(frames))
+
+    assert events[0] == ("start", {"user_message_id": "user-message", "assistant_message_id": "assistant-message"})
+    assert "".join(data["text"] for event, data in events if event == "delta") == "Hello there\n\nBye"
+    assert [data["html"] for event, data in events if event == "block"] == ["<p>Hello there</p>", "<p>Bye</p>"]
+    assert events[-1][0] == "done"
+    assert answer.text == "Hello there\n\nBye"
+
+
+def test_stream_route(client, user_id):
+    login(client, user_id)
+    response = client.post("/process-input/stream", json={"message": "Quand ouvrez-vous ?"})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    events = parse_sse(response.get_data(as_text=True))
+    kinds = [event for event, _ in events]
+    assert kinds[0] == "start" and kinds[-1] == "done"
+    assert "delta" in kinds and "block" in kinds
+    text = "".join(data["text"] for event, data in events if event == "delta")
+    assert "Quand ouvrez-vous ?" in text
+    assert "[doc" not in text
+
+    # The assembled answer is stored like a non-streamed one
+    history = client.get("/get-history?format=raw").get_json()["history"]
+    assert [msg["role"] for msg in history] == ["user", "assistant"]
+    assert history[1]["message_id"] == events[0][1]["assistant_message_id"]
+    assert history[1]["content"] == text
+
+
+def test_stream_route_rejects_empty_input(client, user_id):
+    login(client, user_id)
+    response = client.post("/process-input/stream", json={"message": "  "})
+    assert response.status_code == 400
+
+
+@pytest.fixture
+def saturated(app_module, monkeypatch):
+    # No slot and no queue: every LLM call is shed at admission
+    monkeypatch.setattr(app_module, "llm_dispatcher", dispatch.Dispatcher(max_concurrency=0, queue_size=0))
+
+
+@pytest.mark.parametrize("turns", [0, 1])
+def test_shed_stream_request_gets_a_503(app_module, client, user_id, saturated, turns):
+    login(client, user_id)
+    for i in range(turns):
+        app_module.save_message(user_id, f"earlier {i}", "user")  # not a first turn: not coalesced
+    response = client.post("/process-input/stream", json={"message": "Où est le parking ?"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert app_module.coalescer.snapshot()["in_flight"] == 0
+
+
+def test_shed_async_stream_request_gets_a_503(center, user_id, saturated):
+    import asgi
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": json.dumps({"message": "Où est la pharmacie ?"}).encode()}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.process_input_stream({"type": "http"}, receive, send, user_id))
+    assert sent[0]["status"] == 503
+    assert (b"retry-after", b"1") in sent[0]["headers"]
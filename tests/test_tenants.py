@@ -0,0 +1,130 @@
+import json
+import uuid
+import contextvars
+from types import SimpleNamespace
+import pytest
+import db
+import schema
+import export
+import tenants
+from conftest import CENTER_ID
+
+
+def registry(*centers, default_center_id=None):
+    return tenants.Registry(lambda max_entries: SimpleNamespace(max_entries=max_entries),
+                            loader=lambda: list(centers), default_center_id=default_center_id)
+
+
+@pytest.fixture
+def multi(monkeypatch):
+    monkeypatch.setattr(tenants, "TENANCY", "multi")
+    monkeypatch.setattr(tenants, "TENANT_HEADER_SECRET", "front-door")
+
+
+def test_single_tenancy_ignores_host_and_header():
+    centers = registry(tenants.Center("a", hostnames="a.example"), tenants.Center("b"), default_center_id="b")
+    assert centers.resolve("a.example", "a", "front-door").id == "b"
+
+
+def test_multi_tenancy_resolves_by_host(multi):
+    centers = registry(tenants.Center("a", hostnames="a.example, www.a.example"),
+                       tenants.Center("b", hostnames="b.example"), default_center_id="b")
+    assert centers.resolve("WWW.A.example:443").id == "a"
+    assert centers.resolve("b.example").id == "b"
+    assert centers.resolve("unknown.example").id == "b"
+    assert centers.stats["by_host"] == 2 and centers.stats["by_default"] == 1
+
+    with pytest.raises(tenants.UnknownCenter):
+        registry(tenants.Center("a", hostnames="a.example")).resolve("unknown.example")
+
+
+def test_tenant_header_needs_the_front_door_secret(multi):
+    centers = registry(tenants.Center("a", hostnames="a.example"), tenants.Center("b"))
+    assert centers.resolve("a.example", "b", "front-door").id == "b"
+    # A client naming another center is served the one its Host belongs to
+    assert centers.resolve("a.example", "b").id == "a"
+    assert centers.resolve("a.example", "b", "guess").id == "a"
+    assert centers.stats["untrusted_headers"] == 2
+    with pytest.raises(tenants.UnknownCenter):
+        centers.resolve("a.example", "missing", "front-door")
+
+
+def test_tenant_header_is_ignored_without_a_secret(multi, monkeypatch):
+    monkeypatch.setattr(tenants, "TENANT_HEADER_SECRET", "")
+    centers = registry(tenants.Center("a", hostnames="a.example"), tenants.Center("b"))
+    assert centers.resolve("a.example", "b", "").id == "a"
+
+
+def test_each_center_draws_from_its_own_pool(multi):
+    busy = tenants.Center("busy-center", db_pool_size=1)
+    quiet = tenants.Center("quiet-center", db_pool_size=2)
+
+    def in_center(center, fn):
+        # Each request runs in its own context, as under Flask or asyncio
+        def run():
+            tenants.activate(center)
+            return fn()
+        return contextvars.copy_context().run(run)
+
+    def query():
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            return cursor.fetchone()[0]
+
+    def hold_and_try_again():
+        db.get_pool(tenants.pool_name(busy), 1).timeout = 0.01
+        with db.connection():
+            with pytest.raises(db.PoolTimeout):
+                query()  # the busy center's only connection is taken
+            return in_center(quiet, query)
+
+    assert in_center(busy, hold_and_try_again) == 1
+    pools = db.all_pool_stats()
+    assert pools["center:busy-center"]["max_size"] == 1
+    assert pools["center:busy-center"]["timeouts"] == 1
+    assert pools["center:quiet-center"]["max_size"] == 2
+    assert pools["center:quiet-center"]["timeouts"] == 0
+
+
+@pytest.fixture
+def other_center(app_module, user_id):
+    # A second center with one message, served on its own hostname
+    app_module.save_message(user_id, "message of the test center", "user")
+    center_id = f"other-{uuid.uuid4().hex[:8]}"
+    schema.ensure_center(center_id, "Other center")
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE commercial_centers SET hostnames = ? WHERE id = ?",
+                       (f"{center_id}.example", center_id))
+        cursor.execute(
+            "INSERT INTO conversations (user_id, center_id, message, role, timestamp, message_id) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, center_id, "secret of the other center", "user", "2024-01-01T00:00:00", str(uuid.uuid4()))
+        )
+    app_module.centers._loaded_at = None
+    return center_id
+
+
+def export_rows(client, **kwargs):
+    def run():
+        response = client.get("/export", headers={"Authorization": "Bearer export-token",
+                                                  **kwargs.pop("headers", {})}, **kwargs)
+        assert response.status_code == 200
+        return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    return contextvars.copy_context().run(run)
+
+
+def test_export_is_limited_to_the_resolved_center(monkeypatch, client, other_center):
+    monkeypatch.setattr(export, "EXPORT_TOKEN", "export-token")
+    rows = export_rows(client, query_string={"center": other_center})
+    assert rows and {row["center_id"] for row in rows} == {CENTER_ID}
+
+    monkeypatch.setattr(tenants, "TENANCY", "multi")
+    rows = export_rows(client, base_url=f"http://{other_center}.example")
+    assert [row["message"] for row in rows] == ["secret of the other center"]
+
+    # Neither a query parameter nor a forged tenant header reaches another center
+    rows = export_rows(client, base_url=f"http://{other_center}.example",
+                       query_string={"center": CENTER_ID}, headers={tenants.TENANT_HEADER: CENTER_ID})
+    assert {row["center_id"] for row in rows} == {other_center}
@@ -0,0 +1,103 @@
+import uuid
+import pytest
+import db
+import users
+from conftest import CENTER_ID
+
+
+def user_exists(user_id):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM users WHERE id = ?", (user_id,))
+        return cursor.fetchone()[0] == 1
+
+
+@pytest.fixture
+def upserts(monkeypatch):
+    calls = []
+    original = users.upsert_user
+
+    def counted(user_id, center_id):
+        calls.append(user_id)
+        original(user_id, center_id)
+
+    monkeypatch.setattr(users, "upsert_user", counted)
+    return calls
+
+
+def test_known_ids_cost_no_round_trip(upserts):
+    known = users.KnownUsers(max_entries=10, shared_path="")
+    user_id = str(uuid.uuid4())
+    known.ensure(user_id, CENTER_ID)
+    known.ensure(user_id, CENTER_ID)
+    assert upserts == [user_id]
+    assert user_exists(user_id)
+    stats = known.snapshot()
+    assert (stats["hits"], stats["misses"], stats["upserts"]) == (1, 1, 1)
+    assert stats["hit_rate"] == 0.5
+
+
+def test_upsert_is_idempotent(upserts):
+    user_id = str(uuid.uuid4())
+    # Two workers meeting a new user at once both upsert; neither fails
+    users.KnownUsers(shared_path="").ensure(user_id, CENTER_ID)
+    users.KnownUsers(shared_path="").ensure(user_id, CENTER_ID)
+    assert len(upserts) == 2 and user_exists(user_id)
+
+
+def test_least_recently_used_ids_are_evicted(upserts):
+    known = users.KnownUsers(max_entries=2, shared_path="")
+    first, second, third = (str(uuid.uuid4()) for _ in range(3))
+    for user_id in (first, second, first, third, first, second):
+        known.ensure(user_id, CENTER_ID)
+    assert upserts == [first, second, third, second]
+    assert known.snapshot()["evictions"] == 2
+
+
+def test_invalid_ids_are_rejected(upserts):
+    known = users.KnownUsers(shared_path="")
+    for user_id in ("", "not-a-uuid", None):
+        with pytest.raises(ValueError):
+            known.ensure(user_id, CENTER_ID)
+    assert upserts == []
+
+
+def test_disabled_cache_always_upserts(upserts):
+    known = users.KnownUsers(shared_path="", enabled=False)
+    user_id = str(uuid.uuid4())
+    known.ensure(user_id, CENTER_ID)
+    known.ensure(user_id, CENTER_ID)
+    assert len(upserts) == 2
+    assert known.snapshot()["shared"] is None
+
+
+def test_workers_share_known_ids(tmp_path, upserts):
+    path = str(tmp_path / "users")
+    # Two caches on one file stand in for two workers
+    first, second = users.KnownUsers(shared_path=path), users.KnownUsers(shared_path=path)
+    user_id = str(uuid.uuid4())
+    first.ensure(user_id, CENTER_ID)
+    second.ensure(user_id, CENTER_ID)
+    second.ensure(user_id, CENTER_ID)
+    assert upserts == [user_id]
+    stats = second.snapshot()
+    assert (stats["shared_hits"], stats["hits"], stats["misses"]) == (1, 1, 0)
+    assert stats["shared"]["capacity"] == users.KNOWN_USERS_SHARED_SLOTS
+
+
+def test_full_bucket_drops_its_oldest_id(tmp_path):
+    table = users.SharedTable(str(tmp_path / "users"), slots=3, ways=3)
+    keys = [users.user_key(str(uuid.uuid4())) for _ in range(4)]
+    for key in keys[:3]:
+        table.add(key)
+    table.add(keys[0])  # seen again: now the newest
+    table.add(keys[3])
+    assert [key in table for key in keys] == [True, False, True, True]
+    # A second mapping of the file sees the same ids
+    assert keys[3] in users.SharedTable(str(tmp_path / "users"), slots=3, ways=3)
+    table.close()
+
+
+def test_spellings_of_one_uuid_are_distinct_keys():
+    user_id = str(uuid.uuid4())
+    assert users.user_key(user_id) != users.user_key(user_id.upper())
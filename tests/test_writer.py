@@ -0,0 +1,256 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import pytest
+import writer
+
+
+def record(i, user_id="u"):
+    return {"user_id": user_id, "message_id": f"m{i}", "message": f"message {i}"}
+
+
+class Table:
+    """Stands in for the conversations table, unique on message_id."""
+
+    def __init__(self):
+        self.rows = {}
+        self.batches = []
+        self.single = []
+
+    def insert_batch(self, records):
+        # One transaction: all or nothing
+        if any(r["message_id"] in self.rows for r in records):
+            raise sqlite3.IntegrityError("UNIQUE constraint failed: conversations.message_id")
+        self.batches.append(len(records))
+        for r in records:
+            self.rows[r["message_id"]] = r
+
+    def insert_one(self, r):
+        self.single.append(r["message_id"])
+        if r["message_id"] in self.rows:
+            raise sqlite3.IntegrityError("UNIQUE constraint failed: conversations.message_id")
+        self.rows[r["message_id"]] = r
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def new_writer(table, tmp_path, **kwargs):
+    kwargs.setdefault("flush_interval", 0.01)
+    return writer.MessageWriter(table.insert_batch, table.insert_one, spool_dir=str(tmp_path), **kwargs)
+
+
+def test_messages_are_written_in_batches(tmp_path):
+    table = Table()
+    w = new_writer(table, tmp_path, batch_size=50)
+    for i in range(120):
+        w.enqueue(record(i))
+    w.flush()
+    assert len(table.rows) == 120
+    assert max(table.batches) > 1
+    assert w.pending_for("u") == []
+    w.close()
+
+
+def test_queued_messages_are_pending_until_written(tmp_path):
+    gate = threading.Event()
+    table = Table()
+    w = writer.MessageWriter(lambda records: (gate.wait(), table.insert_batch(records)), table.insert_one,
+                             spool_dir=str(tmp_path), flush_interval=0.01)
+    w.enqueue(record(1))
+    assert [r["message_id"] for r in w.pending_for("u")] == ["m1"]
+    assert w.is_pending("m1")
+    gate.set()
+    w.flush()
+    assert not w.is_pending("m1")
+    assert "m1" in table.rows
+    w.close()
+
+
+def test_spool_of_a_dead_process_is_replayed(tmp_path):
+    # What a worker that died before its batch committed leaves behind
+    dead_pid = 2 ** 22 + 1
+    while writer.pid_alive(dead_pid):
+        dead_pid += 1
+    spooled = [record(1), record(2), record(3)]
+    with open(tmp_path / f"messages-{dead_pid}-1.ndjson", "w", encoding="utf-8") as f:
+        for r in spooled:
+            f.write(json.dumps(r) + "\n")
+
+    table = Table()
+    table.insert_one(record(2))  # committed just before the crash
+    w = new_writer(table, tmp_path)
+    w.enqueue(record(4))
+    w.flush()
+    assert sorted(table.rows) == ["m1", "m2", "m3", "m4"]
+    assert w.snapshot()["replayed"] == 2
+    assert w.snapshot()["failed"] == 1  # the duplicate
+    assert not any(name.startswith(f"messages-{dead_pid}-") for name in os.listdir(tmp_path))
+    w.close()
+
+
+def test_spool_is_replayed_off_the_request_path(tmp_path):
+    dead_pid = 2 ** 22 + 1
+    while writer.pid_alive(dead_pid):
+        dead_pid += 1
+    with open(tmp_path / f"messages-{dead_pid}-1.ndjson", "w", encoding="utf-8") as f:
+        f.write(json.dumps(record(1)) + "\n" + '{"user_id": "u", "mess')  # died mid-line
+
+    gate = threading.Event()
+    table = Table()
+    w = writer.MessageWriter(lambda records: (gate.wait(), table.insert_batch(records)), table.insert_one,
+                             spool_dir=str(tmp_path), flush_interval=0.01)
+    w.enqueue(record(2))  # returns while the writer thread is still replaying
+    assert table.rows == {}
+    gate.set()
+    w.flush()
+    assert sorted(table.rows) == ["m1", "m2"]
+    w.close()
+
+
+def test_spool_is_emptied_once_written(tmp_path):
+    table = Table()
+    w = new_writer(table, tmp_path)
+    w.enqueue(record(1))
+    path = w._segment_path(w._segment)
+    assert os.path.getsize(path) > 0
+    w.flush()
+    assert os.path.getsize(path) == 0
+    w.close()
+    assert not os.path.exists(path)
+
+
+def test_outage_keeps_messages_for_a_later_batch(tmp_path):
+    table = Table()
+    down = {"value": True}
+
+    def insert_batch(records):
+        if down["value"]:
+            raise ConnectionError("database unreachable")
+        table.insert_batch(records)
+
+    def insert_one(r):
+        if down["value"]:
+            raise ConnectionError("database unreachable")
+        table.insert_one(r)
+
+    w = writer.MessageWriter(insert_batch, insert_one, spool_dir=str(tmp_path), flush_interval=0.01)
+    w.enqueue(record(1))
+    time.sleep(0.1)
+    assert w.is_pending("m1")
+    down["value"] = False
+    deadline = time.monotonic() + 5
+    while w.is_pending("m1") and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert "m1" in table.rows
+    w.close()
+
+
+def test_full_queue_falls_back_to_a_synchronous_insert(tmp_path):
+    gate = threading.Event()
+    table = Table()
+    w = writer.MessageWriter(lambda records: (gate.wait(), table.insert_batch(records)), table.insert_one,
+                             spool_dir=str(tmp_path), queue_size=1, put_timeout=0.01, flush_interval=0.01)
+    w.enqueue(record(1))  # taken by the writer thread, which blocks
+    time.sleep(0.05)
+    w.enqueue(record(2))  # fills the queue
+    w.enqueue(record(3))  # written by the caller
+    assert "m3" in table.rows
+    assert w.snapshot()["sync_fallbacks"] == 1
+    gate.set()
+    w.flush()
+    assert sorted(table.rows) == ["m1", "m2", "m3"]
+    w.close()
+
+
+def test_failed_synchronous_insert_is_raised_and_not_left_pending(tmp_path):
+    gate = threading.Event()
+
+    def insert_one(r):
+        raise RuntimeError("database down")
+
+    w = writer.MessageWriter(lambda records: gate.wait(), insert_one, spool_dir=str(tmp_path),
+                             queue_size=1, put_timeout=0.01, flush_interval=0.01)
+    w.enqueue(record(1))
+    time.sleep(0.05)
+    w.enqueue(record(2))
+    with pytest.raises(RuntimeError):
+        w.enqueue(record(3))
+    assert not w.is_pending("m3")
+    assert w.snapshot()["failed"] == 1
+    gate.set()
+    w.close()
+
+
+def test_outage_retries_the_whole_batch_with_backoff(tmp_path):
+    table = Table()
+    attempts = []
+
+    def insert_batch(records):
+        attempts.append(time.monotonic())
+        if len(attempts) <= 3:
+            raise ConnectionError("database unreachable")
+        table.insert_batch(records)
+
+    w = writer.MessageWriter(insert_batch, table.insert_one, spool_dir=str(tmp_path), flush_interval=0.001,
+                             retry_max=0.05)
+    for i in range(5):
+        w.enqueue(record(i))
+    assert wait_until(lambda: len(table.rows) == 5)
+    assert table.single == []  # never row by row during an outage
+    assert attempts[2] - attempts[1] > attempts[1] - attempts[0]
+    assert w.snapshot()["retries"] == 3
+    w.close()
+
+
+def test_transient_row_failure_is_retried_not_dropped(tmp_path):
+    table = Table()
+    table.rows["m0"] = record(0)  # makes the first batch fail as invalid
+    flaky = {"m2": 1}
+
+    def insert_one(r):
+        if flaky.get(r["message_id"]):
+            flaky[r["message_id"]] -= 1
+            raise TimeoutError("deadlock victim")
+        table.insert_one(r)
+
+    w = writer.MessageWriter(table.insert_batch, insert_one, spool_dir=str(tmp_path), flush_interval=0.001,
+                             retry_max=0.01)
+    w.enqueue(record(0))
+    w.enqueue(record(1))
+    w.enqueue(record(2))
+    w.flush()
+    assert wait_until(lambda: "m2" in table.rows)
+    assert not w.is_pending("m2")
+    assert w.snapshot()["failed"] == 1  # only the duplicate m0
+    w.close()
+
+
+def test_row_failing_while_others_succeed_is_dropped_after_max_attempts(tmp_path, caplog):
+    table = Table()
+
+    def insert_batch(records):
+        if any(r["message_id"] == "m2" for r in records):
+            raise TimeoutError("always")
+        table.insert_batch(records)
+
+    def insert_one(r):
+        if r["message_id"] == "m2":
+            raise TimeoutError("always")
+        table.insert_one(r)
+
+    w = writer.MessageWriter(insert_batch, insert_one, spool_dir=str(tmp_path), flush_interval=0.001,
+                             retry_max=0.01, max_attempts=3)
+    w.enqueue(record(1))
+    w.enqueue(record(2))
+    assert wait_until(lambda: not w.is_pending("m2"))
+    assert sorted(table.rows) == ["m1"]
+    assert "Dropping message m2 after 3 attempts" in caplog.text
+    assert w.snapshot()["failed"] == 1
+    w.close()